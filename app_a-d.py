@@ -1,6 +1,8 @@
 
 import time
 import base64
+import bisect
+import sqlite3
 from io import BytesIO
 import streamlit as st
 import pandas as pd
@@ -12,12 +14,19 @@ import boto3
 import re
 import gspread.utils
 import json # Import json for parsing credentials
+import hashlib
 import os
 import math
+import tempfile
+import threading
 import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from pytz import timezone
 from urllib.parse import urlparse, unquote
 import streamlit.components.v1 as components
+from streamlit.errors import StreamlitAPIException
 from typing import Any, Optional, Sequence
 import unicodedata
 import numpy as np
@@ -27,6 +36,34 @@ import folium
 import polyline
 import pdfplumber
 
+try:
+    import fcntl
+except ImportError:  # Windows: sin locks entre procesos.
+    fcntl = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # Sin pyarrow el histórico solo se consulta en Google Sheets.
+    pa = None
+    pq = None
+
+from sheets_quota import (
+    SheetsQuotaUnavailable,
+    acquire_sheets_quota,
+    report_sheets_quota_exhausted,
+    set_sheets_quota_user,
+)
+from historico_parquet import (
+    historico_manifest_update,
+    historico_parquet_delete,
+    historico_parquet_frame,
+    historico_parquet_month,
+    historico_parquet_put_part,
+    refresh_historico_parquet_rows,
+    write_historico_parquet,
+)
+
 _MX_TZ = timezone("America/Mexico_City")
 
 _RECOVERABLE_AUTH_PATTERNS = (
@@ -711,53 +748,176 @@ def _get_route_excel_key_from_row(row: Any) -> str:
     return excel_keys[-1]
 
 
-def _extract_hoja_ruta_fields_from_s3(s3_client_param: Any, row: Any) -> dict[str, str]:
-    out = {"municipio": "", "horario": "", "cantidad": "", "recibe": ""}
-    key = _get_route_excel_key_from_row(row)
-    if not key:
-        return out
+HOJA_RUTA_FIELDS_CACHE_MAX = 2000
+HOJA_RUTA_PREFETCH_WORKERS = 8
+# Etiqueta a buscar en el Excel de ruta por cada campo extraído.
+HOJA_RUTA_FIELD_LABELS = {
+    "municipio": "MUNICIPIO",
+    "horario": "HORA DE ENTREGA",
+    "cantidad": "GRAN TOTAL A COB",
+    "recibe": "RECIBE",
+}
+
+
+def _hoja_ruta_label_norm(value: Any) -> str:
+    return _remove_accents(value).upper().replace(":", "").strip()
+
+
+def _parse_hoja_ruta_fields(payload: bytes) -> dict[str, str]:
+    """
+    Extrae los campos del Excel de ruta en una sola pasada.
+
+    Cada celda se normaliza una vez; se indexan las posiciones (en orden de
+    lectura) de las etiquetas buscadas y el valor se toma a la derecha, abajo o
+    en la ventana abajo-derecha de la etiqueta.
+    """
+    out = {field: "" for field in HOJA_RUTA_FIELD_LABELS}
     try:
-        obj = s3_client_param.get_object(Bucket=S3_BUCKET_NAME, Key=key)
-        payload = obj["Body"].read()
         raw_df = pd.read_excel(BytesIO(payload), header=None, dtype=str)
     except Exception:
         return out
 
-    df = raw_df.fillna("").astype(str)
+    grid = raw_df.fillna("").astype(str).values.tolist()
+    n_rows = len(grid)
+    n_cols = len(grid[0]) if grid else 0
+    plain = [[_normalize_plain_text(cell) for cell in row] for row in grid]
+    norm = [[_hoja_ruta_label_norm(cell) if cell else "" for cell in row] for row in plain]
+
+    targets = {_hoja_ruta_label_norm(label) for label in HOJA_RUTA_FIELD_LABELS.values()}
+    label_index: dict[str, list[tuple[int, int]]] = {}
+    for r in range(n_rows):
+        for c in range(n_cols):
+            if norm[r][c] in targets:
+                label_index.setdefault(norm[r][c], []).append((r, c))
 
     def find_value(label: str) -> str:
-        target = _remove_accents(label).upper().replace(":", "").strip()
-        for r in range(df.shape[0]):
-            for c in range(df.shape[1]):
-                current = _remove_accents(df.iat[r, c]).upper().replace(":", "").strip()
-                if current == target:
-                    # 1) Buscar a la derecha en la misma fila.
-                    for cc in range(c + 1, df.shape[1]):
-                        val = _normalize_plain_text(df.iat[r, cc])
-                        if val:
-                            return val
-                    # 2) Buscar hacia abajo en la misma columna.
-                    for rr in range(r + 1, min(df.shape[0], r + 5)):
-                        val = _normalize_plain_text(df.iat[rr, c])
-                        if val and _remove_accents(val).upper().replace(":", "").strip() != target:
-                            return val
-                    # 3) Buscar en ventana cercana abajo-derecha (formatos combinados).
-                    for rr in range(r + 1, min(df.shape[0], r + 5)):
-                        for cc in range(c + 1, min(df.shape[1], c + 5)):
-                            val = _normalize_plain_text(df.iat[rr, cc])
-                            if val:
-                                norm = _remove_accents(val).upper().replace(":", "").strip()
-                                if norm != target:
-                                    return val
+        target = _hoja_ruta_label_norm(label)
+        for r, c in label_index.get(target, []):
+            # 1) Buscar a la derecha en la misma fila.
+            for cc in range(c + 1, n_cols):
+                if plain[r][cc]:
+                    return plain[r][cc]
+            # 2) Buscar hacia abajo en la misma columna.
+            for rr in range(r + 1, min(n_rows, r + 5)):
+                if plain[rr][c] and norm[rr][c] != target:
+                    return plain[rr][c]
+            # 3) Buscar en ventana cercana abajo-derecha (formatos combinados).
+            for rr in range(r + 1, min(n_rows, r + 5)):
+                for cc in range(c + 1, min(n_cols, c + 5)):
+                    if plain[rr][cc] and norm[rr][cc] != target:
+                        return plain[rr][cc]
         return ""
 
-    out["municipio"] = find_value("MUNICIPIO")
-    out["horario"] = find_value("HORA DE ENTREGA")
-    out["cantidad"] = find_value("GRAN TOTAL A COB")
-    out["recibe"] = find_value("RECIBE")
+    for field, label in HOJA_RUTA_FIELD_LABELS.items():
+        out[field] = find_value(label)
     return out
 
 
+@st.cache_resource
+def _get_hoja_ruta_fields_cache() -> dict[str, Any]:
+    """Campos ya extraídos por ``(llave S3, ETag)``; compartido por sesiones e hilos de precarga."""
+    return {
+        "lock": threading.Lock(),
+        "entries": OrderedDict(),
+        "inflight": {},
+        "executor": None,
+    }
+
+
+def _hoja_ruta_cached_etag(s3_client_param: Any, key: str) -> str:
+    """ETag del objeto: primero el manifiesto en memoria, si no un ``head_object``."""
+    manifest = _get_s3_manifest()
+    with manifest["lock"]:
+        entry = manifest["objects"].get(key) if manifest["ready"] else None
+    etag = str((entry or {}).get("etag", "") or "")
+    if etag:
+        return etag
+    try:
+        return str(s3_client_param.head_object(Bucket=S3_BUCKET_NAME, Key=key).get("ETag", "") or "")
+    except Exception:
+        return ""
+
+
+def _extract_hoja_ruta_fields_by_key(s3_client_param: Any, key: str) -> dict[str, str]:
+    cache = _get_hoja_ruta_fields_cache()
+    etag = _hoja_ruta_cached_etag(s3_client_param, key)
+    if etag:
+        with cache["lock"]:
+            cached = cache["entries"].get((key, etag))
+            if cached is not None:
+                cache["entries"].move_to_end((key, etag))
+                return dict(cached)
+    try:
+        obj = s3_client_param.get_object(Bucket=S3_BUCKET_NAME, Key=key)
+        payload = obj["Body"].read()
+    except Exception:
+        return {field: "" for field in HOJA_RUTA_FIELD_LABELS}
+    fields = _parse_hoja_ruta_fields(payload)
+    etag = str(obj.get("ETag", "") or etag)
+    if etag:
+        with cache["lock"]:
+            cache["entries"][(key, etag)] = fields
+            cache["entries"].move_to_end((key, etag))
+            while len(cache["entries"]) > HOJA_RUTA_FIELDS_CACHE_MAX:
+                cache["entries"].popitem(last=False)
+    return dict(fields)
+
+
+def _extract_hoja_ruta_fields_from_s3(s3_client_param: Any, row: Any) -> dict[str, str]:
+    key = _get_route_excel_key_from_row(row)
+    if not key:
+        return {field: "" for field in HOJA_RUTA_FIELD_LABELS}
+    cache = _get_hoja_ruta_fields_cache()
+    with cache["lock"]:
+        inflight = cache["inflight"].get(key)
+    if inflight is not None:
+        # Una precarga ya está descargando este Excel; se espera su resultado.
+        try:
+            inflight.result(timeout=30)
+        except Exception:
+            pass
+    return _extract_hoja_ruta_fields_by_key(s3_client_param, key)
+
+
+def prefetch_hoja_ruta_fields(s3_client_param: Any, pedidos_df: pd.DataFrame) -> int:
+    """
+    Precarga en paralelo (sin bloquear el render) los campos de Hoja_Ruta de
+    todos los pedidos locales del turno; devuelve cuántos Excel se programaron.
+    """
+    if s3_client_param is None or pedidos_df is None or pedidos_df.empty:
+        return 0
+    keys = {
+        key
+        for key in (_get_route_excel_key_from_row(row) for _, row in pedidos_df.iterrows())
+        if key
+    }
+    if not keys:
+        return 0
+    cache = _get_hoja_ruta_fields_cache()
+    scheduled = 0
+    with cache["lock"]:
+        cached_keys = {key for key, _ in cache["entries"].keys()}
+        if cache["executor"] is None:
+            cache["executor"] = ThreadPoolExecutor(
+                max_workers=HOJA_RUTA_PREFETCH_WORKERS,
+                thread_name_prefix="hoja_ruta_prefetch",
+            )
+        for key in sorted(keys - cached_keys):
+            if key in cache["inflight"]:
+                continue
+            future = cache["executor"].submit(_extract_hoja_ruta_fields_by_key, s3_client_param, key)
+            cache["inflight"][key] = future
+            future.add_done_callback(lambda _f, k=key: _finish_hoja_ruta_prefetch(k))
+            scheduled += 1
+    return scheduled
+
+
+def _finish_hoja_ruta_prefetch(key: str) -> None:
+    cache = _get_hoja_ruta_fields_cache()
+    with cache["lock"]:
+        cache["inflight"].pop(key, None)
+
+
 def _normalize_municipio_for_hoja_ruta(value: Any) -> str:
     """
     Normaliza MUNICIPIO para Hoja_Ruta con reglas operativas:
@@ -840,23 +1000,39 @@ def _normalize_municipio_for_hoja_ruta(value: Any) -> str:
     return normalized_tokens[0]
 
 
-def _run_gsheet_read_with_backoff(func, *, operation_name: str, max_retries: int = 4):
-    """Ejecuta una lectura de Google Sheets con reintento ante errores transitorios."""
-    wait_seconds = 0.8
+# --- Gobernador de cuota de Google Sheets ---
+# Vive en ``sheets_quota`` y lo comparten las tres apps; aquí solo se registra la
+# cuenta de servicio para las cuotas por usuario.
+try:
+    set_sheets_quota_user(st.secrets["gsheets"]["google_credentials"])
+except Exception:
+    pass
+
+
+def _run_gsheet_read_with_backoff(
+    func,
+    *,
+    operation_name: str,
+    max_retries: int = 4,
+    priority: str = "interactive_read",
+):
+    """Ejecuta una lectura de Google Sheets bajo el gobernador de cuota, reintentando ante 429."""
     last_error = None
     for attempt in range(max_retries + 1):
+        if not acquire_sheets_quota("read", priority):
+            # Sin cuota no se llama a la API; quien llama sirve su último snapshot.
+            raise SheetsQuotaUnavailable(f"Sin cuota de lectura de Google Sheets ({operation_name})")
         try:
             return func()
         except Exception as exc:
             last_error = exc
             if attempt >= max_retries or not _is_rate_limit_error(exc):
                 raise
+            report_sheets_quota_exhausted("read")
             st.info(
                 f"⏳ Límite temporal de Google Sheets durante {operation_name}. "
                 f"Reintentando ({attempt + 1}/{max_retries})..."
             )
-            time.sleep(wait_seconds)
-            wait_seconds = min(wait_seconds * 2, 10)
     raise last_error
 
 
@@ -1157,15 +1333,6 @@ def _find_next_data_row_in_section(values: list[list[str]], header_row: int) ->
     return data_end + 1, n_counter
 
 
-def _ensure_rows(ws: Any, needed_row: int) -> None:
-    row_count = int(getattr(ws, "row_count", 0) or 0)
-    if needed_row <= row_count:
-        return
-    rows_to_add = max(100, needed_row - row_count)
-    if hasattr(ws, "add_rows"):
-        ws.add_rows(rows_to_add)
-
-
 def _write_row_values(ws: Any, row_number: int, values: list[Any], start_col: int = 1) -> None:
     end_col = start_col + len(values) - 1
     a1_start = gspread.utils.rowcol_to_a1(row_number, start_col)
@@ -1173,41 +1340,84 @@ def _write_row_values(ws: Any, row_number: int, values: list[Any], start_col: in
     _worksheet_update_range(ws, f"{a1_start}:{a1_end}", [values])
 
 
-def _copy_section_template_block(ws: Any, source_title_row: int, target_title_row: int) -> bool:
-    spreadsheet = getattr(ws, "spreadsheet", None)
-    sheet_id = getattr(ws, "id", None)
-    if spreadsheet is None or sheet_id is None or not hasattr(spreadsheet, "batch_update"):
-        return False
+def _copy_section_template_request(sheet_id: int, source_title_row: int, target_title_row: int) -> dict[str, Any]:
+    return {
+        "copyPaste": {
+            "source": _grid_range(
+                sheet_id,
+                source_title_row,
+                source_title_row + HOJA_RUTA_SECTION_TOTAL_ROWS - 1,
+                1,
+                10,
+            ),
+            "destination": _grid_range(
+                sheet_id,
+                target_title_row,
+                target_title_row + HOJA_RUTA_SECTION_TOTAL_ROWS - 1,
+                1,
+                10,
+            ),
+            "pasteType": "PASTE_NORMAL",
+            "pasteOrientation": "NORMAL",
+        }
+    }
 
-    req = {
-        "requests": [
-            {
-                "copyPaste": {
-                    "source": _grid_range(
-                        sheet_id,
-                        source_title_row,
-                        source_title_row + HOJA_RUTA_SECTION_TOTAL_ROWS - 1,
-                        1,
-                        10,
-                    ),
-                    "destination": _grid_range(
-                        sheet_id,
-                        target_title_row,
-                        target_title_row + HOJA_RUTA_SECTION_TOTAL_ROWS - 1,
-                        1,
-                        10,
-                    ),
-                    "pasteType": "PASTE_NORMAL",
-                    "pasteOrientation": "NORMAL",
+
+def _insert_rows_request(sheet_id: int, start_row: int, count: int) -> dict[str, Any]:
+    return {
+        "insertDimension": {
+            "range": {
+                "sheetId": int(sheet_id),
+                "dimension": "ROWS",
+                "startIndex": max(0, start_row - 1),
+                "endIndex": max(0, start_row - 1 + count),
+            },
+            "inheritFromBefore": False,
+        }
+    }
+
+
+def _paste_values_request(sheet_id: int, row_number: int, start_col: int, rows: list[list[Any]]) -> dict[str, Any]:
+    """Escribe valores interpretados como ``USER_ENTERED`` (pasteData) sin tocar el formato."""
+    data = "\n".join(
+        "\t".join(str(value).replace("\t", " ").replace("\n", " ") for value in row_values)
+        for row_values in rows
+    )
+    return {
+        "pasteData": {
+            "coordinate": {
+                "sheetId": int(sheet_id),
+                "rowIndex": max(0, row_number - 1),
+                "columnIndex": max(0, start_col - 1),
+            },
+            "data": data,
+            "type": "PASTE_VALUES",
+            "delimiter": "\t",
+        }
+    }
+
+
+def _text_cells_request(sheet_id: int, row_number: int, start_col: int, rows: list[list[Any]]) -> dict[str, Any]:
+    """Escribe texto literal (admite saltos de línea); las celdas vacías se limpian."""
+    return {
+        "updateCells": {
+            "start": {
+                "sheetId": int(sheet_id),
+                "rowIndex": max(0, row_number - 1),
+                "columnIndex": max(0, start_col - 1),
+            },
+            "rows": [
+                {
+                    "values": [
+                        {"userEnteredValue": {"stringValue": str(value)}} if str(value) else {}
+                        for value in row_values
+                    ]
                 }
-            }
-        ]
+                for row_values in rows
+            ],
+            "fields": "userEnteredValue",
+        }
     }
-    try:
-        spreadsheet.batch_update(req)
-        return True
-    except Exception:
-        return False
 
 
 def _insert_blank_rows(ws: Any, start_row: int, count: int) -> bool:
@@ -1248,8 +1458,8 @@ def _grid_range(sheet_id: int, row_start_1: int, row_end_1: int, col_start_1: in
     }
 
 
-def _set_range_format(
-    ws: Any,
+def _range_format_request(
+    sheet_id: int,
     *,
     row_start: int,
     row_end: int,
@@ -1261,13 +1471,8 @@ def _set_range_format(
     bg_color: Optional[dict[str, float]] = None,
     horizontal_alignment: Optional[str] = None,
     vertical_alignment: Optional[str] = None,
-) -> None:
-    """Aplica formato a un rango usando Spreadsheet.batch_update."""
-    spreadsheet = getattr(ws, "spreadsheet", None)
-    sheet_id = getattr(ws, "id", None)
-    if spreadsheet is None or sheet_id is None or not hasattr(spreadsheet, "batch_update"):
-        return
-
+) -> dict[str, Any]:
+    """Solicitud ``repeatCell`` con el formato de un rango para Spreadsheet.batch_update."""
     user_format: dict[str, Any] = {
         "textFormat": {
             "fontFamily": font_family,
@@ -1286,57 +1491,51 @@ def _set_range_format(
         user_format["verticalAlignment"] = str(vertical_alignment).upper()
         fields += ",userEnteredFormat.verticalAlignment"
 
-    req = {
-        "requests": [
-            {
-                "repeatCell": {
-                    "range": _grid_range(sheet_id, row_start, row_end, col_start, col_end),
-                    "cell": {"userEnteredFormat": user_format},
-                    "fields": fields,
-                }
-            }
-        ]
+    return {
+        "repeatCell": {
+            "range": _grid_range(sheet_id, row_start, row_end, col_start, col_end),
+            "cell": {"userEnteredFormat": user_format},
+            "fields": fields,
+        }
     }
-    try:
-        spreadsheet.batch_update(req)
-    except Exception:
-        pass
 
 
-def _format_hoja_ruta_new_section(ws: Any, title_row: int, header_row: int) -> None:
+def _hoja_ruta_new_section_format_requests(sheet_id: int, title_row: int, header_row: int) -> list[dict[str, Any]]:
     """Formato visual requerido para secciones nuevas en Hoja_Ruta."""
-    # Título: B:D, Calibri 25 bold, amarillo.
-    _set_range_format(
-        ws,
-        row_start=title_row,
-        row_end=title_row,
-        col_start=2,
-        col_end=4,
-        font_family="Calibri",
-        font_size=25,
-        bold=True,
-        bg_color={"red": 1.0, "green": 0.95, "blue": 0.30},
-    )
-    # Encabezados: A:J, Calibri 24 bold, naranja.
-    _set_range_format(
-        ws,
-        row_start=header_row,
-        row_end=header_row,
-        col_start=1,
-        col_end=10,
-        font_family="Calibri",
-        font_size=24,
-        bold=True,
-        bg_color={"red": 0.95, "green": 0.55, "blue": 0.12},
-    )
+    return [
+        # Título: B:D, Calibri 25 bold, amarillo.
+        _range_format_request(
+            sheet_id,
+            row_start=title_row,
+            row_end=title_row,
+            col_start=2,
+            col_end=4,
+            font_family="Calibri",
+            font_size=25,
+            bold=True,
+            bg_color={"red": 1.0, "green": 0.95, "blue": 0.30},
+        ),
+        # Encabezados: A:J, Calibri 24 bold, naranja.
+        _range_format_request(
+            sheet_id,
+            row_start=header_row,
+            row_end=header_row,
+            col_start=1,
+            col_end=10,
+            font_family="Calibri",
+            font_size=24,
+            bold=True,
+            bg_color={"red": 0.95, "green": 0.55, "blue": 0.12},
+        ),
+    ]
 
 
-def _format_hoja_ruta_data_row(ws: Any, row_number: int, n_value: int) -> None:
+def _hoja_ruta_data_row_format_request(sheet_id: int, row_number: int, n_value: int) -> dict[str, Any]:
     """Formato de contenido A:J Calibri 28 + zebra (impar gris, par blanco)."""
     is_odd = int(n_value) % 2 == 1
     row_bg = {"red": 0.90, "green": 0.90, "blue": 0.90} if is_odd else {"red": 1.0, "green": 1.0, "blue": 1.0}
-    _set_range_format(
-        ws,
+    return _range_format_request(
+        sheet_id,
         row_start=row_number,
         row_end=row_number,
         col_start=1,
@@ -1350,6 +1549,150 @@ def _format_hoja_ruta_data_row(ws: Any, row_number: int, n_value: int) -> None:
     )
 
 
+# --- Índice de secciones de Hoja_Ruta ---
+# Espejo en memoria de cada hoja (valores, filas disponibles y, por sección,
+# fila de título, encabezado, siguiente fila libre y marcador CERRADA). Se
+# actualiza tras cada escritura propia y se relee al vencer el TTL o cuando
+# otra función modifica la hoja, así que agregar un pedido cuesta un solo
+# ``batch_update``.
+HOJA_RUTA_INDEX_TTL_SECONDS = 60
+
+
+@st.cache_resource
+def _get_hoja_ruta_index_cache() -> dict[str, Any]:
+    return {"lock": threading.Lock(), "sheets": {}}
+
+
+def _hoja_ruta_sheet_state(spreadsheet_id: str, sheet_name: str) -> dict[str, Any]:
+    cache = _get_hoja_ruta_index_cache()
+    key = (str(spreadsheet_id), str(sheet_name))
+    with cache["lock"]:
+        state = cache["sheets"].get(key)
+        if state is None:
+            state = {"lock": threading.RLock(), "ws": None, "entry": None}
+            cache["sheets"][key] = state
+        return state
+
+
+def _open_hoja_ruta_sheet(spreadsheet_id: str, sheet_name: str) -> dict[str, Any]:
+    """Estado de la hoja con su worksheet abierto (se reutiliza entre llamadas)."""
+    state = _hoja_ruta_sheet_state(spreadsheet_id, sheet_name)
+    with state["lock"]:
+        if state["ws"] is None:
+            client = get_gspread_client(_credentials_json_dict=GSHEETS_CREDENTIALS)
+            state["ws"] = client.open_by_key(spreadsheet_id).worksheet(sheet_name)
+    return state
+
+
+def _hoja_ruta_index_entry(state: dict[str, Any]) -> dict[str, Any]:
+    """Espejo vigente de la hoja; se relee completo si no existe o venció. Llamar con ``state["lock"]``."""
+    entry = state["entry"]
+    if entry is None or time.time() - entry["loaded_at"] > HOJA_RUTA_INDEX_TTL_SECONDS:
+        ws = state["ws"]
+        values = [list(row_values) for row_values in _hoja_ruta_get_all_values(ws)]
+        entry = {
+            "values": values,
+            "row_count": int(getattr(ws, "row_count", 0) or 0),
+            "loaded_at": time.time(),
+            "sections": {},
+            "facturas": {
+                _normalize_plain_text(row_values[1]).upper()
+                for row_values in values
+                if len(row_values) > 1 and _normalize_plain_text(row_values[1])
+            },
+        }
+        state["entry"] = entry
+    return entry
+
+
+def _hoja_ruta_section_info(entry: dict[str, Any], section_title: str, week_marker: str) -> Optional[dict[str, Any]]:
+    """Título, encabezado, siguiente fila libre y marcador CERRADA de una sección (memoizado)."""
+    memo_key = (section_title, week_marker)
+    info = entry["sections"].get(memo_key)
+    if info is not None:
+        return info
+    values = entry["values"]
+    title_row = _find_section_title_row(values, section_title, week_marker=week_marker)
+    if title_row is None:
+        return None
+    header_row = _find_header_row_below(values, title_row)
+    next_row, n_value = (
+        _find_next_data_row_in_section(values, header_row) if header_row is not None else (None, 1)
+    )
+    info = {
+        "title_row": title_row,
+        "header_row": header_row,
+        "next_row": next_row,
+        "n_value": n_value,
+        "cierre_row": _find_cierre_marker_row_for_title(values, title_row),
+    }
+    entry["sections"][memo_key] = info
+    return info
+
+
+def _hoja_ruta_trimmed_rows(rows: list[list[Any]], width: int) -> list[list[str]]:
+    """Filas recortadas a ``width`` columnas y sin vacíos finales (como las devuelve ``batchGet``)."""
+    trimmed = []
+    for row_values in rows:
+        cells = [str(cell) for cell in list(row_values)[:width]]
+        while cells and not cells[-1].strip():
+            cells.pop()
+        trimmed.append(cells)
+    while trimmed and not trimmed[-1]:
+        trimmed.pop()
+    return trimmed
+
+
+def _hoja_ruta_mirror_matches(ws: Any, entry: dict[str, Any], info: Optional[dict[str, Any]]) -> bool:
+    """
+    Relee de Sheets las columnas A:C (títulos y facturas) y, si existe, el bloque de
+    la sección destino (A:J) para confirmar que el espejo sigue igual antes de escribir.
+
+    Detecta facturas agregadas por otra sesión dentro del TTL (para no duplicarlas) y
+    ediciones manuales en las filas que se van a sobrescribir.
+    """
+    sheet_name = _get_worksheet_name_safe(ws)
+    ranges = [_sheet_a1_range(sheet_name, "A:C")]
+    block_start = block_end = None
+    if info is not None and info["header_row"] is not None:
+        block_start = int(info["title_row"])
+        block_end = int(info["header_row"]) + HOJA_RUTA_SECTION_DATA_ROWS + 1
+        ranges.append(_sheet_a1_range(sheet_name, f"A{block_start}:J{block_end}"))
+    live = _run_gsheet_read_with_backoff(
+        lambda: _values_batch_get(ws.spreadsheet, ranges, acquire_quota=False),
+        operation_name="verificación de hoja de ruta",
+    )
+    values = entry["values"]
+    if len(live) != len(ranges):
+        return False
+    if _hoja_ruta_trimmed_rows(live[0], 3) != _hoja_ruta_trimmed_rows(values, 3):
+        return False
+    if block_start is not None:
+        mirror_block = values[block_start - 1:block_end]
+        if _hoja_ruta_trimmed_rows(live[1], 10) != _hoja_ruta_trimmed_rows(mirror_block, 10):
+            return False
+    return True
+
+
+def invalidate_hoja_ruta_index(ws: Any) -> None:
+    """Descarta el espejo de ``ws`` tras una escritura hecha fuera del índice."""
+    spreadsheet_id = str(getattr(getattr(ws, "spreadsheet", None), "id", "") or "")
+    state = _hoja_ruta_sheet_state(spreadsheet_id, _get_worksheet_name_safe(ws))
+    with state["lock"]:
+        state["entry"] = None
+
+
+def _hoja_ruta_mirror_write(values: list[list[str]], row_number: int, start_col: int, cells: list[Any]) -> None:
+    while len(values) < row_number:
+        values.append([])
+    target = values[row_number - 1]
+    end_col = start_col - 1 + len(cells)
+    if len(target) < end_col:
+        target.extend([""] * (end_col - len(target)))
+    for offset, cell in enumerate(cells):
+        target[start_col - 1 + offset] = str(cell)
+
+
 def _append_local_dia_entry_to_hoja_ruta(row: Any, s3_client_param: Any, origen_tab: Any = "") -> bool:
     st.session_state["last_hoja_ruta_error"] = ""
 
@@ -1392,100 +1735,146 @@ def _append_local_dia_entry_to_hoja_ruta(row: Any, s3_client_param: Any, origen_
 
     hoja_ruta_sheet_name = _resolve_hoja_ruta_sheet_name(origen_tab, row.get("Turno", ""))
     try:
-        client = get_gspread_client(_credentials_json_dict=GSHEETS_CREDENTIALS)
-        ws = client.open_by_key(reportes_almacen_id).worksheet(hoja_ruta_sheet_name)
+        state = _open_hoja_ruta_sheet(reportes_almacen_id, hoja_ruta_sheet_name)
     except Exception as exc:
         return _fail(f"❌ No se pudo abrir Reportes_Almacen/{hoja_ruta_sheet_name}: {exc}")
+    ws = state["ws"]
+    spreadsheet = getattr(ws, "spreadsheet", None)
+    sheet_id = getattr(ws, "id", None)
+    if spreadsheet is None or sheet_id is None or not hasattr(spreadsheet, "batch_update"):
+        return _fail(f"❌ Reportes_Almacen/{hoja_ruta_sheet_name} no admite escrituras por lote.")
 
     section_title, week_marker = _build_section_header(origen_tab, row, fecha_entrega)
-    values = _hoja_ruta_get_all_values(ws)
     factura_norm = _normalize_plain_text(entry["factura"]).upper()
-    if factura_norm:
-        for row_vals in values:
-            factura_cell = row_vals[1] if len(row_vals) > 1 else ""
-            if _normalize_plain_text(factura_cell).upper() == factura_norm:
-                return True
-    title_row = _find_section_title_row(values, section_title, week_marker=week_marker)
+    with state["lock"]:
+        try:
+            requested_at = time.time()
+            index_entry = _hoja_ruta_index_entry(state)
+            # Un espejo de hasta 60 s puede no ver facturas u ediciones de otras
+            # sesiones: antes de escribir se confirma contra Sheets y, si difiere, se relee.
+            if index_entry["loaded_at"] < requested_at and not _hoja_ruta_mirror_matches(
+                ws, index_entry, _hoja_ruta_section_info(index_entry, section_title, week_marker)
+            ):
+                state["entry"] = None
+                index_entry = _hoja_ruta_index_entry(state)
+        except Exception as exc:
+            state["ws"] = None
+            return _fail(f"❌ No se pudo leer Reportes_Almacen/{hoja_ruta_sheet_name}: {exc}")
+        if factura_norm and factura_norm in index_entry["facturas"]:
+            return True
 
-    if title_row is None:
-        # Crear nueva sección arriba de las existentes (la más reciente queda primero).
-        first_section_row = _find_first_section_title_row(values)
-        title_row = (
-            _find_insert_row_before_section(values, first_section_row)
-            if first_section_row is not None
-            else 1
-        )
-        header_row = title_row + 2
-        data_row = header_row + 1
-        data_end_row = data_row + HOJA_RUTA_SECTION_DATA_ROWS - 1
-        block_rows = HOJA_RUTA_SECTION_TOTAL_ROWS + 1
-        _ensure_rows(ws, len(values) + block_rows + 5)
-
-        inserted = False
-        if first_section_row is not None:
-            inserted = _insert_blank_rows(ws, start_row=title_row, count=block_rows)
-            if inserted:
-                template_title_row = first_section_row + block_rows
-            else:
-                title_row = first_section_row
-                header_row = title_row + 2
-                data_row = header_row + 1
-                data_end_row = data_row + HOJA_RUTA_SECTION_DATA_ROWS - 1
-                template_title_row = first_section_row
-        else:
-            template_title_row = None
+        # Todo se arma sobre una copia del espejo y se envía en un solo batch_update.
+        values = [list(row_values) for row_values in index_entry["values"]]
+        row_count = int(index_entry["row_count"])
+        requests_batch: list[dict[str, Any]] = []
 
-        cloned = False
-        if template_title_row is not None:
-            cloned = _copy_section_template_block(
-                ws,
-                source_title_row=template_title_row,
-                target_title_row=title_row,
+        def _ensure_rows(needed_row: int) -> None:
+            nonlocal row_count
+            if needed_row <= row_count:
+                return
+            rows_to_add = max(100, needed_row - row_count)
+            requests_batch.append(
+                {"appendDimension": {"sheetId": int(sheet_id), "dimension": "ROWS", "length": rows_to_add}}
+            )
+            row_count += rows_to_add
+
+        info = _hoja_ruta_section_info(index_entry, section_title, week_marker)
+        section_layout_changed = info is None or info["header_row"] is None
+        if info is None:
+            # Crear nueva sección arriba de las existentes (la más reciente queda primero).
+            first_section_row = _find_first_section_title_row(values)
+            title_row = (
+                _find_insert_row_before_section(values, first_section_row)
+                if first_section_row is not None
+                else 1
             )
-
-        if not cloned:
-            _write_row_values(ws, header_row, REPORTE_ALMACEN_COLUMNS)
-            _format_hoja_ruta_new_section(ws, title_row=title_row, header_row=header_row)
-            for n_idx in range(HOJA_RUTA_SECTION_DATA_ROWS):
-                _write_row_values(ws, data_row + n_idx, [str(n_idx + 1)], start_col=1)
-
-        # Sobrescribir título de la nueva sección y limpiar contenido B:J de filas de captura.
-        _write_row_values(ws, title_row, [week_marker, "", section_title])
-        for r in range(data_row, data_end_row + 1):
-            _write_row_values(ws, r, [""] * 9, start_col=2)
-        _write_row_values(ws, data_end_row + 1, [""] * 10, start_col=1)
-
-        target_row = data_row
-        n_value = 1
-    else:
-        header_row = _find_header_row_below(values, title_row)
-        if header_row is None:
             header_row = title_row + 2
-            _ensure_rows(ws, header_row + 1)
-            _write_row_values(ws, header_row, REPORTE_ALMACEN_COLUMNS)
-            values = _hoja_ruta_get_all_values(ws)
-        target_row, n_value = _find_next_data_row_in_section(values, header_row)
-        if n_value > HOJA_RUTA_SECTION_DATA_ROWS:
-            return _fail(
-                "⚠️ La sección ya está llena (13 filas). No se agregó el pedido para evitar desbordes.",
-                warning=True,
+            data_row = header_row + 1
+            data_end_row = data_row + HOJA_RUTA_SECTION_DATA_ROWS - 1
+            block_rows = HOJA_RUTA_SECTION_TOTAL_ROWS + 1
+            _ensure_rows(len(values) + block_rows + 5)
+
+            if first_section_row is not None:
+                requests_batch.append(_insert_rows_request(sheet_id, title_row, block_rows))
+                values[title_row - 1:title_row - 1] = [[] for _ in range(block_rows)]
+                row_count += block_rows
+                template_title_row = first_section_row + block_rows
+                requests_batch.append(_copy_section_template_request(sheet_id, template_title_row, title_row))
+                for offset in range(HOJA_RUTA_SECTION_TOTAL_ROWS):
+                    src_idx = template_title_row - 1 + offset
+                    src = values[src_idx] if src_idx < len(values) else []
+                    _hoja_ruta_mirror_write(values, title_row + offset, 1, (list(src[:10]) + [""] * 10)[:10])
+            else:
+                requests_batch.append(_paste_values_request(sheet_id, header_row, 1, [REPORTE_ALMACEN_COLUMNS]))
+                requests_batch.extend(_hoja_ruta_new_section_format_requests(sheet_id, title_row, header_row))
+                numeros = [[str(n_idx + 1)] for n_idx in range(HOJA_RUTA_SECTION_DATA_ROWS)]
+                requests_batch.append(_paste_values_request(sheet_id, data_row, 1, numeros))
+                _hoja_ruta_mirror_write(values, header_row, 1, REPORTE_ALMACEN_COLUMNS)
+                for n_idx, numero in enumerate(numeros):
+                    _hoja_ruta_mirror_write(values, data_row + n_idx, 1, numero)
+
+            # Sobrescribir título de la nueva sección y limpiar contenido B:J de filas de captura.
+            requests_batch.append(_text_cells_request(sheet_id, title_row, 1, [[week_marker, "", section_title]]))
+            requests_batch.append(
+                _text_cells_request(sheet_id, data_row, 2, [[""] * 9 for _ in range(HOJA_RUTA_SECTION_DATA_ROWS)])
             )
-        _ensure_rows(ws, target_row)
-
-    row_values = [
-        str(n_value),
-        entry["factura"],
-        entry["nombre_factura"],
-        entry["municipio"],
-        entry["horario"],
-        entry["cantidad"],
-        entry["forma_pago"],
-        entry["vendedor"],
-        entry["recibe"],
-        entry["firma"],
-    ]
-    _write_row_values(ws, target_row, row_values)
-    _format_hoja_ruta_data_row(ws, row_number=target_row, n_value=n_value)
+            requests_batch.append(_text_cells_request(sheet_id, data_end_row + 1, 1, [[""] * 10]))
+            _hoja_ruta_mirror_write(values, title_row, 1, [week_marker, "", section_title])
+            for r in range(data_row, data_end_row + 1):
+                _hoja_ruta_mirror_write(values, r, 2, [""] * 9)
+            _hoja_ruta_mirror_write(values, data_end_row + 1, 1, [""] * 10)
+
+            target_row = data_row
+            n_value = 1
+        else:
+            header_row = info["header_row"]
+            if header_row is None:
+                header_row = info["title_row"] + 2
+                _ensure_rows(header_row + 1)
+                requests_batch.append(_paste_values_request(sheet_id, header_row, 1, [REPORTE_ALMACEN_COLUMNS]))
+                _hoja_ruta_mirror_write(values, header_row, 1, REPORTE_ALMACEN_COLUMNS)
+                target_row, n_value = _find_next_data_row_in_section(values, header_row)
+            else:
+                target_row, n_value = int(info["next_row"]), int(info["n_value"])
+            if n_value > HOJA_RUTA_SECTION_DATA_ROWS:
+                return _fail(
+                    "⚠️ La sección ya está llena (13 filas). No se agregó el pedido para evitar desbordes.",
+                    warning=True,
+                )
+            _ensure_rows(target_row)
+
+        row_values = [
+            str(n_value),
+            entry["factura"],
+            entry["nombre_factura"],
+            entry["municipio"],
+            entry["horario"],
+            entry["cantidad"],
+            entry["forma_pago"],
+            entry["vendedor"],
+            entry["recibe"],
+            entry["firma"],
+        ]
+        requests_batch.append(_paste_values_request(sheet_id, target_row, 1, [row_values]))
+        requests_batch.append(_hoja_ruta_data_row_format_request(sheet_id, target_row, n_value))
+        _hoja_ruta_mirror_write(values, target_row, 1, row_values)
+
+        try:
+            spreadsheet.batch_update({"requests": requests_batch})
+        except Exception as exc:
+            # La hoja pudo cambiar de nombre, borrarse o la sesión del worksheet vencer.
+            state["entry"] = None
+            state["ws"] = None
+            return _fail(f"❌ No se pudo escribir en Reportes_Almacen/{hoja_ruta_sheet_name}: {exc}")
+
+        index_entry["values"] = values
+        index_entry["row_count"] = row_count
+        if factura_norm:
+            index_entry["facturas"].add(factura_norm)
+        if section_layout_changed:
+            index_entry["sections"] = {}
+        else:
+            info["next_row"], info["n_value"] = _find_next_data_row_in_section(values, header_row)
     return True
 
 
@@ -1526,6 +1915,7 @@ def _remove_factura_from_hoja_ruta_sheet(ws: Any, factura: str) -> bool:
             a1_start = gspread.utils.rowcol_to_a1(data_start, 2)
             a1_end = gspread.utils.rowcol_to_a1(data_end, 10)
             _worksheet_update_range(ws, f"{a1_start}:{a1_end}", kept_rows)
+            invalidate_hoja_ruta_index(ws)
             values = _hoja_ruta_get_all_values(ws)
 
         title_row = data_end + 1
@@ -1605,6 +1995,44 @@ def _format_pasa_bodega_date(value: Any, include_time: bool = False) -> str:
     return dt.strftime("%d-%B-%Y %H:%M:%S") if include_time else dt.strftime("%d-%B-%Y")
 
 
+PASA_BODEGA_HEADERS = [
+    "FECHA DE FACTURA",
+    "NUMERO DE FACTURA",
+    "NOMBRE DE CLIENTE",
+    "VENDEDOR",
+    "ESTADO",
+    "FECHA QUE PASO A RECOGER",
+    "COMENTARIOS",
+]
+
+
+def _pasa_bodega_sheet_id() -> str:
+    return str(
+        st.secrets.get("gsheets", {}).get(
+            "reportes_almacen_sheet_id",
+            st.secrets.get("gsheets", {}).get("reportes_sheet_id", ""),
+        )
+    ).strip()
+
+
+def _pasa_bodega_cell_text(value: Any) -> str:
+    """Texto exacto tal como se escribe/lee en Pasa_Bodega, sin normalizar folio ni cliente."""
+    return "" if value is None else str(value)
+
+
+def _pasa_bodega_payload(row: Any) -> dict[str, str]:
+    """Valores de la fila de Pasa_Bodega para el pedido, por encabezado."""
+    return {
+        "FECHA DE FACTURA": _format_pasa_bodega_date(row.get("Fecha_Entrega", "")),
+        "NUMERO DE FACTURA": _normalize_plain_text(row.get("Folio_Factura", "")),
+        "NOMBRE DE CLIENTE": _normalize_plain_text(row.get("Cliente", "")),
+        "VENDEDOR": _normalize_plain_text(row.get("Vendedor_Registro", "")),
+        "ESTADO": _normalize_plain_text(row.get("Estado", "")),
+        "FECHA QUE PASO A RECOGER": _format_pasa_bodega_date(row.get("Fecha_Completado", ""), include_time=True),
+        "COMENTARIOS": "",
+    }
+
+
 def _upsert_pasa_bodega_report_row(row: Any) -> bool:
     """
     Crea/actualiza registro en Reportes_Almacen/Pasa_Bodega.
@@ -1622,12 +2050,7 @@ def _upsert_pasa_bodega_report_row(row: Any) -> bool:
             st.error(msg)
         return False
 
-    reportes_almacen_id = str(
-        st.secrets.get("gsheets", {}).get(
-            "reportes_almacen_sheet_id",
-            st.secrets.get("gsheets", {}).get("reportes_sheet_id", ""),
-        )
-    ).strip()
+    reportes_almacen_id = _pasa_bodega_sheet_id()
     if not reportes_almacen_id:
         return _fail("❌ Falta configurar gsheets.reportes_almacen_sheet_id en secrets.")
 
@@ -1635,19 +2058,7 @@ def _upsert_pasa_bodega_report_row(row: Any) -> bool:
     if not folio_factura:
         return _fail("⚠️ No se pudo registrar en Pasa_Bodega: Folio_Factura vacío.", warning=True)
 
-    def _sheet_cell_text(value: Any) -> str:
-        """Texto exacto tal como se escribe/lee en Pasa_Bodega, sin normalizar folio ni cliente."""
-        return "" if value is None else str(value)
-
-    payload = {
-        "FECHA DE FACTURA": _format_pasa_bodega_date(row.get("Fecha_Entrega", "")),
-        "NUMERO DE FACTURA": folio_factura,
-        "NOMBRE DE CLIENTE": _normalize_plain_text(row.get("Cliente", "")),
-        "VENDEDOR": _normalize_plain_text(row.get("Vendedor_Registro", "")),
-        "ESTADO": _normalize_plain_text(row.get("Estado", "")),
-        "FECHA QUE PASO A RECOGER": _format_pasa_bodega_date(row.get("Fecha_Completado", ""), include_time=True),
-        "COMENTARIOS": "",
-    }
+    payload = _pasa_bodega_payload(row)
 
     try:
         client = get_gspread_client(_credentials_json_dict=GSHEETS_CREDENTIALS)
@@ -1655,15 +2066,7 @@ def _upsert_pasa_bodega_report_row(row: Any) -> bool:
     except Exception as exc:
         return _fail(f"❌ No se pudo abrir Reportes_Almacen/Pasa_Bodega: {exc}")
 
-    expected_headers = [
-        "FECHA DE FACTURA",
-        "NUMERO DE FACTURA",
-        "NOMBRE DE CLIENTE",
-        "VENDEDOR",
-        "ESTADO",
-        "FECHA QUE PASO A RECOGER",
-        "COMENTARIOS",
-    ]
+    expected_headers = PASA_BODEGA_HEADERS
     try:
         headers_read = [str(h or "").strip() for h in ws.row_values(1)]
     except Exception as exc:
@@ -1679,8 +2082,8 @@ def _upsert_pasa_bodega_report_row(row: Any) -> bool:
     fecha_recoger_col_idx = headers.index("FECHA QUE PASO A RECOGER") + 1
     target_row = None
     existing_row_values: list[str] = []
-    target_folio = _sheet_cell_text(payload["NUMERO DE FACTURA"])
-    target_cliente = _sheet_cell_text(payload["NOMBRE DE CLIENTE"])
+    target_folio = _pasa_bodega_cell_text(payload["NUMERO DE FACTURA"])
+    target_cliente = _pasa_bodega_cell_text(payload["NOMBRE DE CLIENTE"])
 
     def _cell(row_values_existing: list[str], one_based_idx: int) -> str:
         zero_based_idx = one_based_idx - 1
@@ -1690,8 +2093,8 @@ def _upsert_pasa_bodega_report_row(row: Any) -> bool:
         # El mismo sistema escribe y después lee estos valores; por eso la fila
         # correcta debe coincidir exactamente por folio y nombre de cliente.
         return (
-            _sheet_cell_text(_cell(row_vals, num_col_idx)) == target_folio
-            and _sheet_cell_text(_cell(row_vals, cliente_col_idx)) == target_cliente
+            _pasa_bodega_cell_text(_cell(row_vals, num_col_idx)) == target_folio
+            and _pasa_bodega_cell_text(_cell(row_vals, cliente_col_idx)) == target_cliente
         )
 
     # Búsqueda exacta por las dos columnas que identifican el registro escrito por la app.
@@ -1712,7 +2115,7 @@ def _upsert_pasa_bodega_report_row(row: Any) -> bool:
         try:
             all_values = ws.get_all_values()
             for row_idx, row_vals in enumerate(all_values[1:], start=2):
-                if _sheet_cell_text(_cell(list(row_vals), num_col_idx)) == target_folio:
+                if _pasa_bodega_cell_text(_cell(list(row_vals), num_col_idx)) == target_folio:
                     target_row = row_idx
                     existing_row_values = list(row_vals)
                     break
@@ -1727,7 +2130,7 @@ def _upsert_pasa_bodega_report_row(row: Any) -> bool:
             col_values = ws.col_values(num_col_idx)
             folio_only_match: tuple[int, list[str]] | None = None
             for i, val in enumerate(col_values[1:], start=2):
-                if _sheet_cell_text(val) != target_folio:
+                if _pasa_bodega_cell_text(val) != target_folio:
                     continue
                 try:
                     row_vals = ws.row_values(i)
@@ -1794,26 +2197,157 @@ def _upsert_pasa_bodega_report_row(row: Any) -> bool:
 
 
 
-def _ensure_visual_state_defaults():
-    """Ensure session_state has all UI control keys with safe defaults."""
+def _upsert_pasa_bodega_report_rows(rows: Sequence[Any]) -> dict[str, str]:
+    """
+    Versión por lote de ``_upsert_pasa_bodega_report_row`` para el completado múltiple.
 
-    state = st.session_state
+    Lee Pasa_Bodega una vez, actualiza las filas existentes en un solo
+    ``values:batchUpdate``, agrega las nuevas con un solo ``values:append`` (la
+    cuadrícula crece si hace falta) y centra B:D en un solo ``batch_update``.
+    Devuelve ``{Folio_Factura: motivo}``; el motivo queda vacío cuando se escribió.
+    """
+    payloads: dict[str, dict[str, str]] = {}
+    for row in rows:
+        payload = _pasa_bodega_payload(row)
+        if payload["NUMERO DE FACTURA"]:
+            payloads[payload["NUMERO DE FACTURA"]] = payload
+    if not payloads:
+        return {}
+
+    def _fail_all(msg: str) -> dict[str, str]:
+        st.session_state["last_pasa_bodega_error"] = msg
+        return {folio: msg for folio in payloads}
 
-    # Índices de pestañas y banderas de scroll
-    state.setdefault("active_main_tab_index", 0)
-    state.setdefault("active_subtab_local_index", 0)
-    state.setdefault("active_date_tab_m_index", 0)
-    state.setdefault("active_date_tab_t_index", 0)
-    state.setdefault("active_date_tab_s_index", 0)
-    state.setdefault("active_date_tab_m_label", "")
-    state.setdefault("active_date_tab_t_label", "")
-    state.setdefault("active_date_tab_s_label", "")
-    state.setdefault("scroll_to_pedido_id", None)
+    reportes_almacen_id = _pasa_bodega_sheet_id()
+    if not reportes_almacen_id:
+        return _fail_all("❌ Falta configurar gsheets.reportes_almacen_sheet_id en secrets.")
 
-    # Diccionarios que controlan expanders o secciones dinámicas
-    state.setdefault("expanded_pedidos", {})
-    state.setdefault("expanded_attachments", {})
-    state.setdefault("expanded_subir_guia", {})
+    try:
+        client = get_gspread_client(_credentials_json_dict=GSHEETS_CREDENTIALS)
+        ws = client.open_by_key(reportes_almacen_id).worksheet("Pasa_Bodega")
+        all_values = _run_gsheet_read_with_backoff(
+            lambda: ws.get_all_values(),
+            operation_name="lectura de Pasa_Bodega",
+        )
+    except Exception as exc:
+        return _fail_all(f"❌ No se pudo leer Reportes_Almacen/Pasa_Bodega: {exc}")
+
+    headers_read = [str(h or "").strip() for h in (all_values[0] if all_values else [])]
+    headers = (
+        headers_read if all(col in headers_read for col in PASA_BODEGA_HEADERS) else PASA_BODEGA_HEADERS
+    )
+    num_col = headers.index("NUMERO DE FACTURA")
+    cliente_col = headers.index("NOMBRE DE CLIENTE")
+
+    # Misma prioridad que el upsert individual: folio+cliente exactos y, si no, solo folio.
+    exact_rows: dict[tuple[str, str], int] = {}
+    folio_rows: dict[str, int] = {}
+    for row_idx, row_vals in enumerate(all_values[1:], start=2):
+        folio = _pasa_bodega_cell_text(row_vals[num_col] if num_col < len(row_vals) else "")
+        cliente = _pasa_bodega_cell_text(row_vals[cliente_col] if cliente_col < len(row_vals) else "")
+        exact_rows.setdefault((folio, cliente), row_idx)
+        folio_rows.setdefault(folio, row_idx)
+
+    worksheet_title = _get_worksheet_name_safe(ws)
+    pending: dict[tuple[str, int, int], dict[str, Any]] = {}
+    written_rows: list[int] = []
+    new_rows: list[tuple[str, list[Any]]] = []
+    motivos = {folio: "" for folio in payloads}
+    for folio, payload in payloads.items():
+        target_row = exact_rows.get((folio, payload["NOMBRE DE CLIENTE"])) or folio_rows.get(folio)
+        if not target_row:
+            new_rows.append((folio, [_sheet_json_value(payload.get(h, "")) for h in headers]))
+            continue
+        existing = list(all_values[target_row - 1])
+        row_values = [existing[i] if i < len(existing) else "" for i in range(len(headers))]
+        for i, header in enumerate(headers):
+            if header in payload and not (header == "COMENTARIOS" and not payload[header]):
+                row_values[i] = payload[header]
+        written_rows.append(target_row)
+        for col_idx, value in enumerate(row_values, start=1):
+            pending[(worksheet_title, target_row, col_idx)] = {
+                "worksheet": ws,
+                "value": _sheet_json_value(value),
+                "value_input_option": "USER_ENTERED",
+            }
+
+    if pending:
+        try:
+            _run_gsheet_write_with_backoff(
+                lambda: _send_sheet_values_batch_update(ws.spreadsheet, pending),
+                operation_name="actualización de Pasa_Bodega",
+            )
+        except Exception as exc:
+            return _fail_all(f"❌ No se pudo actualizar Pasa_Bodega: {exc}")
+
+    if new_rows:
+        # values:append agrega filas a la cuadrícula; un batchUpdate más allá de la
+        # última fila fallaría con "exceeds grid limits" en una hoja crecida solo por append.
+        try:
+            response = _run_gsheet_write_with_backoff(
+                lambda: ws.spreadsheet.values_append(
+                    _sheet_a1_range(worksheet_title, "A1"),
+                    params={"valueInputOption": "USER_ENTERED", "insertDataOption": "INSERT_ROWS"},
+                    body={"values": [values for _, values in new_rows]},
+                ),
+                operation_name="alta en Pasa_Bodega",
+            )
+            updated_range = str((response or {}).get("updates", {}).get("updatedRange", "")).split("!")[-1]
+            first, _, last = updated_range.partition(":")
+            if first:
+                start_row, _ = gspread.utils.a1_to_rowcol(first)
+                end_row, _ = gspread.utils.a1_to_rowcol(last or first)
+                written_rows.extend(range(int(start_row), int(end_row) + 1))
+        except Exception as exc:
+            msg = f"❌ No se pudo agregar a Pasa_Bodega: {exc}"
+            st.session_state["last_pasa_bodega_error"] = msg
+            for folio, _ in new_rows:
+                motivos[folio] = msg
+
+    if not written_rows:
+        return motivos
+    try:
+        sheet_id = int(getattr(ws, "id", 0) or 0)
+        ws.spreadsheet.batch_update(
+            {
+                "requests": [
+                    {
+                        "repeatCell": {
+                            "range": _grid_range(sheet_id, row_idx, row_idx, 2, 4),
+                            "cell": {"userEnteredFormat": {"horizontalAlignment": "CENTER"}},
+                            "fields": "userEnteredFormat.horizontalAlignment",
+                        }
+                    }
+                    for row_idx in written_rows
+                ]
+            }
+        )
+    except Exception:
+        # El formato visual no invalida la escritura de ESTADO y FECHA QUE PASO A RECOGER.
+        pass
+    return motivos
+
+
+def _ensure_visual_state_defaults():
+    """Ensure session_state has all UI control keys with safe defaults."""
+
+    state = st.session_state
+
+    # Índices de pestañas y banderas de scroll
+    state.setdefault("active_main_tab_index", 0)
+    state.setdefault("active_subtab_local_index", 0)
+    state.setdefault("active_date_tab_m_index", 0)
+    state.setdefault("active_date_tab_t_index", 0)
+    state.setdefault("active_date_tab_s_index", 0)
+    state.setdefault("active_date_tab_m_label", "")
+    state.setdefault("active_date_tab_t_label", "")
+    state.setdefault("active_date_tab_s_label", "")
+    state.setdefault("scroll_to_pedido_id", None)
+
+    # Diccionarios que controlan expanders o secciones dinámicas
+    state.setdefault("expanded_pedidos", {})
+    state.setdefault("expanded_attachments", {})
+    state.setdefault("expanded_subir_guia", {})
     state.setdefault("expanded_devoluciones", {})
     state.setdefault("expanded_garantias", {})
 
@@ -1828,7 +2362,6 @@ def _ensure_visual_state_defaults():
     state.setdefault("bulk_selected_pedidos", set())
     state.setdefault("bulk_complete_execute_requested", False)
     state.setdefault("bulk_mode_reset_requested", False)
-    state.setdefault("bulk_checkbox_interaction", False)
     state.setdefault("bulk_search_query", "")
     state.setdefault("bulk_complete_in_progress", False)
     state.setdefault("bulk_complete_progress_current", 0)
@@ -1950,8 +2483,6 @@ def _set_bulk_mode(enabled: bool) -> None:
 
 
 def _mark_bulk_checkbox_interaction(pedido_id: str, checkbox_key: str) -> None:
-    st.session_state["bulk_checkbox_interaction"] = True
-
     selected = _get_bulk_selected_ids()
     is_checked = bool(st.session_state.get(checkbox_key, False))
     if is_checked:
@@ -2581,9 +3112,11 @@ def _sync_turno_cierre_en_hoja_ruta(origen_tab: str, fecha_label: str, cerrar: b
             cierre_row = title_row
 
         _write_row_values(ws, cierre_row, ["", "", "CERRADA"], start_col=1)
+        invalidate_hoja_ruta_index(ws)
     else:
         if cierre_row is not None:
             _write_row_values(ws, cierre_row, ["", "", ""], start_col=1)
+            invalidate_hoja_ruta_index(ws)
     return True, ""
 
 
@@ -2604,21 +3137,18 @@ def _is_turno_cerrado_en_hoja_ruta(origen_tab: str, fecha_label: str) -> tuple[b
     if not reportes_almacen_id:
         return False, "Falta configurar gsheets.reportes_almacen_sheet_id en secrets."
 
+    section_title, week_marker = _build_section_header(origen_tab, {"Turno": origen_tab}, fecha_entrega)
+    sheet_name = _resolve_hoja_ruta_sheet_name(origen_tab, origen_tab)
     try:
-        client = get_gspread_client(_credentials_json_dict=GSHEETS_CREDENTIALS)
-        sheet_name = _resolve_hoja_ruta_sheet_name(origen_tab, origen_tab)
-        ws = client.open_by_key(reportes_almacen_id).worksheet(sheet_name)
+        state = _open_hoja_ruta_sheet(reportes_almacen_id, sheet_name)
+        with state["lock"]:
+            info = _hoja_ruta_section_info(_hoja_ruta_index_entry(state), section_title, week_marker)
     except Exception as exc:
         return False, f"No se pudo abrir la hoja de ruta: {exc}"
-
-    section_title, week_marker = _build_section_header(origen_tab, {"Turno": origen_tab}, fecha_entrega)
-    values = _hoja_ruta_get_all_values(ws)
-    title_row = _find_section_title_row(values, section_title, week_marker=week_marker)
-    if title_row is None:
+    if info is None:
         return False, "No se encontró la sección en Hoja_Ruta para esa fecha/turno."
 
-    cierre_row = _find_cierre_marker_row_for_title(values, title_row)
-    return cierre_row is not None, ""
+    return info["cierre_row"] is not None, ""
 
 
 def collect_tab_locations(
@@ -2766,14 +3296,223 @@ def _exclude_cleaned_completed(df: pd.DataFrame) -> pd.DataFrame:
     return out[~mask_cleaned_completed].copy()
 
 
+# --- Numeración de flujo (por columnas y memorizada) ---
+# La numeración depende del orden global de todos los pedidos, así que se
+# recalcula completa, pero por columnas: las fechas se interpretan una vez por
+# valor distinto (memo compartido entre reruns, solo se parsean valores nuevos) y
+# los mapas finales se memorizan por la huella de las columnas que intervienen.
+FLOW_SORT_DATETIME_FIELDS = (
+    "Hora_Registro",
+    "Fecha_Entrega",
+    "Fecha_Completado",
+    "Fecha_Pago_Comprobante",
+    "Hora_Proceso",
+    "Fecha_Registro",
+)
+FLOW_NUMBER_INPUT_COLUMNS = (
+    "Tipo_Envio",
+    "Tipo_Envio_Original",
+    "ID_Pedido",
+    "Folio_Factura",
+    "Turno",
+    "Estado",
+    "Completados_Limpiado",
+    "Numero_Foraneo",
+    "_gsheet_row_index",
+    "__sheet_row",
+    "gsheet_row_index",
+) + FLOW_SORT_DATETIME_FIELDS
+FLOW_NUMBER_MAPS_KEEP = 8
+FLOW_DATETIME_CACHE_MAX = 50000
+
+
+@st.cache_resource
+def _get_flow_number_cache() -> dict[str, Any]:
+    """Memo de numeración de flujo compartido por todas las sesiones del proceso."""
+    return {"datetimes": {}, "maps": {}}
+
+
+def _map_distinct_values(values: list, fn) -> list:
+    """Aplica ``fn`` una sola vez por valor distinto (respetando el tipo) de ``values``."""
+    memo: dict[tuple[type, Any], Any] = {}
+    out = []
+    for value in values:
+        try:
+            key = (type(value), value)
+            result = memo[key]
+        except KeyError:
+            result = memo[key] = fn(value)
+        except TypeError:
+            result = fn(value)
+        out.append(result)
+    return out
+
+
+def _column_values(df: pd.DataFrame, column: str, default: Any = None) -> list:
+    if column not in df.columns:
+        return [default] * len(df)
+    return df[column].tolist()
+
+
+def _flow_row_key_value(raw: Any) -> str:
+    try:
+        if raw is not None and not pd.isna(raw):
+            return f"row:{int(float(raw))}"
+    except Exception:
+        pass
+    return ""
+
+
+def _flow_row_keys(df: pd.DataFrame) -> list[str]:
+    """Equivalente por columnas de ``_flow_row_key`` para todas las filas."""
+    keys = [""] * len(df)
+    for field in ("_gsheet_row_index", "__sheet_row", "gsheet_row_index"):
+        if field not in df.columns:
+            continue
+        values = _map_distinct_values(df[field].tolist(), _flow_row_key_value)
+        keys = [current or value for current, value in zip(keys, values)]
+    return keys
+
+
+def _flow_parse_datetime(value: Any) -> Any:
+    if not isinstance(value, str):
+        return pd.to_datetime(value, errors="coerce")
+    cache = _get_flow_number_cache()["datetimes"]
+    parsed = cache.get(value)
+    if parsed is None:
+        parsed = pd.to_datetime(value, errors="coerce")
+        if len(cache) >= FLOW_DATETIME_CACHE_MAX:
+            cache.clear()
+        cache[value] = parsed
+    return parsed
+
+
+def _flow_sort_datetimes(df: pd.DataFrame) -> pd.Series:
+    """Equivalente por columnas de ``_parse_row_sort_datetime`` para todas las filas."""
+    result = [pd.NaT] * len(df)
+    pending = list(range(len(df)))
+    for field in FLOW_SORT_DATETIME_FIELDS:
+        if not pending:
+            break
+        if field not in df.columns:
+            continue
+        column = df[field].tolist()
+        parsed = _map_distinct_values([column[pos] for pos in pending], _flow_parse_datetime)
+        still_pending = []
+        for pos, value in zip(pending, parsed):
+            if pd.notna(value):
+                result[pos] = value
+            else:
+                still_pending.append(pos)
+        pending = still_pending
+
+    if pending:
+        index_field = "_gsheet_row_index" if "_gsheet_row_index" in df.columns else "gsheet_row_index"
+        column = _column_values(df, index_field)
+
+        def _fallback(row_idx: Any) -> pd.Timestamp:
+            try:
+                if row_idx is not None and not pd.isna(row_idx):
+                    return pd.Timestamp("1970-01-01") + pd.to_timedelta(int(float(row_idx)), unit="s")
+            except Exception:
+                pass
+            return pd.Timestamp.max
+
+        for pos, value in zip(pending, _map_distinct_values([column[pos] for pos in pending], _fallback)):
+            result[pos] = value
+
+    return pd.Series(result, index=df.index)
+
+
+def _flow_number_fingerprint(df: Optional[pd.DataFrame]) -> str:
+    """Huella de las columnas que determinan la numeración (cambia con cada versión de datos)."""
+    if df is None:
+        return "none"
+    columns = [col for col in FLOW_NUMBER_INPUT_COLUMNS if col in df.columns]
+    digest = hashlib.sha1(f"{len(df)}|{'|'.join(columns)}".encode("utf-8"))
+    if columns and not df.empty:
+        hashed = pd.util.hash_pandas_object(df[columns].astype(str), index=False)
+        digest.update(hashed.to_numpy().tobytes())
+    return digest.hexdigest()
+
+
+def _assign_first_wins(target: dict[str, str], keys_by_row: list[tuple[str, ...]], numbers: list[str]) -> None:
+    for row_keys, numero in zip(keys_by_row, numbers):
+        for key in row_keys:
+            if key and key not in target:
+                target[key] = numero
+
+
+def _flow_local_keys(df: pd.DataFrame) -> list[tuple[str, str, str]]:
+    def _match_key(raw: Any) -> str:
+        return raw if isinstance(raw, str) and raw.startswith("row:") else _flow_key(raw)
+
+    return list(
+        zip(
+            _flow_row_keys(df),
+            _map_distinct_values(_column_values(df, "ID_Pedido", ""), _match_key),
+            _map_distinct_values(_column_values(df, "Folio_Factura", ""), _match_key),
+        )
+    )
+
+
+def _flow_foraneo_frame(df: pd.DataFrame, source_tag: int) -> pd.DataFrame:
+    """Columnas mínimas de un bloque foráneo para el flujo combinado pedidos/casos."""
+    return pd.DataFrame(
+        {
+            "_sort_dt": _flow_sort_datetimes(df).tolist(),
+            "_tag": source_tag,
+            "_row_key": _flow_row_keys(df),
+            "_id_key": _map_distinct_values(_column_values(df, "ID_Pedido", ""), _flow_key),
+            "_folio_key": _map_distinct_values(_column_values(df, "Folio_Factura", ""), _flow_key),
+            "_inactivo": [
+                cancelado or limpiado
+                for cancelado, limpiado in zip(
+                    _map_distinct_values(_column_values(df, "Estado", ""), _is_cancelado_estado),
+                    _map_distinct_values(
+                        _column_values(df, "Completados_Limpiado", ""),
+                        lambda value: _normalize_text_for_matching(str(value)) == "si",
+                    ),
+                )
+            ],
+            "_manual": pd.Series(
+                _map_distinct_values(_column_values(df, "Numero_Foraneo", ""), _parse_foraneo_number)
+                if source_tag == 1
+                else [None] * len(df),
+                dtype=object,
+            ),
+        }
+    )
+
+
 def build_flow_number_maps(
     df_source: pd.DataFrame,
     df_casos: Optional[pd.DataFrame] = None,
 ) -> tuple[dict[str, str], dict[str, str], list[tuple[int, str]]]:
-    """Construye mapas de numeración de flujo: foráneos 01+, locales 1+."""
+    """Construye mapas de numeración de flujo: foráneos 01+, locales 1+.
+
+    El resultado se memoriza por la huella de los datos de entrada, así que los
+    reruns sin cambios en pedidos/casos no vuelven a numerar.
+    """
     if df_source is None or df_source.empty:
         return {}, {}, []
 
+    memo_key = (_flow_number_fingerprint(df_source), _flow_number_fingerprint(df_casos))
+    memo = _get_flow_number_cache()["maps"]
+    cached = memo.get(memo_key)
+    if cached is None:
+        cached = _compute_flow_number_maps(df_source, df_casos)
+        memo[memo_key] = cached
+        while len(memo) > FLOW_NUMBER_MAPS_KEEP:
+            memo.pop(next(iter(memo)), None)
+    map_local, map_foraneo = cached
+    return dict(map_local), dict(map_foraneo), []
+
+
+def _compute_flow_number_maps(
+    df_source: pd.DataFrame,
+    df_casos: Optional[pd.DataFrame],
+) -> tuple[dict[str, str], dict[str, str]]:
     work = _exclude_cleaned_completed(df_source)
     for col in ("Tipo_Envio", "Tipo_Envio_Original", "ID_Pedido", "Folio_Factura"):
         if col not in work.columns:
@@ -2786,25 +3525,13 @@ def build_flow_number_maps(
     df_foraneo = work[mask_foraneo].reset_index(drop=True)
     df_local = work[~mask_foraneo].reset_index(drop=True)
 
-    def _build_map(df_block: pd.DataFrame, formatter) -> dict[str, str]:
-        out: dict[str, str] = {}
-        for idx, row in df_block.iterrows():
-            numero = formatter(idx)
-            row_key = _flow_row_key(row)
-            for raw in (row_key, row.get("ID_Pedido", ""), row.get("Folio_Factura", "")):
-                key = raw if isinstance(raw, str) and raw.startswith("row:") else _flow_key(raw)
-                if key and key not in out:
-                    out[key] = numero
-        return out
-
     map_foraneo: dict[str, str] = {}
     map_local: dict[str, str] = {}
 
     if not df_local.empty:
-        df_local_base = df_local.copy()
-        mask_local_puro = df_local_base["Tipo_Envio"].astype(str).str.strip().eq("📍 Pedido Local")
-        df_local_turno_reset = df_local_base[mask_local_puro].copy()
-        df_local_otro = df_local_base[~mask_local_puro].copy()
+        mask_local_puro = df_local["Tipo_Envio"].astype(str).str.strip().eq("📍 Pedido Local")
+        df_local_turno_reset = df_local[mask_local_puro].copy()
+        df_local_otro = df_local[~mask_local_puro].reset_index(drop=True)
 
         if not df_local_turno_reset.empty:
             df_local_turno_reset["_turno_local_norm"] = (
@@ -2822,33 +3549,28 @@ def build_flow_number_maps(
                 errors="coerce",
             ).dt.strftime("%Y-%m-%d")
             df_local_turno_reset["_fecha_local_norm"] = df_local_turno_reset["_fecha_local_norm"].fillna("sin_fecha")
-            df_local_turno_reset["_sort_dt"] = df_local_turno_reset.apply(
-                _parse_row_sort_datetime,
-                axis=1,
-            )
+            df_local_turno_reset["_sort_dt"] = _flow_sort_datetimes(df_local_turno_reset)
             df_local_turno_reset = df_local_turno_reset.sort_values(
                 by=["_turno_local_norm", "_fecha_local_norm", "_sort_dt"],
                 kind="mergesort",
             ).reset_index(drop=True)
 
-            counters_by_turno_fecha: dict[tuple[str, str], int] = {}
-            for _, row in df_local_turno_reset.iterrows():
-                turno = str(row.get("_turno_local_norm", "")).strip()
-                fecha = str(row.get("_fecha_local_norm", "")).strip() or "sin_fecha"
-                bucket = (turno, fecha)
-                counters_by_turno_fecha[bucket] = counters_by_turno_fecha.get(bucket, 0) + 1
-                numero = str(counters_by_turno_fecha[bucket])
-                row_key = _flow_row_key(row)
-                for raw in (row_key, row.get("ID_Pedido", ""), row.get("Folio_Factura", "")):
-                    key = raw if isinstance(raw, str) and raw.startswith("row:") else _flow_key(raw)
-                    if key and key not in map_local:
-                        map_local[key] = numero
+            # Contador por turno/fecha: posición dentro de su cubeta ya ordenada.
+            numeros_turno = (
+                df_local_turno_reset.groupby(["_turno_local_norm", "_fecha_local_norm"], sort=False).cumcount() + 1
+            )
+            _assign_first_wins(
+                map_local,
+                _flow_local_keys(df_local_turno_reset),
+                numeros_turno.astype(str).tolist(),
+            )
 
         if not df_local_otro.empty:
-            map_local_fallback = _build_map(df_local_otro.reset_index(drop=True), lambda idx: str(idx + 1))
-            for key, numero in map_local_fallback.items():
-                if key and key not in map_local:
-                    map_local[key] = numero
+            _assign_first_wins(
+                map_local,
+                _flow_local_keys(df_local_otro),
+                [str(idx + 1) for idx in range(len(df_local_otro))],
+            )
 
     casos_foraneo = pd.DataFrame()
     if df_casos is not None and not df_casos.empty:
@@ -2860,37 +3582,27 @@ def build_flow_number_maps(
         casos_foraneo = casos_work[
             casos_work["Tipo_Envio_Original"].astype(str).map(_is_exact_pedido_foraneo)
             | casos_work["Tipo_Envio"].astype(str).map(_is_exact_pedido_foraneo)
-        ].copy()
+        ]
 
     # Flujo foráneo combinado:
     # - Pedidos mantienen numeración automática por orden.
     # - Devoluciones/casos foráneos solo entran al flujo si ya tienen Numero_Foraneo.
     # - Registros limpiados (Completados_Limpiado = sí) no cuentan.
-    combined_rows: list[tuple[pd.Timestamp, int, str, pd.Series]] = []
-    if not df_foraneo.empty:
-        for _, row in df_foraneo.iterrows():
-            combined_rows.append((_parse_row_sort_datetime(row), 0, "main", row))
-
-    if not casos_foraneo.empty:
-        for _, row in casos_foraneo.iterrows():
-            combined_rows.append((_parse_row_sort_datetime(row), 1, "caso", row))
-
-    combined_rows.sort(key=lambda item: (item[0], item[1]))
-
-    def _is_limpiado(row_data: pd.Series) -> bool:
-        return _normalize_text_for_matching(str(row_data.get("Completados_Limpiado", ""))) == "si"
+    bloques = [
+        _flow_foraneo_frame(df_block, source_tag)
+        for df_block, source_tag in ((df_foraneo, 0), (casos_foraneo, 1))
+        if not df_block.empty
+    ]
+    if not bloques:
+        return map_local, map_foraneo
 
-    manual_numbers: set[int] = set()
-    for _, _, source_kind, row in combined_rows:
-        if _is_cancelado_estado(row.get("Estado", "")) or _is_limpiado(row):
-            continue
-        if source_kind != "caso":
-            continue
-        parsed = _parse_foraneo_number(row.get("Numero_Foraneo", ""))
-        if parsed is not None:
-            manual_numbers.add(parsed)
+    combined = pd.concat(bloques, ignore_index=True).sort_values(by=["_sort_dt", "_tag"], kind="mergesort")
+    combined = combined[~combined["_inactivo"]]
+    keys_by_row = list(zip(combined["_row_key"], combined["_id_key"], combined["_folio_key"]))
+    is_caso = (combined["_tag"] == 1).tolist()
+    manual = combined["_manual"].tolist()
 
-    used_numbers: set[int] = set(manual_numbers)
+    used_numbers: set[int] = {parsed for parsed, caso in zip(manual, is_caso) if caso and parsed is not None}
     # Mantener continuidad: pedidos foráneos normales deben tomar
     # el menor número disponible (01, 02, 03, ...), saltando únicamente
     # los números manuales ya reservados por casos/devoluciones.
@@ -2900,40 +3612,18 @@ def build_flow_number_maps(
     next_number = 1
 
     # 1) Casos/devoluciones foráneos con Numero_Foraneo manual (se respeta tal cual).
-    for _, _, source_kind, row in combined_rows:
-        if _is_cancelado_estado(row.get("Estado", "")) or _is_limpiado(row):
-            continue
-        if source_kind != "caso":
-            continue
-
-        row_key = _flow_row_key(row)
-        keys = [row_key, _flow_key(row.get("ID_Pedido", "")), _flow_key(row.get("Folio_Factura", ""))]
-        if not any(keys):
-            continue
-
-        parsed = _parse_foraneo_number(row.get("Numero_Foraneo", ""))
-        if parsed is None:
-            continue
-
-        numero_fmt = f"{parsed:02d}"
-        for key in keys:
-            if key and key not in map_foraneo:
-                map_foraneo[key] = numero_fmt
+    for keys, caso, parsed in zip(keys_by_row, is_caso, manual):
+        if caso and parsed is not None and any(keys):
+            _assign_first_wins(map_foraneo, [keys], [f"{parsed:02d}"])
 
     # 2) Pedidos foráneos normales en secuencia, sin repetir manuales.
-    for _, _, source_kind, row in combined_rows:
-        if _is_cancelado_estado(row.get("Estado", "")) or _is_limpiado(row):
-            continue
-        if source_kind == "caso":
-            continue
-
-        row_key = _flow_row_key(row)
-        keys = [row_key, _flow_key(row.get("ID_Pedido", "")), _flow_key(row.get("Folio_Factura", ""))]
-        if not any(keys):
+    for keys, caso in zip(keys_by_row, is_caso):
+        if caso or not any(keys):
             continue
 
         # Evitar colisión por folio/ID repetidos entre filas diferentes:
         # solo tratamos como "ya asignado" si la fila actual ya tiene clave row:.
+        row_key = keys[0]
         if row_key and row_key in map_foraneo:
             continue
 
@@ -2943,13 +3633,9 @@ def build_flow_number_maps(
         next_number += 1
 
         used_numbers.add(numero)
-        numero_fmt = f"{numero:02d}"
+        _assign_first_wins(map_foraneo, [keys], [f"{numero:02d}"])
 
-        for key in keys:
-            if key and key not in map_foraneo:
-                map_foraneo[key] = numero_fmt
-
-    return map_local, map_foraneo, []
+    return map_local, map_foraneo
 
 
 def resolve_flow_display_number(row: pd.Series, fallback_order: Any) -> str:
@@ -3451,7 +4137,9 @@ def get_s3_client():
             's3',
             aws_access_key_id=AWS_ACCESS_KEY_ID,
             aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
-            region_name=AWS_REGION
+            region_name=AWS_REGION,
+            # Opcional: S3 local compatible (MinIO, moto) para pruebas.
+            endpoint_url=AWS_CREDENTIALS.get("endpoint_url") or None,
         )
         return s3
     except Exception as e:
@@ -3542,106 +4230,660 @@ except Exception as e:
     handle_auth_error(e)
 
 
-# --- Data Loading from Google Sheets (Cached) ---
-@st.cache_data(ttl=300, hash_funcs={gspread.client.Client: lambda _: None})
-def get_raw_sheet_data(
+# --- Snapshot compartido por proceso (una sola lectura por worksheet) ---
+SHEET_SNAPSHOT_SHARE_SECONDS = 15
+# Vigencia propia de catálogos que cambian poco (coincide con el TTL de su caché).
+SHEET_SNAPSHOT_MAX_AGE_SECONDS = {"Clientes_Locales": 300}
+
+
+@st.cache_resource
+def _get_sheet_snapshot_store() -> dict[str, Any]:
+    """Almacén por proceso con la última lectura completa de cada worksheet."""
+    return {"lock": threading.Lock(), "entries": {}}
+
+
+def _get_sheet_snapshot_entry(sheet_id: str, worksheet_name: str) -> dict[str, Any]:
+    store = _get_sheet_snapshot_store()
+    key = (str(sheet_id), str(worksheet_name))
+    with store["lock"]:
+        entry = store["entries"].get(key)
+        if entry is None:
+            entry = {
+                "lock": threading.Lock(),
+                "values": None,
+                "version": 0,
+                "fetched_at": 0.0,
+                "stale": True,
+                "sync_state": {"dirty_rows": set()},
+                "frame_lock": threading.Lock(),
+                "frame": None,
+            }
+            store["entries"][key] = entry
+        return entry
+
+
+def get_shared_sheet_snapshot(
     sheet_id: str,
     worksheet_name: str,
-    client: Optional[gspread.client.Client] = None,
-) -> list[list[str]]:
-    gspread_client = client or g_spread_client
-    if gspread_client is None:
-        raise ValueError("No se proporcionó un cliente de gspread para obtener los datos.")
-    max_attempts = 3
-    base_delay = 1
-    for attempt in range(max_attempts):
-        wait_seconds = base_delay * (2 ** attempt)
-        try:
-            sheet = gspread_client.open_by_key(sheet_id)
-            worksheet = sheet.worksheet(worksheet_name)
-            return worksheet.get_all_values()
-        except gspread.exceptions.APIError as api_error:
-            # ℹ️ Solo limpiamos la caché de esta función para no reiniciar otros estados de la app.
-            get_raw_sheet_data.clear()
-            if _is_recoverable_auth_error(api_error) and attempt < max_attempts - 1:
-                st.warning(
-                    f"🔁 Error de autenticación con Google Sheets (intento {attempt + 1}/{max_attempts}). "
-                    f"Reintentando en {wait_seconds}s..."
-                )
-                time.sleep(wait_seconds)
-                continue
+    fetch_fn,
+    *,
+    max_age_seconds: Optional[float] = None,
+    incremental: bool = False,
+) -> tuple[Any, int]:
+    """
+    Devuelve ``(valores, versión)`` de una worksheet compartiendo la lectura entre sesiones.
 
-            if attempt < max_attempts - 1:
-                st.warning(
-                    f"⚠️ Error de la API de Google Sheets (intento {attempt + 1}/{max_attempts}). "
-                    f"Reintentando en {wait_seconds}s..."
-                )
-                time.sleep(wait_seconds)
-                continue
+    Solo una sesión ejecuta ``fetch_fn`` a la vez (single-flight); las sesiones que
+    llegan mientras la lectura está en curso esperan y reutilizan su resultado.
+    La versión solo avanza cuando el contenido leído cambia respecto al snapshot previo.
+    Con ``incremental=True`` se llama ``fetch_fn(valores_previos, sync_state)`` para
+    que la lectura pueda limitarse a los rangos que cambiaron.
+    """
+    if max_age_seconds is None:
+        max_age_seconds = SHEET_SNAPSHOT_MAX_AGE_SECONDS.get(worksheet_name, SHEET_SNAPSHOT_SHARE_SECONDS)
+    entry = _get_sheet_snapshot_entry(sheet_id, worksheet_name)
+    requested_at = time.time()
+    with entry["lock"]:
+        fetched_at = float(entry["fetched_at"] or 0)
+        if entry["values"] is not None and not entry["stale"]:
+            if fetched_at >= requested_at or (time.time() - fetched_at) < max_age_seconds:
+                return entry["values"], int(entry["version"])
 
-            if _is_recoverable_auth_error(api_error):
-                handle_auth_error(api_error)
+        try:
+            if incremental:
+                values = fetch_fn(entry["values"], entry["sync_state"])
             else:
-                st.error(f"❌ Error de la API de Google Sheets: {api_error}")
-            raise
-        except RequestException as net_err:
-            get_raw_sheet_data.clear()
-            if attempt < max_attempts - 1:
-                st.warning(
-                    f"⚠️ Error de red al conectar con Google Sheets (intento {attempt + 1}/{max_attempts}). "
-                    f"Reintentando en {wait_seconds}s..."
-                )
-                time.sleep(wait_seconds)
-                continue
+                values = fetch_fn()
+        except SheetsQuotaUnavailable:
+            if entry["values"] is None:
+                raise
+            # Sin cuota: se sirve el snapshot previo; sigue vencido y se relee en la próxima visita.
+            return entry["values"], int(entry["version"])
+        return values, _store_sheet_snapshot_values(entry, values)
 
-            handle_auth_error(net_err)
-            raise
-        except Exception as e:
-            get_raw_sheet_data.clear()  # 🔁 Limpiar solo la caché de esta función en caso de error de token/API
-            if attempt < max_attempts - 1:
-                st.warning(
-                    f"⚠️ Error inesperado al conectar con Google Sheets (intento {attempt + 1}/{max_attempts}). "
-                    f"Reintentando en {wait_seconds}s..."
-                )
-                time.sleep(wait_seconds)
+
+def _store_sheet_snapshot_values(entry: dict[str, Any], values: Any) -> int:
+    """Guarda ``values`` en la entrada (con su lock tomado) y devuelve la versión vigente."""
+    if entry["values"] is None or values != entry["values"]:
+        entry["version"] = int(entry["version"]) + 1
+    entry["values"] = values
+    entry["fetched_at"] = time.time()
+    entry["stale"] = False
+    return int(entry["version"])
+
+
+def invalidate_sheet_snapshot(
+    sheet_id: str,
+    worksheet_name: Optional[str] = None,
+    *,
+    row_indexes: Optional[Sequence[int]] = None,
+    full_resync: bool = False,
+) -> None:
+    """
+    Marca como vencido el snapshot para que la siguiente lectura vaya a Sheets.
+
+    ``row_indexes`` registra las filas escritas para que la sincronización incremental
+    las vuelva a leer; ``full_resync`` obliga a una lectura completa (p. ej. tras
+    eliminar filas o en una recarga manual).
+    """
+    store = _get_sheet_snapshot_store()
+    with store["lock"]:
+        for (entry_sheet_id, entry_worksheet), entry in store["entries"].items():
+            if entry_sheet_id != str(sheet_id):
                 continue
+            if worksheet_name is not None and entry_worksheet != str(worksheet_name):
+                continue
+            entry["stale"] = True
+            sync_state = entry["sync_state"]
+            if full_resync:
+                sync_state["force_full"] = True
+            if row_indexes:
+                sync_state["dirty_rows"].update(int(idx) for idx in row_indexes if int(idx) > 1)
 
-            st.error(
-                "❌ No se pudo conectar con Google Sheets después de varios intentos. "
-                "Verifica tu conectividad o tus credenciales de servicio."
-            )
-            raise
 
+def _invalidate_worksheet_snapshot(
+    worksheet: Any,
+    row_indexes: Optional[Sequence[int]] = None,
+    *,
+    full_resync: bool = False,
+) -> None:
+    """Invalida el snapshot de la worksheet recibida tras una escritura."""
+    spreadsheet_id = getattr(getattr(worksheet, "spreadsheet", None), "id", None) or GOOGLE_SHEET_ID
+    worksheet_name = _get_worksheet_name_safe(worksheet)
+    if worksheet_name:
+        invalidate_sheet_snapshot(
+            spreadsheet_id,
+            worksheet_name,
+            row_indexes=row_indexes,
+            full_resync=full_resync,
+        )
 
-def process_sheet_data(all_data: list[list[str]]) -> tuple[pd.DataFrame, list[str]]:
+
+def apply_sheet_snapshot_cells(
+    sheet_id: str,
+    worksheet_name: str,
+    cells: dict[int, dict[int, Any]],
+) -> int:
     """
-    Convierte los datos en crudo de Google Sheets en un DataFrame procesado.
+    Refleja en el snapshot celdas ya escritas en Sheets (``{fila: {columna: valor}}``).
+
+    Avanza la versión sin releer la hoja, así las sesiones toman el cambio en su
+    siguiente rerun sin limpiar cachés.
     """
-    if not all_data:
-        return pd.DataFrame(), []
+    entry = _get_sheet_snapshot_entry(sheet_id, worksheet_name)
+    with entry["lock"]:
+        values = entry["values"]
+        if not values:
+            return int(entry["version"])
+        updated = list(values)
+        for row_idx, row_cells in cells.items():
+            pos = int(row_idx) - 1
+            if pos < 1 or pos >= len(updated):
+                continue
+            row = list(updated[pos])
+            for col_idx, value in row_cells.items():
+                if int(col_idx) > len(row):
+                    row.extend([""] * (int(col_idx) - len(row)))
+                row[int(col_idx) - 1] = str(value)
+            updated[pos] = row
+        if updated != values:
+            # Lista nueva: el DataFrame incremental compara contra la anterior.
+            entry["values"] = updated
+            entry["version"] = int(entry["version"]) + 1
+        return int(entry["version"])
 
-    headers = all_data[0]
-    data_rows = all_data[1:]
-    df = pd.DataFrame(data_rows, columns=headers)
-    df['_gsheet_row_index'] = df.index + 2
 
-    expected_columns = [
-        'ID_Pedido', 'Folio_Factura', 'Hora_Registro', 'Vendedor_Registro', 'Cliente',
-        'Tipo_Envio', 'Fecha_Entrega', 'Comentario', 'Modificacion_Surtido',
-        'Adjuntos', 'Adjuntos_Surtido', 'Adjuntos_Guia',
-        'Estado', 'Estado_Pago', 'Fecha_Completado', 'Hora_Proceso', 'Turno',
-        'Estado_Entrega', 'Direccion_Guia_Retorno',
-        'Fecha_Pago_Comprobante', 'Forma_Pago_Comprobante', 'Monto_Comprobante',
-        'Banco_Destino_Pago', 'Terminal'
-    ]
+def get_sheet_snapshot_version(sheet_id: str, worksheet_name: str) -> int:
+    """Versión del último snapshot leído para la worksheet (0 si aún no hay lectura)."""
+    return int(_get_sheet_snapshot_entry(sheet_id, worksheet_name)["version"])
 
 
+def _snapshot_version_of(df: pd.DataFrame) -> int:
+    """Versión de snapshot con la que se construyó un DataFrame de pedidos/casos."""
+    return int(getattr(df, "attrs", {}).get("snapshot_version", 0) or 0)
 
-    for col in expected_columns:
-        if col not in df.columns:
-            df[col] = ''
 
-    df['Comentario'] = df['Comentario'].apply(normalize_sheet_text)
+# --- Sincronización incremental (delta) de las hojas de pedidos ---
+DELTA_SYNC_WORKSHEETS = {GOOGLE_SHEET_WORKSHEET_NAME, GOOGLE_SHEET_HISTORICAL_WORKSHEET_NAME}
+DELTA_SYNC_FULL_RESYNC_SECONDS = 900
+DELTA_SYNC_BLOCK_ROWS = 200
+DELTA_SYNC_MAX_RANGES = 60
+DELTA_SYNC_HOT_DAYS = 2
+DELTA_SYNC_COLD_ESTADOS = {ESTADO_COMPLETADO, "🟣 Cancelado", "✅ Viajó"}
+SHEETS_VALUES_BATCH_GET_URL = "https://sheets.googleapis.com/v4/spreadsheets/{}/values:batchGet"
+SHEETS_VALUES_BATCH_UPDATE_URL = "https://sheets.googleapis.com/v4/spreadsheets/{}/values:batchUpdate"
+
+
+def _sheet_a1_range(worksheet_name: str, a1_range: str) -> str:
+    safe_name = str(worksheet_name).replace("'", "''")
+    return f"'{safe_name}'!{a1_range}"
+
+
+def _values_batch_get(
+    spreadsheet: Any,
+    ranges: list[str],
+    *,
+    acquire_quota: bool = True,
+) -> list[list[list[str]]]:
+    """
+    Lee varios rangos A1 en una sola llamada ``values:batchGet``.
+
+    Con ``acquire_quota`` toma cuota de lectura interactiva; si no la hay a tiempo
+    lanza ``SheetsQuotaUnavailable`` sin llamar a la API.
+    """
+    if not ranges:
+        return []
+    if acquire_quota and not acquire_sheets_quota("read", "interactive_read"):
+        raise SheetsQuotaUnavailable("Sin cuota de lectura de Google Sheets")
+    if hasattr(spreadsheet, "values_batch_get"):
+        response = spreadsheet.values_batch_get(ranges)
+    else:
+        # gspread 3.1.0 no expone batchGet; se usa la sesión autorizada del cliente.
+        response = spreadsheet.client.request(
+            "get",
+            SHEETS_VALUES_BATCH_GET_URL.format(spreadsheet.id),
+            params={"ranges": list(ranges), "majorDimension": "ROWS"},
+        ).json()
+    value_ranges = response.get("valueRanges", []) if isinstance(response, dict) else []
+    return [list(item.get("values", []) or []) for item in value_ranges]
+
+
+def _delta_sync_hot_rows(previous_values: list[list[str]]) -> set[int]:
+    """
+    Filas (1-based) de los bloques que aún pueden cambiar.
+
+    Un bloque es "frío" solo si todas sus filas están en un estado final con
+    ``Fecha_Completado`` de hace más de ``DELTA_SYNC_HOT_DAYS`` días.
+    """
+    headers = previous_values[0]
+    data_rows = previous_values[1:]
+    total = len(data_rows)
+    if not total:
+        return set()
+    if "Estado" not in headers or "Fecha_Completado" not in headers:
+        return set(range(2, total + 2))
+
+    estado_idx = headers.index("Estado")
+    fecha_idx = headers.index("Fecha_Completado")
+    estados = pd.Series([row[estado_idx] if estado_idx < len(row) else "" for row in data_rows])
+    fechas = pd.to_datetime(
+        pd.Series([row[fecha_idx] if fecha_idx < len(row) else "" for row in data_rows]),
+        errors="coerce",
+    )
+    cutoff = pd.Timestamp(mx_now().replace(tzinfo=None) - timedelta(days=DELTA_SYNC_HOT_DAYS))
+    cold = estados.astype(str).str.strip().isin(DELTA_SYNC_COLD_ESTADOS) & fechas.notna() & (fechas < cutoff)
+
+    hot_rows: set[int] = set()
+    cold_flags = cold.to_numpy()
+    for start in range(0, total, DELTA_SYNC_BLOCK_ROWS):
+        end = min(start + DELTA_SYNC_BLOCK_ROWS, total)
+        if not cold_flags[start:end].all():
+            hot_rows.update(range(start + 2, end + 2))
+    return hot_rows
+
+
+def _delta_sync_sheet_values(
+    gspread_client: Any,
+    sheet_id: str,
+    worksheet_name: str,
+    previous_values: Optional[list[list[str]]],
+    sync_state: dict[str, Any],
+    companion_ranges: Sequence[str] = (),
+    companion_results: Optional[list[list[list[str]]]] = None,
+) -> Optional[list[list[str]]]:
+    """
+    Actualiza el snapshot leyendo solo los rangos que pueden haber cambiado.
+
+    1. Se sondean la fila de encabezados y las columnas ``ID_Pedido`` y ``Estado``
+       para conocer el número de filas, confirmar que ninguna fila se movió o
+       eliminó y detectar filas frías cuyo estado cambió (p. ej. un pedido
+       completado que se reabre). El sondeo se hace siempre: el ``modifiedTime``
+       de Drive puede tardar en reflejar una edición.
+    2. Se leen en un solo ``batchGet`` los bloques "calientes", las filas con
+       otro ``Estado``, las escritas localmente y las nuevas al final, y se
+       parchean sobre el snapshot.
+
+    Los ``companion_ranges`` viajan en el mismo sondeo y sus valores se agregan a
+    ``companion_results``. Devuelve ``None`` cuando se requiere una lectura completa.
+    """
+    if not previous_values or sync_state.get("force_full"):
+        return None
+    if time.time() - float(sync_state.get("full_at", 0) or 0) > DELTA_SYNC_FULL_RESYNC_SECONDS:
+        return None
+
+    headers = list(previous_values[0])
+    if "ID_Pedido" not in headers:
+        return None
+    width = len(headers)
+    id_idx = headers.index("ID_Pedido")
+    estado_idx = headers.index("Estado") if "Estado" in headers else None
+
+    dirty_rows = set(sync_state.get("dirty_rows", set()))
+    spreadsheet = gspread_client.open_by_key(sheet_id)
+    probe_ranges = [_sheet_a1_range(worksheet_name, "1:1")]
+    for col_idx in (id_idx, estado_idx):
+        if col_idx is not None:
+            col_letter = gspread.utils.rowcol_to_a1(1, col_idx + 1)[:-1]
+            probe_ranges.append(_sheet_a1_range(worksheet_name, f"{col_letter}:{col_letter}"))
+    probe = _values_batch_get(spreadsheet, [*probe_ranges, *companion_ranges])
+    if len(probe) != len(probe_ranges) + len(companion_ranges):
+        return None
+    if companion_results is not None:
+        companion_results.extend(probe[len(probe_ranges):])
+    live_headers = list(probe[0][0]) if probe[0] else []
+    if len(live_headers) > width or live_headers + [""] * (width - len(live_headers)) != headers:
+        return None
+
+    live_ids = [str(row[0]).strip() if row else "" for row in probe[1][1:]]
+    previous_ids = [str(row[id_idx]).strip() if id_idx < len(row) else "" for row in previous_values[1:]]
+    if len(live_ids) < len(previous_ids) or live_ids[:len(previous_ids)] != previous_ids:
+        return None
+
+    previous_total = len(previous_values)
+    live_total = len(live_ids) + 1
+    rows_to_fetch = _delta_sync_hot_rows(previous_values)
+    if estado_idx is not None:
+        # Una fila fría cuyo Estado cambió vuelve a estar caliente: se relee completa.
+        live_estados = [str(row[0]).strip() if row else "" for row in probe[2][1:]]
+        for offset, row in enumerate(previous_values[1:]):
+            previous_estado = str(row[estado_idx]).strip() if estado_idx < len(row) else ""
+            live_estado = live_estados[offset] if offset < len(live_estados) else ""
+            if live_estado != previous_estado:
+                rows_to_fetch.add(offset + 2)
+    rows_to_fetch.update(row for row in dirty_rows if 1 < row <= live_total)
+    rows_to_fetch.update(range(previous_total + 1, live_total + 1))
+    ranges = _compress_row_indexes(sorted(rows_to_fetch))
+    if len(ranges) > DELTA_SYNC_MAX_RANGES:
+        return None
+
+    last_col_letter = gspread.utils.rowcol_to_a1(1, width)[:-1]
+    fetched_blocks = _values_batch_get(
+        spreadsheet,
+        [_sheet_a1_range(worksheet_name, f"A{start}:{last_col_letter}{end}") for start, end in ranges],
+    )
+    if len(fetched_blocks) != len(ranges):
+        return None
+
+    values = list(previous_values)
+    values.extend([[""] * width for _ in range(live_total - previous_total)])
+    for (start, end), block in zip(ranges, fetched_blocks):
+        for offset, row_number in enumerate(range(start, end + 1)):
+            row = [str(v) for v in block[offset]] if offset < len(block) else []
+            if len(row) > width:
+                return None
+            values[row_number - 1] = row + [""] * (width - len(row))
+
+    while len(values) > 1 and not any(str(v).strip() for v in values[-1]):
+        values.pop()
+
+    sync_state["dirty_rows"].difference_update(dirty_rows)
+    return values
+
+
+def _sync_sheet_values(
+    gspread_client: Any,
+    sheet_id: str,
+    worksheet_name: str,
+    previous_values: Optional[list[list[str]]],
+    sync_state: dict[str, Any],
+) -> list[list[str]]:
+    """
+    Lectura del snapshot: incremental para hojas de pedidos, completa como respaldo.
+
+    Las worksheets compañeras del arranque que también necesitan lectura viajan en
+    el mismo ``batchGet`` y quedan sembradas en sus snapshots.
+    """
+    companions = _claim_startup_companions(sheet_id, worksheet_name)
+    companion_ranges = [_sheet_whole_range(name) for name, _ in companions]
+    companion_results: list[list[list[str]]] = []
+    try:
+        if worksheet_name in DELTA_SYNC_WORKSHEETS:
+            try:
+                values = _delta_sync_sheet_values(
+                    gspread_client,
+                    sheet_id,
+                    worksheet_name,
+                    previous_values,
+                    sync_state,
+                    companion_ranges,
+                    companion_results,
+                )
+            except (gspread.exceptions.APIError, SheetsQuotaUnavailable):
+                raise
+            except Exception:
+                values = None
+            if values is not None:
+                return values
+
+        pending_dirty_rows = set(sync_state.get("dirty_rows", set()))
+        if companion_results:
+            # El sondeo delta ya trajo las compañeras; solo falta la hoja propia.
+            companion_ranges = []
+        batches = _values_batch_get(
+            gspread_client.open_by_key(sheet_id),
+            [_sheet_whole_range(worksheet_name), *companion_ranges],
+        )
+        values = _rectangular_sheet_values(batches[0]) if batches else []
+        if companion_ranges:
+            companion_results = batches[1:]
+        sync_state["full_at"] = time.time()
+        sync_state["force_full"] = False
+        sync_state["dirty_rows"].difference_update(pending_dirty_rows)
+        return values
+    finally:
+        for (_, entry), rows in zip(companions, companion_results):
+            _store_sheet_snapshot_values(entry, _rectangular_sheet_values(rows))
+        for _, entry in companions:
+            entry["lock"].release()
+
+
+# --- Lectura agrupada del arranque ---
+# Tras la hoja principal el arranque carga casos_especiales y, en los flujos de
+# ruta, Clientes_Locales. Si sus snapshots también están vencidos se leen en el
+# mismo ``batchGet`` que la hoja principal (1 viaje en lugar de ~4).
+STARTUP_BATCH_COMPANIONS = {
+    GOOGLE_SHEET_WORKSHEET_NAME: ("casos_especiales", "Clientes_Locales"),
+    GOOGLE_SHEET_HISTORICAL_WORKSHEET_NAME: ("casos_especiales", "Clientes_Locales"),
+}
+
+
+def _sheet_whole_range(worksheet_name: str) -> str:
+    """Rango A1 que cubre la worksheet completa (solo el nombre entre comillas)."""
+    return "'{}'".format(str(worksheet_name).replace("'", "''"))
+
+
+def _rectangular_sheet_values(rows: list[list[Any]]) -> list[list[str]]:
+    """Rellena filas cortas como ``get_all_values`` (la API omite celdas vacías finales)."""
+    width = max((len(row) for row in rows), default=0)
+    return [[str(v) for v in row] + [""] * (width - len(row)) for row in rows]
+
+
+def _claim_startup_companions(sheet_id: str, worksheet_name: str) -> list[tuple[str, dict[str, Any]]]:
+    """
+    Toma (sin bloquear) los snapshots compañeros que necesitan lectura.
+
+    Si otra sesión ya está leyendo una compañera se omite; los locks tomados se
+    liberan en ``_sync_sheet_values``.
+    """
+    claimed: list[tuple[str, dict[str, Any]]] = []
+    now = time.time()
+    for name in STARTUP_BATCH_COMPANIONS.get(worksheet_name, ()):
+        entry = _get_sheet_snapshot_entry(sheet_id, name)
+        if not entry["lock"].acquire(blocking=False):
+            continue
+        max_age = SHEET_SNAPSHOT_MAX_AGE_SECONDS.get(name, SHEET_SNAPSHOT_SHARE_SECONDS)
+        needs_fetch = (
+            entry["values"] is None
+            or entry["stale"]
+            or (now - float(entry["fetched_at"] or 0)) >= max_age
+        )
+        if needs_fetch and name not in DELTA_SYNC_WORKSHEETS:
+            claimed.append((name, entry))
+        else:
+            entry["lock"].release()
+    return claimed
+
+
+def _changed_data_positions(
+    previous_values: list[list[str]],
+    values: list[list[str]],
+) -> Optional[list[int]]:
+    """
+    Posiciones (0-based, sin encabezado) de filas distintas entre dos snapshots.
+
+    Compara por bloques de ``DELTA_SYNC_BLOCK_ROWS`` filas y solo revisa fila por fila
+    los bloques que difieren. Devuelve ``None`` si cambió el encabezado o se
+    eliminaron filas (en ese caso hay que reprocesar todo).
+    """
+    if not previous_values or not values:
+        return None
+    if previous_values[0] != values[0] or len(values) < len(previous_values):
+        return None
+
+    changed: list[int] = []
+    previous_total = len(previous_values)
+    for start in range(1, previous_total, DELTA_SYNC_BLOCK_ROWS):
+        end = min(start + DELTA_SYNC_BLOCK_ROWS, previous_total)
+        if previous_values[start:end] == values[start:end]:
+            continue
+        changed.extend(pos - 1 for pos in range(start, end) if previous_values[pos] != values[pos])
+    changed.extend(range(previous_total - 1, len(values) - 1))
+    return changed
+
+
+def _process_sheet_data_incremental(
+    sheet_id: str,
+    worksheet_name: str,
+    all_data: list[list[str]],
+) -> tuple[pd.DataFrame, list[str]]:
+    """
+    Igual que ``process_sheet_data`` pero reutiliza el DataFrame del snapshot previo.
+
+    Solo se reprocesan las filas que cambiaron o se agregaron; como la posición de
+    cada fila no cambia entre snapshots, ``_gsheet_row_index`` permanece estable.
+    """
+    entry = _get_sheet_snapshot_entry(sheet_id, worksheet_name)
+    with entry["frame_lock"]:
+        cached = entry.get("frame")
+        df = None
+        headers = list(all_data[0]) if all_data else []
+        if cached is not None:
+            changed = _changed_data_positions(cached["values"], all_data)
+            if changed is not None and not changed:
+                df = cached["df"]
+            elif changed is not None:
+                partial, _ = process_sheet_data([all_data[0]] + [all_data[pos + 1] for pos in changed])
+                partial.index = pd.Index(changed)
+                partial["_gsheet_row_index"] = partial.index + 2
+                base = cached["df"].drop(index=[pos for pos in changed if pos in cached["df"].index])
+                df = pd.concat([base, partial]).sort_index()
+        if df is None:
+            df, headers = process_sheet_data(all_data)
+        entry["frame"] = {"values": all_data, "df": df}
+    return df.copy(), headers
+
+
+# --- Data Loading from Google Sheets (Cached) ---
+def _read_sheet_snapshot(
+    sheet_id: str,
+    worksheet_name: str,
+    client: Optional[gspread.client.Client] = None,
+) -> tuple[list[list[str]], int]:
+    """Lee la worksheet a través del snapshot compartido, con reintentos; si está vigente no llama a Sheets."""
+    gspread_client = client or g_spread_client
+    if gspread_client is None:
+        raise ValueError("No se proporcionó un cliente de gspread para obtener los datos.")
+    max_attempts = 3
+    base_delay = 1
+    for attempt in range(max_attempts):
+        wait_seconds = base_delay * (2 ** attempt)
+        try:
+            return get_shared_sheet_snapshot(
+                sheet_id,
+                worksheet_name,
+                lambda previous_values, sync_state: _sync_sheet_values(
+                    gspread_client, sheet_id, worksheet_name, previous_values, sync_state
+                ),
+                incremental=True,
+            )
+        except gspread.exceptions.APIError as api_error:
+            # ℹ️ Solo limpiamos la caché de esta función para no reiniciar otros estados de la app.
+            get_raw_sheet_data.clear()
+            if _is_rate_limit_error(api_error):
+                report_sheets_quota_exhausted("read")
+            if _is_recoverable_auth_error(api_error) and attempt < max_attempts - 1:
+                st.warning(
+                    f"🔁 Error de autenticación con Google Sheets (intento {attempt + 1}/{max_attempts}). "
+                    f"Reintentando en {wait_seconds}s..."
+                )
+                time.sleep(wait_seconds)
+                continue
+
+            if attempt < max_attempts - 1:
+                st.warning(
+                    f"⚠️ Error de la API de Google Sheets (intento {attempt + 1}/{max_attempts}). "
+                    f"Reintentando en {wait_seconds}s..."
+                )
+                time.sleep(wait_seconds)
+                continue
+
+            if _is_recoverable_auth_error(api_error):
+                handle_auth_error(api_error)
+            else:
+                st.error(f"❌ Error de la API de Google Sheets: {api_error}")
+            raise
+        except RequestException as net_err:
+            get_raw_sheet_data.clear()
+            if attempt < max_attempts - 1:
+                st.warning(
+                    f"⚠️ Error de red al conectar con Google Sheets (intento {attempt + 1}/{max_attempts}). "
+                    f"Reintentando en {wait_seconds}s..."
+                )
+                time.sleep(wait_seconds)
+                continue
+
+            handle_auth_error(net_err)
+            raise
+        except Exception as e:
+            get_raw_sheet_data.clear()  # 🔁 Limpiar solo la caché de esta función en caso de error de token/API
+            if attempt < max_attempts - 1:
+                st.warning(
+                    f"⚠️ Error inesperado al conectar con Google Sheets (intento {attempt + 1}/{max_attempts}). "
+                    f"Reintentando en {wait_seconds}s..."
+                )
+                time.sleep(wait_seconds)
+                continue
+
+            st.error(
+                "❌ No se pudo conectar con Google Sheets después de varios intentos. "
+                "Verifica tu conectividad o tus credenciales de servicio."
+            )
+            raise
+
+
+def current_sheet_snapshot_version(
+    sheet_id: str,
+    worksheet_name: str,
+    client: Optional[gspread.client.Client] = None,
+) -> int:
+    """
+    Versión vigente del snapshot, para usarla como clave de las cachés de datos.
+
+    Pasa primero por ``get_shared_sheet_snapshot`` (sin llamar a Sheets mientras
+    siga vigente), así la antigüedad de los datos la decide
+    ``SHEET_SNAPSHOT_SHARE_SECONDS`` y no el TTL de ``st.cache_data``. Si Sheets
+    falla y ya hay una lectura previa, se usa su versión.
+    """
+    try:
+        _, version = _read_sheet_snapshot(sheet_id, worksheet_name, client)
+    except Exception:
+        if get_sheet_snapshot_version(sheet_id, worksheet_name) == 0:
+            raise
+        return get_sheet_snapshot_version(sheet_id, worksheet_name)
+    return version
+
+
+@st.cache_data(ttl=300, hash_funcs={gspread.client.Client: lambda _: None})
+def get_raw_sheet_data(
+    sheet_id: str,
+    worksheet_name: str,
+    client: Optional[gspread.client.Client] = None,
+    snapshot_version: int = 0,
+) -> tuple[list[list[str]], int]:
+    # ``snapshot_version`` solo forma parte de la clave de caché; quien llama la
+    # obtiene de ``current_sheet_snapshot_version``, así que el TTL solo libera memoria.
+    return _read_sheet_snapshot(sheet_id, worksheet_name, client)
+
+
+def process_sheet_data(all_data: list[list[str]]) -> tuple[pd.DataFrame, list[str]]:
+    """
+    Convierte los datos en crudo de Google Sheets en un DataFrame procesado.
+    """
+    if not all_data:
+        return pd.DataFrame(), []
+
+    headers = all_data[0]
+    data_rows = all_data[1:]
+    df = pd.DataFrame(data_rows, columns=headers)
+    df['_gsheet_row_index'] = df.index + 2
+
+    expected_columns = [
+        'ID_Pedido', 'Folio_Factura', 'Hora_Registro', 'Vendedor_Registro', 'Cliente',
+        'Tipo_Envio', 'Fecha_Entrega', 'Comentario', 'Modificacion_Surtido',
+        'Adjuntos', 'Adjuntos_Surtido', 'Adjuntos_Guia',
+        'Estado', 'Estado_Pago', 'Fecha_Completado', 'Hora_Proceso', 'Turno',
+        'Estado_Entrega', 'Direccion_Guia_Retorno',
+        'Fecha_Pago_Comprobante', 'Forma_Pago_Comprobante', 'Monto_Comprobante',
+        'Banco_Destino_Pago', 'Terminal'
+    ]
+
+
+
+    for col in expected_columns:
+        if col not in df.columns:
+            df[col] = ''
+
+    df['Comentario'] = df['Comentario'].apply(normalize_sheet_text)
     if 'Direccion_Guia_Retorno' in df.columns:
         df['Direccion_Guia_Retorno'] = df['Direccion_Guia_Retorno'].apply(
             normalize_sheet_text
@@ -3692,9 +4934,16 @@ def get_filtered_sheet_dataframe(
     client: Optional[gspread.client.Client] = None,
     *,
     light_mode: bool = False,
+    snapshot_version: int = 0,
 ) -> tuple[pd.DataFrame, list[str]]:
-    raw = get_raw_sheet_data(sheet_id=sheet_id, worksheet_name=worksheet_name, client=client)
-    df, headers = process_sheet_data(raw)
+    raw, snapshot_version = get_raw_sheet_data(
+        sheet_id=sheet_id,
+        worksheet_name=worksheet_name,
+        client=client,
+        snapshot_version=snapshot_version,
+    )
+    df, headers = _process_sheet_data_incremental(sheet_id, worksheet_name, raw)
+    df.attrs["snapshot_version"] = snapshot_version
     if light_mode:
         df = _filter_relevant_pedidos(df, headers, worksheet_name)
     return df, headers
@@ -3847,6 +5096,82 @@ def _get_live_headers_preserving_positions(worksheet, fallback_headers=None):
         return list(fallback_headers or [])
 
 
+# --- Registro de encabezados por worksheet ---
+# La fila 1 se lee una vez por (spreadsheet, worksheet) y se comparte entre sesiones.
+# Se valida contra la huella de la fila 1 del snapshot compartido (sin lecturas
+# extra) y se invalida cuando ``ensure_columns`` agrega columnas o una escritura falla.
+HEADER_REGISTRY_MAX_AGE_SECONDS = 600
+
+
+@st.cache_resource
+def _get_header_registry() -> dict[str, Any]:
+    """Encabezados vigentes por ``(spreadsheet_id, worksheet)`` compartidos por el proceso."""
+    return {"lock": threading.Lock(), "entries": {}}
+
+
+def _headers_fingerprint(headers: Sequence[Any]) -> str:
+    """Huella de la fila 1 ignorando los vacíos del final (relleno de ``get_all_values``)."""
+    trimmed = [str(h or "").strip() for h in headers]
+    while trimmed and not trimmed[-1]:
+        trimmed.pop()
+    return hashlib.sha1("\x1f".join(trimmed).encode("utf-8")).hexdigest()
+
+
+def _header_registry_key(worksheet: Any) -> tuple[str, str]:
+    spreadsheet_id = str(getattr(getattr(worksheet, "spreadsheet", None), "id", "") or "")
+    return spreadsheet_id, _get_worksheet_name_safe(worksheet)
+
+
+def get_registered_headers(worksheet: Any, fallback_headers=None) -> list[str]:
+    """
+    Fila 1 de la worksheet (conservando posiciones) desde el registro compartido.
+
+    Si el snapshot de datos trae una fila 1 distinta y más reciente, se adopta sin
+    leer Sheets; solo se lee la fila 1 cuando no hay registro o ya venció.
+    """
+    spreadsheet_id, worksheet_name = _header_registry_key(worksheet)
+    registry = _get_header_registry()
+    key = (spreadsheet_id, worksheet_name)
+    now = time.time()
+    with registry["lock"]:
+        entry = registry["entries"].get(key)
+
+    snapshot = _get_sheet_snapshot_entry(spreadsheet_id, worksheet_name)
+    snapshot_values = snapshot["values"]
+    if entry and (now - float(entry["loaded_at"])) < HEADER_REGISTRY_MAX_AGE_SECONDS:
+        if not snapshot_values or not snapshot_values[0]:
+            return list(entry["headers"])
+        if _headers_fingerprint(snapshot_values[0]) == entry["fingerprint"]:
+            return list(entry["headers"])
+        if float(snapshot["fetched_at"] or 0) > float(entry["loaded_at"]):
+            headers = list(snapshot_values[0])
+            with registry["lock"]:
+                registry["entries"][key] = {
+                    "headers": headers,
+                    "fingerprint": _headers_fingerprint(headers),
+                    "loaded_at": float(snapshot["fetched_at"]),
+                }
+            return list(headers)
+
+    headers = _get_live_headers_preserving_positions(worksheet, None)
+    if not headers:
+        return list(entry["headers"]) if entry else list(fallback_headers or [])
+    with registry["lock"]:
+        registry["entries"][key] = {
+            "headers": list(headers),
+            "fingerprint": _headers_fingerprint(headers),
+            "loaded_at": time.time(),
+        }
+    return list(headers)
+
+
+def invalidate_header_registry(worksheet: Any) -> None:
+    """Olvida los encabezados registrados para que la siguiente escritura relea la fila 1."""
+    registry = _get_header_registry()
+    with registry["lock"]:
+        registry["entries"].pop(_header_registry_key(worksheet), None)
+
+
 def _find_header_col_in_row1(worksheet, header_name: str, fallback_headers=None) -> Optional[int]:
     """
     Busca un encabezado exclusivamente en la fila 1 y devuelve su índice 1-based.
@@ -3854,112 +5179,353 @@ def _find_header_col_in_row1(worksheet, header_name: str, fallback_headers=None)
     Importante: no usa ``worksheet.find`` porque en algunos escenarios puede devolver
     coincidencias fuera de la fila de encabezados o quedar afectado por rangos/valores
     no esperados. Para escrituras críticas, la única fuente válida para ubicar columnas
-    es la fila 1 leída completa, conservando posiciones.
+    es la fila 1 conservando posiciones, tomada del registro de encabezados.
     """
     target_norm = str(header_name or "").strip().lower()
     if not target_norm:
         return None
 
-    headers = _get_live_headers_preserving_positions(worksheet, fallback_headers)
+    headers = get_registered_headers(worksheet, fallback_headers)
     for idx, header in enumerate(headers, start=1):
         if str(header or "").strip().lower() == target_norm:
             return idx
     return None
 
 
-def update_gsheet_cell(worksheet, headers, row_index, col_name, value):
+# --- Cola de escrituras agrupadas (write-behind) ---
+# Las escrituras de celdas se encolan por spreadsheet; la misma celda conserva
+# solo el último valor y todo lo pendiente se envía en un único
+# ``values:batchUpdate``. Si otra sesión ya está enviando, la escritura espera y
+# viaja en el mismo lote o en el siguiente (group commit).
+SHEET_WRITE_MAX_ATTEMPTS = 3
+SHEET_WRITE_RESULTS_KEEP = 500
+
+
+@st.cache_resource
+def _get_sheet_write_queue() -> dict[str, Any]:
+    """Cola de escrituras compartida por todas las sesiones del proceso."""
+    return {"lock": threading.Lock(), "spreadsheets": {}}
+
+
+def _get_sheet_write_state(spreadsheet_id: str) -> dict[str, Any]:
+    queue = _get_sheet_write_queue()
+    with queue["lock"]:
+        state = queue["spreadsheets"].get(str(spreadsheet_id))
+        if state is None:
+            state = {
+                "flush_lock": threading.Lock(),
+                "spreadsheet": None,
+                "pending": {},
+                "pending_tickets": set(),
+                "next_ticket": 0,
+                "flushed_ticket": 0,
+                "failed_tickets": {},
+            }
+            queue["spreadsheets"][str(spreadsheet_id)] = state
+        return state
+
+
+def _sheet_json_value(value: Any) -> Any:
+    """Convierte el valor a un tipo serializable en JSON para la API de Sheets."""
+    if value is None:
+        return ""
+    if isinstance(value, (bool, int, float, str)):
+        return value
+    if hasattr(value, "item"):
+        try:
+            return value.item()
+        except Exception:
+            pass
+    return str(value)
+
+
+def _enqueue_sheet_cell_writes(writes: list[tuple[Any, list[tuple[int, int, Any]], str]]) -> tuple[str, int]:
     """
-    Actualiza una celda específica en Google Sheets.
-    row_index es el índice de fila de gspread (base 1).
-    col_name es el nombre de la columna.
-    headers es la lista de encabezados obtenida previamente.
+    Encola ``(worksheet, celdas, valueInputOption)`` de un mismo spreadsheet y
+    devuelve ``(spreadsheet_id, ticket)``.
+
+    Todo se encola bajo un solo lock con un solo ticket, así que un envío de otra
+    sesión toma las celdas de la llamada completas o ninguna.
     """
-    def _normalize_header_name(name: Any) -> str:
-        return str(name or "").strip().lower()
+    spreadsheet = writes[0][0].spreadsheet
+    spreadsheet_id = str(spreadsheet.id)
+    state = _get_sheet_write_state(spreadsheet_id)
+    queue = _get_sheet_write_queue()
+    with queue["lock"]:
+        state["next_ticket"] += 1
+        ticket = int(state["next_ticket"])
+        state["spreadsheet"] = spreadsheet
+        state["pending_tickets"].add(ticket)
+        for worksheet, cells, value_input_option in writes:
+            worksheet_title = _get_worksheet_name_safe(worksheet)
+            for row_idx, col_idx, value in cells:
+                key = (worksheet_title, int(row_idx), int(col_idx))
+                # La última escritura a la misma celda gana; se reinserta para
+                # conservar el orden de llegada dentro del lote.
+                state["pending"].pop(key, None)
+                state["pending"][key] = {
+                    "worksheet": worksheet,
+                    "value": _sheet_json_value(value),
+                    "value_input_option": value_input_option,
+                }
+    return spreadsheet_id, ticket
 
-    col_index = _find_header_col_in_row1(worksheet, col_name, headers)
 
-    if col_index is None:
-        st.error(f"❌ Error: La columna '{col_name}' no se encontró en Google Sheets para la actualización. Verifica los encabezados.")
-        return False
+def _send_sheet_values_batch_update(spreadsheet: Any, pending: dict) -> None:
+    """Envía las celdas pendientes; una llamada por ``valueInputOption`` (normalmente una)."""
+    data_by_option: dict[str, list[dict[str, Any]]] = {}
+    for (worksheet_title, row_idx, col_idx), item in pending.items():
+        data_by_option.setdefault(item["value_input_option"], []).append(
+            {
+                "range": _sheet_a1_range(worksheet_title, gspread.utils.rowcol_to_a1(row_idx, col_idx)),
+                "values": [[item["value"]]],
+            }
+        )
+    for value_input_option, data in data_by_option.items():
+        body = {"valueInputOption": value_input_option, "data": data}
+        if hasattr(spreadsheet, "values_batch_update"):
+            spreadsheet.values_batch_update(body)
+        else:
+            # gspread 3.1.0 no expone values:batchUpdate; se usa la sesión del cliente.
+            spreadsheet.client.request(
+                "post",
+                SHEETS_VALUES_BATCH_UPDATE_URL.format(spreadsheet.id),
+                json=body,
+            )
 
-    max_attempts = 3
-    base_delay = 1
 
-    for attempt in range(max_attempts):
-        wait_seconds = base_delay * (2 ** attempt)
-        try:
-            worksheet.update_cell(row_index, col_index, value)
-            worksheet_name = _get_worksheet_name_safe(worksheet)
-            if worksheet_name:
-                _record_local_sheet_update(worksheet_name, int(row_index), {col_name: value})
-            # st.cache_data.clear() # Limpiar solo si hay un cambio que justifique una recarga completa
-            return True
-        except gspread.exceptions.APIError as api_error:
-            is_recoverable = _is_recoverable_auth_error(api_error)
-            if attempt < max_attempts - 1:
+def _flush_sheet_write_queue(spreadsheet_id: str, ticket: int) -> bool:
+    """Envía las escrituras pendientes hasta ``ticket`` y devuelve si ese ticket quedó escrito."""
+    state = _get_sheet_write_state(spreadsheet_id)
+    queue = _get_sheet_write_queue()
+    with state["flush_lock"]:
+        with queue["lock"]:
+            if int(state["flushed_ticket"]) >= int(ticket):
+                return state["failed_tickets"].pop(int(ticket), None) is None
+            pending = state["pending"]
+            pending_tickets = state["pending_tickets"]
+            state["pending"] = {}
+            state["pending_tickets"] = set()
+            spreadsheet = state["spreadsheet"]
+            last_ticket = int(state["next_ticket"])
+
+        ok = False
+        base_delay = 1
+        for attempt in range(SHEET_WRITE_MAX_ATTEMPTS):
+            wait_seconds = base_delay * (2 ** attempt)
+            if not acquire_sheets_quota("write", "interactive_write"):
+                # La cola del gobernador ya esperó su máximo: no se envía y el lote
+                # queda como fallido para que la acción se reintente, sin dormir más aquí.
+                st.warning(
+                    "⏳ Google Sheets está al límite de escrituras en este momento. "
+                    "El cambio no se envió; inténtalo de nuevo en unos segundos."
+                )
+                break
+            try:
+                _send_sheet_values_batch_update(spreadsheet, pending)
+                ok = True
+                break
+            except gspread.exceptions.APIError as api_error:
+                is_recoverable = _is_recoverable_auth_error(api_error)
+                rate_limited = _is_rate_limit_error(api_error)
+                if rate_limited:
+                    report_sheets_quota_exhausted("write")
+                if attempt < SHEET_WRITE_MAX_ATTEMPTS - 1:
+                    if rate_limited:
+                        # Tras un 429 la espera del relleno la hace ``acquire_sheets_quota``.
+                        continue
+                    if is_recoverable:
+                        st.warning(
+                            f"🔁 Error de autenticación/cuota al actualizar Google Sheets "
+                            f"(intento {attempt + 1}/{SHEET_WRITE_MAX_ATTEMPTS}). Reintentando en {wait_seconds}s..."
+                        )
+                    else:
+                        st.warning(
+                            f"⚠️ Error de la API de Google Sheets al actualizar celdas "
+                            f"(intento {attempt + 1}/{SHEET_WRITE_MAX_ATTEMPTS}). Reintentando en {wait_seconds}s..."
+                        )
+                    time.sleep(wait_seconds)
+                    continue
+
                 if is_recoverable:
-                    st.warning(
-                        f"🔁 Error de autenticación/cuota al actualizar Google Sheets "
-                        f"(intento {attempt + 1}/{max_attempts}). Reintentando en {wait_seconds}s..."
+                    st.error(
+                        "❌ No se pudo completar la actualización en Google Sheets por un error de autenticación/cuota "
+                        "después de varios intentos."
                     )
+                    handle_auth_error(api_error)
                 else:
+                    st.error(f"❌ Error definitivo de la API de Google Sheets: {api_error}")
+                break
+            except RequestException as net_err:
+                if attempt < SHEET_WRITE_MAX_ATTEMPTS - 1:
                     st.warning(
-                        f"⚠️ Error de la API de Google Sheets al actualizar celdas "
-                        f"(intento {attempt + 1}/{max_attempts}). Reintentando en {wait_seconds}s..."
+                        f"⚠️ Error de red al actualizar Google Sheets (intento {attempt + 1}/{SHEET_WRITE_MAX_ATTEMPTS}). "
+                        f"Reintentando en {wait_seconds}s..."
                     )
-                time.sleep(wait_seconds)
-                continue
+                    time.sleep(wait_seconds)
+                    continue
 
-            if is_recoverable:
                 st.error(
-                    "❌ No se pudo completar la actualización en Google Sheets por un error de autenticación/cuota "
-                    "después de varios intentos."
-                )
-                handle_auth_error(api_error)
-            else:
-                st.error(f"❌ Error definitivo de la API de Google Sheets: {api_error}")
-            break
-        except RequestException as net_err:
-            if attempt < max_attempts - 1:
-                st.warning(
-                    f"⚠️ Error de red al actualizar Google Sheets (intento {attempt + 1}/{max_attempts}). "
-                    f"Reintentando en {wait_seconds}s..."
+                    "❌ No se pudo conectar con Google Sheets para actualizar los datos después de varios intentos. "
+                    "Verifica tu conexión o credenciales."
                 )
-                time.sleep(wait_seconds)
-                continue
+                handle_auth_error(net_err)
+                break
+            except Exception as exc:
+                if attempt < SHEET_WRITE_MAX_ATTEMPTS - 1:
+                    st.warning(
+                        f"⚠️ Error inesperado al actualizar Google Sheets (intento {attempt + 1}/{SHEET_WRITE_MAX_ATTEMPTS}). "
+                        f"Reintentando en {wait_seconds}s..."
+                    )
+                    time.sleep(wait_seconds)
+                    continue
+
+                st.error(f"❌ Error inesperado al actualizar Google Sheets: {exc}")
+                break
+
+        rows_by_worksheet: dict[str, tuple[Any, set[int]]] = {}
+        for (worksheet_title, row_idx, _), item in pending.items():
+            rows_by_worksheet.setdefault(worksheet_title, (item["worksheet"], set()))[1].add(row_idx)
+        for worksheet, row_indexes in rows_by_worksheet.values():
+            _invalidate_worksheet_snapshot(worksheet, sorted(row_indexes))
+            if not ok:
+                # Una escritura rechazada puede deberse a columnas movidas: releer la fila 1.
+                invalidate_header_registry(worksheet)
+
+        with queue["lock"]:
+            state["flushed_ticket"] = max(int(state["flushed_ticket"]), last_ticket)
+            if not ok:
+                for pending_ticket in sorted(pending_tickets):
+                    state["failed_tickets"][int(pending_ticket)] = True
+                failed_tickets = state["failed_tickets"]
+                while len(failed_tickets) > SHEET_WRITE_RESULTS_KEEP:
+                    failed_tickets.pop(next(iter(failed_tickets)))
+            written = state["failed_tickets"].pop(int(ticket), None) is None
+
+    filas_historico = [
+        row_idx
+        for worksheet_title, row_idx, _ in pending
+        if worksheet_title == GOOGLE_SHEET_HISTORICAL_WORKSHEET_NAME
+    ]
+    if ok and filas_historico and spreadsheet_id == GOOGLE_SHEET_ID:
+        # Las filas ya archivadas también viven en el Parquet: se reexportan para no leer datos viejos.
+        try:
+            _refresh_historico_parquet_from_sheet(spreadsheet, filas_historico)
+        except Exception as exc:
+            st.warning(
+                f"⚠️ No se pudo actualizar el histórico columnar (Parquet): {exc}. "
+                "Usa «Regenerar histórico columnar» para corregirlo."
+            )
+    return written
+
+
+@contextmanager
+def coalesced_sheet_writes():
+    """Agrupa las escrituras de celdas del bloque y las envía juntas al salir.
+
+    Dentro del bloque ``update_gsheet_cell`` y ``batch_update_gsheet_cells`` solo
+    guardan las celdas en el búfer del bloque y devuelven ``True``; el resultado
+    real queda en ``resultado["ok"]`` después del ``with``. Las celdas pasan a la
+    cola compartida hasta salir del bloque más externo, así que el envío de otra
+    sesión nunca se lleva solo una parte. Los bloques anidados se envían con el
+    más externo.
+    """
+    scopes = st.session_state.setdefault("_sheet_write_scopes", [])
+    scope = {"ok": True, "writes": {}, "local_updates": []}
+    scopes.append(scope)
+    try:
+        yield scope
+    finally:
+        scopes.pop()
+        if scopes:
+            parent = scopes[-1]
+            for spreadsheet_id, writes in scope["writes"].items():
+                parent["writes"].setdefault(spreadsheet_id, []).extend(writes)
+            parent["local_updates"].extend(scope["local_updates"])
+        else:
+            for spreadsheet_id, writes in scope["writes"].items():
+                _, ticket = _enqueue_sheet_cell_writes(writes)
+                if not _flush_sheet_write_queue(spreadsheet_id, ticket):
+                    scope["ok"] = False
+            if scope["ok"]:
+                for worksheet_name, row_idx, values in scope["local_updates"]:
+                    _record_local_sheet_update(worksheet_name, row_idx, values)
+
+
+def _write_sheet_cells(
+    worksheet: Any,
+    cells: list[tuple[int, int, Any]],
+    *,
+    value_input_option: str,
+    local_updates: Optional[dict[int, dict[str, Any]]] = None,
+) -> bool:
+    """Encola celdas y las envía (o las guarda en el búfer de un ``coalesced_sheet_writes`` activo)."""
+    write = (worksheet, list(cells), value_input_option)
+    worksheet_name = _get_worksheet_name_safe(worksheet)
+    scopes = st.session_state.get("_sheet_write_scopes") or []
+    if scopes:
+        scope = scopes[-1]
+        scope["writes"].setdefault(str(worksheet.spreadsheet.id), []).append(write)
+        if worksheet_name:
+            for row_idx, values in (local_updates or {}).items():
+                if values:
+                    scope["local_updates"].append((worksheet_name, int(row_idx), values))
+        return True
+
+    spreadsheet_id, ticket = _enqueue_sheet_cell_writes([write])
+    if not _flush_sheet_write_queue(spreadsheet_id, ticket):
+        return False
+    if worksheet_name:
+        for row_idx, values in (local_updates or {}).items():
+            if values:
+                _record_local_sheet_update(worksheet_name, int(row_idx), values)
+    return True
 
-            st.error(
-                "❌ No se pudo conectar con Google Sheets para actualizar los datos después de varios intentos. "
-                "Verifica tu conexión o credenciales."
-            )
-            handle_auth_error(net_err)
-            break
-        except Exception as exc:
-            if attempt < max_attempts - 1:
-                st.warning(
-                    f"⚠️ Error inesperado al actualizar Google Sheets (intento {attempt + 1}/{max_attempts}). "
-                    f"Reintentando en {wait_seconds}s..."
-                )
-                time.sleep(wait_seconds)
-                continue
 
-            st.error(f"❌ Error inesperado al actualizar Google Sheets: {exc}")
-            break
+def update_gsheet_cell(worksheet, headers, row_index, col_name, value):
+    """
+    Actualiza una celda específica en Google Sheets.
+    row_index es el índice de fila de gspread (base 1).
+    col_name es el nombre de la columna.
+    headers es la lista de encabezados obtenida previamente.
+    La escritura pasa por la cola agrupada (ver ``coalesced_sheet_writes``).
+    """
+    col_index = _find_header_col_in_row1(worksheet, col_name, headers)
+
+    if col_index is None:
+        st.error(f"❌ Error: La columna '{col_name}' no se encontró en Google Sheets para la actualización. Verifica los encabezados.")
+        return False
+
+    return _write_sheet_cells(
+        worksheet,
+        [(int(row_index), int(col_index), value)],
+        value_input_option="USER_ENTERED",
+        local_updates={int(row_index): {col_name: value}},
+    )
 
-    return False
-    
 def cargar_pedidos_desde_google_sheet(sheet_id, worksheet_name):
     """
     Carga los datos de una hoja de Google Sheets y devuelve un DataFrame y los encabezados.
+    Lee del snapshot compartido (que puede venir sembrado por la lectura agrupada del
+    arranque) y reproduce la conversión numérica de ``get_all_records``.
     """
     try:
         client = get_gspread_client(_credentials_json_dict=GSHEETS_CREDENTIALS)
-        worksheet = client.open_by_key(sheet_id).worksheet(worksheet_name)
-        headers = worksheet.row_values(1)
+
+        def _fetch_values() -> list[list[str]]:
+            batches = _values_batch_get(client.open_by_key(sheet_id), [_sheet_whole_range(worksheet_name)])
+            return _rectangular_sheet_values(batches[0]) if batches else []
+
+        values, _ = get_shared_sheet_snapshot(sheet_id, worksheet_name, _fetch_values)
+        headers = list(values[0]) if values else []
+        # ``row_values(1)`` no incluía los encabezados vacíos del final.
+        while headers and not str(headers[-1]).strip():
+            headers.pop()
 
         if headers:
-            df = pd.DataFrame(worksheet.get_all_records())
+            keys = values[0]
+            records = [dict(zip(keys, gspread.utils.numericise_all(row))) for row in values[1:]]
+            df = pd.DataFrame(records)
             return df, headers
         else:
             return pd.DataFrame(), []
@@ -4072,9 +5638,235 @@ def _ruta_opt_fix_municipio(municipio: str) -> str:
     return _RUTA_OPT_MUNICIPIO_FIXES.get(m, municipio)
 
 
+# --- Caché persistente de geocodificación ---
+# Resultados por proveedor y dirección normalizada en SQLite (sobrevive reinicios
+# y se comparte entre sesiones/procesos). Se consulta antes de cualquier llamada
+# HTTP; los fallos también se guardan (caché negativa) con vigencia más corta.
+GEOCODE_CACHE_PATH = os.environ.get(
+    "GEOCODE_CACHE_PATH",
+    os.path.join(tempfile.gettempdir(), "app_almacen_geocode_cache.sqlite3"),
+)
+GEOCODE_TTL_SECONDS = 90 * 24 * 3600
+GEOCODE_NEGATIVE_TTL_SECONDS = 7 * 24 * 3600  # el proveedor respondió sin resultado
+GEOCODE_ERROR_TTL_SECONDS = 15 * 60  # error HTTP/red: se reintenta pronto
+_GEOCODE_MISS = object()
+
+
+def _geocode_store_connect() -> sqlite3.Connection:
+    conn = sqlite3.connect(GEOCODE_CACHE_PATH, timeout=30)
+    conn.executescript(
+        """
+        CREATE TABLE IF NOT EXISTS geocodes (
+            proveedor TEXT NOT NULL,
+            direccion TEXT NOT NULL,
+            resultado TEXT,
+            confianza TEXT NOT NULL DEFAULT '',
+            creado REAL NOT NULL,
+            expira REAL NOT NULL,
+            PRIMARY KEY (proveedor, direccion)
+        );
+        CREATE TABLE IF NOT EXISTS geocode_contadores (
+            proveedor TEXT NOT NULL,
+            evento TEXT NOT NULL,
+            total INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (proveedor, evento)
+        );
+        """
+    )
+    return conn
+
+
+def _geocode_address_key(address: str) -> str:
+    """Dirección normalizada para la llave (sin acentos, minúsculas, espacios y comas uniformes)."""
+    txt = _remove_accents(normalize_sheet_text(address)).lower()
+    txt = re.sub(r"\s*,\s*", ", ", txt)
+    return " ".join(txt.split()).strip(" ,;-")
+
+
+def _geocode_count(conn: sqlite3.Connection, provider: str, event: str) -> None:
+    conn.execute(
+        "INSERT INTO geocode_contadores (proveedor, evento, total) VALUES (?, ?, 1) "
+        "ON CONFLICT(proveedor, evento) DO UPDATE SET total = total + 1",
+        (provider, event),
+    )
+
+
+def _geocode_to_json(result: Optional[dict[str, Any]]) -> Optional[str]:
+    if result is None:
+        return None
+    return json.dumps({k: sorted(v) if isinstance(v, set) else v for k, v in result.items()})
+
+
+def _geocode_from_json(raw: Optional[str]) -> Optional[dict[str, Any]]:
+    if raw is None:
+        return None
+    result = json.loads(raw)
+    for key in ("types", "component_types"):
+        if isinstance(result.get(key), list):
+            result[key] = set(result[key])
+    return result
+
+
+def geocode_store_get(provider: str, address: str) -> Any:
+    """Resultado vigente (``None`` si está en caché negativa) o ``_GEOCODE_MISS``."""
+    key = _geocode_address_key(address)
+    if not key:
+        return _GEOCODE_MISS
+    try:
+        conn = _geocode_store_connect()
+        try:
+            row = conn.execute(
+                "SELECT resultado FROM geocodes WHERE proveedor = ? AND direccion = ? AND expira > ?",
+                (provider, key, time.time()),
+            ).fetchone()
+            if row is None:
+                _geocode_count(conn, provider, "fallo_cache")
+                conn.commit()
+                return _GEOCODE_MISS
+            _geocode_count(conn, provider, "acierto" if row[0] is not None else "acierto_negativo")
+            conn.commit()
+            return _geocode_from_json(row[0])
+        finally:
+            conn.close()
+    except (sqlite3.Error, ValueError):
+        return _GEOCODE_MISS
+
+
+def geocode_store_put(
+    provider: str,
+    address: str,
+    result: Optional[dict[str, Any]],
+    *,
+    ttl_seconds: int = GEOCODE_TTL_SECONDS,
+    confianza: str = "",
+    event: str = "",
+) -> None:
+    """Guarda el resultado (o el fallo, con ``result=None``) y cuenta ``event`` si se indica."""
+    key = _geocode_address_key(address)
+    if not key:
+        return
+    now = time.time()
+    try:
+        conn = _geocode_store_connect()
+        try:
+            conn.execute(
+                "INSERT OR REPLACE INTO geocodes (proveedor, direccion, resultado, confianza, creado, expira) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (provider, key, _geocode_to_json(result), confianza, now, now + ttl_seconds),
+            )
+            if event:
+                _geocode_count(conn, provider, event)
+            conn.commit()
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        pass
+
+
+def geocode_store_stats() -> dict[str, dict[str, int]]:
+    """Contadores por proveedor: aciertos, fallos de caché, consultas HTTP, sin resultado y errores."""
+    try:
+        conn = _geocode_store_connect()
+        try:
+            rows = conn.execute("SELECT proveedor, evento, total FROM geocode_contadores").fetchall()
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        return {}
+    stats: dict[str, dict[str, int]] = {}
+    for provider, event, total in rows:
+        stats.setdefault(provider, {})[event] = int(total)
+    return stats
+
+
+@st.cache_resource
+def _get_geocode_warm_state() -> dict[str, Any]:
+    return {"lock": threading.Lock(), "fingerprint": None}
+
+
+def warm_geocode_store_from_clientes(clientes_df: pd.DataFrame, lat_col: str, lng_col: str) -> int:
+    """Precarga en bloque las coordenadas confiables de Clientes_Locales (una vez por versión de la hoja)."""
+    if clientes_df is None or clientes_df.empty:
+        return 0
+    lat = pd.to_numeric(clientes_df.get(lat_col), errors="coerce")
+    lng = pd.to_numeric(clientes_df.get(lng_col), errors="coerce")
+    rows: list[tuple[str, str, str, str]] = []
+    for (_, cli_row), lat_val, lng_val in zip(clientes_df.iterrows(), lat, lng):
+        if pd.isna(lat_val) or pd.isna(lng_val):
+            continue
+        confianza = str(cli_row.get("Confianza_Final", "")).strip().upper()
+        metodo = str(cli_row.get("Metodo_Final", "")).strip()
+        direccion = str(cli_row.get("Direccion_Final", "")).strip()
+        if not _ruta_opt_coord_is_route_safe(confianza, metodo, direccion):
+            continue
+        zone_key = next(
+            (zone for zone in _RUTA_OPT_ZONE_CONFIG if _coords_in_zone(float(lat_val), float(lng_val), zone)),
+            "",
+        )
+        base_addr = _ruta_opt_cliente_base_address(cli_row)
+        if not zone_key or not base_addr:
+            continue
+        result = {
+            "lat": float(lat_val),
+            "lng": float(lng_val),
+            "direccion": direccion,
+            "confianza": confianza,
+            "metodo": metodo or "CLIENTES_LOCALES",
+        }
+        for variant in _ruta_opt_address_variants(base_addr):
+            rows.append((f"{zone_key}|{variant}", _geocode_to_json(result), confianza))
+
+    fingerprint = hashlib.sha1(repr(rows).encode("utf-8")).hexdigest()
+    state = _get_geocode_warm_state()
+    with state["lock"]:
+        if state["fingerprint"] == fingerprint:
+            return 0
+        now = time.time()
+        try:
+            conn = _geocode_store_connect()
+            try:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO geocodes (proveedor, direccion, resultado, confianza, creado, expira) "
+                    "VALUES ('cascada', ?, ?, ?, ?, ?)",
+                    [
+                        (_geocode_address_key(key), raw, confianza, now, now + GEOCODE_TTL_SECONDS)
+                        for key, raw, confianza in rows
+                    ],
+                )
+                conn.commit()
+            finally:
+                conn.close()
+        except sqlite3.Error:
+            return 0
+        state["fingerprint"] = fingerprint
+    return len(rows)
+
+
+def _ruta_opt_cliente_base_address(cliente_row: Any, pedido: Any = None) -> str:
+    """Dirección base del cliente (Direccion_Final o calle, colonia, municipio y C.P.)."""
+    municipio = str(cliente_row.get("Municipio", "") or (pedido.get("Municipio", "") if pedido is not None else "")).strip()
+    calle = str(cliente_row.get("CalleyNumero", "")).strip()
+    col = str(cliente_row.get("Col", "")).strip()
+    cp = str(cliente_row.get("C_P.", "")).strip()
+    direccion_final = str(cliente_row.get("Direccion_Final", "")).strip()
+    return direccion_final or ", ".join([x for x in [calle, col, municipio, cp, "Mexico"] if x])
+
+
+def _ruta_opt_address_variants(base_addr: str) -> list[str]:
+    """Variantes de llave de una dirección: tal cual, limpieza básica y limpieza agresiva."""
+    variants: list[str] = []
+    for variant in (base_addr, _ruta_opt_clean_basic_address(base_addr), _ruta_opt_clean_aggressive_address(base_addr)):
+        if variant and variant not in variants:
+            variants.append(variant)
+    return variants
+
+
 def _ruta_opt_geocode_nominatim(address: str) -> Optional[dict[str, Any]]:
     if not address:
         return None
+    cached = geocode_store_get("nominatim", address)
+    if cached is not _GEOCODE_MISS:
+        return cached
     try:
         resp = requests.get(
             _RUTA_OPT_NOMINATIM_URL,
@@ -4083,12 +5875,14 @@ def _ruta_opt_geocode_nominatim(address: str) -> Optional[dict[str, Any]]:
             timeout=12,
         )
         if resp.status_code != 200:
+            geocode_store_put("nominatim", address, None, ttl_seconds=GEOCODE_ERROR_TTL_SECONDS, event="error")
             return None
         data = resp.json()
         if not data:
+            geocode_store_put("nominatim", address, None, ttl_seconds=GEOCODE_NEGATIVE_TTL_SECONDS, event="sin_resultado")
             return None
         first = data[0]
-        return {
+        result = {
             "lat": float(first.get("lat")),
             "lng": float(first.get("lon")),
             "formatted_address": str(first.get("display_name", "")).strip(),
@@ -4096,12 +5890,18 @@ def _ruta_opt_geocode_nominatim(address: str) -> Optional[dict[str, Any]]:
             "importance": float(first.get("importance", 0) or 0),
         }
     except Exception:
+        geocode_store_put("nominatim", address, None, ttl_seconds=GEOCODE_ERROR_TTL_SECONDS, event="error")
         return None
+    geocode_store_put("nominatim", address, result, event="consulta_ok")
+    return result
 
 
 def _ruta_opt_geocode_google(address: str, api_key: str) -> Optional[dict[str, Any]]:
     if not address or not api_key:
         return None
+    cached = geocode_store_get("google", address)
+    if cached is not _GEOCODE_MISS:
+        return cached
     try:
         resp = requests.get(
             "https://maps.googleapis.com/maps/api/geocode/json",
@@ -4109,9 +5909,14 @@ def _ruta_opt_geocode_google(address: str, api_key: str) -> Optional[dict[str, A
             timeout=12,
         )
         if resp.status_code != 200:
+            geocode_store_put("google", address, None, ttl_seconds=GEOCODE_ERROR_TTL_SECONDS, event="error")
             return None
         data = resp.json()
-        if data.get("status") != "OK" or not data.get("results"):
+        if data.get("status") == "ZERO_RESULTS" or (data.get("status") == "OK" and not data.get("results")):
+            geocode_store_put("google", address, None, ttl_seconds=GEOCODE_NEGATIVE_TTL_SECONDS, event="sin_resultado")
+            return None
+        if data.get("status") != "OK":
+            geocode_store_put("google", address, None, ttl_seconds=GEOCODE_ERROR_TTL_SECONDS, event="error")
             return None
         result = data["results"][0]
         loc = result["geometry"]["location"]
@@ -4121,7 +5926,7 @@ def _ruta_opt_geocode_google(address: str, api_key: str) -> Optional[dict[str, A
             for comp in result.get("address_components", [])
             for t in comp.get("types", [])
         }
-        return {
+        geocoded = {
             "lat": float(loc.get("lat")),
             "lng": float(loc.get("lng")),
             "formatted_address": str(result.get("formatted_address", "")).strip(),
@@ -4131,7 +5936,10 @@ def _ruta_opt_geocode_google(address: str, api_key: str) -> Optional[dict[str, A
             "component_types": component_types,
         }
     except Exception:
+        geocode_store_put("google", address, None, ttl_seconds=GEOCODE_ERROR_TTL_SECONDS, event="error")
         return None
+    geocode_store_put("google", address, geocoded, event="consulta_ok")
+    return geocoded
 
 
 def _ruta_opt_google_result_is_precise(result: dict[str, Any]) -> bool:
@@ -4241,15 +6049,15 @@ def _attempt_autogeocode_for_cliente(
     google_api_key: str,
 ) -> Optional[dict[str, Any]]:
     municipio = str(cliente_row.get("Municipio", "") or pedido.get("Municipio", "")).strip()
-    calle = str(cliente_row.get("CalleyNumero", "")).strip()
-    col = str(cliente_row.get("Col", "")).strip()
-    cp = str(cliente_row.get("C_P.", "")).strip()
-    direccion_final = str(cliente_row.get("Direccion_Final", "")).strip()
-
-    base_addr = direccion_final or ", ".join([x for x in [calle, col, municipio, cp, "Mexico"] if x])
+    base_addr = _ruta_opt_cliente_base_address(cliente_row, pedido)
     if not base_addr:
         return None
 
+    for variant in _ruta_opt_address_variants(base_addr):
+        cached = geocode_store_get("cascada", f"{zone_key}|{variant}")
+        if cached is not _GEOCODE_MISS and cached is not None:
+            return cached
+
     municipio_fix = _ruta_opt_fix_municipio(municipio)
     zone_city = "Saltillo, Coahuila, Mexico" if zone_key == "saltillo" else "Monterrey, Nuevo Leon, Mexico"
     basic = _ruta_opt_clean_basic_address(base_addr)
@@ -4292,13 +6100,15 @@ def _attempt_autogeocode_for_cliente(
 
     google_precise = _ruta_opt_google_result_is_precise(google_result)
     confianza = "OK_ALTO" if google_precise and osm_match else "OK_REVISAR"
-    return {
+    result = {
         "lat": float(google_result["lat"]),
         "lng": float(google_result["lng"]),
         "direccion": google_result.get("formatted_address") or addr,
         "confianza": confianza,
         "metodo": f"{metodo}+OSM_VALIDADO" if osm_match else metodo,
     }
+    geocode_store_put("cascada", f"{zone_key}|{base_addr}", result, confianza=confianza)
+    return result
 
 
 
@@ -4412,6 +6222,7 @@ def _collect_route_candidates(
     )
     clientes_work = clientes_work.drop_duplicates(subset=["_cliente_norm"], keep="first")
     clientes_map = clientes_work.set_index("_cliente_norm")
+    warm_geocode_store_from_clientes(clientes_work, lat_col, lng_col)
     geocode_cache: dict[str, Optional[dict[str, Any]]] = {}
     confirmed_address_map = user_confirmed_addresses or {}
 
@@ -4615,63 +6426,507 @@ def _build_hoja_ruta_download_df(
     return df[REPORTE_ALMACEN_COLUMNS].copy()
 
 
-def _call_directions_optimized_route(
-    api_key: str,
-    waypoints: list[str],
-    departure_time_unix: Optional[int] = None,
-) -> Optional[dict[str, Any]]:
-    if not waypoints:
-        return None
+# --- Optimizador local de rutas (VRP/TSP) ---
+# El orden de las paradas se calcula localmente sobre una matriz de tiempos
+# (haversine corregido por factor de calle); Google Directions solo se usa al
+# final para ETA con tráfico y trazo del mapa, en tramos de hasta
+# ``_RUTA_OPT_MAX_WAYPOINTS`` paradas.
+_RUTA_OPT_ORIGIN_LAT = 25.5853
+_RUTA_OPT_ORIGIN_LNG = -100.2446
+_RUTA_OPT_ROAD_FACTOR = 1.35
+_RUTA_OPT_AVG_SPEED_KMH = 30.0
+_RUTA_OPT_SERVICE_MINUTES = 12
+# Segundos de costo por cada segundo de llegada después de la ventana de entrega.
+_RUTA_OPT_LATE_PENALTY = 20.0
+_RUTA_OPT_MAX_IMPROVE_PASSES = 8
+_RUTA_OPT_HORARIO_COLUMNS = ("Horario_Entrega", "Hora_Entrega", "Horario")
+
+
+# --- Caché persistente de tiempos de traslado ---
+# Cada tramo que Directions ya cobró se guarda en SQLite por par de coordenadas
+# redondeadas y franja horaria de salida. El optimizador arma su matriz con
+# estos tiempos reales y las ETA solo piden a Directions los tramos que faltan.
+RUTA_MATRIX_CACHE_PATH = os.environ.get(
+    "RUTA_MATRIX_CACHE_PATH",
+    os.path.join(tempfile.gettempdir(), "app_almacen_ruta_tramos.sqlite3"),
+)
+RUTA_MATRIX_TTL_SECONDS = 14 * 24 * 3600
+RUTA_MATRIX_COORD_DECIMALS = 4  # ~11 m
 
-    params = {
-        "origin": _RUTA_OPT_ORIGIN,
-        "destination": _RUTA_OPT_ORIGIN,
-        "waypoints": "optimize:true|" + "|".join(waypoints),
-        "mode": "driving",
-        "departure_time": departure_time_unix if departure_time_unix is not None else "now",
-        "traffic_model": "best_guess",
-        "language": "es",
-        "region": "mx",
-        "key": api_key,
+
+def _ruta_matrix_connect() -> sqlite3.Connection:
+    conn = sqlite3.connect(RUTA_MATRIX_CACHE_PATH, timeout=30)
+    conn.executescript(
+        """
+        CREATE TABLE IF NOT EXISTS tramos (
+            origen TEXT NOT NULL,
+            destino TEXT NOT NULL,
+            franja INTEGER NOT NULL,
+            distancia_m REAL NOT NULL,
+            duracion_s REAL NOT NULL,
+            tramo TEXT NOT NULL,
+            actualizado REAL NOT NULL,
+            PRIMARY KEY (origen, destino, franja)
+        );
+        """
+    )
+    return conn
+
+
+def _ruta_matrix_point_key(lat: float, lng: float) -> str:
+    decimals = RUTA_MATRIX_COORD_DECIMALS
+    return f"{round(float(lat), decimals):.{decimals}f},{round(float(lng), decimals):.{decimals}f}"
+
+
+def _ruta_matrix_hour_bucket(departure_time_unix: Optional[int] = None) -> int:
+    """Hora local (0-23) de salida de la ruta; ``None`` usa la hora actual."""
+    if departure_time_unix is None:
+        return mx_now().hour
+    return datetime.fromtimestamp(int(departure_time_unix), _MX_TZ).hour
+
+
+def _ruta_leg_seconds(leg: dict[str, Any]) -> int:
+    return int(((leg.get("duration_in_traffic") or leg.get("duration") or {}).get("value", 0)) or 0)
+
+
+def _ruta_matrix_compact_leg(leg: dict[str, Any]) -> dict[str, Any]:
+    """Conserva del tramo solo lo que usan las tablas, ETA y el trazo del mapa."""
+    compact = {
+        key: leg[key]
+        for key in ("distance", "duration", "duration_in_traffic", "start_location", "end_location")
+        if key in leg
     }
+    compact["steps"] = [
+        {"polyline": {"points": step.get("polyline", {}).get("points", "")}}
+        for step in leg.get("steps", [])
+        if step.get("polyline", {}).get("points")
+    ]
+    return compact
+
+
+def ruta_matrix_get_legs(
+    pairs: Sequence[tuple[str, str]],
+    hour_bucket: int,
+) -> dict[tuple[str, str], dict[str, Any]]:
+    """Tramos vigentes en caché para los pares ``(origen, destino)`` de la franja."""
+    wanted = set(pairs)
+    origins = sorted({origin for origin, _ in wanted})
+    if not origins:
+        return {}
     try:
-        response = requests.get(
-            "https://maps.googleapis.com/maps/api/directions/json",
-            params=params,
-            timeout=25,
-        )
-    except requests.RequestException as exc:
-        st.error(f"❌ Error al llamar Google Directions API: {exc}")
-        return None
+        conn = _ruta_matrix_connect()
+        try:
+            rows = conn.execute(
+                "SELECT origen, destino, tramo FROM tramos WHERE franja = ? AND actualizado >= ? "
+                f"AND origen IN ({','.join('?' * len(origins))})",
+                [int(hour_bucket), time.time() - RUTA_MATRIX_TTL_SECONDS, *origins],
+            ).fetchall()
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        return {}
+    return {(origin, dest): json.loads(raw) for origin, dest, raw in rows if (origin, dest) in wanted}
+
+
+def ruta_matrix_put_legs(entries: Sequence[tuple[str, str, dict[str, Any]]], hour_bucket: int) -> None:
+    """Guarda tramos de Directions ``(origen, destino, leg)`` en la franja indicada."""
+    if not entries:
+        return
+    now = time.time()
+    try:
+        conn = _ruta_matrix_connect()
+        try:
+            conn.executemany(
+                "INSERT OR REPLACE INTO tramos (origen, destino, franja, distancia_m, duracion_s, tramo, actualizado) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (
+                        origin,
+                        dest,
+                        int(hour_bucket),
+                        float((leg.get("distance") or {}).get("value", 0) or 0),
+                        float(_ruta_leg_seconds(leg)),
+                        json.dumps(_ruta_matrix_compact_leg(leg)),
+                        now,
+                    )
+                    for origin, dest, leg in entries
+                ],
+            )
+            conn.commit()
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        pass
 
-    if response.status_code != 200:
-        st.error(f"❌ Google Directions respondió con HTTP {response.status_code}.")
+
+def ruta_matrix_lookup(keys: Sequence[str], hour_bucket: int) -> dict[tuple[str, str], tuple[float, float]]:
+    """``(distancia_m, duracion_s)`` en caché entre todos los pares de ``keys``."""
+    unique = sorted(set(keys))
+    if not unique:
+        return {}
+    placeholders = ",".join("?" * len(unique))
+    try:
+        conn = _ruta_matrix_connect()
+        try:
+            rows = conn.execute(
+                "SELECT origen, destino, distancia_m, duracion_s FROM tramos "
+                f"WHERE franja = ? AND actualizado >= ? AND origen IN ({placeholders}) AND destino IN ({placeholders})",
+                [int(hour_bucket), time.time() - RUTA_MATRIX_TTL_SECONDS, *unique, *unique],
+            ).fetchall()
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        return {}
+    return {(origin, dest): (float(dist), float(dur)) for origin, dest, dist, dur in rows}
+
+
+def _ruta_opt_parse_horario_window(value: Any) -> Optional[tuple[int, int]]:
+    """Convierte '10 am a 2 pm' / '3-7' en ``(inicio, fin)`` en segundos desde medianoche."""
+    raw = _normalize_plain_text(value)
+    if not raw:
+        return None
+    normalized = _remove_accents(raw).lower().replace(".", "")
+    m = re.search(
+        r"(\d{1,2})(?::(\d{2}))?\s*(am|pm)?\s*(?:a|-)\s*(\d{1,2})(?::(\d{2}))?\s*(am|pm)?",
+        normalized,
+    )
+    if not m:
         return None
 
-    data = response.json()
-    status = data.get("status", "")
-    if status != "OK":
-        st.error(f"❌ Google Directions no pudo generar la ruta. Status: {status}.")
+    def _to_seconds(hour_txt: str, minute_txt: Optional[str], meridiem: Optional[str]) -> int:
+        hour = int(hour_txt) % 24
+        if meridiem == "pm" and hour < 12:
+            hour += 12
+        elif meridiem == "am" and hour == 12:
+            hour = 0
+        elif not meridiem and hour < 8:
+            # En reparto, '3-7' sin am/pm siempre es por la tarde.
+            hour += 12
+        return hour * 3600 + int(minute_txt or 0) * 60
+
+    start = _to_seconds(m.group(1), m.group(2), m.group(3) or m.group(6))
+    end = _to_seconds(m.group(4), m.group(5), m.group(6))
+    if end <= start:
         return None
+    return start, end
 
-    routes = data.get("routes", [])
-    if not routes:
-        st.error("❌ Google Directions no devolvió rutas.")
+
+def _ruta_opt_candidate_window(candidate: dict[str, Any]) -> Optional[tuple[int, int]]:
+    pedido = candidate.get("pedido", {})
+    for col in _RUTA_OPT_HORARIO_COLUMNS:
+        window = _ruta_opt_parse_horario_window(pedido.get(col, "") if hasattr(pedido, "get") else "")
+        if window:
+            return window
+    return None
+
+
+def _ruta_opt_candidate_zone(candidate: dict[str, Any]) -> str:
+    lat = float(candidate.get("lat", _RUTA_OPT_ORIGIN_LAT))
+    lng = float(candidate.get("lng", _RUTA_OPT_ORIGIN_LNG))
+    return next((zone for zone in _RUTA_OPT_ZONE_CONFIG if _coords_in_zone(lat, lng, zone)), "")
+
+
+def _ruta_opt_travel_matrix(
+    points: Sequence[tuple[float, float]],
+    hour_bucket: Optional[int] = None,
+) -> tuple[np.ndarray, np.ndarray]:
+    """Matrices de distancia (m) y tiempo de manejo (s) entre ``points``.
+
+    Los pares con tramo real en caché para ``hour_bucket`` usan ese valor; el
+    resto se estima con haversine, factor de calle y velocidad promedio.
+    """
+    coords = np.radians(np.asarray(points, dtype=float).reshape(-1, 2))
+    lat = coords[:, 0][:, None]
+    lng = coords[:, 1][:, None]
+    a = (
+        np.sin((lat - lat.T) / 2) ** 2
+        + np.cos(lat) * np.cos(lat.T) * np.sin((lng - lng.T) / 2) ** 2
+    )
+    dist_m = 6371000.0 * 2 * np.arctan2(np.sqrt(a), np.sqrt(np.clip(1 - a, 0.0, None))) * _RUTA_OPT_ROAD_FACTOR
+    dur_s = dist_m / (_RUTA_OPT_AVG_SPEED_KMH * 1000.0 / 3600.0)
+    if hour_bucket is not None:
+        keys = [_ruta_matrix_point_key(lat_val, lng_val) for lat_val, lng_val in points]
+        cached = ruta_matrix_lookup(keys, hour_bucket)
+        if cached:
+            for a, key_a in enumerate(keys):
+                for b, key_b in enumerate(keys):
+                    hit = cached.get((key_a, key_b))
+                    if hit is not None and a != b:
+                        dist_m[a, b], dur_s[a, b] = hit
+    return dist_m, dur_s
+
+
+def _ruta_opt_route_cost(
+    route: Sequence[int],
+    dur: list[list[float]],
+    windows: list[Optional[tuple[int, int]]],
+    start_s: float,
+    service_s: float,
+) -> float:
+    """Tiempo total de la vuelta (manejo, servicio y esperas) más penalización por retraso."""
+    t = start_s
+    late = 0.0
+    prev = 0
+    for node in route:
+        t += dur[prev][node]
+        window = windows[node]
+        if window is not None:
+            if t < window[0]:
+                t = float(window[0])
+            elif t > window[1]:
+                late += t - window[1]
+        t += service_s
+        prev = node
+    t += dur[prev][0]
+    return (t - start_s) + _RUTA_OPT_LATE_PENALTY * late
+
+
+def _ruta_opt_nearest_neighbour(nodes: Sequence[int], dur: list[list[float]]) -> list[int]:
+    remaining = list(nodes)
+    route: list[int] = []
+    current = 0
+    while remaining:
+        nxt = min(remaining, key=lambda node: dur[current][node])
+        remaining.remove(nxt)
+        route.append(nxt)
+        current = nxt
+    return route
+
+
+def _ruta_opt_improve_route(route: list[int], cost_fn) -> list[int]:
+    """Mejora local con 2-opt y Or-opt (segmentos de 1 a 3 paradas) hasta converger."""
+    best = list(route)
+    best_cost = cost_fn(best)
+    n = len(best)
+    for _ in range(_RUTA_OPT_MAX_IMPROVE_PASSES):
+        improved = False
+        for i in range(n - 1):
+            for j in range(i + 1, n):
+                candidate = best[:i] + best[i:j + 1][::-1] + best[j + 1:]
+                cost = cost_fn(candidate)
+                if cost < best_cost - 1e-6:
+                    best, best_cost, improved = candidate, cost, True
+        for seg_len in (1, 2, 3):
+            for i in range(n - seg_len + 1):
+                segment = best[i:i + seg_len]
+                rest = best[:i] + best[i + seg_len:]
+                for k in range(len(rest) + 1):
+                    if k == i:
+                        continue
+                    candidate = rest[:k] + segment + rest[k:]
+                    cost = cost_fn(candidate)
+                    if cost < best_cost - 1e-6:
+                        best, best_cost, improved = candidate, cost, True
+                        break
+        if not improved:
+            break
+    return best
+
+
+def _ruta_opt_split_by_sweep(nodes: list[int], points: Sequence[tuple[float, float]], groups: int) -> list[list[int]]:
+    """Reparte las paradas en ``groups`` sectores contiguos por ángulo desde el origen."""
+    origin_lat, origin_lng = points[0]
+    ordered = sorted(
+        nodes,
+        key=lambda node: math.atan2(points[node][0] - origin_lat, points[node][1] - origin_lng),
+    )
+    size, extra = divmod(len(ordered), groups)
+    result: list[list[int]] = []
+    start = 0
+    for g in range(groups):
+        end = start + size + (1 if g < extra else 0)
+        result.append(ordered[start:end])
+        start = end
+    return result
+
+
+def _ruta_opt_relocate_between_routes(routes: list[list[int]], cost_fn) -> list[list[int]]:
+    """Mueve paradas entre rutas de la misma zona mientras baje el costo total."""
+    routes = [list(route) for route in routes]
+    costs = [cost_fn(route) for route in routes]
+    for _ in range(_RUTA_OPT_MAX_IMPROVE_PASSES):
+        improved = False
+        for a in range(len(routes)):
+            for node in list(routes[a]):
+                if len(routes[a]) <= 1:
+                    break
+                without = [n for n in routes[a] if n != node]
+                without_cost = cost_fn(without)
+                for b in range(len(routes)):
+                    if b == a:
+                        continue
+                    best_pos, best_cost = None, costs[a] + costs[b]
+                    for pos in range(len(routes[b]) + 1):
+                        candidate = routes[b][:pos] + [node] + routes[b][pos:]
+                        total = without_cost + cost_fn(candidate)
+                        if total < best_cost - 1e-6:
+                            best_pos, best_cost = pos, total
+                    if best_pos is not None:
+                        routes[b].insert(best_pos, node)
+                        routes[a] = without
+                        costs[a] = without_cost
+                        costs[b] = cost_fn(routes[b])
+                        improved = True
+                        break
+        if not improved:
+            break
+    return [_ruta_opt_improve_route(route, cost_fn) for route in routes]
+
+
+def solve_ruta_opt_vrp(
+    candidates: list[dict[str, Any]],
+    *,
+    num_choferes: int = 1,
+    start_seconds: Optional[int] = None,
+    service_minutes: int = _RUTA_OPT_SERVICE_MINUTES,
+) -> list[list[dict[str, Any]]]:
+    """
+    Ordena las paradas localmente y devuelve una ruta (lista de candidatos) por chofer.
+
+    Cada chofer atiende una sola zona de ``_RUTA_OPT_ZONE_CONFIG``; los choferes
+    se reparten entre zonas según el número de paradas. Se construye con vecino
+    más cercano, se mejora con 2-opt/Or-opt y, con varios choferes, se reubican
+    paradas entre rutas de la misma zona. Las ventanas de ``Horario_Entrega``
+    penalizan llegar tarde y obligan a esperar si se llega antes.
+    """
+    if not candidates:
+        return []
+    points = [(_RUTA_OPT_ORIGIN_LAT, _RUTA_OPT_ORIGIN_LNG)] + [
+        (float(c["lat"]), float(c["lng"])) for c in candidates
+    ]
+    windows: list[Optional[tuple[int, int]]] = [None] + [_ruta_opt_candidate_window(c) for c in candidates]
+    if start_seconds is None:
+        now_local = mx_now()
+        start_seconds = now_local.hour * 3600 + now_local.minute * 60
+    _, dur_matrix = _ruta_opt_travel_matrix(points, hour_bucket=int(start_seconds // 3600) % 24)
+    dur = dur_matrix.tolist()
+    service_s = float(service_minutes) * 60.0
+
+    def cost_fn(route: Sequence[int]) -> float:
+        return _ruta_opt_route_cost(route, dur, windows, float(start_seconds), service_s) if route else 0.0
+
+    nodes_by_zone: dict[str, list[int]] = {}
+    for node, candidate in enumerate(candidates, start=1):
+        nodes_by_zone.setdefault(_ruta_opt_candidate_zone(candidate), []).append(node)
+
+    total_stops = len(candidates)
+    choferes = max(1, int(num_choferes or 1))
+    routes: list[list[int]] = []
+    for zone_nodes in nodes_by_zone.values():
+        zone_choferes = max(1, round(choferes * len(zone_nodes) / total_stops))
+        zone_choferes = min(zone_choferes, len(zone_nodes))
+        zone_routes = [
+            _ruta_opt_improve_route(_ruta_opt_nearest_neighbour(group, dur), cost_fn)
+            for group in _ruta_opt_split_by_sweep(zone_nodes, points, zone_choferes)
+        ]
+        if len(zone_routes) > 1:
+            zone_routes = _ruta_opt_relocate_between_routes(zone_routes, cost_fn)
+        routes.extend(route for route in zone_routes if route)
+
+    return [[candidates[node - 1] for node in route] for route in routes]
+
+
+def _ruta_opt_format_leg(dist_m: float, dur_s: float) -> tuple[dict[str, Any], dict[str, Any]]:
+    minutes = int(round(dur_s / 60))
+    dur_txt = f"{minutes // 60} h {minutes % 60} min" if minutes >= 60 else f"{minutes} min"
+    return (
+        {"value": int(round(dist_m)), "text": f"{dist_m / 1000:.1f} km"},
+        {"value": int(round(dur_s)), "text": dur_txt},
+    )
+
+
+def _ruta_opt_local_route(ordered: list[dict[str, Any]], hour_bucket: Optional[int] = None) -> dict[str, Any]:
+    """Tramos estimados con la matriz local (sin trazo) para cuando Directions no responde."""
+    points = [(_RUTA_OPT_ORIGIN_LAT, _RUTA_OPT_ORIGIN_LNG)] + [
+        (float(c["lat"]), float(c["lng"])) for c in ordered
+    ]
+    dist_m, dur_s = _ruta_opt_travel_matrix(points, hour_bucket=hour_bucket)
+    sequence = list(range(len(points))) + [0]
+    legs: list[dict[str, Any]] = []
+    for a, b in zip(sequence, sequence[1:]):
+        distance, duration = _ruta_opt_format_leg(float(dist_m[a][b]), float(dur_s[a][b]))
+        legs.append(
+            {
+                "distance": distance,
+                "duration": duration,
+                "start_location": {"lat": points[a][0], "lng": points[a][1]},
+                "end_location": {"lat": points[b][0], "lng": points[b][1]},
+                "steps": [],
+            }
+        )
+    return {"legs": legs}
+
+
+def _ruta_opt_directions_for_order(
+    api_key: str,
+    ordered: list[dict[str, Any]],
+    departure_time_unix: Optional[int] = None,
+) -> Optional[dict[str, Any]]:
+    """
+    ETA y trazo para un orden ya resuelto, reutilizando tramos en caché.
+
+    Solo se piden a Directions los tramos que faltan en la franja de salida,
+    agrupados en tramos contiguos de hasta ``_RUTA_OPT_MAX_WAYPOINTS`` paradas;
+    cambiar un pedido de la ruta cuesta una sola llamada.
+    """
+    if not ordered:
         return None
-    return routes[0]
+    points = (
+        [(_RUTA_OPT_ORIGIN_LAT, _RUTA_OPT_ORIGIN_LNG)]
+        + [(float(c["lat"]), float(c["lng"])) for c in ordered]
+        + [(_RUTA_OPT_ORIGIN_LAT, _RUTA_OPT_ORIGIN_LNG)]
+    )
+    sequence = [_RUTA_OPT_ORIGIN] + [f"{c['lat']},{c['lng']}" for c in ordered] + [_RUTA_OPT_ORIGIN]
+    keys = [_ruta_matrix_point_key(lat_val, lng_val) for lat_val, lng_val in points]
+    pairs = list(zip(keys, keys[1:]))
+    hour_bucket = _ruta_matrix_hour_bucket(departure_time_unix)
+    cached = ruta_matrix_get_legs(pairs, hour_bucket)
+    legs: list[Optional[dict[str, Any]]] = [cached.get(pair) for pair in pairs]
+    missing = [i for i, leg in enumerate(legs) if leg is None]
+
+    base_departure = int(departure_time_unix) if departure_time_unix is not None else int(time.time())
+    idx = 0
+    while idx < len(missing):
+        start = missing[idx]
+        end = start + 1
+        while idx < len(missing) and missing[idx] + 1 - start <= _RUTA_OPT_MAX_WAYPOINTS + 1:
+            end = missing[idx] + 1
+            idx += 1
+        span_departure = base_departure + sum(
+            _ruta_leg_seconds(leg) for leg in legs[:start] if leg
+        ) + _RUTA_OPT_SERVICE_MINUTES * 60 * start
+        route = _call_directions_custom_route(
+            api_key,
+            sequence[start + 1:end],
+            departure_time_unix=span_departure if departure_time_unix is not None or start else None,
+            origin=sequence[start],
+            destination=sequence[end],
+        )
+        span_legs = route.get("legs", []) if route else []
+        if len(span_legs) != end - start:
+            return None
+        for offset, leg in enumerate(span_legs):
+            legs[start + offset] = leg
+        ruta_matrix_put_legs(
+            [(keys[start + offset], keys[start + offset + 1], leg) for offset, leg in enumerate(span_legs)],
+            hour_bucket,
+        )
+    return {"legs": legs}
 
 
 def _call_directions_custom_route(
     api_key: str,
     ordered_waypoints: list[str],
     departure_time_unix: Optional[int] = None,
+    *,
+    origin: str = _RUTA_OPT_ORIGIN,
+    destination: str = _RUTA_OPT_ORIGIN,
 ) -> Optional[dict[str, Any]]:
-    if not ordered_waypoints:
+    if not ordered_waypoints and origin == destination:
         return None
     params = {
-        "origin": _RUTA_OPT_ORIGIN,
-        "destination": _RUTA_OPT_ORIGIN,
-        "waypoints": "|".join(ordered_waypoints),
+        "origin": origin,
+        "destination": destination,
         "mode": "driving",
         "departure_time": departure_time_unix if departure_time_unix is not None else "now",
         "traffic_model": "best_guess",
@@ -4679,6 +6934,8 @@ def _call_directions_custom_route(
         "region": "mx",
         "key": api_key,
     }
+    if ordered_waypoints:
+        params["waypoints"] = "|".join(ordered_waypoints)
     try:
         response = requests.get(
             "https://maps.googleapis.com/maps/api/directions/json",
@@ -4713,6 +6970,14 @@ def _render_ruta_optimizada_ui(
     found_coords_key = f"ruta_opt_found_coords_{context_key}"
     save_coords_key = f"ruta_opt_save_coords_{context_key}"
 
+    num_choferes = st.number_input(
+        "🚚 Choferes",
+        min_value=1,
+        max_value=10,
+        value=1,
+        step=1,
+        key=f"ruta_opt_choferes_{context_key}",
+    )
     if st.button("📍 Generar Ruta Optimizada", key=run_key):
         api_key = str(st.secrets.get("api_keys", {}).get("google_maps_api_key", "")).strip()
         _ = str(st.secrets.get("api_keys", {}).get("openai_api_key", "")).strip()  # reservado para uso futuro
@@ -4746,6 +7011,16 @@ def _render_ruta_optimizada_ui(
                 "ℹ️ Se incluirán al final del archivo de hoja de ruta los clientes pendientes "
                 "(sin coordenadas o fuera de zona)."
             )
+        geocode_stats = geocode_store_stats()
+        if geocode_stats:
+            st.caption(
+                "🗺️ Caché de geocodificación: "
+                + " · ".join(
+                    f"{provider}: {counts.get('acierto', 0) + counts.get('acierto_negativo', 0)} aciertos / "
+                    f"{counts.get('fallo_cache', 0)} fallos"
+                    for provider, counts in sorted(geocode_stats.items())
+                )
+            )
 
         if len(candidates) < 2:
             st.info("ℹ️ Se requieren al menos 2 pedidos válidos en 🔵 En Proceso con coordenadas confiables/en zona para generar la ruta.")
@@ -4773,54 +7048,60 @@ def _render_ruta_optimizada_ui(
             }
             return
 
-        if len(candidates) > _RUTA_OPT_MAX_WAYPOINTS:
+        routes = solve_ruta_opt_vrp(candidates, num_choferes=int(num_choferes))
+        route_legs: list[tuple[list[dict[str, Any]], list[dict[str, Any]]]] = []
+        used_local_estimate = False
+        for route_ordered in routes:
+            route = _ruta_opt_directions_for_order(api_key, route_ordered)
+            if not route:
+                route = _ruta_opt_local_route(route_ordered, hour_bucket=_ruta_matrix_hour_bucket())
+                used_local_estimate = True
+            route_legs.append((route_ordered, route.get("legs", [])))
+        if used_local_estimate:
             st.warning(
-                f"⚠️ Google Directions permite hasta {_RUTA_OPT_MAX_WAYPOINTS} waypoints optimizados por solicitud. "
-                "Se tomarán los primeros pedidos válidos."
+                "⚠️ Google Directions no respondió; distancias y tiempos son estimaciones locales sin trazo de calles."
             )
-            candidates = candidates[:_RUTA_OPT_MAX_WAYPOINTS]
-
-        wp = [f"{c['lat']},{c['lng']}" for c in candidates]
-        route = _call_directions_optimized_route(api_key, wp)
-        if not route:
-            st.session_state.pop(state_key, None)
-            return
-
-        order_idx = route.get("waypoint_order", [])
-        ordered = [candidates[i] for i in order_idx] if order_idx else candidates
-        legs = route.get("legs", [])
 
+        multi_chofer = len(route_legs) > 1
+        ordered: list[dict[str, Any]] = []
+        ordered_labels: list[str] = []
         rows_simple: list[dict[str, Any]] = []
         dist_total_m = 0
         dur_total_s = 0
 
-        for i, leg in enumerate(legs):
-            if i == 0:
-                de_txt = "Origen"
-                a_txt = ordered[0]["cliente"] if ordered else "Destino"
-            elif i == len(legs) - 1:
-                de_txt = ordered[-1]["cliente"] if ordered else "Origen"
-                a_txt = "Origen"
-            else:
-                de_txt = ordered[i - 1]["cliente"]
-                a_txt = ordered[i]["cliente"]
+        for chofer_idx, (route_ordered, legs) in enumerate(route_legs, start=1):
+            ordered.extend(route_ordered)
+            ordered_labels.extend(
+                f"{c['cliente']} (Chofer {chofer_idx})" if multi_chofer else c["cliente"] for c in route_ordered
+            )
+            for i, leg in enumerate(legs):
+                if i == 0:
+                    de_txt = "Origen"
+                    a_txt = route_ordered[0]["cliente"] if route_ordered else "Destino"
+                elif i == len(legs) - 1:
+                    de_txt = route_ordered[-1]["cliente"] if route_ordered else "Origen"
+                    a_txt = "Origen"
+                else:
+                    de_txt = route_ordered[i - 1]["cliente"]
+                    a_txt = route_ordered[i]["cliente"]
 
-            dist = leg.get("distance", {})
-            dur = leg.get("duration_in_traffic") or leg.get("duration") or {}
-            dist_val = int(dist.get("value", 0) or 0)
-            dur_val = int(dur.get("value", 0) or 0)
-            dist_total_m += dist_val
-            dur_total_s += dur_val
+                dist = leg.get("distance", {})
+                dur = leg.get("duration_in_traffic") or leg.get("duration") or {}
+                dist_val = int(dist.get("value", 0) or 0)
+                dur_val = int(dur.get("value", 0) or 0)
+                dist_total_m += dist_val
+                dur_total_s += dur_val
 
-            rows_simple.append(
-                {
+                row_simple = {
                     "Paso": i + 1,
                     "De": de_txt,
                     "A": a_txt,
                     "Distancia": dist.get("text", ""),
                     "Tiempo": dur.get("text", ""),
                 }
-            )
+                if multi_chofer:
+                    row_simple = {"Chofer": chofer_idx, **row_simple}
+                rows_simple.append(row_simple)
 
         df_simple = pd.DataFrame(rows_simple)
         resumen = pd.DataFrame(
@@ -4829,11 +7110,16 @@ def _render_ruta_optimizada_ui(
                 {"Métrica": "Tiempo total min", "Valor": round(dur_total_s / 60, 1)},
             ]
         )
+        if multi_chofer:
+            resumen = pd.concat(
+                [resumen, pd.DataFrame([{"Métrica": "Choferes", "Valor": len(route_legs)}])],
+                ignore_index=True,
+            )
 
-        first_leg = legs[0] if legs else {}
+        first_leg = route_legs[0][1][0] if route_legs and route_legs[0][1] else {}
         start_loc = first_leg.get("start_location", {}) if isinstance(first_leg, dict) else {}
-        origin_lat = float(start_loc.get("lat", 25.67))
-        origin_lng = float(start_loc.get("lng", -100.31))
+        origin_lat = float(start_loc.get("lat", _RUTA_OPT_ORIGIN_LAT))
+        origin_lng = float(start_loc.get("lng", _RUTA_OPT_ORIGIN_LNG))
 
         m = folium.Map(location=[origin_lat, origin_lng], zoom_start=12, control_scale=True)
 
@@ -4857,86 +7143,91 @@ def _render_ruta_optimizada_ui(
             ),
         ).add_to(m)
 
-        # CLIENTES usando snap real de Directions (end_location de cada tramo)
-        for i, leg in enumerate(legs[:-1], start=1):
-            end_loc = leg.get("end_location", {})
-            lat = float(end_loc.get("lat", origin_lat))
-            lng = float(end_loc.get("lng", origin_lng))
-            c = ordered[i - 1] if i - 1 < len(ordered) else {}
-            cliente = str(c.get("cliente", f"Cliente {i}"))
-            direccion = str(c.get("direccion", ""))
-
+        colors = ["darkblue", "darkgreen", "darkred", "purple", "black", "brown", "gray", "orange"]
+        num_colors = len(colors)
+        for chofer_idx, (route_ordered, legs) in enumerate(route_legs):
+            chofer_txt = f"Chofer {chofer_idx + 1} · " if multi_chofer else ""
+            badge_color = colors[chofer_idx % num_colors] if multi_chofer else "black"
+
+            # CLIENTES usando snap real de Directions (end_location de cada tramo)
+            for i, leg in enumerate(legs[:-1], start=1):
+                end_loc = leg.get("end_location", {})
+                lat = float(end_loc.get("lat", origin_lat))
+                lng = float(end_loc.get("lng", origin_lng))
+                c = route_ordered[i - 1] if i - 1 < len(route_ordered) else {}
+                cliente = str(c.get("cliente", f"Cliente {i}"))
+                direccion = str(c.get("direccion", ""))
+
+                folium.Marker(
+                    [lat, lng],
+                    popup=f"{chofer_txt}{i}. {cliente}<br>{direccion}",
+                    tooltip=f"{chofer_txt}{i}. {cliente}",
+                    icon=folium.Icon(color="red"),
+                ).add_to(m)
+                folium.Marker(
+                    [lat, lng],
+                    icon=folium.features.DivIcon(
+                        icon_size=(30, 30),
+                        icon_anchor=(15, 15),
+                        html=(
+                            f'<div style="font-size:14px;color:white;background-color:{badge_color};border-radius:50%;'
+                            f'width:24px;height:24px;text-align:center;line-height:24px;font-weight:bold;'
+                            f'border:2px solid white;">{i}</div>'
+                        ),
+                    ),
+                ).add_to(m)
+
+            # REGRESO
+            ret_num = len(route_ordered) + 1
+            last_leg = legs[-1] if legs else {}
+            end_origin = last_leg.get("end_location", {}) if isinstance(last_leg, dict) else {}
+            ret_lat = float(end_origin.get("lat", origin_lat))
+            ret_lng = float(end_origin.get("lng", origin_lng))
             folium.Marker(
-                [lat, lng],
-                popup=f"{i}. {cliente}<br>{direccion}",
-                tooltip=f"{i}. {cliente}",
-                icon=folium.Icon(color="red"),
+                [ret_lat, ret_lng],
+                popup=f"{chofer_txt}{ret_num}. REGRESO AL ORIGEN",
+                tooltip=f"{chofer_txt}{ret_num}. REGRESO AL ORIGEN",
+                icon=folium.Icon(color="blue"),
             ).add_to(m)
-            folium.Marker(
-                [lat, lng],
-                icon=folium.features.DivIcon(
-                    icon_size=(30, 30),
-                    icon_anchor=(15, 15),
-                    html=(
-                        '<div style="font-size:14px;color:white;background-color:black;border-radius:50%;'
-                        f'width:24px;height:24px;text-align:center;line-height:24px;font-weight:bold;'
-                        f'border:2px solid white;">{i}</div>'
+            if not multi_chofer:
+                folium.Marker(
+                    [ret_lat, ret_lng],
+                    icon=folium.features.DivIcon(
+                        icon_size=(30, 30),
+                        icon_anchor=(15, 15),
+                        html=(
+                            '<div style="font-size:14px;color:white;background-color:blue;border-radius:50%;'
+                            f'width:24px;height:24px;text-align:center;line-height:24px;font-weight:bold;'
+                            f'border:2px solid white;">{ret_num}</div>'
+                        ),
                     ),
-                ),
-            ).add_to(m)
-
-        # REGRESO
-        ret_num = len(ordered) + 1
-        last_leg = legs[-1] if legs else {}
-        end_origin = last_leg.get("end_location", {}) if isinstance(last_leg, dict) else {}
-        ret_lat = float(end_origin.get("lat", origin_lat))
-        ret_lng = float(end_origin.get("lng", origin_lng))
-        folium.Marker(
-            [ret_lat, ret_lng],
-            popup=f"{ret_num}. REGRESO AL ORIGEN",
-            tooltip=f"{ret_num}. REGRESO AL ORIGEN",
-            icon=folium.Icon(color="blue"),
-        ).add_to(m)
-        folium.Marker(
-            [ret_lat, ret_lng],
-            icon=folium.features.DivIcon(
-                icon_size=(30, 30),
-                icon_anchor=(15, 15),
-                html=(
-                    '<div style="font-size:14px;color:white;background-color:blue;border-radius:50%;'
-                    f'width:24px;height:24px;text-align:center;line-height:24px;font-weight:bold;'
-                    f'border:2px solid white;">{ret_num}</div>'
-                ),
-            ),
-        ).add_to(m)
-
-        # Dibujar tramos por pasos (color por tramo)
-        colors = ["darkblue", "darkgreen", "darkred", "purple", "black", "brown", "gray", "orange"]
-        num_colors = len(colors)
-        for i, leg in enumerate(legs):
-            leg_points: list[tuple[float, float]] = []
-            for step_data in leg.get("steps", []):
-                encoded = step_data.get("polyline", {}).get("points", "")
-                if not encoded:
-                    continue
-                try:
-                    leg_points.extend(polyline.decode(encoded))
-                except Exception:
+                ).add_to(m)
+
+            # Dibujar tramos por pasos (color por tramo; por chofer si hay varios)
+            for i, leg in enumerate(legs):
+                leg_points: list[tuple[float, float]] = []
+                for step_data in leg.get("steps", []):
+                    encoded = step_data.get("polyline", {}).get("points", "")
+                    if not encoded:
+                        continue
+                    try:
+                        leg_points.extend(polyline.decode(encoded))
+                    except Exception:
+                        continue
+                if not leg_points:
                     continue
-            if not leg_points:
-                continue
 
-            dur_txt = (
-                leg.get("duration_in_traffic", {}).get("text")
-                or leg.get("duration", {}).get("text", "")
-            )
-            folium.PolyLine(
-                locations=leg_points,
-                color=colors[i % num_colors],
-                weight=5,
-                opacity=0.9,
-                tooltip=f"Tramo {i + 1}: {leg.get('distance', {}).get('text', '')} ({dur_txt})",
-            ).add_to(m)
+                dur_txt = (
+                    leg.get("duration_in_traffic", {}).get("text")
+                    or leg.get("duration", {}).get("text", "")
+                )
+                folium.PolyLine(
+                    locations=leg_points,
+                    color=colors[(chofer_idx if multi_chofer else i) % num_colors],
+                    weight=5,
+                    opacity=0.9,
+                    tooltip=f"{chofer_txt}Tramo {i + 1}: {leg.get('distance', {}).get('text', '')} ({dur_txt})",
+                ).add_to(m)
 
         map_html = m.get_root().render()
 
@@ -4960,7 +7251,7 @@ def _render_ruta_optimizada_ui(
         output_excel.seek(0)
 
         st.session_state[state_key] = {
-            "ordered": [c["cliente"] for c in ordered],
+            "ordered": ordered_labels,
             "df_simple": df_simple,
             "resumen": resumen,
             "map_html": map_html,
@@ -4988,6 +7279,7 @@ def _render_ruta_optimizada_ui(
                     failed += 1
             if saved_ok:
                 st.success(f"✅ Coordenadas guardadas: {saved_ok}.")
+                invalidate_sheet_snapshot(GOOGLE_SHEET_ID, _RUTA_OPT_CLIENTES_SHEET)
                 _load_clientes_locales_df.clear()
             if failed:
                 st.warning(f"⚠️ No se pudieron guardar {failed} coordenadas.")
@@ -5036,101 +7328,41 @@ def _render_ruta_optimizada_ui(
 def batch_update_gsheet_cells(worksheet, updates_list, *, headers: Optional[list[str]] = None):
     """
     Realiza múltiples actualizaciones de celdas en una sola solicitud por lotes a Google Sheets
-    utilizando worksheet.update_cells().
+    a través de la cola agrupada (un ``values:batchUpdate`` por spreadsheet).
     updates_list: Lista de diccionarios, cada uno con las claves 'range' y 'values'.
                   Ej: [{'range': 'A1', 'values': [['nuevo_valor']]}, ...]
     """
     if not updates_list:
         return False
 
-    cell_list = []
+    cells: list[tuple[int, int, Any]] = []
     for update_item in updates_list:
         range_str = update_item['range']
         value = update_item['values'][0][0] # Asumiendo un único valor como [['valor']]
 
         # Convertir la notación A1 (ej. 'A1') a índice de fila y columna (base 1)
         row, col = gspread.utils.a1_to_rowcol(range_str)
-        # Crear un objeto Cell y añadirlo a la lista
-        cell_list.append(gspread.Cell(row=row, col=col, value=value))
+        cells.append((int(row), int(col), value))
 
-    if not cell_list:
+    if not cells:
         return False
 
-    max_attempts = 3
-    base_delay = 1
-
-    for attempt in range(max_attempts):
-        wait_seconds = base_delay * (2 ** attempt)
-        try:
-            worksheet.update_cells(cell_list)  # Este es el método correcto para batch update en el worksheet
-            if headers:
-                worksheet_name = _get_worksheet_name_safe(worksheet)
-                if worksheet_name:
-                    updates_by_row: dict[int, dict[str, Any]] = {}
-                    for item in updates_list:
-                        row_idx, _ = gspread.utils.a1_to_rowcol(item["range"])
-                        row_values = updates_by_row.setdefault(int(row_idx), {})
-                        row_values.update(
-                            _updates_list_to_column_values(headers, [item], target_row_index=int(row_idx))
-                        )
-                    for row_idx, values in updates_by_row.items():
-                        if values:
-                            _record_local_sheet_update(worksheet_name, row_idx, values)
-            # st.cache_data.clear() # Limpiar solo si hay un cambio que justifique una recarga completa
-            return True
-        except gspread.exceptions.APIError as api_error:
-            is_recoverable = _is_recoverable_auth_error(api_error)
-            if attempt < max_attempts - 1:
-                if is_recoverable:
-                    st.warning(
-                        f"🔁 Error de autenticación/cuota al actualizar Google Sheets "
-                        f"(intento {attempt + 1}/{max_attempts}). Reintentando en {wait_seconds}s..."
-                    )
-                else:
-                    st.warning(
-                        f"⚠️ Error de la API de Google Sheets al actualizar celdas "
-                        f"(intento {attempt + 1}/{max_attempts}). Reintentando en {wait_seconds}s..."
-                    )
-                time.sleep(wait_seconds)
-                continue
-
-            if is_recoverable:
-                st.error(
-                    "❌ No se pudo completar la actualización en Google Sheets por un error de autenticación/cuota "
-                    "después de varios intentos."
-                )
-                handle_auth_error(api_error)
-            else:
-                st.error(f"❌ Error definitivo de la API de Google Sheets: {api_error}")
-            break
-        except RequestException as net_err:
-            if attempt < max_attempts - 1:
-                st.warning(
-                    f"⚠️ Error de red al actualizar Google Sheets (intento {attempt + 1}/{max_attempts}). "
-                    f"Reintentando en {wait_seconds}s..."
-                )
-                time.sleep(wait_seconds)
-                continue
-
-            st.error(
-                "❌ No se pudo conectar con Google Sheets para actualizar los datos después de varios intentos. "
-                "Verifica tu conexión o credenciales."
+    updates_by_row: dict[int, dict[str, Any]] = {}
+    if headers:
+        for item in updates_list:
+            row_idx, _ = gspread.utils.a1_to_rowcol(item["range"])
+            row_values = updates_by_row.setdefault(int(row_idx), {})
+            row_values.update(
+                _updates_list_to_column_values(headers, [item], target_row_index=int(row_idx))
             )
-            handle_auth_error(net_err)
-            break
-        except Exception as exc:
-            if attempt < max_attempts - 1:
-                st.warning(
-                    f"⚠️ Error inesperado al actualizar Google Sheets (intento {attempt + 1}/{max_attempts}). "
-                    f"Reintentando en {wait_seconds}s..."
-                )
-                time.sleep(wait_seconds)
-                continue
-
-            st.error(f"❌ Error inesperado al actualizar Google Sheets: {exc}")
-            break
 
-    return False
+    # ``update_cells`` escribía en modo RAW; se conserva para no alterar el formato.
+    return _write_sheet_cells(
+        worksheet,
+        cells,
+        value_input_option="RAW",
+        local_updates=updates_by_row,
+    )
 
 
 def _read_sheet_row_uncached(worksheet: Any, row_index: int) -> list[Any]:
@@ -5174,11 +7406,12 @@ def _update_cell_by_validated_col(
 ) -> bool:
     """Actualiza una celda por índice ya validado y registra la actualización local."""
     try:
-        worksheet.update_cell(int(row_index), int(col_index), value)
-        worksheet_name = _get_worksheet_name_safe(worksheet)
-        if worksheet_name:
-            _record_local_sheet_update(worksheet_name, int(row_index), {col_name: value})
-        return True
+        return _write_sheet_cells(
+            worksheet,
+            [(int(row_index), int(col_index), value)],
+            value_input_option="USER_ENTERED",
+            local_updates={int(row_index): {col_name: value}},
+        )
     except Exception as exc:
         st.error(f"❌ Error al actualizar '{col_name}' en Google Sheets: {exc}")
         return False
@@ -5290,7 +7523,7 @@ def _repair_contaminated_modificacion_estado_rows(
     if df is None or df.empty or not required_df_cols.issubset(df.columns):
         return 0
 
-    live_headers = _get_live_headers_preserving_positions(worksheet, headers)
+    live_headers = get_registered_headers(worksheet, headers)
     col_mod = _find_header_col_in_row1(worksheet, "Modificacion_Surtido", live_headers)
     col_estado = _find_header_col_in_row1(worksheet, "Estado", live_headers)
     col_hora = _find_header_col_in_row1(worksheet, "Hora_Proceso", live_headers)
@@ -5386,7 +7619,7 @@ def confirmar_modificacion_surtido(
 
     live_headers = list(headers or [])
     try:
-        fetched_headers = _get_live_headers_preserving_positions(worksheet, headers)
+        fetched_headers = get_registered_headers(worksheet, headers)
         if fetched_headers:
             live_headers = fetched_headers
     except Exception:
@@ -5624,15 +7857,12 @@ def mirror_guide_value(
     return headers
 
 def get_column_indices(worksheet, column_names):
-    """Obtain fresh column indices for the specified headers."""
+    """Obtain column indices for the specified headers from the header registry."""
     indices = {}
     for name in column_names:
-        try:
-            cell = worksheet.find(name)
-            indices[name] = cell.col if cell else None
-        except gspread.exceptions.CellNotFound:
+        indices[name] = _find_header_col_in_row1(worksheet, name)
+        if indices[name] is None:
             st.error(f"❌ Columna '{name}' no encontrada en la hoja.")
-            indices[name] = None
     return indices
 
 def ensure_columns(worksheet, headers, required_cols):
@@ -5646,6 +7876,9 @@ def ensure_columns(worksheet, headers, required_cols):
         return headers
 
     new_headers = headers + missing
+    # La fila 1 va a cambiar: el registro y el snapshot deben releerla.
+    invalidate_header_registry(worksheet)
+    _invalidate_worksheet_snapshot(worksheet, full_resync=True)
 
     # 1) Intento con update (si existe en tu versión de gspread)
     try:
@@ -5706,7 +7939,8 @@ def upload_file_to_s3(s3_client_param, bucket_name, file_obj, s3_key):
         if hasattr(file_obj, "type") and file_obj.type:
             put_kwargs["ContentType"] = file_obj.type
 
-        s3_client_param.put_object(**put_kwargs)
+        response = s3_client_param.put_object(**put_kwargs)
+        record_s3_manifest_upload(s3_key, len(put_kwargs["Body"]), (response or {}).get("ETag", ""))
 
         permanent_url = f"https://{bucket_name}.s3.{AWS_REGION}.amazonaws.com/{s3_key}"
 
@@ -5721,10 +7955,169 @@ def upload_file_to_s3(s3_client_param, bucket_name, file_obj, s3_key):
 
 # --- AWS S3 Helper Functions (Copied from app_admin.py directly) ---
 
+# --- Manifiesto de adjuntos en S3 ---
+# Índice en memoria (por proceso) de todos los objetos del bucket: clave, tamaño,
+# ETag y fecha. Se llena con un recorrido paginado, se mantiene al día con
+# ``upload_file_to_s3`` y se reconcilia periódicamente en segundo plano, de modo
+# que pintar las tarjetas de pedidos no hace llamadas ``list_objects_v2``.
+S3_MANIFEST_RECONCILE_SECONDS = 300
+
+
+@st.cache_resource
+def _get_s3_manifest() -> dict[str, Any]:
+    """Manifiesto compartido por todas las sesiones del proceso."""
+    return {
+        "lock": threading.Lock(),
+        "crawl_lock": threading.Lock(),
+        "objects": {},
+        "sorted_keys": [],
+        "uploads": {},
+        "prefixes": {},
+        "ready": False,
+        "version": 0,
+        "crawled_at": 0.0,
+        "last_error": "",
+    }
+
+
+def _s3_object_entry(item: dict[str, Any]) -> dict[str, Any]:
+    return {
+        "key": item["Key"],
+        "size": item.get("Size", 0),
+        "etag": str(item.get("ETag", "")),
+        "last_modified": item.get("LastModified"),
+    }
+
+
+def _iter_s3_objects(s3_client_param, prefix: str = ""):
+    """Recorre todos los objetos bajo ``prefix`` página por página (sin tope de 1000 claves)."""
+    paginator = s3_client_param.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=S3_BUCKET_NAME, Prefix=prefix):
+        for item in page.get("Contents", []) or []:
+            yield item
+
+
+def _reconcile_s3_manifest_locked(manifest: dict[str, Any], s3_client_param) -> int:
+    started = time.time()
+    objects = {item["Key"]: _s3_object_entry(item) for item in _iter_s3_objects(s3_client_param)}
+    with manifest["lock"]:
+        # Las subidas hechas durante el recorrido pueden no venir en el listado.
+        for key, uploaded_at in list(manifest["uploads"].items()):
+            if uploaded_at >= started and key in manifest["objects"]:
+                objects.setdefault(key, manifest["objects"][key])
+            else:
+                manifest["uploads"].pop(key, None)
+        manifest["objects"] = objects
+        manifest["sorted_keys"] = sorted(objects)
+        manifest["prefixes"] = {}
+        manifest["version"] += 1
+        manifest["ready"] = True
+        manifest["crawled_at"] = time.time()
+        manifest["last_error"] = ""
+    return len(objects)
+
+
+def reconcile_s3_manifest(s3_client_param) -> int:
+    """Recorre el bucket completo y reemplaza el manifiesto; devuelve el número de objetos."""
+    manifest = _get_s3_manifest()
+    with manifest["crawl_lock"]:
+        return _reconcile_s3_manifest_locked(manifest, s3_client_param)
+
+
+def ensure_s3_manifest(s3_client_param) -> bool:
+    """Garantiza una primera carga del manifiesto; ``False`` si no se pudo listar el bucket."""
+    manifest = _get_s3_manifest()
+    if manifest["ready"]:
+        return True
+    if not s3_client_param:
+        return False
+    try:
+        with manifest["crawl_lock"]:
+            if not manifest["ready"]:
+                _reconcile_s3_manifest_locked(manifest, s3_client_param)
+        return True
+    except Exception as exc:
+        manifest["last_error"] = str(exc)
+        return False
+
+
+def record_s3_manifest_upload(s3_key: str, size: int, etag: str = "") -> None:
+    """Registra en el manifiesto un objeto recién subido."""
+    manifest = _get_s3_manifest()
+    with manifest["lock"]:
+        if s3_key not in manifest["objects"]:
+            bisect.insort(manifest["sorted_keys"], s3_key)
+        manifest["objects"][s3_key] = {
+            "key": s3_key,
+            "size": size,
+            "etag": str(etag or ""),
+            "last_modified": datetime.now(timezone("UTC")),
+        }
+        manifest["uploads"][s3_key] = time.time()
+        manifest["prefixes"] = {}
+        manifest["version"] += 1
+
+
+def _manifest_keys_with_prefix(manifest: dict[str, Any], prefix: str) -> list[str]:
+    keys = manifest["sorted_keys"]
+    start = bisect.bisect_left(keys, prefix)
+    end = start
+    while end < len(keys) and keys[end].startswith(prefix):
+        end += 1
+    return keys[start:end]
+
+
+def _find_pedido_prefix_in_manifest(manifest: dict[str, Any], possible_prefixes: list[str], folder_name: str) -> Optional[str]:
+    with manifest["lock"]:
+        cache_key = (tuple(possible_prefixes), folder_name)
+        if cache_key in manifest["prefixes"]:
+            return manifest["prefixes"][cache_key]
+        resolved = None
+        for pedido_prefix in possible_prefixes:
+            start = bisect.bisect_left(manifest["sorted_keys"], pedido_prefix)
+            if start < len(manifest["sorted_keys"]) and manifest["sorted_keys"][start].startswith(pedido_prefix):
+                resolved = pedido_prefix
+                break
+        if resolved is None:
+            # Búsqueda amplia sobre todo el bucket (antes solo 100 claves arbitrarias).
+            for key in manifest["sorted_keys"]:
+                if folder_name in key and "/" in key:
+                    resolved = "/".join(key.split("/")[:-1]) + "/"
+                    break
+        manifest["prefixes"][cache_key] = resolved
+        return resolved
+
+
+def _s3_manifest_reconcile_loop(state: dict[str, Any]) -> None:
+    while True:
+        time.sleep(S3_MANIFEST_RECONCILE_SECONDS)
+        try:
+            state["last_objects"] = reconcile_s3_manifest(get_s3_client())
+            state["last_run"] = time.time()
+            state["last_error"] = ""
+        except Exception as exc:
+            state["last_error"] = str(exc)
+
+
+@st.cache_resource
+def start_s3_manifest_reconciler() -> dict[str, Any]:
+    """Arranca (una vez por proceso) el hilo que reconcilia el manifiesto con S3."""
+    state: dict[str, Any] = {"last_run": 0.0, "last_objects": 0, "last_error": ""}
+    thread = threading.Thread(
+        target=_s3_manifest_reconcile_loop,
+        args=(state,),
+        name="s3-manifest-reconciler",
+        daemon=True,
+    )
+    thread.start()
+    return state
+
+
 def find_pedido_subfolder_prefix(s3_client_param, parent_prefix, folder_name):
     """
     Finds the correct S3 prefix for a given order folder.
     Searches for various possible prefix formats.
+    Resolves against the S3 manifest; falls back to live probes if it is unavailable.
     """
     if not s3_client_param:
         return None
@@ -5738,6 +8131,9 @@ def find_pedido_subfolder_prefix(s3_client_param, parent_prefix, folder_name):
         folder_name
     ]
 
+    if ensure_s3_manifest(s3_client_param):
+        return _find_pedido_prefix_in_manifest(_get_s3_manifest(), possible_prefixes, str(folder_name))
+
     for pedido_prefix in possible_prefixes:
         try:
             response = s3_client_param.list_objects_v2(
@@ -5753,23 +8149,6 @@ def find_pedido_subfolder_prefix(s3_client_param, parent_prefix, folder_name):
             # Continue to the next prefix if there's an error with the current one
             continue
 
-    # If direct prefix search fails, try a broader search
-    try:
-        response = s3_client_param.list_objects_v2(
-            Bucket=S3_BUCKET_NAME,
-            MaxKeys=100 # Adjust MaxKeys or implement pagination if many objects are expected
-        )
-
-        if 'Contents' in response:
-            for obj in response['Contents']:
-                if folder_name in obj['Key']:
-                    if '/' in obj['Key']:
-                        prefix_parts = obj['Key'].split('/')[:-1]
-                        return '/'.join(prefix_parts) + '/'
-
-    except Exception:
-        pass # Silently fail if broader search also has issues
-
     return None
 
 def get_files_in_s3_prefix(s3_client_param, prefix):
@@ -5780,24 +8159,24 @@ def get_files_in_s3_prefix(s3_client_param, prefix):
         return []
 
     try:
-        response = s3_client_param.list_objects_v2(
-            Bucket=S3_BUCKET_NAME,
-            Prefix=prefix,
-            MaxKeys=100 # Adjust MaxKeys or implement pagination if many files are expected
-        )
+        if ensure_s3_manifest(s3_client_param):
+            manifest = _get_s3_manifest()
+            with manifest["lock"]:
+                items = [manifest["objects"][key] for key in _manifest_keys_with_prefix(manifest, prefix)]
+        else:
+            items = [_s3_object_entry(item) for item in _iter_s3_objects(s3_client_param, prefix)]
 
         files = []
-        if 'Contents' in response:
-            for item in response['Contents']:
-                if not item['Key'].endswith('/'): # Exclude folders
-                    file_name = item['Key'].split('/')[-1]
-                    if file_name:
-                        files.append({
-                            'title': file_name,
-                            'key': item['Key'],
-                            'size': item['Size'],
-                            'last_modified': item['LastModified']
-                        })
+        for item in items:
+            if not item['key'].endswith('/'): # Exclude folders
+                file_name = item['key'].split('/')[-1]
+                if file_name:
+                    files.append({
+                        'title': file_name,
+                        'key': item['key'],
+                        'size': item['size'],
+                        'last_modified': item['last_modified']
+                    })
         return files
 
     except Exception as e:
@@ -5814,32 +8193,94 @@ def extract_s3_key(url_or_key: str) -> str:
     return url_or_key
 
 
+# --- Caché de URLs prefirmadas ---
+# Firmar una URL es barato pero se hacía para cada adjunto visible en cada rerun
+# y la URL (válida 7 días) se tiraba segundos después. Se reutiliza la misma
+# URL hasta un margen antes de su expiración; LRU acotado por proceso.
+PRESIGNED_URL_CACHE_MAX = 5000
+PRESIGNED_URL_SAFETY_MARGIN_SECONDS = 3600
+
+
+@st.cache_resource
+def _get_presigned_url_cache() -> dict[str, Any]:
+    """Caché LRU de URLs prefirmadas compartida por todas las sesiones del proceso."""
+    return {"lock": threading.Lock(), "urls": OrderedDict()}
+
+
+def _presigned_url_params(clean_key: Any) -> dict[str, Any]:
+    params = {"Bucket": S3_BUCKET_NAME, "Key": clean_key}
+    if isinstance(clean_key, str):
+        lower_key = clean_key.lower()
+        if lower_key.endswith(INLINE_EXT):
+            filename = (clean_key.split("/")[-1] or "archivo").replace('"', "")
+            params["ResponseContentDisposition"] = f'inline; filename="{filename}"'  # FORCE INLINE VIEW (PDF / IMAGES)
+            if lower_key.endswith(".pdf"):
+                params["ResponseContentType"] = "application/pdf"
+            elif lower_key.endswith((".jpg", ".jpeg")):
+                params["ResponseContentType"] = "image/jpeg"
+            elif lower_key.endswith(".png"):
+                params["ResponseContentType"] = "image/png"
+            elif lower_key.endswith(".webp"):
+                params["ResponseContentType"] = "image/webp"
+    return params
+
+
+def presign_s3_file_download_urls(
+    s3_client_param, object_keys_or_urls: Sequence[Any], expires_in: int = 604800
+) -> list[str]:
+    """Devuelve las URLs prefirmadas de varios objetos, firmando solo las que no están en caché."""
+    cache = _get_presigned_url_cache()
+    now = time.time()
+    # Se reutiliza hasta ``margen`` antes de expirar (a lo más una cuarta parte de la vigencia).
+    reuse_seconds = expires_in - min(PRESIGNED_URL_SAFETY_MARGIN_SECONDS, expires_in // 4)
+    params_list = [_presigned_url_params(extract_s3_key(value)) for value in object_keys_or_urls]
+    cache_keys = [
+        (
+            params["Bucket"],
+            params["Key"],
+            params.get("ResponseContentDisposition", ""),
+            params.get("ResponseContentType", ""),
+            int(expires_in),
+        )
+        for params in params_list
+    ]
+    urls: list[Optional[str]] = [None] * len(params_list)
+    with cache["lock"]:
+        for pos, cache_key in enumerate(cache_keys):
+            entry = cache["urls"].get(cache_key)
+            if entry and entry[1] > now:
+                cache["urls"].move_to_end(cache_key)
+                urls[pos] = entry[0]
+
+    signed: dict[tuple, str] = {}
+    for pos, params in enumerate(params_list):
+        if urls[pos] is None:
+            cache_key = cache_keys[pos]
+            if cache_key not in signed:
+                signed[cache_key] = s3_client_param.generate_presigned_url(
+                    "get_object",
+                    Params=params,
+                    ExpiresIn=expires_in,
+                )
+            urls[pos] = signed[cache_key]
+
+    if signed:
+        with cache["lock"]:
+            for cache_key, url in signed.items():
+                cache["urls"][cache_key] = (url, now + reuse_seconds)
+                cache["urls"].move_to_end(cache_key)
+            while len(cache["urls"]) > PRESIGNED_URL_CACHE_MAX:
+                cache["urls"].popitem(last=False)
+    return urls
+
+
 def get_s3_file_download_url(s3_client_param, object_key_or_url, expires_in=604800):
-    """Genera y retorna una URL prefirmada para archivos almacenados en S3."""
+    """Genera y retorna una URL prefirmada para archivos almacenados en S3 (reutilizada desde la caché)."""
     if not s3_client_param or not S3_BUCKET_NAME:
         st.error("❌ Configuración de S3 incompleta. Verifica el cliente y el nombre del bucket.")
         return "#"
     try:
-        clean_key = extract_s3_key(object_key_or_url)
-        params = {"Bucket": S3_BUCKET_NAME, "Key": clean_key}
-        if isinstance(clean_key, str):
-            lower_key = clean_key.lower()
-            if lower_key.endswith(INLINE_EXT):
-                filename = (clean_key.split("/")[-1] or "archivo").replace('"', "")
-                params["ResponseContentDisposition"] = f'inline; filename="{filename}"'  # FORCE INLINE VIEW (PDF / IMAGES)
-                if lower_key.endswith(".pdf"):
-                    params["ResponseContentType"] = "application/pdf"
-                elif lower_key.endswith((".jpg", ".jpeg")):
-                    params["ResponseContentType"] = "image/jpeg"
-                elif lower_key.endswith(".png"):
-                    params["ResponseContentType"] = "image/png"
-                elif lower_key.endswith(".webp"):
-                    params["ResponseContentType"] = "image/webp"
-        return s3_client_param.generate_presigned_url(
-            "get_object",
-            Params=params,
-            ExpiresIn=expires_in,
-        )
+        return presign_s3_file_download_urls(s3_client_param, [object_key_or_url], expires_in)[0]
     except Exception as e:
         st.error(f"❌ Error al generar URL prefirmada: {e}")
         return "#"
@@ -6157,17 +8598,6 @@ def es_victor_devolucion_sin_guia(row: Any, origen_tab: Any, current_main_tab_la
     return "devoluci" in context_text or "devoluciones" in context_text
 
 
-def _mark_skip_demorado_check_once() -> None:
-    """Evita el auto-cambio a Demorado en el rerun inmediato tras una acción manual."""
-
-    st.session_state["skip_demorado_check_once"] = True
-
-
-def _preserve_and_mark_skip_demorado() -> None:
-    preserve_tab_state()
-    _mark_skip_demorado_check_once()
-
-
 def completar_pedido(
     df: pd.DataFrame,
     idx: int,
@@ -6313,78 +8743,275 @@ def completar_pedido(
     return True
 
 
-# --- Helper Functions (existing in app.py) ---
-
-def ordenar_pedidos_custom(df_pedidos_filtrados):
+def completar_pedidos_en_lote(
+    df: pd.DataFrame,
+    rows: Sequence[Any],
+    worksheet: Any,
+    headers: list,
+    origen_tab: str = "bulk_multi",
+) -> list[dict[str, Any]]:
     """
-    Ordena el DataFrame con:
-    1. Modificación de Surtido
-    2. Demorados
-    3. Pendientes
-    4. En Proceso
-    En cada grupo se muestran primero los más antiguos y al final los más recientes.
+    Completa varios pedidos con una lectura de verificación y una sola escritura.
+
+    1. Lee ID_Pedido/Estado/Surtidor de la hoja en un ``values:batchGet`` y valida
+       cada fila contra esa lectura (otra sesión pudo moverla o completarla).
+    2. Escribe Estado y Fecha_Completado de todos los pedidos válidos en un
+       único ``values:batchUpdate``.
+    3. Actualiza Pasa_Bodega para los pedidos de ese flujo en un solo lote.
+
+    Devuelve un resultado por pedido: ``{"ID_Pedido", "ok", "detalle"}``.
     """
-    if df_pedidos_filtrados.empty:
-        return df_pedidos_filtrados
+    resultados: dict[str, dict[str, Any]] = {}
+    candidatos: list[tuple[str, int, Any]] = []
+    for row in rows:
+        pedido_id = str(row.get("ID_Pedido", "") or "").strip()
+        if not pedido_id:
+            continue
+        resultado = {"ID_Pedido": pedido_id, "ok": False, "detalle": ""}
+        resultados[pedido_id] = resultado
+        try:
+            gsheet_row_index = int(row.get("_gsheet_row_index"))
+        except (TypeError, ValueError):
+            gsheet_row_index = 0
+        if gsheet_row_index <= 1:
+            resultado["detalle"] = "sin índice de fila en Google Sheets"
+            continue
+        if pedido_requiere_guia(row) and not pedido_tiene_guia_adjunta(row):
+            resultado["detalle"] = "requiere guía antes de completar"
+            continue
+        candidatos.append((pedido_id, gsheet_row_index, row))
 
-    df_pedidos_filtrados = df_pedidos_filtrados.copy()
+    def _fallar_candidatos(detalle: str) -> list[dict[str, Any]]:
+        for pedido_id, _, _ in candidatos:
+            resultados[pedido_id]["detalle"] = detalle
+        return list(resultados.values())
 
-    # Asegurar datetime para ordenar por antigüedad
-    if 'Hora_Registro' in df_pedidos_filtrados.columns:
-        df_pedidos_filtrados['Hora_Registro_dt'] = pd.to_datetime(
-            df_pedidos_filtrados['Hora_Registro'], errors='coerce'
-        )
-    else:
-        df_pedidos_filtrados['Hora_Registro_dt'] = pd.NaT
+    if not candidatos:
+        return list(resultados.values())
 
-    if 'Fecha_Registro' in df_pedidos_filtrados.columns:
-        df_pedidos_filtrados['Fecha_Registro_dt'] = pd.to_datetime(
-            df_pedidos_filtrados['Fecha_Registro'], errors='coerce'
-        )
+    try:
+        estado_col = headers.index("Estado") + 1
+        fecha_completado_col = headers.index("Fecha_Completado") + 1
+        id_col = headers.index("ID_Pedido") + 1
+    except ValueError as err:
+        return _fallar_candidatos(f"falta la columna requerida: {err}")
+    es_victor = usuario_actual_es_victor()
+    if "Surtidor" in headers:
+        surtidor_col = headers.index("Surtidor") + 1
+    elif es_victor:
+        surtidor_col = None
     else:
-        df_pedidos_filtrados['Fecha_Registro_dt'] = pd.NaT
+        # Sin la columna no se puede comprobar el Surtidor: no se completa a ciegas.
+        return _fallar_candidatos("falta la columna requerida: 'Surtidor'")
+
+    worksheet_name = _get_worksheet_name_safe(worksheet)
+    check_cols = [id_col, estado_col] + ([surtidor_col] if surtidor_col else [])
+    ranges = []
+    for col_idx in check_cols:
+        column_letter = re.sub(r"\d", "", gspread.utils.rowcol_to_a1(1, col_idx))
+        ranges.append(_sheet_a1_range(worksheet_name, f"{column_letter}1:{column_letter}"))
+    try:
+        columnas = _run_gsheet_read_with_backoff(
+            lambda: _values_batch_get(worksheet.spreadsheet, ranges, acquire_quota=False),
+            operation_name="verificación del completado múltiple",
+        )
+    except Exception as exc:
+        return _fallar_candidatos(f"no se pudo verificar en Google Sheets: {exc}")
 
-    df_pedidos_filtrados['Fecha_Orden_dt'] = df_pedidos_filtrados['Hora_Registro_dt'].combine_first(
-        df_pedidos_filtrados['Fecha_Registro_dt']
-    )
+    def _celda(column: list[list[str]], row_idx: int) -> str:
+        cell = column[row_idx - 1] if row_idx - 1 < len(column) else []
+        return str(cell[0]).strip() if cell else ""
 
-    def get_sort_key(row):
-        mod_texto = str(row.get("Modificacion_Surtido", "")).strip()
-        refact_tipo = str(row.get("Refacturacion_Tipo", "")).strip()
-        estado = str(row.get("Estado", "")).strip()
-        tiene_modificacion_sin_confirmar = (
-            mod_texto and
-            not mod_texto.endswith("[✔CONFIRMADO]") and
-            refact_tipo != "Datos Fiscales"
+    now = mx_now()
+    now_str = now.strftime("%Y-%m-%d %H:%M:%S")
+    updates: list[dict[str, Any]] = []
+    validados: list[tuple[str, int, Any]] = []
+    for pedido_id, gsheet_row_index, row in candidatos:
+        resultado = resultados[pedido_id]
+        if _celda(columnas[0], gsheet_row_index) != pedido_id:
+            resultado["detalle"] = "la fila cambió en Google Sheets; recarga e intenta de nuevo"
+            continue
+        estado_actual = _celda(columnas[1], gsheet_row_index)
+        estado_requerido = ESTADO_AUDITADO if _es_pedido_local(row) else ESTADO_EN_PROCESO
+        if estado_actual != estado_requerido:
+            resultado["detalle"] = f"cambió de estado a {estado_actual or 'N/A'} (requiere {estado_requerido})"
+            continue
+        if surtidor_col and not es_victor and not _celda(columnas[2], gsheet_row_index):
+            resultado["detalle"] = "no tiene Surtidor asignado"
+            continue
+        updates.append(
+            {"range": gspread.utils.rowcol_to_a1(gsheet_row_index, estado_col), "values": [[ESTADO_COMPLETADO]]}
+        )
+        updates.append(
+            {"range": gspread.utils.rowcol_to_a1(gsheet_row_index, fecha_completado_col), "values": [[now_str]]}
         )
+        validados.append((pedido_id, gsheet_row_index, row))
+
+    if not validados:
+        return list(resultados.values())
+
+    if not batch_update_gsheet_cells(worksheet, updates, headers=headers):
+        for pedido_id, _, _ in validados:
+            resultados[pedido_id]["detalle"] = "no se pudo escribir en Google Sheets"
+        return list(resultados.values())
+
+    ids_df = df.get("ID_Pedido", pd.Series(dtype=str)).astype(str).str.strip()
+    mask_completados = ids_df.isin([pedido_id for pedido_id, _, _ in validados])
+    df.loc[mask_completados, "Estado"] = ESTADO_COMPLETADO
+    df.loc[mask_completados, "Fecha_Completado"] = now
+
+    pasa_bodega_rows: dict[str, dict[str, Any]] = {}
+    for pedido_id, _, row in validados:
+        resultados[pedido_id]["ok"] = True
+        snapshot = row.to_dict() if isinstance(row, pd.Series) else dict(row)
+        snapshot["Estado"] = ESTADO_COMPLETADO
+        snapshot["Fecha_Completado"] = now
+        if _is_pasa_bodega_order(snapshot, origen_tab):
+            pasa_bodega_rows[pedido_id] = snapshot
+        st.session_state["expanded_pedidos"][pedido_id] = True
+        st.session_state["expanded_attachments"][pedido_id] = True
+
+    if pasa_bodega_rows:
+        motivos = _upsert_pasa_bodega_report_rows(list(pasa_bodega_rows.values()))
+        for pedido_id, snapshot in pasa_bodega_rows.items():
+            folio = _normalize_plain_text(snapshot.get("Folio_Factura", ""))
+            motivo = motivos.get(folio, "Folio_Factura vacío") if folio else "Folio_Factura vacío"
+            if motivo:
+                resultados[pedido_id]["detalle"] = f"completado, pero no se actualizó Pasa_Bodega: {motivo}"
 
-        fecha_orden = row.get('Fecha_Orden_dt')
-        if pd.isna(fecha_orden):
-            fecha_orden = pd.Timestamp.max
+    try:
+        df["Fecha_Completado"] = pd.to_datetime(df["Fecha_Completado"], errors="coerce")
+    except Exception:
+        pass
+    st.session_state["reload_after_action"] = True
+    return list(resultados.values())
+
+
+# --- Helper Functions (existing in app.py) ---
 
-        if tiene_modificacion_sin_confirmar:
-            return (0, fecha_orden)
+ORDEN_CUSTOM_COLUMN = "_orden_custom"
+ORDEN_CUSTOM_ESTADOS = ("🔴 Demorado", "🟡 Pendiente", "🔵 En Proceso")
 
-        if estado == "🔴 Demorado":
-            return (1, fecha_orden)
 
-        if estado == "🟡 Pendiente":
-            return (2, fecha_orden)
+def _orden_custom_claves(df: pd.DataFrame) -> tuple[np.ndarray, np.ndarray]:
+    """Prioridad (int8) y fecha de orden (ns) de cada fila para ``ordenar_pedidos_custom``."""
+    def _texto(col: str) -> pd.Series:
+        if col not in df.columns:
+            return pd.Series("", index=df.index)
+        return df[col].astype(str).str.strip()
+
+    mod_texto = _texto("Modificacion_Surtido")
+    modificacion_sin_confirmar = (
+        mod_texto.ne("")
+        & ~mod_texto.str.endswith("[✔CONFIRMADO]")
+        & _texto("Refacturacion_Tipo").ne("Datos Fiscales")
+    )
+    estado = _texto("Estado")
+    prioridad = np.select(
+        [modificacion_sin_confirmar.to_numpy()]
+        + [estado.eq(valor).to_numpy() for valor in ORDEN_CUSTOM_ESTADOS],
+        [0, 1, 2, 3],
+        default=4,
+    ).astype(np.int8)
+
+    def _fechas(col: str) -> pd.Series:
+        if col not in df.columns:
+            return pd.Series(pd.NaT, index=df.index, dtype="datetime64[ns]")
+        return pd.to_datetime(df[col], errors="coerce")
+
+    fecha_orden = _fechas("Hora_Registro").combine_first(_fechas("Fecha_Registro"))
+    if getattr(fecha_orden.dt, "tz", None) is not None:
+        fecha_orden = fecha_orden.dt.tz_convert(None)
+    fecha_ns = fecha_orden.astype("datetime64[ns]").fillna(pd.Timestamp.max).astype("int64").to_numpy()
+    return prioridad, fecha_ns
 
-        if estado == "🔵 En Proceso":
-            return (3, fecha_orden)
 
-        return (4, fecha_orden)
+def _orden_custom_rango_directo(df: pd.DataFrame) -> np.ndarray:
+    prioridad, fecha_ns = _orden_custom_claves(df)
+    orden = np.lexsort((fecha_ns, prioridad))
+    rango = np.empty(len(df), dtype=np.int64)
+    rango[orden] = np.arange(len(df), dtype=np.int64)
+    return rango
 
 
-    df_pedidos_filtrados['custom_sort_key'] = df_pedidos_filtrados.apply(get_sort_key, axis=1)
+@st.cache_data(max_entries=16, show_spinner=False)
+def _orden_custom_rango(
+    worksheet_name: str,
+    snapshot_version: int,
+    local_key: tuple,
+    _df: pd.DataFrame,
+) -> tuple[np.ndarray, np.ndarray]:
+    # ``_df`` no forma parte de la clave de caché: lo determinan la hoja, la versión
+    # del snapshot y las actualizaciones locales de la sesión (``local_key``).
+    filas = pd.to_numeric(_df.get("_gsheet_row_index", pd.Series(dtype=float)), errors="coerce").to_numpy()
+    return filas, _orden_custom_rango_directo(_df)
+
+
+def _orden_custom_local_key(worksheet_name: str) -> tuple:
+    """Actualizaciones locales aplicadas al DataFrame (cambian el orden sin cambiar la versión)."""
+    worksheet_updates = st.session_state.get("local_sheet_updates", {}).get(worksheet_name, {})
+    return tuple(
+        sorted(
+            (int(row_index), str(col), str(value))
+            for row_index, updates in worksheet_updates.items()
+            for col, value in updates.items()
+            if not str(col).startswith("__")
+        )
+    )
+
 
-    df_sorted = df_pedidos_filtrados.sort_values(by='custom_sort_key', ascending=True)
+def asignar_orden_custom(
+    df: pd.DataFrame,
+    snapshot_version: Optional[int] = None,
+    worksheet_name: str = "",
+) -> pd.DataFrame:
+    """
+    Precalcula en ``_orden_custom`` la posición de cada fila en el orden de
+    ``ordenar_pedidos_custom``; las vistas derivadas del DataFrame reutilizan
+    esa permutación en lugar de recalcular las claves.
 
-    return df_sorted.drop(
-        columns=['custom_sort_key', 'Hora_Registro_dt', 'Fecha_Registro_dt', 'Fecha_Orden_dt'],
-        errors='ignore',
+    Con ``snapshot_version`` la permutación se cachea por versión del snapshot
+    (como ``get_raw_sheet_data``) y no se recalcula en cada rerun.
+    """
+    if df.empty:
+        return df
+    if not snapshot_version:
+        # Sin versión conocida (0) no hay clave confiable: se calcula directo.
+        df[ORDEN_CUSTOM_COLUMN] = _orden_custom_rango_directo(df)
+        return df
+    filas, rango = _orden_custom_rango(
+        worksheet_name,
+        int(snapshot_version),
+        _orden_custom_local_key(worksheet_name),
+        df,
     )
+    filas_actuales = pd.to_numeric(df.get("_gsheet_row_index", pd.Series(dtype=float)), errors="coerce").to_numpy()
+    if len(filas) != len(df) or not np.array_equal(filas, filas_actuales, equal_nan=True):
+        # Mismas claves pero otras filas (no debería pasar): se calcula sin caché.
+        rango = _orden_custom_rango_directo(df)
+    df[ORDEN_CUSTOM_COLUMN] = rango
+    return df
+
+
+def ordenar_pedidos_custom(df_pedidos_filtrados):
+    """
+    Ordena el DataFrame con:
+    1. Modificación de Surtido
+    2. Demorados
+    3. Pendientes
+    4. En Proceso
+    En cada grupo se muestran primero los más antiguos y al final los más recientes.
+    """
+    if df_pedidos_filtrados.empty:
+        return df_pedidos_filtrados
+
+    rango = df_pedidos_filtrados.get(ORDEN_CUSTOM_COLUMN)
+    if rango is not None and rango.notna().all():
+        orden = np.argsort(rango.to_numpy(), kind="stable")
+    else:
+        prioridad, fecha_ns = _orden_custom_claves(df_pedidos_filtrados)
+        orden = np.lexsort((fecha_ns, prioridad))
+    return df_pedidos_filtrados.iloc[orden].copy()
 
 
 def _render_paginated_iterrows(df_source: pd.DataFrame, view_key: str):
@@ -6420,59 +9047,180 @@ def _render_paginated_iterrows(df_source: pd.DataFrame, view_key: str):
 
     return enumerate(visible_df.iterrows(), start=1)
 
-def check_and_update_demorados(df_to_check, worksheet, headers):
+# --- Barrido de demorados en segundo plano ---
+# Un solo hilo por despliegue (el proceso que obtiene el candado líder) revisa
+# cada minuto los snapshots compartidos y pasa a '🔴 Demorado' los pedidos
+# '🟡 Pendiente' con más de 1 hora desde su registro. Las sesiones ven el cambio
+# porque el snapshot avanza de versión; no se limpian cachés ni se fuerzan reruns.
+DEMORADO_SWEEP_INTERVAL_SECONDS = 60
+DEMORADO_SWEEP_LOCK_PATH = os.environ.get(
+    "DEMORADO_SWEEP_LOCK_PATH",
+    os.path.join(tempfile.gettempdir(), "app_almacen_demorado_sweeper.lock"),
+)
+DEMORADO_SWEEP_WORKSHEETS = (
+    GOOGLE_SHEET_WORKSHEET_NAME,
+    GOOGLE_SHEET_HISTORICAL_WORKSHEET_NAME,
+    "casos_especiales",
+)
+DEMORADO_AFTER_SECONDS = 3600
+
+
+def _demorado_candidate_rows(df: pd.DataFrame, current_time: datetime) -> list[int]:
     """
-    Revisa pedidos en estado '🟡 Pendiente' que lleven más de 1 hora desde su registro
-    y los actualiza a '🔴 Demorado'.
+    Filas de Sheets que deben pasar de '🟡 Pendiente' a '🔴 Demorado'.
+
+    Misma regla que la revisión por fila anterior: los pedidos locales con
+    Fecha_Entrega futura no cuentan y la Hora_Registro sin zona se toma como
+    hora de Ciudad de México.
     """
-    updates_to_perform = []
-    zona_mexico = timezone("America/Mexico_City")
-    current_time = datetime.now(zona_mexico)
+    if df.empty or "Estado" not in df.columns or "_gsheet_row_index" not in df.columns:
+        return []
 
-    try:
-        estado_col_index = headers.index('Estado') + 1
-    except ValueError:
-        st.error("❌ Error interno: Columna 'Estado' no encontrada en los encabezados de Google Sheets.")
-        return df_to_check, False
+    pendientes = df[df["Estado"] == "🟡 Pendiente"]
+    if pendientes.empty:
+        return []
+
+    tipo_envio = pendientes.get("Tipo_Envio", pd.Series("", index=pendientes.index)).astype(str).str.strip()
+    es_local = tipo_envio == "📍 Pedido Local"
+    fecha_futura = pd.Series(False, index=pendientes.index)
+    if es_local.any():
+        fechas_locales = pendientes.loc[es_local].get(
+            "Fecha_Entrega", pd.Series("", index=pendientes.index[es_local])
+        )
+
+        def _es_fecha_futura(value: Any) -> bool:
+            fecha = pd.to_datetime(value, errors="coerce", dayfirst=True)
+            return bool(pd.notna(fecha) and fecha.date() > current_time.date())
+
+        fecha_futura.loc[es_local] = _map_distinct_values(fechas_locales.tolist(), _es_fecha_futura)
+
+    hora_registro = pendientes.get("Hora_Registro", pd.Series(pd.NaT, index=pendientes.index))
+    if pd.api.types.is_datetime64_any_dtype(hora_registro):
+        if hora_registro.dt.tz is None:
+            hora_registro = hora_registro.dt.tz_localize("America/Mexico_City")
+        segundos = (pd.Timestamp(current_time) - hora_registro).dt.total_seconds()
+    else:
+        def _segundos_desde(value: Any) -> float:
+            hora = pd.to_datetime(value, errors="coerce")
+            if pd.isna(hora):
+                return float("nan")
+            hora = hora.tz_localize("America/Mexico_City") if hora.tzinfo is None else hora
+            return (current_time - hora).total_seconds()
+
+        segundos = pd.Series(
+            _map_distinct_values(hora_registro.tolist(), _segundos_desde),
+            index=pendientes.index,
+            dtype=float,
+        )
+
+    demorados = ~fecha_futura & (segundos > DEMORADO_AFTER_SECONDS) & pendientes["_gsheet_row_index"].notna()
+    return sorted(int(row) for row in pendientes.loc[demorados, "_gsheet_row_index"])
 
-    changes_made = False
 
-    for idx, row in df_to_check.iterrows():
-        if row['Estado'] != "🟡 Pendiente":
+def _sweep_demorados_once(gspread_client: Any) -> int:
+    """Un barrido: candidatos desde los snapshots, 1 lectura de verificación y 1 escritura."""
+    current_time = datetime.now(timezone("America/Mexico_City"))
+    candidates: dict[str, tuple[int, list[int]]] = {}
+    for worksheet_name in DEMORADO_SWEEP_WORKSHEETS:
+        # Solo se barren las hojas que alguna sesión tiene cargadas en el snapshot.
+        values = _get_sheet_snapshot_entry(GOOGLE_SHEET_ID, worksheet_name)["values"]
+        if not values or len(values) < 2 or "Estado" not in values[0]:
             continue
+        df, headers = _process_sheet_data_incremental(GOOGLE_SHEET_ID, worksheet_name, values)
+        rows = _demorado_candidate_rows(df, current_time)
+        if rows:
+            candidates[worksheet_name] = (headers.index("Estado") + 1, rows)
 
-        tipo_envio = str(row.get('Tipo_Envio', '')).strip()
-        if tipo_envio == "📍 Pedido Local":
-            fecha_entrega = pd.to_datetime(
-                row.get('Fecha_Entrega', ''),
-                errors='coerce',
-                dayfirst=True,
-            )
-            if pd.notna(fecha_entrega) and fecha_entrega.date() > current_time.date():
-                continue
+    if not candidates:
+        return 0
+    if not acquire_sheets_quota("read", "background"):
+        return 0
+
+    # Verificación en Sheets: otra sesión pudo procesar el pedido después del snapshot.
+    spreadsheet = gspread_client.open_by_key(GOOGLE_SHEET_ID)
+    ranges = []
+    for worksheet_name, (estado_col, _) in candidates.items():
+        column_letter = re.sub(r"\d", "", gspread.utils.rowcol_to_a1(1, estado_col))
+        ranges.append(_sheet_a1_range(worksheet_name, f"{column_letter}1:{column_letter}"))
+    try:
+        estados_actuales = _values_batch_get(spreadsheet, ranges, acquire_quota=False)
+    except gspread.exceptions.APIError as api_error:
+        if _is_rate_limit_error(api_error):
+            report_sheets_quota_exhausted("read")
+        raise
+
+    pending: dict[tuple[str, int, int], dict[str, Any]] = {}
+    for (worksheet_name, (estado_col, rows)), column in zip(candidates.items(), estados_actuales):
+        for row_idx in rows:
+            cell = column[row_idx - 1] if row_idx - 1 < len(column) else []
+            if cell and str(cell[0]).strip() == "🟡 Pendiente":
+                pending[(worksheet_name, row_idx, estado_col)] = {
+                    "worksheet": None,
+                    "value": "🔴 Demorado",
+                    "value_input_option": "RAW",
+                }
+    if not pending:
+        return 0
+    if not acquire_sheets_quota("write", "background"):
+        return 0
+
+    try:
+        _send_sheet_values_batch_update(spreadsheet, pending)
+    except gspread.exceptions.APIError as api_error:
+        if _is_rate_limit_error(api_error):
+            report_sheets_quota_exhausted("write")
+        raise
+
+    cells_by_worksheet: dict[str, dict[int, dict[int, Any]]] = {}
+    for (worksheet_name, row_idx, col_idx), item in pending.items():
+        cells_by_worksheet.setdefault(worksheet_name, {}).setdefault(row_idx, {})[col_idx] = item["value"]
+    for worksheet_name, cells in cells_by_worksheet.items():
+        apply_sheet_snapshot_cells(GOOGLE_SHEET_ID, worksheet_name, cells)
+    return len(pending)
+
+
+def _acquire_demorado_sweeper_leadership(state: dict[str, Any]) -> bool:
+    """Candado líder entre procesos; se conserva mientras el proceso siga vivo."""
+    if state.get("lock_file") is not None or fcntl is None:
+        return True
+    try:
+        lock_file = open(DEMORADO_SWEEP_LOCK_PATH, "a+")
+    except OSError:
+        return False
+    try:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return False
+    state["lock_file"] = lock_file
+    return True
 
-        hora_registro = pd.to_datetime(row.get('Hora_Registro'), errors='coerce')
-        gsheet_row_index = row.get('_gsheet_row_index')
 
-        if pd.notna(hora_registro):
-            hora_registro = hora_registro.tz_localize("America/Mexico_City") if hora_registro.tzinfo is None else hora_registro
-            if (current_time - hora_registro).total_seconds() > 3600 and gsheet_row_index is not None:
-                updates_to_perform.append({
-                    'range': f"{gspread.utils.rowcol_to_a1(gsheet_row_index, estado_col_index)}",
-                    'values': [["🔴 Demorado"]]
-                })
-                df_to_check.loc[idx, "Estado"] = "🔴 Demorado"
-                changes_made = True
+def _demorado_sweeper_loop(state: dict[str, Any]) -> None:
+    while True:
+        try:
+            if _acquire_demorado_sweeper_leadership(state):
+                client = get_gspread_client(_credentials_json_dict=GSHEETS_CREDENTIALS)
+                state["last_updates"] = _sweep_demorados_once(client)
+                state["last_run"] = time.time()
+                state["last_error"] = ""
+        except Exception as exc:
+            state["last_error"] = str(exc)
+        time.sleep(DEMORADO_SWEEP_INTERVAL_SECONDS)
 
-    if updates_to_perform:
-        if batch_update_gsheet_cells(worksheet, updates_to_perform, headers=headers):
-            st.toast(f"✅ Se actualizaron {len(updates_to_perform)} pedidos a 'Demorado'.", icon="✅")
-            return df_to_check, changes_made
-        else:
-            st.error("❌ Falló la actualización por lotes a 'Demorado'.")
-            return df_to_check, False
 
-    return df_to_check, False
+@st.cache_resource
+def start_demorado_sweeper() -> dict[str, Any]:
+    """Arranca (una vez por proceso) el hilo que barre pedidos demorados."""
+    state: dict[str, Any] = {"lock_file": None, "last_run": 0.0, "last_updates": 0, "last_error": ""}
+    thread = threading.Thread(
+        target=_demorado_sweeper_loop,
+        args=(state,),
+        name="demorado-sweeper",
+        daemon=True,
+    )
+    thread.start()
+    return state
 
 
 def marcar_contexto_pedido(row_id, origen_tab=None, *, scroll=True):
@@ -6570,6 +9318,54 @@ def ensure_expanders_open(row_id: Any, *dict_names: str) -> None:
             st.session_state[dict_name] = {row_id: True}
 
 
+# --- Carga diferida de adjuntos por pedido ---
+# Streamlit ejecuta el contenido de un expander aunque esté cerrado, así que el
+# trabajo con S3 de cada tarjeta se difiere hasta que el pedido se abre (o se
+# piden sus archivos) y se memoiza por pedido y versión de datos.
+ADJUNTOS_MEMO_MAX = 300
+
+
+def adjuntos_pedido_habilitados(pedido_id: Any) -> bool:
+    """``True`` si el pedido está abierto o ya se pidieron sus archivos en esta sesión."""
+    return bool(
+        st.session_state.get("expanded_pedidos", {}).get(pedido_id)
+        or st.session_state.get("adjuntos_pedidos_cargados", {}).get(pedido_id)
+    )
+
+
+def render_cargar_adjuntos_button(pedido_id: Any, key_suffix: str) -> None:
+    """Botón que habilita la carga de archivos del pedido y lo mantiene abierto."""
+    st.button(
+        "📂 Cargar archivos",
+        key=f"cargar_adjuntos_{key_suffix}",
+        on_click=ensure_expanders_open,
+        args=(pedido_id, "expanded_pedidos", "adjuntos_pedidos_cargados"),
+    )
+
+
+def get_pedido_s3_folder_memo(s3_client_param, pedido_id: Any, worksheet: Any = None) -> tuple[Optional[str], list[dict[str, Any]]]:
+    """Prefijo y archivos del pedido en S3, memoizados por pedido, snapshot y manifiesto."""
+    worksheet_name = _get_worksheet_name_safe(worksheet) if worksheet is not None else ""
+    memo_key = (
+        str(pedido_id),
+        worksheet_name,
+        get_sheet_snapshot_version(GOOGLE_SHEET_ID, worksheet_name) if worksheet_name else 0,
+        _get_s3_manifest()["version"],
+    )
+    memo = st.session_state.setdefault("_adjuntos_s3_memo", {})
+    cached = memo.get(memo_key)
+    if cached is not None:
+        return cached
+
+    prefix = find_pedido_subfolder_prefix(s3_client_param, S3_ATTACHMENT_PREFIX, pedido_id)
+    files = get_files_in_s3_prefix(s3_client_param, prefix) if prefix else []
+    result = (prefix, files)
+    memo[memo_key] = result
+    while len(memo) > ADJUNTOS_MEMO_MAX:
+        memo.pop(next(iter(memo)))
+    return result
+
+
 def handle_generic_upload_change(
     row_id: Any,
     expander_dict_names: Sequence[str] | str | None,
@@ -6749,14 +9545,12 @@ def mostrar_pedido_detalle(
                 )
                 clicked_procesar = st.form_submit_button(
                     "⚙️ Procesar",
-                    on_click=_mark_skip_demorado_check_once,
                     use_container_width=True,
                 )
         else:
             clicked_procesar = col_print_btn.button(
                 "⚙️ Procesar",
                 key=f"procesar_{row['ID_Pedido']}_{origen_tab}",
-                on_click=_mark_skip_demorado_check_once,
             )
 
     if clicked_procesar:
@@ -6875,16 +9669,50 @@ def mostrar_pedido_detalle(
                     # Mantener vista/pestaña sin forzar salto de scroll
                     marcar_contexto_pedido(row["ID_Pedido"], origen_tab, scroll=False)
 
-                    preserve_tab_state()
-                    st.session_state["refresh_data_caches_pending"] = True
-                    st.session_state["reload_after_action"] = True
-                    st.rerun()
+                    preserve_tab_state()
+                    rerun_pedido_card()
                 else:
                     st.error("❌ Falló la actualización del estado a 'En Proceso'.")
         else:
             st.toast("ℹ️ Este pedido ya no está en Pendiente/Demorado.", icon="ℹ️")
 
+def rerun_pedido_card() -> None:
+    """Re-ejecuta solo la tarjeta del pedido (fragmento); fuera de un fragmento, toda la app."""
+    try:
+        st.rerun(scope="fragment")
+    except StreamlitAPIException:
+        st.rerun()
+
+
+def _apply_local_row_overlay(row: Any, worksheet: Any) -> Any:
+    """
+    Aplica a ``row`` las escrituras locales pendientes de reflejarse en el snapshot.
+
+    Usa ``_apply_local_sheet_updates`` sobre la fila, con sus mismas reglas: las
+    escrituras locales vencen a los 180 s y nunca degradan el Estado de Sheets.
+    """
+    worksheet_name = _get_worksheet_name_safe(worksheet)
+    if not st.session_state.get("local_sheet_updates", {}).get(worksheet_name):
+        return row
+    return _apply_local_sheet_updates(row.to_frame().T.copy(), worksheet_name).iloc[0]
+
+
+@st.fragment
 def mostrar_pedido(df, idx, row, orden, origen_tab, current_main_tab_label, worksheet, headers, s3_client_param):
+    """
+    Tarjeta de un pedido como fragmento de Streamlit.
+
+    Las acciones que solo cambian la tarjeta (procesar, auditar, prioridad,
+    comprobantes, guías, modificaciones) la re-ejecutan con ``rerun_pedido_card``
+    sobre la fila local (``_apply_local_row_overlay``); completar un pedido o
+    moverlo de fecha/turno cambia las pestañas y sigue haciendo un rerun completo.
+    """
+    if isinstance(row, pd.Series):
+        row = _apply_local_row_overlay(row, worksheet)
+    _render_pedido_card(df, idx, row, orden, origen_tab, current_main_tab_label, worksheet, headers, s3_client_param)
+
+
+def _render_pedido_card(df, idx, row, orden, origen_tab, current_main_tab_label, worksheet, headers, s3_client_param):
     """
     Displays a single order with its details, actions, and attachments.
     Includes logic for updating status, surtidor, notes, and handling attachments.
@@ -6969,7 +9797,7 @@ def mostrar_pedido(df, idx, row, orden, origen_tab, current_main_tab_label, work
                     )
                     if ok_mod_material:
                         st.success("✅ Modificación por material actualizada.")
-                        st.rerun()
+                        rerun_pedido_card()
                     else:
                         st.error("❌ No se pudo actualizar Tipo_Modificacion.")
             else:
@@ -6993,7 +9821,7 @@ def mostrar_pedido(df, idx, row, orden, origen_tab, current_main_tab_label, work
                             st.success("✅ Prioridad actualizada y Mod por Material desmarcado.")
                         else:
                             st.success("✅ Prioridad actualizada.")
-                        st.rerun()
+                        rerun_pedido_card()
                     else:
                         st.error("❌ No se pudo actualizar prioridad.")
 
@@ -7024,7 +9852,7 @@ def mostrar_pedido(df, idx, row, orden, origen_tab, current_main_tab_label, work
                                 st.success("✅ Mod por Material actualizado y Prioridad desmarcada.")
                             else:
                                 st.success("✅ Color de Mod por Material actualizado.")
-                            st.rerun()
+                            rerun_pedido_card()
                         else:
                             st.error("❌ No se pudo actualizar Completados_Limpiado.")
                 else:
@@ -7365,89 +10193,94 @@ def mostrar_pedido(df, idx, row, orden, origen_tab, current_main_tab_label, work
             "📎 Archivos (Adjuntos y Guía)",
             expanded=True,
         ):
-            contenido_attachments = False
-            sheet_attachments = _normalize_urls(row.get("Adjuntos", ""))
-            sheet_attachments = _filter_out_original_route_when_modified(sheet_attachments)
-            sheet_attachment_keys = {
-                extract_s3_key(att) for att in sheet_attachments if att
-            }
-            originals_hidden_by_sheet_mod = _collect_original_route_names_from_modified(
-                sheet_attachments
-            )
-
-            if sheet_attachments:
-                contenido_attachments = True
-                for attachment in sheet_attachments:
-                    attachment_url = resolve_storage_url(s3_client_param, attachment)
-                    parsed = urlparse(attachment)
-                    display_name = os.path.basename(parsed.path) or attachment
-                    if not display_name and attachment_url:
-                        display_name = os.path.basename(urlparse(attachment_url).path)
-                    if not display_name:
-                        display_name = attachment
-                    st.markdown(
-                        f'- 📄 **{display_name}** (<a href="{attachment_url}" target="_blank">🔗 Ver/Descargar</a>)',
-                        unsafe_allow_html=True,
-                    )
+            if not adjuntos_pedido_habilitados(row['ID_Pedido']):
+                st.caption("Los archivos se consultan en S3 al abrir el pedido.")
+                render_cargar_adjuntos_button(row['ID_Pedido'], f"{row['ID_Pedido']}_{origen_tab}")
+            else:
+                contenido_attachments = False
+                sheet_attachments = _normalize_urls(row.get("Adjuntos", ""))
+                sheet_attachments = _filter_out_original_route_when_modified(sheet_attachments)
+                sheet_attachment_keys = {
+                    extract_s3_key(att) for att in sheet_attachments if att
+                }
+                originals_hidden_by_sheet_mod = _collect_original_route_names_from_modified(
+                    sheet_attachments
+                )
 
-            pedido_folder_prefix = find_pedido_subfolder_prefix(
-                s3_client_param, S3_ATTACHMENT_PREFIX, row['ID_Pedido']
-            )
+                if sheet_attachments:
+                    contenido_attachments = True
+                    for attachment in sheet_attachments:
+                        attachment_url = resolve_storage_url(s3_client_param, attachment)
+                        parsed = urlparse(attachment)
+                        display_name = os.path.basename(parsed.path) or attachment
+                        if not display_name and attachment_url:
+                            display_name = os.path.basename(urlparse(attachment_url).path)
+                        if not display_name:
+                            display_name = attachment
+                        st.markdown(
+                            f'- 📄 **{display_name}** (<a href="{attachment_url}" target="_blank">🔗 Ver/Descargar</a>)',
+                            unsafe_allow_html=True,
+                        )
 
-            if pedido_folder_prefix:
-                files_in_folder = get_files_in_s3_prefix(
-                    s3_client_param, pedido_folder_prefix
+                pedido_folder_prefix, files_in_folder = get_pedido_s3_folder_memo(
+                    s3_client_param, row['ID_Pedido'], worksheet
                 )
-                if files_in_folder:
-                    filtered_files_to_display = [
-                        f for f in files_in_folder
-                        if "comprobante" not in f['title'].lower() and "surtido" not in f['title'].lower()
-                    ]
-                    folder_titles = [f.get("title", "") for f in filtered_files_to_display]
-                    visible_titles = set(
-                        _filter_out_original_route_when_modified(folder_titles)
-                    )
-                    filtered_files_to_display = [
-                        f for f in filtered_files_to_display
-                        if f.get("title", "") in visible_titles
-                    ]
-                    if originals_hidden_by_sheet_mod:
+
+                if pedido_folder_prefix:
+                    if files_in_folder:
+                        filtered_files_to_display = [
+                            f for f in files_in_folder
+                            if "comprobante" not in f['title'].lower() and "surtido" not in f['title'].lower()
+                        ]
+                        folder_titles = [f.get("title", "") for f in filtered_files_to_display]
+                        visible_titles = set(
+                            _filter_out_original_route_when_modified(folder_titles)
+                        )
                         filtered_files_to_display = [
                             f for f in filtered_files_to_display
-                            if str(f.get("title", "")).strip().lower()
-                            not in originals_hidden_by_sheet_mod
+                            if f.get("title", "") in visible_titles
                         ]
-                    filtered_files_to_display = [
-                        f for f in filtered_files_to_display
-                        if extract_s3_key(f['key']) not in sheet_attachment_keys
-                    ]
-                    if filtered_files_to_display:
-                        contenido_attachments = True
-                        st.markdown("**Adjuntos en carpeta S3:**")
-                        for file_info in filtered_files_to_display:
-                            file_url = get_s3_file_download_url(
-                                s3_client_param, file_info['key']
-                            )
-                            display_name = file_info['title']
-                            if row['ID_Pedido'] in display_name:
-                                display_name = (
-                                    display_name.replace(row['ID_Pedido'], "").replace("__", "_")
-                                    .replace("_-", "_").replace("-_", "_").strip('_').strip('-')
+                        if originals_hidden_by_sheet_mod:
+                            filtered_files_to_display = [
+                                f for f in filtered_files_to_display
+                                if str(f.get("title", "")).strip().lower()
+                                not in originals_hidden_by_sheet_mod
+                            ]
+                        filtered_files_to_display = [
+                            f for f in filtered_files_to_display
+                            if extract_s3_key(f['key']) not in sheet_attachment_keys
+                        ]
+                        if filtered_files_to_display:
+                            contenido_attachments = True
+                            st.markdown("**Adjuntos en carpeta S3:**")
+                            try:
+                                folder_urls = presign_s3_file_download_urls(
+                                    s3_client_param, [f['key'] for f in filtered_files_to_display]
                                 )
-                            st.markdown(
-                                f'- 📄 **{display_name}** (<a href="{file_url}" target="_blank">🔗 Ver/Descargar</a>)',
-                                unsafe_allow_html=True,
-                            )
+                            except Exception as e:
+                                st.error(f"❌ Error al generar URL prefirmada: {e}")
+                                folder_urls = ["#"] * len(filtered_files_to_display)
+                            for file_info, file_url in zip(filtered_files_to_display, folder_urls):
+                                display_name = file_info['title']
+                                if row['ID_Pedido'] in display_name:
+                                    display_name = (
+                                        display_name.replace(row['ID_Pedido'], "").replace("__", "_")
+                                        .replace("_-", "_").replace("-_", "_").strip('_').strip('-')
+                                    )
+                                st.markdown(
+                                    f'- 📄 **{display_name}** (<a href="{file_url}" target="_blank">🔗 Ver/Descargar</a>)',
+                                    unsafe_allow_html=True,
+                                )
+                        else:
+                            if not contenido_attachments:
+                                st.info("No hay adjuntos para mostrar (excluyendo comprobantes y surtidos).")
                     else:
                         if not contenido_attachments:
-                            st.info("No hay adjuntos para mostrar (excluyendo comprobantes y surtidos).")
-                else:
-                    if not contenido_attachments:
-                        st.info("No se encontraron archivos en la carpeta del pedido en S3.")
-            elif not contenido_attachments:
-                st.error(
-                    f"❌ No se encontró la carpeta (prefijo S3) del pedido '{row['ID_Pedido']}'."
-                )
+                            st.info("No se encontraron archivos en la carpeta del pedido en S3.")
+                elif not contenido_attachments:
+                    st.error(
+                        f"❌ No se encontró la carpeta (prefijo S3) del pedido '{row['ID_Pedido']}'."
+                    )
 
         if es_local_bodega:
             if not pago_confirmado:
@@ -7642,49 +10475,37 @@ def mostrar_pedido(df, idx, row, orden, origen_tab, current_main_tab_label, work
                                 if success and uploaded_key:
                                     uploaded_comp_keys.append(uploaded_key)
 
-                        if updates and batch_update_gsheet_cells(
-                            worksheet, updates, headers=headers_for_write
-                        ):
-                            # Salvaguarda: en algunos casos Google Sheets puede terminar
-                            # mostrando un valor inesperado (p. ej. fecha) en Estado_Pago.
-                            # Verificamos y forzamos "✅ Pagado" si no quedó confirmado.
-                            if "Estado_Pago" in headers_for_write:
-                                estado_guardado = ""
-                                try:
-                                    col_estado = headers_for_write.index("Estado_Pago") + 1
-                                    estado_guardado = str(
-                                        worksheet.cell(gsheet_row_index, col_estado).value or ""
-                                    ).strip()
-                                except Exception:
-                                    estado_guardado = ""
-
-                                if not _estado_pago_es_pagado(estado_guardado):
+                        # Pago y Adjuntos salen en un solo values:batchUpdate. Estado_Pago
+                        # va en modo RAW, así que Sheets no lo reinterpreta (p. ej. como fecha)
+                        # y no hace falta releer la celda para confirmarlo.
+                        nueva_lista_adjuntos = None
+                        if uploaded_comp_keys and "Adjuntos" in headers_for_write:
+                            nueva_lista_adjuntos = _merge_uploaded_urls(
+                                row.get("Adjuntos", ""), uploaded_comp_keys
+                            )
+                        guardado = False
+                        with coalesced_sheet_writes() as escritura:
+                            if updates and batch_update_gsheet_cells(
+                                worksheet, updates, headers=headers_for_write
+                            ):
+                                guardado = True
+                                if nueva_lista_adjuntos is not None:
                                     update_gsheet_cell(
                                         worksheet,
                                         headers_for_write,
                                         gsheet_row_index,
-                                        "Estado_Pago",
-                                        "✅ Pagado",
+                                        "Adjuntos",
+                                        nueva_lista_adjuntos,
                                     )
-
+                        if guardado and escritura["ok"]:
                             for col_name, col_value in campos_valores.items():
                                 if col_name in df.columns:
                                     df.at[idx, col_name] = col_value
                                     row[col_name] = col_value
 
-                            if uploaded_comp_keys and "Adjuntos" in headers_for_write:
-                                nueva_lista_adjuntos = _merge_uploaded_urls(
-                                    row.get("Adjuntos", ""), uploaded_comp_keys
-                                )
-                                if update_gsheet_cell(
-                                    worksheet,
-                                    headers_for_write,
-                                    gsheet_row_index,
-                                    "Adjuntos",
-                                    nueva_lista_adjuntos,
-                                ):
-                                    df.at[idx, "Adjuntos"] = nueva_lista_adjuntos
-                                    row["Adjuntos"] = nueva_lista_adjuntos
+                            if nueva_lista_adjuntos is not None:
+                                df.at[idx, "Adjuntos"] = nueva_lista_adjuntos
+                                row["Adjuntos"] = nueva_lista_adjuntos
 
                             ensure_expanders_open(row["ID_Pedido"], "expanded_pedidos")
                             marcar_contexto_pedido(
@@ -7692,9 +10513,7 @@ def mostrar_pedido(df, idx, row, orden, origen_tab, current_main_tab_label, work
                             )
                             preserve_tab_state()
                             st.toast("✅ Comprobante guardado correctamente.", icon="✅")
-                            st.session_state["refresh_data_caches_pending"] = True
-                            st.session_state["reload_after_action"] = True
-                            st.rerun()
+                            rerun_pedido_card()
                         else:
                             st.error("❌ No se pudo guardar la información del comprobante.")
 
@@ -7715,7 +10534,6 @@ def mostrar_pedido(df, idx, row, orden, origen_tab, current_main_tab_label, work
             if col_print_btn.button(
                 "🔎 Marcar Auditado",
                 key=f"audit_button_{row['ID_Pedido']}_{origen_tab}",
-                on_click=_mark_skip_demorado_check_once,
             ):
                 if update_gsheet_cell(
                     worksheet,
@@ -7729,9 +10547,7 @@ def mostrar_pedido(df, idx, row, orden, origen_tab, current_main_tab_label, work
                     st.toast("✅ Pedido marcado como 🔎 Auditado", icon="✅")
                     marcar_contexto_pedido(row["ID_Pedido"], origen_tab, scroll=False)
                     preserve_tab_state()
-                    st.session_state["refresh_data_caches_pending"] = True
-                    st.session_state["reload_after_action"] = True
-                    st.rerun()
+                    rerun_pedido_card()
                 else:
                     st.error("❌ No se pudo actualizar el estado a '🔎 Auditado'.")
 
@@ -7759,7 +10575,6 @@ def mostrar_pedido(df, idx, row, orden, origen_tab, current_main_tab_label, work
                     "🟢 Completar",
                     key=f"complete_button_{row['ID_Pedido']}_{origen_tab}",
                     disabled=disabled_complete_btn,
-                    on_click=_mark_skip_demorado_check_once,
                 ):
                     if not puede_completar_por_pago:
                         st.error("⚠️ No puedes completar el pedido hasta que Estado_Pago sea ✅ Pagado.")
@@ -7783,7 +10598,6 @@ def mostrar_pedido(df, idx, row, orden, origen_tab, current_main_tab_label, work
                     "🟢 Completar",
                     key=f"complete_button_{row['ID_Pedido']}_{origen_tab}",
                     disabled=disabled_complete_btn,
-                    on_click=_mark_skip_demorado_check_once,
                 ):
                     if not puede_completar_por_pago:
                         st.error("⚠️ No puedes completar el pedido hasta que Estado_Pago sea ✅ Pagado.")
@@ -7803,7 +10617,6 @@ def mostrar_pedido(df, idx, row, orden, origen_tab, current_main_tab_label, work
                     "🟢 Completar",
                     key=f"complete_button_{row['ID_Pedido']}_{origen_tab}",
                     disabled=disabled_complete_btn,
-                    on_click=_mark_skip_demorado_check_once,
                 ):
                     if not puede_completar_por_pago:
                         st.error("⚠️ No puedes completar el pedido hasta que Estado_Pago sea ✅ Pagado.")
@@ -7824,7 +10637,6 @@ def mostrar_pedido(df, idx, row, orden, origen_tab, current_main_tab_label, work
                     "🟢 Completar",
                     key=f"complete_button_{row['ID_Pedido']}_{origen_tab}",
                     disabled=disabled_complete_btn,
-                    on_click=_mark_skip_demorado_check_once,
                 ):
                     if not puede_completar_por_pago:
                         st.error("⚠️ No puedes completar el pedido hasta que Estado_Pago sea ✅ Pagado.")
@@ -7847,7 +10659,6 @@ def mostrar_pedido(df, idx, row, orden, origen_tab, current_main_tab_label, work
                     if col2.button(
                         "🟢 Completar sin guía",
                         key=f"btn_force_complete_{row['ID_Pedido']}",
-                        on_click=_mark_skip_demorado_check_once,
                     ):
                         completar_pedido(
                             df,
@@ -7896,8 +10707,7 @@ def mostrar_pedido(df, idx, row, orden, origen_tab, current_main_tab_label, work
                         marcar_contexto_pedido(row["ID_Pedido"], origen_tab, scroll=False)
 
                         preserve_tab_state()
-                        st.session_state["reload_after_action"] = True
-                        st.rerun()
+                        rerun_pedido_card()
                     else:
                         st.error("❌ Falló la actualización del estado a 'En Proceso'.")
                         
@@ -7996,9 +10806,23 @@ def mostrar_pedido(df, idx, row, orden, origen_tab, current_main_tab_label, work
                                 row.get(target_col_for_guide, ""),
                                 uploaded_keys,
                             )
-                            success = update_gsheet_cell(
-                                worksheet, headers, gsheet_row_index, target_col_for_guide, nueva_lista
-                            )
+                            # La guía y su columna complementaria salen en una sola escritura.
+                            with coalesced_sheet_writes() as escritura:
+                                success = update_gsheet_cell(
+                                    worksheet, headers, gsheet_row_index, target_col_for_guide, nueva_lista
+                                )
+                                if success:
+                                    headers = mirror_guide_value(
+                                        worksheet,
+                                        headers,
+                                        gsheet_row_index,
+                                        df,
+                                        idx,
+                                        row,
+                                        target_col_for_guide,
+                                        nueva_lista,
+                                    )
+                            success = success and escritura["ok"]
                             if success:
                                 # 🚀 OPTIMIZACIÓN 4: Actualizar DataFrame localmente
                                 if target_col_for_guide == "Hoja_Ruta_Mensajero":
@@ -8008,16 +10832,6 @@ def mostrar_pedido(df, idx, row, orden, origen_tab, current_main_tab_label, work
                                     df.at[idx, "Adjuntos_Guia"] = nueva_lista
                                     row["Adjuntos_Guia"] = nueva_lista
 
-                                headers = mirror_guide_value(
-                                    worksheet,
-                                    headers,
-                                    gsheet_row_index,
-                                    df,
-                                    idx,
-                                    row,
-                                    target_col_for_guide,
-                                    nueva_lista,
-                                )
                                 # 🚀 OPTIMIZACIÓN 5: Feedback rápido con toast
                                 st.toast(
                                     f"📤 {len(uploaded_keys)} guía(s) subida(s) con éxito.",
@@ -8063,8 +10877,6 @@ def mostrar_pedido(df, idx, row, orden, origen_tab, current_main_tab_label, work
                                 # Mantener contexto del pedido sin forzar scroll
                                 marcar_contexto_pedido(row["ID_Pedido"], origen_tab, scroll=False)
                                 preserve_tab_state()
-                                st.session_state["refresh_data_caches_pending"] = True
-                                st.session_state["reload_after_action"] = True
                                 render_guia_upload_feedback(
                                     success_placeholder,
                                     row["ID_Pedido"],
@@ -8081,7 +10893,7 @@ def mostrar_pedido(df, idx, row, orden, origen_tab, current_main_tab_label, work
                                     origen_tab,
                             allow_from_any_status=is_victor_simple_flow,
                                 )
-                                st.rerun()
+                                rerun_pedido_card()
                             else:
                                 st.error(
                                     "❌ No se pudo actualizar el Google Sheet con los archivos de guía."
@@ -8132,9 +10944,8 @@ def mostrar_pedido(df, idx, row, orden, origen_tab, current_main_tab_label, work
                                     s3_client_param=s3_client_param,
                                 )
                             st.success("✅ Cambios de surtido confirmados y pedido en '🔵 En Proceso'.")
-                            st.cache_data.clear()
                             marcar_contexto_pedido(row["ID_Pedido"], origen_tab, scroll=False)
-                            st.rerun()
+                            rerun_pedido_card()
                         else:
                             st.error("❌ No se pudo confirmar la modificación.")
                 
@@ -8182,9 +10993,8 @@ def mostrar_pedido(df, idx, row, orden, origen_tab, current_main_tab_label, work
                                 st.success(
                                     "✅ Cambios de surtido confirmados y pedido en '🔵 En Proceso'."
                                 )
-                                st.cache_data.clear()
                                 marcar_contexto_pedido(row["ID_Pedido"], origen_tab, scroll=False)
-                                st.rerun()
+                                rerun_pedido_card()
                             else:
                                 st.error("❌ No se pudo confirmar la modificación.")
 
@@ -8195,13 +11005,13 @@ def mostrar_pedido(df, idx, row, orden, origen_tab, current_main_tab_label, work
                 if match:
                     mod_surtido_archivos_mencionados_raw.extend([f.strip() for f in match.group(1).split(',')])
 
-            # Buscar en S3
-            if pedido_folder_prefix is None:
-                pedido_folder_prefix = find_pedido_subfolder_prefix(s3_client_param, S3_ATTACHMENT_PREFIX, row['ID_Pedido'])
-
+            # Buscar en S3 (solo con el pedido abierto; ver ``adjuntos_pedido_habilitados``)
+            adjuntos_habilitados = adjuntos_pedido_habilitados(row['ID_Pedido'])
             surtido_files_in_s3 = []
-            if pedido_folder_prefix:
-                all_files_in_folder = get_files_in_s3_prefix(s3_client_param, pedido_folder_prefix)
+            if adjuntos_habilitados:
+                pedido_folder_prefix, all_files_in_folder = get_pedido_s3_folder_memo(
+                    s3_client_param, row['ID_Pedido'], worksheet
+                )
                 surtido_files_in_s3 = [
                     f for f in all_files_in_folder
                     if "surtido" in f['title'].lower()
@@ -8224,7 +11034,7 @@ def mostrar_pedido(df, idx, row, orden, origen_tab, current_main_tab_label, work
                 if not any(s_file['title'] == existing_f['title'] for existing_f in all_surtido_related_files):
                     all_surtido_related_files.append(s_file)
 
-            for raw_url in adjuntos_surtido_urls:
+            for raw_url in (adjuntos_surtido_urls if adjuntos_habilitados else []):
                 resolved_url = resolve_storage_url(s3_client_param, raw_url)
                 if not resolved_url:
                     continue
@@ -8239,7 +11049,10 @@ def mostrar_pedido(df, idx, row, orden, origen_tab, current_main_tab_label, work
                     'url': resolved_url,
                 })
 
-            if all_surtido_related_files:
+            if not adjuntos_habilitados and (hay_adjuntos_texto or hay_adjuntos_campo):
+                st.markdown("Adjuntos de Modificación (Surtido/Relacionados):")
+                render_cargar_adjuntos_button(row['ID_Pedido'], f"surtido_{row['ID_Pedido']}_{origen_tab}")
+            elif all_surtido_related_files:
                 st.markdown("Adjuntos de Modificación (Surtido/Relacionados):")
                 archivos_ya_mostrados_para_mod = set()
 
@@ -8402,22 +11215,25 @@ def mostrar_pedido_solo_guia(df, idx, row, orden, origen_tab, current_main_tab_l
                         row.get("Adjuntos_Guia", ""),
                         uploaded_keys,
                     )
-                    success = update_gsheet_cell(
-                        worksheet, headers, gsheet_row_index, "Adjuntos_Guia", nueva_lista
-                    )
+                    with coalesced_sheet_writes() as escritura:
+                        success = update_gsheet_cell(
+                            worksheet, headers, gsheet_row_index, "Adjuntos_Guia", nueva_lista
+                        )
+                        if success:
+                            headers = mirror_guide_value(
+                                worksheet,
+                                headers,
+                                gsheet_row_index,
+                                df,
+                                idx,
+                                row,
+                                "Adjuntos_Guia",
+                                nueva_lista,
+                            )
+                    success = success and escritura["ok"]
                     if success:
                         df.at[idx, "Adjuntos_Guia"] = nueva_lista
                         row["Adjuntos_Guia"] = nueva_lista
-                        headers = mirror_guide_value(
-                            worksheet,
-                            headers,
-                            gsheet_row_index,
-                            df,
-                            idx,
-                            row,
-                            "Adjuntos_Guia",
-                            nueva_lista,
-                        )
                         st.toast(
                             f"📤 {len(uploaded_keys)} guía(s) subida(s) con éxito.",
                             icon="📦",
@@ -8490,7 +11306,7 @@ def mostrar_pedido_solo_guia(df, idx, row, orden, origen_tab, current_main_tab_l
         if st.button(
             "🟢 Completar",
             key=f"btn_completar_only_{row['ID_Pedido']}",
-            on_click=_preserve_and_mark_skip_demorado,
+            on_click=preserve_tab_state,
         ):
             if is_tab_guias and not has_file:
                 st.error("⚠️ Debes subir la guía antes de completar este pedido.")
@@ -8550,7 +11366,7 @@ def mostrar_pedido_solo_guia(df, idx, row, orden, origen_tab, current_main_tab_l
             if col2.button(
                 "🟢 Completar sin guía",
                 key=f"btn_force_complete_{row['ID_Pedido']}",
-                on_click=_preserve_and_mark_skip_demorado,
+                on_click=preserve_tab_state,
             ):
                 completar_pedido(
                     df,
@@ -8575,6 +11391,7 @@ def _load_pedidos():
         worksheet_name=ACTIVE_MAIN_WORKSHEET_NAME,
         client=g_spread_client,
         light_mode=True,
+        snapshot_version=current_sheet_snapshot_version(GOOGLE_SHEET_ID, ACTIVE_MAIN_WORKSHEET_NAME, g_spread_client),
     )
     _refresh_sheet_row_identity(df, ACTIVE_MAIN_WORKSHEET_NAME)
     df = _apply_local_sheet_updates(df, ACTIVE_MAIN_WORKSHEET_NAME)
@@ -8603,94 +11420,717 @@ def _compress_row_indexes(row_indexes: list[int]) -> list[tuple[int, int]]:
     return ranges
 
 
-def _delete_rows_by_indexes(worksheet, row_indexes: list[int]) -> None:
-    """Elimina filas físicas en lotes, de abajo hacia arriba, para evitar corrimientos."""
-    row_indexes = [int(idx) for idx in row_indexes if int(idx) > 1]
-    ranges = _compress_row_indexes(row_indexes)
-    if not ranges:
-        return
+def _delete_rows_by_indexes(worksheet, row_indexes: list[int]) -> None:
+    """Elimina filas físicas en lotes, de abajo hacia arriba, para evitar corrimientos."""
+    row_indexes = [int(idx) for idx in row_indexes if int(idx) > 1]
+    ranges = _compress_row_indexes(row_indexes)
+    if not ranges:
+        return
+
+    requests = []
+    sheet_id = worksheet.id
+    for start, end in sorted(ranges, key=lambda r: r[0], reverse=True):
+        requests.append(
+            {
+                "deleteDimension": {
+                    "range": {
+                        "sheetId": sheet_id,
+                        "dimension": "ROWS",
+                        "startIndex": int(start) - 1,
+                        "endIndex": int(end),
+                    }
+                }
+            }
+        )
+
+    _run_gsheet_write_with_backoff(
+        lambda: worksheet.spreadsheet.batch_update({"requests": requests}),
+        operation_name="eliminación de filas",
+    )
+    _invalidate_worksheet_snapshot(worksheet, full_resync=True)
+
+
+def _is_rate_limit_error(exc: Exception) -> bool:
+    """Detecta errores de cuota/límite de escritura de Google Sheets."""
+    text = str(exc)
+    signals = (
+        "429",
+        "RESOURCE_EXHAUSTED",
+        "RATE_LIMIT",
+        "Quota exceeded",
+        "quota metric",
+    )
+    return any(sig in text for sig in signals)
+
+
+def _run_gsheet_write_with_backoff(
+    func,
+    *,
+    operation_name: str,
+    max_retries: int = 5,
+    priority: str = "interactive_write",
+):
+    """Ejecuta una escritura bajo el gobernador de cuota (``SheetsQuotaUnavailable`` sin tokens); ante 429 reintenta."""
+    last_error = None
+    for attempt in range(max_retries + 1):
+        if not acquire_sheets_quota("write", priority):
+            raise SheetsQuotaUnavailable(f"Sin cuota de escritura de Google Sheets ({operation_name})")
+        try:
+            return func()
+        except Exception as exc:
+            last_error = exc
+            if attempt >= max_retries or not _is_rate_limit_error(exc):
+                raise
+            report_sheets_quota_exhausted("write")
+            st.info(
+                f"⏳ Límite temporal de Google Sheets durante {operation_name}. "
+                f"Reintentando ({attempt + 1}/{max_retries})..."
+            )
+    raise last_error
+
+
+def _trim_spreadsheet_to_used_cells(spreadsheet, min_rows: int = 2, min_cols: int = 1) -> None:
+    """Recorta filas/columnas sobrantes por hoja para liberar celdas totales del workbook."""
+    for ws in spreadsheet.worksheets():
+        values = ws.get_all_values()
+        used_rows = max(len(values), min_rows)
+        used_cols = min_cols
+        if values:
+            used_cols = max(max((len(r) for r in values), default=min_cols), min_cols)
+
+        target_rows = max(used_rows, min_rows)
+        target_cols = max(used_cols, min_cols)
+
+        if ws.row_count != target_rows or ws.col_count != target_cols:
+            ws.resize(rows=target_rows, cols=target_cols)
+
+
+# --- Archivo de pedidos al histórico con journal local ---
+# Cada limpieza se registra primero en un journal SQLite (corrida y lotes con sus
+# filas) y después se escribe en Sheets. El mismo journal guarda el puntero a la
+# cola del histórico y el índice de ID_Pedido ya archivados, así que la limpieza
+# no vuelve a leer la hoja histórica completa. Una corrida que falla se retoma en
+# la siguiente limpieza desde el último lote confirmado; tras ARCHIVE_MAX_ATTEMPTS
+# fallos queda como 'fallida' y se deja de retomar hasta reintentarla o descartarla.
+ARCHIVE_JOURNAL_PATH = os.environ.get(
+    "ARCHIVE_JOURNAL_PATH",
+    os.path.join(tempfile.gettempdir(), "app_almacen_archivo_journal.sqlite3"),
+)
+ARCHIVE_BATCH_ROWS = 200
+ARCHIVE_TAIL_PROBE_ROWS = 500
+ARCHIVE_CELL_LIMIT_ERROR = "above the limit of 10000000 cells"
+ARCHIVE_MAX_ATTEMPTS = 3
+ARCHIVE_RESUMABLE_STATES = ("anexando", "verificado")
+
+
+@st.cache_resource
+def _get_archive_lock() -> threading.Lock:
+    """Un solo archivo en curso por proceso (el candado de archivo cubre otros procesos)."""
+    return threading.Lock()
+
+
+def _archive_journal_connect() -> sqlite3.Connection:
+    conn = sqlite3.connect(ARCHIVE_JOURNAL_PATH, timeout=30)
+    conn.executescript(
+        """
+        PRAGMA journal_mode=WAL;
+        CREATE TABLE IF NOT EXISTS archivo_corridas (
+            corrida TEXT PRIMARY KEY,
+            hoja TEXT NOT NULL,
+            creado REAL NOT NULL,
+            estado TEXT NOT NULL,
+            ids TEXT NOT NULL,
+            encabezados TEXT NOT NULL DEFAULT '[]',
+            filas_operativas TEXT NOT NULL DEFAULT '[]',
+            intentos INTEGER NOT NULL DEFAULT 0,
+            error TEXT NOT NULL DEFAULT ''
+        );
+        CREATE TABLE IF NOT EXISTS archivo_lotes (
+            corrida TEXT NOT NULL,
+            lote INTEGER NOT NULL,
+            ids TEXT NOT NULL,
+            filas TEXT NOT NULL,
+            estado TEXT NOT NULL,
+            PRIMARY KEY (corrida, lote)
+        );
+        CREATE TABLE IF NOT EXISTS archivo_ids (
+            hoja TEXT NOT NULL,
+            id_pedido TEXT NOT NULL,
+            fila INTEGER NOT NULL,
+            PRIMARY KEY (hoja, id_pedido)
+        );
+        CREATE TABLE IF NOT EXISTS archivo_cola (
+            hoja TEXT PRIMARY KEY,
+            siguiente_fila INTEGER NOT NULL,
+            actualizado REAL NOT NULL
+        );
+        """
+    )
+    # Journals creados por versiones anteriores no tienen todas las columnas.
+    columnas = {row[1] for row in conn.execute("PRAGMA table_info(archivo_corridas)")}
+    for columna, definicion in (
+        ("encabezados", "TEXT NOT NULL DEFAULT '[]'"),
+        ("filas_operativas", "TEXT NOT NULL DEFAULT '[]'"),
+        ("intentos", "INTEGER NOT NULL DEFAULT 0"),
+    ):
+        if columna not in columnas:
+            conn.execute(f"ALTER TABLE archivo_corridas ADD COLUMN {columna} {definicion}")
+    return conn
+
+
+@contextmanager
+def _archive_exclusive():
+    """Exclusión entre sesiones y procesos; falla rápido si otra limpieza está en curso."""
+    lock = _get_archive_lock()
+    if not lock.acquire(blocking=False):
+        raise RuntimeError("otra limpieza del histórico está en curso.")
+    lock_file = None
+    try:
+        if fcntl is not None:
+            lock_file = open(f"{ARCHIVE_JOURNAL_PATH}.lock", "a+")
+            try:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                raise RuntimeError("otra limpieza del histórico está en curso.")
+        yield
+    finally:
+        if lock_file is not None:
+            lock_file.close()
+        lock.release()
+
+
+def _archive_cell_value(value: Any) -> Any:
+    if pd.isna(value):
+        return ""
+    if isinstance(value, (pd.Timestamp, datetime)):
+        return value.isoformat(sep=" ")
+    if hasattr(value, "isoformat"):
+        return value.isoformat()
+    return _sheet_json_value(value)
+
+
+def _archive_column_letter(col_idx: int) -> str:
+    return re.sub(r"\d", "", gspread.utils.rowcol_to_a1(1, col_idx))
+
+
+def _archive_first_cell(cell: Any) -> str:
+    return str(cell[0]).strip() if cell else ""
+
+
+def _archive_rebuild_index(conn: sqlite3.Connection, hoja: str, worksheet_historical: Any, id_col: int) -> int:
+    """Relee la columna ID_Pedido del histórico (solo la primera vez o si la hoja se reordenó)."""
+    letter = _archive_column_letter(id_col)
+    worksheet_name = _get_worksheet_name_safe(worksheet_historical)
+    (column,) = _run_gsheet_read_with_backoff(
+        lambda: _values_batch_get(
+            worksheet_historical.spreadsheet,
+            [_sheet_a1_range(worksheet_name, f"{letter}2:{letter}")],
+            acquire_quota=False,
+        ),
+        operation_name="índice del histórico",
+    )
+    tail = 2 + len(column)
+    with conn:
+        conn.execute("DELETE FROM archivo_ids WHERE hoja = ?", (hoja,))
+        conn.executemany(
+            "INSERT OR REPLACE INTO archivo_ids (hoja, id_pedido, fila) VALUES (?, ?, ?)",
+            [
+                (hoja, _archive_first_cell(cell), row_idx)
+                for row_idx, cell in enumerate(column, start=2)
+                if _archive_first_cell(cell)
+            ],
+        )
+        conn.execute(
+            "INSERT OR REPLACE INTO archivo_cola (hoja, siguiente_fila, actualizado) VALUES (?, ?, ?)",
+            (hoja, tail, time.time()),
+        )
+    return tail
+
+
+def _archive_sync_tail(conn: sqlite3.Connection, hoja: str, worksheet_historical: Any, id_col: int) -> int:
+    """
+    Devuelve la siguiente fila libre del histórico leyendo solo alrededor del puntero.
+
+    Las filas que otros procesos anexaron desde la última corrida se agregan al
+    índice. Si la fila anterior al puntero ya no tiene ID (la hoja se editó o
+    reordenó a mano), el índice se reconstruye.
+    """
+    stored = conn.execute("SELECT siguiente_fila FROM archivo_cola WHERE hoja = ?", (hoja,)).fetchone()
+    if stored is None:
+        return _archive_rebuild_index(conn, hoja, worksheet_historical, id_col)
+
+    letter = _archive_column_letter(id_col)
+    worksheet_name = _get_worksheet_name_safe(worksheet_historical)
+    tail = int(stored[0])
+    while True:
+        start = max(tail - 1, 2)
+        end = tail + ARCHIVE_TAIL_PROBE_ROWS - 1
+        (column,) = _run_gsheet_read_with_backoff(
+            lambda: _values_batch_get(
+                worksheet_historical.spreadsheet,
+                [_sheet_a1_range(worksheet_name, f"{letter}{start}:{letter}{end}")],
+                acquire_quota=False,
+            ),
+            operation_name="puntero del histórico",
+        )
+        if start < tail and not (column and _archive_first_cell(column[0])):
+            return _archive_rebuild_index(conn, hoja, worksheet_historical, id_col)
+        nuevos = [
+            (hoja, _archive_first_cell(cell), row_idx)
+            for row_idx, cell in enumerate(column, start=start)
+            if row_idx >= tail and _archive_first_cell(cell)
+        ]
+        tail = max(tail, start + len(column))
+        with conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO archivo_ids (hoja, id_pedido, fila) VALUES (?, ?, ?)",
+                nuevos,
+            )
+            conn.execute(
+                "UPDATE archivo_cola SET siguiente_fila = ?, actualizado = ? WHERE hoja = ?",
+                (tail, time.time(), hoja),
+            )
+        if start + len(column) <= end:
+            return tail
+
+
+def _archive_indexed_rows(conn: sqlite3.Connection, hoja: str, ids: Sequence[str]) -> dict[str, int]:
+    """``{ID_Pedido: fila}`` de los IDs que el índice ya tiene en el histórico."""
+    found: dict[str, int] = {}
+    ids = list(ids)
+    for i in range(0, len(ids), 500):
+        chunk = ids[i:i + 500]
+        found.update(
+            conn.execute(
+                f"SELECT id_pedido, fila FROM archivo_ids WHERE hoja = ? AND id_pedido IN ({','.join('?' * len(chunk))})",
+                [hoja, *chunk],
+            ).fetchall()
+        )
+    return found
+
+
+def _archive_append_batch(worksheet_historical: Any, rows: list[list[Any]], tail: int) -> tuple[int, int]:
+    """Anexa un lote con ``values:append`` y devuelve las filas ``(inicio, fin)`` que ocupó."""
+    worksheet_name = _get_worksheet_name_safe(worksheet_historical)
+
+    def _append() -> dict[str, Any]:
+        return worksheet_historical.spreadsheet.values_append(
+            _sheet_a1_range(worksheet_name, f"A{max(tail - 1, 1)}"),
+            params={"valueInputOption": "RAW"},
+            body={"values": rows},
+        )
+
+    try:
+        response = _run_gsheet_write_with_backoff(_append, operation_name="archivo en histórico")
+    except Exception as append_error:
+        if ARCHIVE_CELL_LIMIT_ERROR not in str(append_error):
+            raise
+        _trim_spreadsheet_to_used_cells(worksheet_historical.spreadsheet)
+        response = _run_gsheet_write_with_backoff(_append, operation_name="archivo en histórico")
+
+    updated_range = str((response or {}).get("updates", {}).get("updatedRange", "")).split("!")[-1]
+    first, _, last = updated_range.partition(":")
+    start_row, _ = gspread.utils.a1_to_rowcol(first)
+    end_row, _ = gspread.utils.a1_to_rowcol(last or first)
+    if end_row - start_row + 1 != len(rows):
+        raise ValueError(f"El histórico reportó un rango anexado inesperado: {updated_range}.")
+    return int(start_row), int(end_row)
+
+
+def _archive_execute_run(
+    conn: sqlite3.Connection,
+    corrida: str,
+    hoja: str,
+    worksheet_historical: Any,
+) -> None:
+    """Anexa los lotes pendientes de la corrida; los IDs ya indexados se dan por escritos."""
+    lotes = conn.execute(
+        "SELECT lote, ids, filas FROM archivo_lotes WHERE corrida = ? AND estado = 'pendiente' ORDER BY lote",
+        (corrida,),
+    ).fetchall()
+    for lote, ids_raw, filas_raw in lotes:
+        ids = json.loads(ids_raw)
+        filas = json.loads(filas_raw)
+        # Un lote que se anexó antes de una caída ya aparece en el índice tras sincronizar la cola.
+        ya_indexados = _archive_indexed_rows(conn, hoja, ids)
+        pendientes = [(pid, fila) for pid, fila in zip(ids, filas) if pid not in ya_indexados]
+        if pendientes:
+            tail = int(
+                conn.execute("SELECT siguiente_fila FROM archivo_cola WHERE hoja = ?", (hoja,)).fetchone()[0]
+            )
+            start_row, end_row = _archive_append_batch(worksheet_historical, [fila for _, fila in pendientes], tail)
+        with conn:
+            if pendientes:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO archivo_ids (hoja, id_pedido, fila) VALUES (?, ?, ?)",
+                    [(hoja, pid, start_row + offset) for offset, (pid, _) in enumerate(pendientes)],
+                )
+                conn.execute(
+                    "UPDATE archivo_cola SET siguiente_fila = MAX(siguiente_fila, ?), actualizado = ? WHERE hoja = ?",
+                    (end_row + 1, time.time(), hoja),
+                )
+            conn.execute(
+                "UPDATE archivo_lotes SET estado = 'escrito' WHERE corrida = ? AND lote = ?",
+                (corrida, lote),
+            )
+
+
+def _archive_verify_ids(
+    conn: sqlite3.Connection,
+    hoja: str,
+    worksheet_historical: Any,
+    id_col: int,
+    ids: Sequence[str],
+) -> list[str]:
+    """Relee solo las filas del índice para ``ids`` y devuelve los que no están en el histórico."""
+    indexed = _archive_indexed_rows(conn, hoja, ids)
+    faltantes = [pid for pid in ids if pid not in indexed]
+    ranges = _compress_row_indexes(list(indexed.values()))
+    if not ranges:
+        return faltantes
+    letter = _archive_column_letter(id_col)
+    worksheet_name = _get_worksheet_name_safe(worksheet_historical)
+    columnas = _run_gsheet_read_with_backoff(
+        lambda: _values_batch_get(
+            worksheet_historical.spreadsheet,
+            [_sheet_a1_range(worksheet_name, f"{letter}{start}:{letter}{end}") for start, end in ranges],
+            acquire_quota=False,
+        ),
+        operation_name="verificación del histórico",
+    )
+    leidos: dict[int, str] = {}
+    for (start, _), column in zip(ranges, columnas):
+        for offset, cell in enumerate(column):
+            leidos[start + offset] = _archive_first_cell(cell)
+    faltantes.extend(pid for pid, fila in indexed.items() if leidos.get(fila) != pid)
+    return faltantes
+
+
+def _archive_delete_from_operativa(
+    worksheet_main: Any,
+    headers_main: list,
+    filas_operativas: Sequence[Sequence[Any]],
+) -> tuple[int, int]:
+    """
+    Elimina de la base operativa las filas registradas en la corrida.
+
+    Antes de borrar relee la columna ID_Pedido completa. Una fila que ya no tiene
+    su ID (porque una corrida retomada antes borró filas de arriba y la hoja se
+    recorrió) se vuelve a ubicar por ID_Pedido cuando ese ID aparece en una sola
+    fila no reclamada; si no, se omite. Devuelve ``(eliminadas, omitidas)``.
+    """
+    esperados = [(int(fila), str(pid)) for fila, pid in filas_operativas if int(fila) > 1]
+    if not esperados:
+        return 0, 0
+    letter = _archive_column_letter(headers_main.index("ID_Pedido") + 1)
+    worksheet_name = _get_worksheet_name_safe(worksheet_main)
+    (columna,) = _run_gsheet_read_with_backoff(
+        lambda: _values_batch_get(
+            worksheet_main.spreadsheet,
+            [_sheet_a1_range(worksheet_name, f"{letter}2:{letter}")],
+            acquire_quota=False,
+        ),
+        operation_name="filas a eliminar",
+    )
+    leidos = {offset + 2: _archive_first_cell(cell) for offset, cell in enumerate(columna)}
+    filas_por_id: dict[str, list[int]] = {}
+    for fila, pid in leidos.items():
+        if pid:
+            filas_por_id.setdefault(pid, []).append(fila)
+
+    row_indexes = {fila for fila, pid in esperados if leidos.get(fila) == pid}
+    for fila, pid in esperados:
+        if leidos.get(fila) == pid:
+            continue
+        libres = [candidata for candidata in filas_por_id.get(pid, []) if candidata not in row_indexes]
+        if len(libres) == 1:
+            row_indexes.add(libres[0])
+    _delete_rows_by_indexes(worksheet_main, sorted(row_indexes))
+    return len(row_indexes), len(esperados) - len(row_indexes)
+
+
+def _archive_finish_run(
+    conn: sqlite3.Connection,
+    corrida: str,
+    hoja: str,
+    worksheet_historical: Any,
+    id_col: int,
+    worksheet_main: Any,
+    headers_main: list,
+    ids: Sequence[str],
+    filas_operativas: Sequence[Sequence[Any]],
+    timings: dict[str, float],
+    status_slot: Any,
+    progress_bar: Any,
+) -> int:
+    """
+    Lotes → verificación → eliminación operativa; cada etapa queda asentada en el journal.
+
+    Devuelve cuántas filas operativas no se eliminaron porque su ID_Pedido cambió.
+    Cada fallo suma un intento; al llegar a ``ARCHIVE_MAX_ATTEMPTS`` la corrida
+    queda como 'fallida' y ya no bloquea las siguientes limpiezas.
+    """
+    def _mark(estado: str, error: str = "") -> None:
+        with conn:
+            conn.execute(
+                "UPDATE archivo_corridas SET estado = ?, error = ? WHERE corrida = ?",
+                (estado, error, corrida),
+            )
+
+    omitidas = 0
+
+    estado = conn.execute("SELECT estado FROM archivo_corridas WHERE corrida = ?", (corrida,)).fetchone()[0]
+    try:
+        if estado == "anexando":
+            status_slot.info("📦 Moviendo pedidos al histórico...")
+            progress_bar.progress(45)
+            t0 = time.perf_counter()
+            _archive_execute_run(conn, corrida, hoja, worksheet_historical)
+            timings["anexado"] = timings.get("anexado", 0.0) + time.perf_counter() - t0
+
+            status_slot.info("🔐 Verificando integridad de los datos...")
+            progress_bar.progress(70)
+            t0 = time.perf_counter()
+            faltantes = _archive_verify_ids(conn, hoja, worksheet_historical, id_col, ids)
+            if faltantes:
+                # El histórico se reordenó o editó: se reconstruye el índice y se vuelve a verificar.
+                _archive_rebuild_index(conn, hoja, worksheet_historical, id_col)
+                faltantes = _archive_verify_ids(conn, hoja, worksheet_historical, id_col, ids)
+            timings["verificación"] = timings.get("verificación", 0.0) + time.perf_counter() - t0
+            if faltantes:
+                raise ValueError(f"Verificación incompleta: faltan {len(faltantes)} ID_Pedido en histórico.")
+            _mark("verificado")
+            estado = "verificado"
+
+        if estado == "verificado":
+            status_slot.info("🧹 Eliminando pedidos de la base operativa...")
+            progress_bar.progress(88)
+            t0 = time.perf_counter()
+            _, omitidas = _archive_delete_from_operativa(worksheet_main, headers_main, filas_operativas)
+            timings["eliminación"] = timings.get("eliminación", 0.0) + time.perf_counter() - t0
+            # Los lotes se conservan hasta exportarse al histórico columnar.
+            _mark("completo")
+        return omitidas
+    except Exception as exc:
+        with conn:
+            conn.execute(
+                "UPDATE archivo_corridas SET intentos = intentos + 1, error = ?, "
+                "estado = CASE WHEN intentos + 1 >= ? THEN 'fallida' ELSE estado END WHERE corrida = ?",
+                (str(exc), ARCHIVE_MAX_ATTEMPTS, corrida),
+            )
+        raise
+
+
+def _archive_failed_runs() -> list[dict[str, Any]]:
+    """Corridas que agotaron sus intentos, con el último error, para revisarlas en la UI."""
+    hoja = f"{GOOGLE_SHEET_ID}/{GOOGLE_SHEET_HISTORICAL_WORKSHEET_NAME}"
+    conn = _archive_journal_connect()
+    try:
+        rows = conn.execute(
+            "SELECT corrida, creado, ids, intentos, error FROM archivo_corridas "
+            "WHERE hoja = ? AND estado = 'fallida' ORDER BY creado",
+            (hoja,),
+        ).fetchall()
+    finally:
+        conn.close()
+    return [
+        {"corrida": corrida, "creado": creado, "pedidos": len(json.loads(ids_raw)), "intentos": intentos, "error": error}
+        for corrida, creado, ids_raw, intentos, error in rows
+    ]
 
-    requests = []
-    sheet_id = worksheet.id
-    for start, end in sorted(ranges, key=lambda r: r[0], reverse=True):
-        requests.append(
-            {
-                "deleteDimension": {
-                    "range": {
-                        "sheetId": sheet_id,
-                        "dimension": "ROWS",
-                        "startIndex": int(start) - 1,
-                        "endIndex": int(end),
-                    }
-                }
-            }
-        )
 
-    _run_gsheet_write_with_backoff(
-        lambda: worksheet.spreadsheet.batch_update({"requests": requests}),
-        operation_name="eliminación de filas",
-    )
+def _archive_resolve_failed_run(corrida: str, *, descartar: bool) -> None:
+    """
+    Reintenta (vuelve a 'anexando' con los intentos en cero) o descarta una corrida fallida.
 
+    Al descartar se borran sus lotes no escritos; los ya anexados siguen en el
+    histórico y se exportan al Parquet como los de una corrida completa. Las filas
+    operativas de una corrida descartada no se eliminan.
+    """
+    with _archive_exclusive():
+        conn = _archive_journal_connect()
+        try:
+            with conn:
+                if descartar:
+                    conn.execute(
+                        "DELETE FROM archivo_lotes WHERE corrida = ? AND estado = 'pendiente'",
+                        (corrida,),
+                    )
+                    conn.execute(
+                        "UPDATE archivo_corridas SET estado = 'descartada' WHERE corrida = ? AND estado = 'fallida'",
+                        (corrida,),
+                    )
+                else:
+                    conn.execute(
+                        "UPDATE archivo_corridas SET estado = 'anexando', intentos = 0, error = '' "
+                        "WHERE corrida = ? AND estado = 'fallida'",
+                        (corrida,),
+                    )
+        finally:
+            conn.close()
 
-def _is_rate_limit_error(exc: Exception) -> bool:
-    """Detecta errores de cuota/límite de escritura de Google Sheets."""
-    text = str(exc)
-    signals = (
-        "429",
-        "RESOURCE_EXHAUSTED",
-        "RATE_LIMIT",
-        "Quota exceeded",
-        "quota metric",
-    )
-    return any(sig in text for sig in signals)
 
+def render_archive_failed_runs() -> None:
+    """Aviso de limpiezas que no terminaron, con opción de reintentarlas o descartarlas."""
+    omitidas = int(st.session_state.pop("archive_last_omitidas", 0) or 0)
+    if omitidas:
+        st.warning(
+            f"⚠️ {omitidas} fila(s) no se eliminaron de la base operativa porque su ID_Pedido "
+            "cambió desde que se seleccionaron; ya están en el histórico."
+        )
+    try:
+        fallidas = _archive_failed_runs()
+    except Exception:
+        return
+    for corrida in fallidas:
+        creado = datetime.fromtimestamp(corrida["creado"]).strftime("%d/%m %H:%M")
+        st.error(
+            f"❌ Limpieza del {creado} ({corrida['pedidos']} pedido(s)) falló {corrida['intentos']} veces "
+            f"y se dejó de retomar. Último error: {corrida['error']}"
+        )
+        col_retry, col_discard = st.columns(2)
+        accion = None
+        if col_retry.button("🔁 Reintentar", key=f"archive_retry_{corrida['corrida']}"):
+            accion = False
+        if col_discard.button(
+            "🗑️ Descartar",
+            key=f"archive_discard_{corrida['corrida']}",
+            help="Los pedidos quedan en la base operativa; lo ya anexado al histórico se conserva.",
+        ):
+            accion = True
+        if accion is not None:
+            try:
+                _archive_resolve_failed_run(corrida["corrida"], descartar=accion)
+                st.rerun()
+            except RuntimeError as exc:
+                st.warning(f"⚠️ {exc}")
 
-def _run_gsheet_write_with_backoff(func, *, operation_name: str, max_retries: int = 5):
-    """Ejecuta una operación de escritura con backoff exponencial ante 429."""
-    wait_seconds = 1.2
-    last_error = None
-    for attempt in range(max_retries + 1):
-        try:
-            return func()
-        except Exception as exc:
-            last_error = exc
-            if attempt >= max_retries or not _is_rate_limit_error(exc):
-                raise
-            st.info(
-                f"⏳ Límite temporal de Google Sheets durante {operation_name}. "
-                f"Reintentando ({attempt + 1}/{max_retries})..."
-            )
-            time.sleep(wait_seconds)
-            wait_seconds = min(wait_seconds * 2, 12)
-    raise last_error
 
+# --- Histórico columnar (Parquet en S3) ---
+# El formato, el manifiesto y la compactación viven en ``historico_parquet`` (los
+# comparten las tres apps); aquí solo se genera y se alimenta desde la hoja histórica.
 
-def _trim_spreadsheet_to_used_cells(spreadsheet, min_rows: int = 2, min_cols: int = 1) -> None:
-    """Recorta filas/columnas sobrantes por hoja para liberar celdas totales del workbook."""
-    for ws in spreadsheet.worksheets():
-        values = ws.get_all_values()
-        used_rows = max(len(values), min_rows)
-        used_cols = min_cols
-        if values:
-            used_cols = max(max((len(r) for r in values), default=min_cols), min_cols)
 
-        target_rows = max(used_rows, min_rows)
-        target_cols = max(used_cols, min_cols)
+def backfill_historico_parquet(s3_client_param: Any) -> int:
+    """
+    Genera el histórico columnar completo con una lectura de la hoja histórica.
 
-        if ws.row_count != target_rows or ws.col_count != target_cols:
-            ws.resize(rows=target_rows, cols=target_cols)
+    Reemplaza las partes anteriores y marca el manifiesto como completo; desde ese
+    momento los lectores dejan de consultar la hoja histórica en Sheets. Las partes
+    exportadas después de iniciar la lectura (filas editadas mientras tanto) se
+    conservan.
+    """
+    if pq is None:
+        raise RuntimeError("pyarrow no está instalado.")
+    inicio_ms = int(time.time() * 1000)
+    spreadsheet = g_spread_client.open_by_key(GOOGLE_SHEET_ID)
+    (values,) = _run_gsheet_read_with_backoff(
+        lambda: _values_batch_get(
+            spreadsheet,
+            [_sheet_whole_range(GOOGLE_SHEET_HISTORICAL_WORKSHEET_NAME)],
+            acquire_quota=False,
+        ),
+        operation_name="histórico columnar",
+        priority="background",
+    )
+    if not values:
+        return 0
+    df = historico_parquet_frame(values[0], values[1:], range(2, len(values) + 1), exportado_ms=inicio_ms)
+    new_parts: dict[str, dict[str, Any]] = {}
+    for mes, df_mes in df.groupby(historico_parquet_month(df), sort=True):
+        key, meta = historico_parquet_put_part(s3_client_param, S3_BUCKET_NAME, str(mes), df_mes)
+        new_parts[key] = meta
+
+    old_keys: list[str] = []
+
+    def _replace(manifest: dict[str, Any]) -> None:
+        parts = manifest.get("parts", {})
+        old_keys[:] = [key for key, meta in parts.items() if int(meta.get("exportado_ms", 0) or 0) <= inicio_ms]
+        manifest["parts"] = {**{key: parts[key] for key in parts if key not in old_keys}, **new_parts}
+        manifest["backfill"] = True
+        manifest["backfill_filas"] = int(len(df))
+        manifest["backfill_at"] = mx_now_str()
+
+    historico_manifest_update(s3_client_param, S3_BUCKET_NAME, _replace)
+    historico_parquet_delete(s3_client_param, S3_BUCKET_NAME, [key for key in old_keys if key not in new_parts])
+    return int(len(df))
+
+
+def _refresh_historico_parquet_from_sheet(spreadsheet: Any, filas: Sequence[int]) -> None:
+    """Relee de la hoja histórica las filas escritas y las reexporta al Parquet."""
+    filas = sorted({int(fila) for fila in filas if int(fila) > 1})
+    if pq is None or not filas:
+        return
+    bloques = _compress_row_indexes(filas)
+    ranges = [_sheet_a1_range(GOOGLE_SHEET_HISTORICAL_WORKSHEET_NAME, "1:1")] + [
+        _sheet_a1_range(GOOGLE_SHEET_HISTORICAL_WORKSHEET_NAME, f"{start}:{end}") for start, end in bloques
+    ]
+    values = _run_gsheet_read_with_backoff(
+        lambda: _values_batch_get(spreadsheet, ranges, acquire_quota=False),
+        operation_name="reexportar histórico columnar",
+        priority="background",
+    )
+    if not values or not values[0]:
+        return
+    filas_valores: dict[int, list[Any]] = {}
+    for (start, end), bloque in zip(bloques, values[1:]):
+        for fila in range(start, end + 1):
+            offset = fila - start
+            if offset < len(bloque) and any(str(v).strip() for v in bloque[offset]):
+                filas_valores[fila] = bloque[offset]
+    refresh_historico_parquet_rows(get_s3_client(), S3_BUCKET_NAME, values[0][0], filas_valores)
+
+
+def _historico_export_pending(conn: sqlite3.Connection, hoja: str, s3_client_param: Any) -> int:
+    """Exporta a Parquet los lotes escritos de corridas terminadas; se borran del journal al quedar en S3."""
+    pendientes = conn.execute(
+        "SELECT l.corrida, l.lote, l.ids, l.filas, c.encabezados FROM archivo_lotes l "
+        "JOIN archivo_corridas c ON c.corrida = l.corrida "
+        "WHERE c.hoja = ? AND c.estado IN ('completo', 'descartada') AND l.estado = 'escrito' "
+        "ORDER BY c.creado, l.lote",
+        (hoja,),
+    ).fetchall()
+    if not pendientes:
+        return 0
+    exportados = 0
+    if pq is not None:
+        ids_por_lote = [json.loads(ids_raw) for _, _, ids_raw, _, _ in pendientes]
+        filas_index = _archive_indexed_rows(conn, hoja, [pid for ids in ids_por_lote for pid in ids])
+        frames = []
+        for (_, _, _, filas_raw, encabezados_raw), ids in zip(pendientes, ids_por_lote):
+            frames.append(
+                historico_parquet_frame(
+                    json.loads(encabezados_raw),
+                    json.loads(filas_raw),
+                    [int(filas_index.get(pid, 0)) for pid in ids],
+                )
+            )
+        exportados = write_historico_parquet(s3_client_param, S3_BUCKET_NAME, pd.concat(frames, ignore_index=True))
+    with conn:
+        conn.executemany(
+            "DELETE FROM archivo_lotes WHERE corrida = ? AND lote = ?",
+            [(corrida, lote) for corrida, lote, _, _, _ in pendientes],
+        )
+    return exportados
 
 
 def archive_and_clean_pedidos(
     df_objetivo: pd.DataFrame,
     worksheet_main,
     headers_main,
+    *,
+    dry_run: bool = False,
 ) -> tuple[bool, str, int]:
-    """Archiva pedidos en histórico y elimina de base operativa solo tras verificar integridad."""
+    """
+    Archiva pedidos en histórico y elimina de base operativa solo tras verificar integridad.
+
+    Primero retoma cualquier corrida inconclusa del journal. Con ``dry_run=True``
+    no escribe en Sheets: devuelve en el mensaje el plan y el tiempo de cada etapa.
+    """
     progress_bar = st.progress(0)
     status_slot = st.empty()
     etapa = "inicio"
-    ya_eliminados_en_fallback = False
+    timings: dict[str, float] = {}
     try:
         etapa = "identificación"
         status_slot.info("🔎 Identificando pedidos a limpiar...")
@@ -8707,172 +12147,150 @@ def archive_and_clean_pedidos(
         if pedidos_a_limpiar.empty:
             return False, "No se encontraron índices válidos para eliminar en base operativa.", 0
 
-        ids_limpiar = (
-            pedidos_a_limpiar.get("ID_Pedido", pd.Series(dtype=str))
-            .astype(str)
-            .str.strip()
-            .tolist()
-        )
+        ids_limpiar = [
+            pid
+            for pid in pedidos_a_limpiar.get("ID_Pedido", pd.Series(dtype=str)).astype(str).str.strip().tolist()
+            if pid
+        ]
         if not ids_limpiar:
             return False, "No se pudieron obtener los ID_Pedido a limpiar.", 0
 
-        etapa = "movimiento a histórico"
-        status_slot.info("📦 Moviendo pedidos al histórico...")
-        progress_bar.progress(45)
-
-        worksheet_historical = g_spread_client.open_by_key(GOOGLE_SHEET_ID).worksheet(
-            GOOGLE_SHEET_HISTORICAL_WORKSHEET_NAME
-        )
-        headers_hist = worksheet_historical.row_values(1)
-        headers_origen = headers_main
-
-        if "ID_Pedido" not in headers_hist:
-            raise ValueError("La hoja histórica no contiene la columna ID_Pedido.")
-
-        id_col_hist = headers_hist.index("ID_Pedido") + 1
-        ids_existentes_hist = {
-            str(v).strip()
-            for v in worksheet_historical.col_values(id_col_hist)[1:]
-            if str(v).strip()
-        }
-
-        def _normalize_gsheet_value(value):
-            if pd.isna(value):
-                return ""
-            if isinstance(value, (pd.Timestamp, datetime)):
-                return value.isoformat(sep=" ")
-            if hasattr(value, "isoformat"):
-                return value.isoformat()
-            return value
-
-        rows_to_append = []
-        for _, row in pedidos_a_limpiar.iterrows():
-            pedido_id = str(row.get("ID_Pedido", "")).strip()
-            if pedido_id and pedido_id in ids_existentes_hist:
-                continue
+        with _archive_exclusive():
+            etapa = "puntero del histórico"
+            t0 = time.perf_counter()
+            worksheet_historical = g_spread_client.open_by_key(GOOGLE_SHEET_ID).worksheet(
+                GOOGLE_SHEET_HISTORICAL_WORKSHEET_NAME
+            )
+            headers_hist = get_registered_headers(worksheet_historical)
+            if "ID_Pedido" not in headers_hist:
+                raise ValueError("La hoja histórica no contiene la columna ID_Pedido.")
+            id_col_hist = headers_hist.index("ID_Pedido") + 1
+            hoja = f"{GOOGLE_SHEET_ID}/{GOOGLE_SHEET_HISTORICAL_WORKSHEET_NAME}"
 
-            row_map = {col: row.get(col, "") for col in headers_origen}
-            rows_to_append.append([
-                _normalize_gsheet_value(row_map.get(col, "")) for col in headers_hist
-            ])
-
-        historical_values_before = worksheet_historical.get_all_values()
-        start_row = len(historical_values_before) + 1
-
-        chunk_size = 200
-        total_cols = max(len(headers_hist), 1)
-        last_col_letter = gspread.utils.rowcol_to_a1(1, total_cols)[:-1]
-
-        def _append_rows_in_chunks() -> None:
-            if hasattr(worksheet_historical, "append_rows"):
-                for i in range(0, len(rows_to_append), chunk_size):
-                    chunk_rows = rows_to_append[i:i + chunk_size]
-                    _run_gsheet_write_with_backoff(
-                        lambda chunk=chunk_rows: worksheet_historical.append_rows(
-                            chunk,
-                            value_input_option="RAW",
-                        ),
-                        operation_name="archivo en histórico",
+            conn = _archive_journal_connect()
+            try:
+                tail = _archive_sync_tail(conn, hoja, worksheet_historical, id_col_hist)
+                timings["puntero"] = time.perf_counter() - t0
+
+                inconclusas = conn.execute(
+                    "SELECT corrida, ids, filas_operativas FROM archivo_corridas "
+                    f"WHERE hoja = ? AND estado IN ({','.join('?' * len(ARCHIVE_RESUMABLE_STATES))}) "
+                    "ORDER BY creado",
+                    (hoja, *ARCHIVE_RESUMABLE_STATES),
+                ).fetchall()
+
+                t0 = time.perf_counter()
+                ya_archivados = _archive_indexed_rows(conn, hoja, ids_limpiar)
+                rows_to_append: list[tuple[str, list[Any]]] = []
+                # Fila exacta de cada pedido seleccionado: solo esas se eliminan de la operativa.
+                filas_operativas: list[list[Any]] = []
+                vistos: set[str] = set()
+                for _, row in pedidos_a_limpiar.iterrows():
+                    pedido_id = str(row.get("ID_Pedido", "")).strip()
+                    if pedido_id:
+                        filas_operativas.append([int(row["_gsheet_row_index"]), pedido_id])
+                    if not pedido_id or pedido_id in ya_archivados or pedido_id in vistos:
+                        continue
+                    vistos.add(pedido_id)
+                    rows_to_append.append(
+                        (pedido_id, [_archive_cell_value(row.get(col, "")) for col in headers_hist])
                     )
-            elif hasattr(worksheet_historical, "update"):
-                for i in range(0, len(rows_to_append), chunk_size):
-                    chunk_rows = rows_to_append[i:i + chunk_size]
-                    chunk_start_row = start_row + i
-                    chunk_end_row = chunk_start_row + len(chunk_rows) - 1
-                    chunk_range = f"A{chunk_start_row}:{last_col_letter}{chunk_end_row}"
-                    _run_gsheet_write_with_backoff(
-                        lambda r=chunk_range, chunk=chunk_rows: worksheet_historical.update(
-                            r,
-                            chunk,
-                            value_input_option="RAW",
-                        ),
-                        operation_name="archivo en histórico",
+                timings["plan"] = time.perf_counter() - t0
+
+                if dry_run:
+                    lotes = math.ceil(len(rows_to_append) / ARCHIVE_BATCH_ROWS)
+                    detalle_tiempos = ", ".join(f"{k}: {v * 1000:.0f} ms" for k, v in timings.items())
+                    reporte = (
+                        f"Simulación: {len(ids_limpiar)} pedido(s) seleccionados, "
+                        f"{len(ya_archivados)} ya estaban en histórico, {len(rows_to_append)} por anexar "
+                        f"en {lotes} lote(s) desde la fila {tail}; {len(inconclusas)} corrida(s) por retomar. "
+                        f"Tiempos: {detalle_tiempos}."
+                    )
+                    st.session_state["archive_last_timings"] = dict(timings)
+                    progress_bar.progress(100)
+                    status_slot.empty()
+                    return True, reporte, len(ids_limpiar)
+
+                # Las corridas retomadas pueden borrar filas por arriba de las de este plan;
+                # ``_archive_delete_from_operativa`` las vuelve a ubicar por ID_Pedido.
+                omitidas = 0
+                for corrida_previa, ids_previos, filas_previas in inconclusas:
+                    etapa = "corrida previa"
+                    status_slot.info("♻️ Retomando una limpieza anterior que no terminó...")
+                    omitidas += _archive_finish_run(
+                        conn,
+                        corrida_previa,
+                        hoja,
+                        worksheet_historical,
+                        id_col_hist,
+                        worksheet_main,
+                        headers_main,
+                        json.loads(ids_previos),
+                        json.loads(filas_previas),
+                        timings,
+                        status_slot,
+                        progress_bar,
                     )
-            elif hasattr(worksheet_historical, "append_row"):
-                for row_values in rows_to_append:
-                    _run_gsheet_write_with_backoff(
-                        lambda vals=row_values: worksheet_historical.append_row(
-                            vals,
-                            value_input_option="RAW",
+
+                etapa = "movimiento a histórico"
+                corrida = uuid.uuid4().hex
+                with conn:
+                    conn.execute(
+                        "INSERT INTO archivo_corridas (corrida, hoja, creado, estado, ids, encabezados, filas_operativas) "
+                        "VALUES (?, ?, ?, 'anexando', ?, ?, ?)",
+                        (
+                            corrida,
+                            hoja,
+                            time.time(),
+                            json.dumps(ids_limpiar),
+                            json.dumps(list(headers_hist)),
+                            json.dumps(filas_operativas),
                         ),
-                        operation_name="archivo en histórico",
                     )
-            else:
-                raise AttributeError(
-                    "La hoja histórica no soporta métodos de escritura compatibles (append_rows/update/append_row)."
+                    conn.executemany(
+                        "INSERT INTO archivo_lotes (corrida, lote, ids, filas, estado) VALUES (?, ?, ?, ?, 'pendiente')",
+                        [
+                            (
+                                corrida,
+                                lote,
+                                json.dumps([pid for pid, _ in rows_to_append[i:i + ARCHIVE_BATCH_ROWS]]),
+                                json.dumps([fila for _, fila in rows_to_append[i:i + ARCHIVE_BATCH_ROWS]]),
+                            )
+                            for lote, i in enumerate(range(0, len(rows_to_append), ARCHIVE_BATCH_ROWS))
+                        ],
+                    )
+                etapa = "archivo en histórico"
+                omitidas += _archive_finish_run(
+                    conn,
+                    corrida,
+                    hoja,
+                    worksheet_historical,
+                    id_col_hist,
+                    worksheet_main,
+                    headers_main,
+                    ids_limpiar,
+                    filas_operativas,
+                    timings,
+                    status_slot,
+                    progress_bar,
                 )
+                if omitidas:
+                    st.session_state["archive_last_omitidas"] = omitidas
 
-        try:
-            if rows_to_append:
-                _append_rows_in_chunks()
-        except Exception as append_error:
-            error_text = str(append_error)
-            if "above the limit of 10000000 cells" not in error_text:
-                raise
-            status_slot.info("🧰 Liberando espacio de celdas en el workbook y reintentando...")
-            _trim_spreadsheet_to_used_cells(worksheet_historical.spreadsheet)
-            worksheet_historical = g_spread_client.open_by_key(GOOGLE_SHEET_ID).worksheet(
-                GOOGLE_SHEET_HISTORICAL_WORKSHEET_NAME
-            )
-            try:
-                _append_rows_in_chunks()
-            except Exception as retry_error:
-                retry_text = str(retry_error)
-                if "above the limit of 10000000 cells" not in retry_text:
-                    raise
-
-                status_slot.info("🔄 Sin espacio temporal para archivar: liberando celdas al eliminar en operativa y reintentando...")
-                row_indexes_fallback = pedidos_a_limpiar["_gsheet_row_index"].astype(int).tolist()
-                _delete_rows_by_indexes(worksheet_main, row_indexes_fallback)
-                ya_eliminados_en_fallback = True
-
+                t0 = time.perf_counter()
                 try:
-                    if rows_to_append:
-                        _append_rows_in_chunks()
-                except Exception:
-                    # Mejor esfuerzo de recuperación para evitar pérdida de datos.
-                    rows_restore = []
-                    for _, row_restore in pedidos_a_limpiar.iterrows():
-                        row_map_restore = {
-                            col: row_restore.get(col, "") for col in headers_main
-                        }
-                        rows_restore.append([
-                            _normalize_gsheet_value(row_map_restore.get(col, ""))
-                            for col in headers_main
-                        ])
-                    if rows_restore and hasattr(worksheet_main, "append_rows"):
-                        _run_gsheet_write_with_backoff(
-                            lambda: worksheet_main.append_rows(rows_restore, value_input_option="RAW"),
-                            operation_name="restauración de pedidos",
-                        )
-                    raise
-
-        etapa = "verificación"
-        status_slot.info("🔐 Verificando integridad de los datos...")
-        progress_bar.progress(70)
-
-        ids_historial_actual = {
-            str(v).strip()
-            for v in worksheet_historical.col_values(id_col_hist)[1:]
-            if str(v).strip()
-        }
-        faltantes = [pid for pid in ids_limpiar if pid and pid not in ids_historial_actual]
-        if faltantes:
-            raise ValueError(
-                f"Verificación incompleta: faltan {len(faltantes)} ID_Pedido en histórico."
-            )
-
-        etapa = "eliminación operativa"
-        status_slot.info("🧹 Eliminando pedidos de la base operativa...")
-        progress_bar.progress(88)
-
-        row_indexes = pedidos_a_limpiar["_gsheet_row_index"].astype(int).tolist()
-        if not ya_eliminados_en_fallback:
-            _delete_rows_by_indexes(worksheet_main, row_indexes)
-
+                    _historico_export_pending(conn, hoja, s3_client)
+                except Exception as exc:
+                    # Sheets ya tiene las filas; la exportación se reintenta en la siguiente limpieza.
+                    st.warning(f"⚠️ No se pudo actualizar el histórico columnar (Parquet): {exc}")
+                timings["parquet"] = time.perf_counter() - t0
+            finally:
+                conn.close()
+
+        st.session_state["archive_last_timings"] = dict(timings)
         progress_bar.progress(100)
         status_slot.empty()
-        return True, "", len(row_indexes)
+        return True, "", len(ids_limpiar)
 
     except Exception as e:
         status_slot.empty()
@@ -8887,6 +12305,7 @@ def _load_casos():
         worksheet_name="casos_especiales",
         client=g_spread_client,
         light_mode=False,
+        snapshot_version=current_sheet_snapshot_version(GOOGLE_SHEET_ID, "casos_especiales", g_spread_client),
     )
     _refresh_sheet_row_identity(df, "casos_especiales")
     return _apply_local_sheet_updates(df, "casos_especiales"), headers
@@ -8898,12 +12317,14 @@ if st.session_state.pop("reload_after_action", False):
     pass
 
 if st.session_state.pop("refresh_data_caches_pending", False):
+    invalidate_sheet_snapshot(GOOGLE_SHEET_ID, full_resync=True)
     st.cache_data.clear()
 
 if st.session_state.get("need_compare"):
     prev_pedidos = st.session_state.get("prev_pedidos_count", 0)
     prev_casos = st.session_state.get("prev_casos_count", 0)
     for attempt in range(3):
+        invalidate_sheet_snapshot(GOOGLE_SHEET_ID, full_resync=True)
         get_raw_sheet_data.clear()
         get_filtered_sheet_dataframe.clear()
         df_main, headers_main = _load_pedidos()
@@ -8946,30 +12367,17 @@ for col in required_cols_main:
     if col not in df_main.columns:
         df_main[col] = ""
 
-skip_demorado_check_once = st.session_state.pop("skip_demorado_check_once", False)
-if st.session_state.pop("bulk_checkbox_interaction", False):
-    skip_demorado_check_once = True
-
-
-def _handle_demorado_sync_rerun():
-    """Mantiene la navegación actual y relanza la app tras auto-sincronizar estados."""
-    st.cache_data.clear()
-    set_active_main_tab(st.session_state.get("active_main_tab_index", 0))
-    st.session_state["active_subtab_local_index"] = st.session_state.get("active_subtab_local_index", 0)
-    st.session_state["active_date_tab_m_index"] = st.session_state.get("active_date_tab_m_index", 0)
-    st.session_state["active_date_tab_t_index"] = st.session_state.get("active_date_tab_t_index", 0)
-    st.rerun()
+# Pendiente → Demorado lo aplica el barrido en segundo plano (uno por despliegue).
+start_demorado_sweeper()
+start_s3_manifest_reconciler()
 
 
 if df_main is not None:
-    if (not skip_demorado_check_once) and (not df_main.empty):
-        df_main, changes_made_by_demorado_check = check_and_update_demorados(df_main, worksheet_main, headers_main)
-        if changes_made_by_demorado_check:
-            _handle_demorado_sync_rerun()
-
     flow_map_local, flow_map_foraneo, pending_case_number_updates = build_flow_number_maps(df_main, df_casos)
     st.session_state["flow_number_map_local"] = flow_map_local
     st.session_state["flow_number_map_foraneo"] = flow_map_foraneo
+    # Versión con la que se construyó ``df_main`` (no la actual: el snapshot pudo avanzar).
+    df_main = asignar_orden_custom(df_main, _snapshot_version_of(df_main), ACTIVE_MAIN_WORKSHEET_NAME)
 
 
     # --- 🔔 Alerta de Modificación de Surtido ---
@@ -9093,68 +12501,29 @@ if df_main is not None:
             completados_ok = 0
             fallidos = list(fallidos_pre)
             preserve_tab_state()
-            _mark_skip_demorado_check_once()
 
             total_a_completar = len(pedidos_a_completar)
             st.session_state["bulk_complete_in_progress"] = True
             st.session_state["bulk_complete_progress_current"] = 0
             st.session_state["bulk_complete_progress_total"] = total_a_completar
-            progress_bar = st.progress(0, text=f"Completando 0 de {total_a_completar} pedidos seleccionados...")
-
-            for idx, pedido_row in enumerate(pedidos_a_completar, start=1):
-                pedido_id = str(pedido_row.get("ID_Pedido", "")).strip()
-                if not pedido_id:
-                    progress_ratio = idx / max(total_a_completar, 1)
-                    st.session_state["bulk_complete_progress_current"] = idx
-                    progress_bar.progress(progress_ratio, text=f"Completando {idx} de {total_a_completar} pedidos seleccionados...")
-                    continue
-
-                requires = pedido_requiere_guia(pedido_row)
-                has_file = pedido_tiene_guia_adjunta(pedido_row)
-                if requires and not has_file:
-                    fallidos.append(f"{pedido_id}: requiere guía antes de completar")
-                    progress_ratio = idx / max(total_a_completar, 1)
-                    st.session_state["bulk_complete_progress_current"] = idx
-                    progress_bar.progress(progress_ratio, text=f"Completando {idx} de {total_a_completar} pedidos seleccionados...")
-                    continue
-
-                row_idx_list = df_main.index[
-                    df_main.get("ID_Pedido", pd.Series(dtype=str)).astype(str).str.strip() == pedido_id
-                ].tolist()
-                if not row_idx_list:
-                    fallidos.append(f"{pedido_id}: no se encontró en datos cargados")
-                    progress_ratio = idx / max(total_a_completar, 1)
-                    st.session_state["bulk_complete_progress_current"] = idx
-                    progress_bar.progress(progress_ratio, text=f"Completando {idx} de {total_a_completar} pedidos seleccionados...")
-                    continue
+            progress_bar = st.progress(0, text=f"Completando {total_a_completar} pedidos seleccionados...")
 
-                df_idx = row_idx_list[0]
-                gsheet_row_index = pedido_row.get("_gsheet_row_index")
-                if gsheet_row_index is None or str(gsheet_row_index).strip() == "":
-                    fallidos.append(f"{pedido_id}: sin índice de fila en Google Sheets")
-                    progress_ratio = idx / max(total_a_completar, 1)
-                    st.session_state["bulk_complete_progress_current"] = idx
-                    progress_bar.progress(progress_ratio, text=f"Completando {idx} de {total_a_completar} pedidos seleccionados...")
-                    continue
-
-                ok = completar_pedido(
-                    df_main,
-                    df_idx,
-                    pedido_row,
-                    worksheet_main,
-                    headers_main,
-                    gsheet_row_index,
-                    "bulk_multi",
-                    success_message=f"✅ Pedido {pedido_id} completado",
-                    trigger_rerun=False,
-                )
-                if ok:
+            resultados_lote = completar_pedidos_en_lote(
+                df_main,
+                pedidos_a_completar,
+                worksheet_main,
+                headers_main,
+                "bulk_multi",
+            )
+            for resultado in resultados_lote:
+                if resultado["ok"]:
                     completados_ok += 1
+                    if resultado["detalle"]:
+                        st.warning(f"⚠️ {resultado['ID_Pedido']}: {resultado['detalle']}")
                 else:
-                    fallidos.append(f"{pedido_id}: no se pudo completar")
-
-                progress_ratio = idx / max(total_a_completar, 1)
-                progress_bar.progress(progress_ratio, text=f"Completando {idx} de {total_a_completar} pedidos seleccionados...")
+                    fallidos.append(f"{resultado['ID_Pedido']}: {resultado['detalle'] or 'no se pudo completar'}")
+            st.session_state["bulk_complete_progress_current"] = total_a_completar
+            progress_bar.progress(1.0, text=f"Completando {total_a_completar} de {total_a_completar} pedidos seleccionados...")
 
             progress_bar.empty()
             st.session_state["bulk_complete_in_progress"] = False
@@ -9234,13 +12603,6 @@ if df_main is not None:
             "contaminadas. Fecha_Modificacion se conservó y Nombre_Responsable se limpió si tenía Hora_Proceso."
         )
 
-    if (not skip_demorado_check_once) and (df_casos is not None) and (not df_casos.empty):
-        df_casos, changes_made_by_demorado_check_casos = check_and_update_demorados(
-            df_casos, worksheet_casos, headers_casos
-        )
-        if changes_made_by_demorado_check_casos:
-            _handle_demorado_sync_rerun()
-
     if pending_case_number_updates and "Numero_Foraneo" in headers_casos:
         col_num_foraneo = headers_casos.index("Numero_Foraneo") + 1
         updates_num_foraneo = [
@@ -10112,6 +13474,7 @@ if df_main is not None:
                             pedidos_turno_activos["Fecha_Entrega_dt"]
                             == current_selected_date_dt
                         ].copy()
+                        prefetch_hoja_ruta_fields(s3_client, pedidos_fecha)
                         route_scope = "monterrey"
                         route_context = f"local_{origen_tab}_{tab_label}".replace(" ", "_")
                         _render_ruta_optimizada_ui(
@@ -10308,6 +13671,7 @@ if df_main is not None:
                                     pedidos_s_activos["Fecha_Entrega_dt"]
                                     == current_selected_date_dt
                                 ].copy()
+                                prefetch_hoja_ruta_fields(s3_client, pedidos_fecha)
                                 route_context = f"saltillo_{tab_label}".replace(" ", "_")
                                 _render_ruta_optimizada_ui(
                                     pedidos_fecha=pedidos_fecha,
@@ -11203,10 +14567,12 @@ if df_main is not None:
 
                                 now_str = mx_now_str()
                                 ok = True
-                                if "Estado" in headers_casos:
-                                    ok &= update_gsheet_cell(worksheet_casos, headers_casos, gsheet_row_idx, "Estado", "🔵 En Proceso")
-                                if "Hora_Proceso" in headers_casos:
-                                    ok &= update_gsheet_cell(worksheet_casos, headers_casos, gsheet_row_idx, "Hora_Proceso", now_str)
+                                with coalesced_sheet_writes() as escritura:
+                                    if "Estado" in headers_casos:
+                                        ok &= update_gsheet_cell(worksheet_casos, headers_casos, gsheet_row_idx, "Estado", "🔵 En Proceso")
+                                    if "Hora_Proceso" in headers_casos:
+                                        ok &= update_gsheet_cell(worksheet_casos, headers_casos, gsheet_row_idx, "Hora_Proceso", now_str)
+                                ok &= escritura["ok"]
 
                                 if ok:
                                     # Reflejo inmediato local sin recargar
@@ -11265,53 +14631,55 @@ if df_main is not None:
                                     )
                                     ok = False
                                 else:
-                                    tipo_sel = st.session_state.get(
-                                        tipo_key, tipo_envio_actual
-                                    )
-                                    if "Tipo_Envio_Original" in headers_casos:
-                                        ok &= update_gsheet_cell(
-                                            worksheet_casos,
-                                            headers_casos,
-                                            gsheet_row_idx,
-                                            "Tipo_Envio_Original",
-                                            tipo_sel,
-                                        )
-                                        row["Tipo_Envio_Original"] = tipo_sel
-                                    if tipo_sel == "📍 Pedido Local":
-                                        turno_sel = st.session_state.get(
-                                            turno_key, turno_actual
+                                    with coalesced_sheet_writes() as escritura:
+                                        tipo_sel = st.session_state.get(
+                                            tipo_key, tipo_envio_actual
                                         )
-                                        if "Turno" in headers_casos:
+                                        if "Tipo_Envio_Original" in headers_casos:
                                             ok &= update_gsheet_cell(
                                                 worksheet_casos,
                                                 headers_casos,
                                                 gsheet_row_idx,
-                                                "Turno",
-                                                turno_sel,
+                                                "Tipo_Envio_Original",
+                                                tipo_sel,
                                             )
-                                            row["Turno"] = turno_sel
-                                    ok &= update_gsheet_cell(
-                                        worksheet_casos,
-                                        headers_casos,
-                                        gsheet_row_idx,
-                                        "Estado",
-                                        "🟢 Completado",
-                                    )
-                                    mx_now = mx_now_str()
-                                    _ = update_gsheet_cell(
-                                        worksheet_casos,
-                                        headers_casos,
-                                        gsheet_row_idx,
-                                        "Fecha_Completado",
-                                        mx_now,
-                                    )
-                                    _ = update_gsheet_cell(
-                                        worksheet_casos,
-                                        headers_casos,
-                                        gsheet_row_idx,
-                                        "Fecha_Entrega",
-                                        mx_now,
-                                    )
+                                            row["Tipo_Envio_Original"] = tipo_sel
+                                        if tipo_sel == "📍 Pedido Local":
+                                            turno_sel = st.session_state.get(
+                                                turno_key, turno_actual
+                                            )
+                                            if "Turno" in headers_casos:
+                                                ok &= update_gsheet_cell(
+                                                    worksheet_casos,
+                                                    headers_casos,
+                                                    gsheet_row_idx,
+                                                    "Turno",
+                                                    turno_sel,
+                                                )
+                                                row["Turno"] = turno_sel
+                                        ok &= update_gsheet_cell(
+                                            worksheet_casos,
+                                            headers_casos,
+                                            gsheet_row_idx,
+                                            "Estado",
+                                            "🟢 Completado",
+                                        )
+                                        mx_now = mx_now_str()
+                                        _ = update_gsheet_cell(
+                                            worksheet_casos,
+                                            headers_casos,
+                                            gsheet_row_idx,
+                                            "Fecha_Completado",
+                                            mx_now,
+                                        )
+                                        _ = update_gsheet_cell(
+                                            worksheet_casos,
+                                            headers_casos,
+                                            gsheet_row_idx,
+                                            "Fecha_Entrega",
+                                            mx_now,
+                                        )
+                                    ok &= escritura["ok"]
                                 if ok:
                                     st.session_state[
                                         "flash_msg"
@@ -11753,10 +15121,12 @@ if df_main is not None:
 
                                 now_str = mx_now_str()
                                 ok = True
-                                if "Estado" in headers_casos:
-                                    ok &= update_gsheet_cell(worksheet_casos, headers_casos, gsheet_row_idx, "Estado", "🔵 En Proceso")
-                                if "Hora_Proceso" in headers_casos:
-                                    ok &= update_gsheet_cell(worksheet_casos, headers_casos, gsheet_row_idx, "Hora_Proceso", now_str)
+                                with coalesced_sheet_writes() as escritura:
+                                    if "Estado" in headers_casos:
+                                        ok &= update_gsheet_cell(worksheet_casos, headers_casos, gsheet_row_idx, "Estado", "🔵 En Proceso")
+                                    if "Hora_Proceso" in headers_casos:
+                                        ok &= update_gsheet_cell(worksheet_casos, headers_casos, gsheet_row_idx, "Hora_Proceso", now_str)
+                                ok &= escritura["ok"]
     
                                 if ok:
                                     row["Estado"] = "🔵 En Proceso"
@@ -12025,53 +15395,55 @@ if df_main is not None:
                                     )
                                     ok = False
                                 else:
-                                    tipo_sel = st.session_state.get(
-                                        tipo_key, tipo_envio_actual
-                                    )
-                                    if "Tipo_Envio_Original" in headers_casos:
-                                        ok &= update_gsheet_cell(
-                                            worksheet_casos,
-                                            headers_casos,
-                                            gsheet_row_idx,
-                                            "Tipo_Envio_Original",
-                                            tipo_sel,
-                                        )
-                                        row["Tipo_Envio_Original"] = tipo_sel
-                                    if tipo_sel == "📍 Pedido Local":
-                                        turno_sel = st.session_state.get(
-                                            turno_key, turno_actual
+                                    with coalesced_sheet_writes() as escritura:
+                                        tipo_sel = st.session_state.get(
+                                            tipo_key, tipo_envio_actual
                                         )
-                                        if "Turno" in headers_casos:
+                                        if "Tipo_Envio_Original" in headers_casos:
                                             ok &= update_gsheet_cell(
                                                 worksheet_casos,
                                                 headers_casos,
                                                 gsheet_row_idx,
-                                                "Turno",
-                                                turno_sel,
+                                                "Tipo_Envio_Original",
+                                                tipo_sel,
                                             )
-                                            row["Turno"] = turno_sel
-                                    ok &= update_gsheet_cell(
-                                        worksheet_casos,
-                                        headers_casos,
-                                        gsheet_row_idx,
-                                        "Estado",
-                                        "🟢 Completado",
-                                    )
-                                    mx_now = mx_now_str()
-                                    _ = update_gsheet_cell(
-                                        worksheet_casos,
-                                        headers_casos,
-                                        gsheet_row_idx,
-                                        "Fecha_Completado",
-                                        mx_now,
-                                    )
-                                    _ = update_gsheet_cell(
-                                        worksheet_casos,
-                                        headers_casos,
-                                        gsheet_row_idx,
-                                        "Fecha_Entrega",
-                                        mx_now,
-                                    )
+                                            row["Tipo_Envio_Original"] = tipo_sel
+                                        if tipo_sel == "📍 Pedido Local":
+                                            turno_sel = st.session_state.get(
+                                                turno_key, turno_actual
+                                            )
+                                            if "Turno" in headers_casos:
+                                                ok &= update_gsheet_cell(
+                                                    worksheet_casos,
+                                                    headers_casos,
+                                                    gsheet_row_idx,
+                                                    "Turno",
+                                                    turno_sel,
+                                                )
+                                                row["Turno"] = turno_sel
+                                        ok &= update_gsheet_cell(
+                                            worksheet_casos,
+                                            headers_casos,
+                                            gsheet_row_idx,
+                                            "Estado",
+                                            "🟢 Completado",
+                                        )
+                                        mx_now = mx_now_str()
+                                        _ = update_gsheet_cell(
+                                            worksheet_casos,
+                                            headers_casos,
+                                            gsheet_row_idx,
+                                            "Fecha_Completado",
+                                            mx_now,
+                                        )
+                                        _ = update_gsheet_cell(
+                                            worksheet_casos,
+                                            headers_casos,
+                                            gsheet_row_idx,
+                                            "Fecha_Entrega",
+                                            mx_now,
+                                        )
+                                    ok &= escritura["ok"]
                                 if ok:
                                     st.session_state[
                                         "flash_msg"
@@ -12523,23 +15895,10 @@ if df_main is not None:
                                 )
                             elif candidates:
                                 st.session_state[pending_review_key] = []
-                                if len(candidates) > _RUTA_OPT_MAX_WAYPOINTS:
-                                    progress_holder.empty()
-                                    route_blocked = True
-                                    st.error(
-                                        f"❌ Se seleccionaron {len(candidates)} pedidos, pero Google Directions permite hasta "
-                                        f"{_RUTA_OPT_MAX_WAYPOINTS} paradas por solicitud. Divide la ruta para no omitir pedidos."
-                                    )
-                                    candidates = []
-                                else:
-                                    progress_bar.progress(60, text="Optimizando ruta general (con prioridad suave)...")
-                                global_route = _call_directions_optimized_route(
-                                    api_key,
-                                    [f"{c['lat']},{c['lng']}" for c in candidates],
-                                    departure_time_unix=departure_time_unix,
-                                )
-                                global_order_idx = global_route.get("waypoint_order", []) if global_route else []
-                                ordered_base = [candidates[i] for i in global_order_idx] if global_order_idx else candidates
+                                progress_bar.progress(60, text="Optimizando ruta general (con prioridad suave)...")
+                                salida_seconds = salida_dt_local.hour * 3600 + salida_dt_local.minute * 60
+                                solved_routes = solve_ruta_opt_vrp(candidates, start_seconds=salida_seconds)
+                                ordered_base = [cand for solved in solved_routes for cand in solved]
 
                                 max_priority_candidates = []
                                 normal_candidates = []
@@ -12588,9 +15947,9 @@ if df_main is not None:
                                 st.warning("No se encontraron pedidos con coordenadas válidas para generar ruta.")
                             else:
                                 progress_bar.progress(80, text="Calculando ruta final con prioridad...")
-                                route = _call_directions_custom_route(
+                                route = _ruta_opt_directions_for_order(
                                     api_key,
-                                    [f"{c['lat']},{c['lng']}" for c in final_candidates],
+                                    final_candidates,
                                     departure_time_unix=departure_time_unix,
                                 )
                                 if route:
@@ -12878,6 +16237,7 @@ if df_main is not None:
                 if ok:
                     st.success("✅ Limpieza completada correctamente.")
                     st.success(f"📊 Total de pedidos archivados: {total_archivados}")
+                    invalidate_sheet_snapshot(GOOGLE_SHEET_ID, full_resync=True)
                     get_raw_sheet_data.clear()
                     get_filtered_sheet_dataframe.clear()
                     set_active_main_tab(7)
@@ -12885,7 +16245,26 @@ if df_main is not None:
                 else:
                     st.error("❌ Error durante la limpieza. No se eliminaron pedidos.")
                     st.error(f"Etapa con fallo: {err}")
-    
+            if not df_completados_historial.empty and st.button("⏱️ Simular limpieza"):
+                ok, reporte, _ = archive_and_clean_pedidos(
+                    df_completados_historial, worksheet_main, headers_main, dry_run=True
+                )
+                if ok:
+                    st.info(reporte)
+                else:
+                    st.error(f"Etapa con fallo: {reporte}")
+            if pq is not None and st.button(
+                "📦 Regenerar histórico columnar",
+                help="Lee una vez la hoja histórica y la guarda como Parquet por mes en S3.",
+            ):
+                try:
+                    with st.spinner("Generando histórico columnar..."):
+                        total_filas = backfill_historico_parquet(s3_client)
+                    st.success(f"✅ Histórico columnar generado con {total_filas} fila(s).")
+                except Exception as exc:
+                    st.error(f"❌ No se pudo generar el histórico columnar: {exc}")
+        render_archive_failed_runs()
+
         df_completados_historial["Fecha_Completado"] = pd.to_datetime(
             df_completados_historial["Fecha_Completado"],
             errors="coerce",
@@ -12951,6 +16330,7 @@ if df_main is not None:
                         if ok:
                             st.success("✅ Limpieza completada correctamente.")
                             st.success(f"📊 Total de pedidos archivados: {total_archivados}")
+                            invalidate_sheet_snapshot(GOOGLE_SHEET_ID, full_resync=True)
                             get_raw_sheet_data.clear()
                             get_filtered_sheet_dataframe.clear()
                             set_active_main_tab(7)
@@ -12993,6 +16373,7 @@ if df_main is not None:
                     if ok:
                         st.success("✅ Limpieza completada correctamente.")
                         st.success(f"📊 Total de pedidos archivados: {total_archivados}")
+                        invalidate_sheet_snapshot(GOOGLE_SHEET_ID, full_resync=True)
                         get_raw_sheet_data.clear()
                         get_filtered_sheet_dataframe.clear()
                         set_active_main_tab(6)
@@ -13095,6 +16476,7 @@ if df_main is not None:
                         ]
                         if updates and batch_update_gsheet_cells(worksheet_casos, updates, headers=headers_casos):
                             st.success(f"✅ {len(updates)} devoluciones marcadas como limpiadas.")
+                            invalidate_sheet_snapshot(GOOGLE_SHEET_ID, full_resync=True)
                             get_raw_sheet_data.clear()
                             get_filtered_sheet_dataframe.clear()
                             set_active_main_tab(7)
@@ -13132,6 +16514,7 @@ if df_main is not None:
                         ]
                         if updates and batch_update_gsheet_cells(worksheet_casos, updates, headers=headers_casos):
                             st.success(f"✅ {len(updates)} garantías marcadas como limpiadas.")
+                            invalidate_sheet_snapshot(GOOGLE_SHEET_ID, full_resync=True)
                             get_raw_sheet_data.clear()
                             get_filtered_sheet_dataframe.clear()
                             set_active_main_tab(6)
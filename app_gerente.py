@@ -10,7 +10,10 @@ import requests
 import pdfplumber
 import json
 import hashlib
+import os
+import tempfile
 import re
+import sqlite3
 import unicodedata
 from io import BytesIO
 from oauth2client.service_account import ServiceAccountCredentials
@@ -22,13 +25,32 @@ import urllib.parse
 import urllib.request
 import urllib.error
 import time
+import threading
+import sys
 import traceback
 import calendar
 import base64
 from html import escape
+from collections import OrderedDict
 from collections.abc import Mapping
 from zoneinfo import ZoneInfo
 
+try:
+    import fcntl
+except ImportError:  # Windows: sin locks entre procesos.
+    fcntl = None
+
+from sheets_quota import (
+    SheetsQuotaUnavailable,
+    acquire_sheets_quota,
+    report_sheets_quota_exhausted,
+    set_sheets_quota_user,
+)
+from historico_parquet import (
+    load_historico_columnar,
+    refresh_historico_parquet_rows,
+)
+
 
 # --- CONFIGURACIÓN DE STREAMLIT ---
 st.set_page_config(page_title="📦 Panel de Gestión", layout="wide")
@@ -1039,10 +1061,6 @@ SPREADSHEET_ID_MAIN = "1aWkSelodaz0nWfQx7FZAysGnIYGQFJxAN7RO3YgCiZY"
 SPREADSHEET_ID_ALEJANDRO = "1lWZEL228boUMH_tAdQ3_ZGkYHZZuEkfv"
 _ALE_ID_CACHE = {}
 _ALE_BOOTSTRAP_CACHE = {}
-_MAIN_SPREADSHEET_CACHE = None
-_COBRANZA_SPREADSHEET_CACHE = None
-_COBRANZA_WS_CACHE = None
-_COBRANZA_VALUES_CACHE = {}
 _COBRANZA_MAIL_LAST_SENT = {}
 
 
@@ -1068,7 +1086,9 @@ try:
         "s3",
         aws_access_key_id=st.secrets["aws"]["aws_access_key_id"],
         aws_secret_access_key=st.secrets["aws"]["aws_secret_access_key"],
-        region_name=st.secrets["aws"]["aws_region"]
+        region_name=st.secrets["aws"]["aws_region"],
+        # Opcional: S3 local compatible (MinIO, moto) para pruebas.
+        endpoint_url=st.secrets["aws"].get("endpoint_url") or None,
     )
     S3_BUCKET = st.secrets["aws"]["s3_bucket_name"]
     AWS_REGION = st.secrets["aws"]["aws_region"]
@@ -1095,10 +1115,31 @@ def _is_transient_gspread_error(exc: Exception) -> bool:
     return any(token in text for token in ["quota", "ratelimit", "rate limit", "backend error", "timeout"])
 
 
-def _retry_gspread_api_call(fn, retries: int = 5, base_delay: float = 0.8):
-    """Ejecuta `fn` con reintentos ante APIError transitorio (o redacted sin status)."""
+# --- Gobernador de cuota de Google Sheets ---
+# Vive en ``sheets_quota`` y lo comparten las tres apps; aquí solo se registra la
+# cuenta de servicio para las cuotas por usuario.
+try:
+    set_sheets_quota_user(st.secrets["gsheets"]["google_credentials"])
+except Exception:
+    pass
+
+
+def _retry_gspread_api_call(
+    fn,
+    retries: int = 5,
+    base_delay: float = 0.8,
+    kind: str = "read",
+    priority: str | None = None,
+):
+    """Ejecuta `fn` bajo el gobernador de cuota, con reintentos ante APIError transitorio (o redacted sin status)."""
+    priority = priority or ("interactive_write" if kind == "write" else "interactive_read")
     last_exc = None
     for attempt in range(retries):
+        if not acquire_sheets_quota(kind, priority):
+            # Sin cuota no se llama a la API (tampoco en el primer intento).
+            raise SheetsQuotaUnavailable(
+                f"Sin cuota de {'escritura' if kind == 'write' else 'lectura'} de Google Sheets"
+            )
         try:
             return fn()
         except gspread.exceptions.APIError as exc:
@@ -1108,25 +1149,179 @@ def _retry_gspread_api_call(fn, retries: int = 5, base_delay: float = 0.8):
             # Si luce permanente, damos un intento adicional corto y luego dejamos propagar.
             if (not _is_transient_gspread_error(exc)) and attempt >= 1:
                 raise
+            status_code = getattr(getattr(exc, "response", None), "status_code", None)
+            if status_code == 429 or "quota" in str(exc).lower():
+                # La espera hasta que se rellene la cuota la hace la cola del gobernador.
+                report_sheets_quota_exhausted(kind)
+                continue
             time.sleep(base_delay * (attempt + 1))
 
     if last_exc:
         raise last_exc
 
 
-def get_main_spreadsheet(force_refresh: bool = False):
-    """Abre y cachea el spreadsheet principal con reintentos para errores transitorios."""
-    global _MAIN_SPREADSHEET_CACHE
+# Caché del proceso (compartida entre sesiones) con vencimiento, LRU y tope de memoria.
+# Cada valor vive en un espacio ("namespace") para invalidarlo junto tras escrituras;
+# una sola sesión carga cada llave a la vez y las demás reutilizan su resultado.
+GERENTE_CACHE_MAX_BYTES = int(float(os.environ.get("GERENTE_CACHE_MAX_MB", "128")) * 1024 * 1024)
+GERENTE_CACHE_HANDLE_TTL_SECONDS = 1800  # Menor a la vida del token OAuth del cliente.
 
-    if _MAIN_SPREADSHEET_CACHE is not None and not force_refresh:
-        return _MAIN_SPREADSHEET_CACHE
 
-    _MAIN_SPREADSHEET_CACHE = _retry_gspread_api_call(
-        lambda: gspread_client.open_by_key(SPREADSHEET_ID_MAIN),
-        retries=4,
-        base_delay=0.8,
+@st.cache_resource
+def _get_gerente_cache_store() -> dict:
+    """Entradas, contadores y locks de carga de la caché del proceso."""
+    return {
+        "lock": threading.Lock(),
+        "entries": OrderedDict(),
+        "flights": {},
+        "epochs": {},
+        "bytes": 0,
+        "stats": {"hits": 0, "misses": 0, "evictions": 0, "expired": 0, "invalidations": 0},
+    }
+
+
+def _gerente_cache_sizeof(value) -> int:
+    """Tamaño aproximado en bytes de un valor cacheado."""
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(deep=True, index=True).sum())
+    if isinstance(value, (list, tuple)):
+        total = sys.getsizeof(value)
+        for item in value:
+            if isinstance(item, (list, tuple)):
+                total += sys.getsizeof(item) + sum(sys.getsizeof(v) for v in item)
+            else:
+                total += sys.getsizeof(item)
+        return total
+    return sys.getsizeof(value)
+
+
+def _gerente_cache_drop(store: dict, cache_key) -> None:
+    entry = store["entries"].pop(cache_key, None)
+    if entry is not None:
+        store["bytes"] -= entry["size"]
+    flight = store["flights"].get(cache_key)
+    if flight is not None and not flight.locked():
+        store["flights"].pop(cache_key, None)
+
+
+def _gerente_cache_store_value(store: dict, cache_key, value, ttl_seconds: float) -> None:
+    now = time.time()
+    for old_key in [k for k, e in store["entries"].items() if e["expires_at"] <= now]:
+        _gerente_cache_drop(store, old_key)
+        store["stats"]["expired"] += 1
+    _gerente_cache_drop(store, cache_key)
+    size = _gerente_cache_sizeof(value)
+    store["entries"][cache_key] = {
+        "value": value,
+        "size": size,
+        "loaded_at": now,
+        "expires_at": now + float(ttl_seconds),
+    }
+    store["bytes"] += size
+    while store["bytes"] > GERENTE_CACHE_MAX_BYTES and store["entries"]:
+        _gerente_cache_drop(store, next(iter(store["entries"])))
+        store["stats"]["evictions"] += 1
+
+
+def gerente_cache_get(namespace: str, key, loader, *, ttl_seconds: float, use_cache: bool = True):
+    """Devuelve el valor cacheado de ``(namespace, key)`` o lo carga con ``loader()``.
+
+    Con ``use_cache=False`` se fuerza una carga nueva, salvo que otra sesión haya
+    terminado una carga después de esta llamada. Las cargas que coinciden con una
+    invalidación del mismo namespace no se guardan.
+    """
+    store = _get_gerente_cache_store()
+    cache_key = (str(namespace), key)
+    requested_at = time.time()
+    with store["lock"]:
+        flight = store["flights"].setdefault(cache_key, threading.Lock())
+    with flight:
+        with store["lock"]:
+            entry = store["entries"].get(cache_key)
+            if entry is not None and entry["expires_at"] <= time.time():
+                _gerente_cache_drop(store, cache_key)
+                store["stats"]["expired"] += 1
+                entry = None
+            if entry is not None and (use_cache or entry["loaded_at"] >= requested_at):
+                store["entries"].move_to_end(cache_key)
+                store["stats"]["hits"] += 1
+                return entry["value"]
+            store["stats"]["misses"] += 1
+            epoch = store["epochs"].get(cache_key[0], 0)
+        value = loader()
+        with store["lock"]:
+            if store["epochs"].get(cache_key[0], 0) == epoch:
+                _gerente_cache_store_value(store, cache_key, value, ttl_seconds)
+        return value
+
+
+def gerente_cache_peek(namespace: str, key, default=None):
+    """Devuelve el valor vigente de ``(namespace, key)`` sin cargarlo si falta."""
+    store = _get_gerente_cache_store()
+    cache_key = (str(namespace), key)
+    with store["lock"]:
+        entry = store["entries"].get(cache_key)
+        if entry is None or entry["expires_at"] <= time.time():
+            return default
+        store["entries"].move_to_end(cache_key)
+        store["stats"]["hits"] += 1
+        return entry["value"]
+
+
+def gerente_cache_put(namespace: str, key, value, *, ttl_seconds: float) -> None:
+    """Guarda un valor ya conocido (por ejemplo, el resultado de una escritura)."""
+    store = _get_gerente_cache_store()
+    with store["lock"]:
+        _gerente_cache_store_value(store, (str(namespace), key), value, ttl_seconds)
+
+
+def gerente_cache_invalidate(namespace: str, key=None) -> None:
+    """Descarta ``key`` (o todo el namespace si es ``None``); se llama después de escribir."""
+    store = _get_gerente_cache_store()
+    namespace = str(namespace)
+    with store["lock"]:
+        store["epochs"][namespace] = store["epochs"].get(namespace, 0) + 1
+        targets = [
+            k for k in store["entries"]
+            if k[0] == namespace and (key is None or k[1] == key)
+        ]
+        for cache_key in targets:
+            _gerente_cache_drop(store, cache_key)
+        store["stats"]["invalidations"] += len(targets)
+
+
+def gerente_cache_stats() -> dict:
+    """Contadores y memoria ocupada, total y por namespace."""
+    store = _get_gerente_cache_store()
+    with store["lock"]:
+        por_namespace: dict[str, dict] = {}
+        for (namespace, _), entry in store["entries"].items():
+            item = por_namespace.setdefault(namespace, {"entradas": 0, "bytes": 0})
+            item["entradas"] += 1
+            item["bytes"] += entry["size"]
+        return {
+            **store["stats"],
+            "entradas": len(store["entries"]),
+            "bytes": store["bytes"],
+            "max_bytes": GERENTE_CACHE_MAX_BYTES,
+            "por_namespace": por_namespace,
+        }
+
+
+def get_main_spreadsheet(force_refresh: bool = False):
+    """Abre y cachea el spreadsheet principal con reintentos para errores transitorios."""
+    if force_refresh:
+        gerente_cache_invalidate("spreadsheet", SPREADSHEET_ID_MAIN)
+    return gerente_cache_get(
+        "spreadsheet",
+        SPREADSHEET_ID_MAIN,
+        lambda: _retry_gspread_api_call(
+            lambda: gspread_client.open_by_key(SPREADSHEET_ID_MAIN),
+            retries=4,
+            base_delay=0.8,
+        ),
+        ttl_seconds=GERENTE_CACHE_HANDLE_TTL_SECONDS,
     )
-    return _MAIN_SPREADSHEET_CACHE
 
 
 def get_main_worksheet(nombre_hoja: str):
@@ -1156,6 +1351,83 @@ def _get_all_records_with_retry(sheet, retries: int = 3):
     )
 
 
+# Snapshot compartido por proceso: una sola lectura por worksheet aunque varias
+# sesiones (o varias funciones cacheadas) pidan la misma hoja al mismo tiempo.
+SHEET_SNAPSHOT_SHARE_SECONDS = 30
+
+
+@st.cache_resource
+def _get_sheet_snapshot_store() -> dict:
+    """Almacén por proceso con la última lectura completa de cada worksheet."""
+    return {"lock": threading.Lock(), "entries": {}}
+
+
+def _get_sheet_snapshot_entry(sheet_id: str, nombre_hoja: str) -> dict:
+    store = _get_sheet_snapshot_store()
+    key = (str(sheet_id), str(nombre_hoja))
+    with store["lock"]:
+        entry = store["entries"].get(key)
+        if entry is None:
+            entry = {
+                "lock": threading.Lock(),
+                "values": None,
+                "version": 0,
+                "fetched_at": 0.0,
+                "stale": True,
+            }
+            store["entries"][key] = entry
+        return entry
+
+
+def get_shared_sheet_snapshot(sheet_id: str, nombre_hoja: str, fetch_fn, *, max_age_seconds: float = SHEET_SNAPSHOT_SHARE_SECONDS):
+    """Devuelve `(valores, version)` compartiendo una sola lectura entre sesiones (single-flight).
+
+    Las sesiones que llegan mientras otra lectura está en curso esperan y reutilizan
+    su resultado. La versión solo avanza cuando el contenido leído cambia.
+    """
+    entry = _get_sheet_snapshot_entry(sheet_id, nombre_hoja)
+    requested_at = time.time()
+    with entry["lock"]:
+        fetched_at = float(entry["fetched_at"] or 0)
+        if entry["values"] is not None and not entry["stale"]:
+            if fetched_at >= requested_at or (time.time() - fetched_at) < max_age_seconds:
+                return entry["values"], int(entry["version"])
+
+        values = fetch_fn()
+        if entry["values"] is None or values != entry["values"]:
+            entry["version"] = int(entry["version"]) + 1
+        entry["values"] = values
+        entry["fetched_at"] = time.time()
+        entry["stale"] = False
+        return values, int(entry["version"])
+
+
+def invalidate_sheet_snapshot(sheet_id: str, nombre_hoja: str | None = None) -> None:
+    """Marca como vencido el snapshot para que la siguiente lectura vaya a Sheets."""
+    store = _get_sheet_snapshot_store()
+    with store["lock"]:
+        for (entry_sheet_id, entry_hoja), entry in store["entries"].items():
+            if entry_sheet_id != str(sheet_id):
+                continue
+            if nombre_hoja is not None and entry_hoja != str(nombre_hoja):
+                continue
+            entry["stale"] = True
+
+
+def get_sheet_snapshot_version(sheet_id: str, nombre_hoja: str) -> int:
+    """Versión del último snapshot leído para la worksheet (0 si aún no hay lectura)."""
+    return int(_get_sheet_snapshot_entry(sheet_id, nombre_hoja)["version"])
+
+
+def _get_shared_main_records(nombre_hoja: str):
+    """Registros de una hoja del spreadsheet principal vía snapshot compartido."""
+    return get_shared_sheet_snapshot(
+        SPREADSHEET_ID_MAIN,
+        nombre_hoja,
+        lambda: _get_all_records_with_retry(get_main_worksheet(nombre_hoja)),
+    )
+
+
 PEDIDOS_SHEETS = ("datos_pedidos", "data_pedidos")
 PEDIDOS_COLUMNAS_MINIMAS = [
     "ID_Pedido", "Hora_Registro", "Cliente", "Estado", "Vendedor_Registro", "Folio_Factura",
@@ -1230,14 +1502,12 @@ def cargar_hoja_pedidos(nombre_hoja):
     y, en último caso, devuelve DataFrame vacío para no tumbar la app completa.
     """
     try:
-        sheet = get_main_worksheet(nombre_hoja)
-        data = _get_all_records_with_retry(sheet)
+        data, snapshot_version = _get_shared_main_records(nombre_hoja)
     except gspread.exceptions.APIError as e:
         # Fallback específico: si falla data_pedidos, intentar datos_pedidos.
         if nombre_hoja == "data_pedidos":
             try:
-                sheet = get_main_worksheet("datos_pedidos")
-                data = _get_all_records_with_retry(sheet)
+                data, snapshot_version = _get_shared_main_records("datos_pedidos")
                 nombre_hoja = "datos_pedidos"
                 st.warning("⚠️ No se pudo leer 'data_pedidos'. Se usó fallback a 'datos_pedidos'.")
             except Exception:
@@ -1260,6 +1530,7 @@ def cargar_hoja_pedidos(nombre_hoja):
     # Fila real en Google Sheets (considerando encabezado en fila 1).
     # Se usa para asegurar que las modificaciones se escriban en el pedido correcto.
     df["__sheet_row"] = df.index + 2
+    df.attrs["snapshot_version"] = snapshot_version
     return df
 
 def _extract_sheet_id(value: str) -> str:
@@ -1385,7 +1656,10 @@ def analizar_facturas_check_desde_df(df_facturas_input: pd.DataFrame, *, ventana
         & (df_facturas["_fecha_factura_dt"] <= ahora_naive)
     ].copy()
 
-    df_pedidos_match = cargar_pedidos().copy()
+    # Cada factura se busca en ±72 h de su fecha.
+    df_pedidos_match = cargar_pedidos_lectura(
+        desde=pd.Timestamp(limite_ventana - timedelta(hours=72)).floor("D"),
+    ).copy()
     df_casos_match = cargar_casos_especiales().copy()
     df_casos_match["__hoja_origen"] = "casos_especiales"
     df_pedidos_match = pd.concat([df_pedidos_match, df_casos_match], ignore_index=True, sort=False)
@@ -1804,9 +2078,7 @@ def get_alejandro_worksheet(nombre_hoja: str):
     return gspread_client.open_by_key(spreadsheet_id).worksheet(nombre_hoja)
 
 
-@st.cache_data(ttl=180, show_spinner=False)
-def cargar_alejandro_hoja(nombre_hoja: str) -> pd.DataFrame:
-    """Carga una hoja de alejandro_data y garantiza columnas mínimas."""
+def _leer_alejandro_hoja(nombre_hoja: str) -> pd.DataFrame:
     sheet = get_alejandro_worksheet(nombre_hoja)
     data = _get_all_records_with_retry(sheet)
     df = pd.DataFrame(data)
@@ -1819,6 +2091,18 @@ def cargar_alejandro_hoja(nombre_hoja: str) -> pd.DataFrame:
     return df
 
 
+def cargar_alejandro_hoja(nombre_hoja: str) -> pd.DataFrame:
+    """Carga una hoja de alejandro_data y garantiza columnas mínimas."""
+    df = gerente_cache_get(
+        "alejandro",
+        nombre_hoja,
+        lambda: _leer_alejandro_hoja(nombre_hoja),
+        ttl_seconds=180,
+    )
+    # Copia para que las vistas puedan modificar el DataFrame sin tocar la caché.
+    return df.copy()
+
+
 def now_iso():
     return now_cdmx().strftime("%Y-%m-%d %H:%M:%S")
 
@@ -1870,7 +2154,7 @@ def safe_append(nombre_hoja: str, row_dict: dict):
     row = [row_dict.get(c, "") for c in cols]
     try:
         sheet.append_row(row, value_input_option="USER_ENTERED")
-        cargar_alejandro_hoja.clear()
+        gerente_cache_invalidate("alejandro")
     except Exception as e:
         msg = str(e)
         if "not supported for this document" in msg.lower():
@@ -1919,7 +2203,7 @@ def safe_update_by_id(nombre_hoja: str, id_col: str, id_value: str, updates: dic
         return False
 
     sheet.update_cells(cells, value_input_option="USER_ENTERED")
-    cargar_alejandro_hoja.clear()
+    gerente_cache_invalidate("alejandro")
     return True
 
 
@@ -1943,6 +2227,7 @@ def safe_delete_rows_by_filter(nombre_hoja: str, predicate) -> int:
             (lambda rn=row_num: sheet.delete_rows(rn))
             if hasattr(sheet, "delete_rows")
             else (lambda rn=row_num: sheet.delete_row(rn)),
+            kind="write",
             retries=4,
             base_delay=0.7,
         )
@@ -1950,7 +2235,7 @@ def safe_delete_rows_by_filter(nombre_hoja: str, predicate) -> int:
         time.sleep(0.12)
 
     if rows_to_delete:
-        cargar_alejandro_hoja.clear()
+        gerente_cache_invalidate("alejandro")
 
     return len(rows_to_delete)
 
@@ -2016,6 +2301,21 @@ def debug_alejandro_documento() -> dict:
 
 
 
+# --- Histórico columnar (Parquet en S3) ---
+# Lectura y reexportación viven en ``historico_parquet``, compartido con app_a-d
+# (que lo escribe al archivar) y app_i-d.
+def _reexportar_filas_historico(ws, headers: list, filas: list) -> None:
+    """Relee filas de datos_pedidos recién editadas y las reexporta al Parquet; un fallo solo se avisa."""
+    try:
+        filas_valores = {
+            int(fila): _retry_gspread_api_call(lambda fila=fila: ws.row_values(int(fila)), priority="background")
+            for fila in filas
+        }
+        refresh_historico_parquet_rows(s3_client, S3_BUCKET, headers, filas_valores)
+    except Exception as exc:
+        st.warning(f"⚠️ Se guardó en Google Sheets, pero no se actualizó el histórico columnar (Parquet): {exc}")
+
+
 # --- FUNCIONES ---
 @st.cache_data(ttl=300)
 def cargar_pedidos():
@@ -2036,8 +2336,7 @@ def cargar_casos_especiales():
     Lee la hoja 'casos_especiales' y regresa un DataFrame.
     Si faltan columnas del ejemplo, las crea vacías para evitar KeyError.
     """
-    sheet = get_main_worksheet("casos_especiales")
-    data = _get_all_records_with_retry(sheet)
+    data, snapshot_version = _get_shared_main_records("casos_especiales")
     df = pd.DataFrame(data)
 
     columnas_ejemplo = [
@@ -2061,13 +2360,37 @@ def cargar_casos_especiales():
     # Fila real en Google Sheets (encabezado en fila 1) para ubicar el caso exacto
     # incluso cuando existan IDs_Pedido repetidos en la hoja.
     df["__sheet_row"] = df.index + 2
+    df.attrs["snapshot_version"] = snapshot_version
     return df
 
 
+@st.cache_data(ttl=300)
+def cargar_pedidos_lectura(desde=None):
+    """
+    Pedidos para consultas de solo lectura: el histórico desde el Parquet en S3 y
+    data_pedidos desde Sheets. Sin histórico columnar equivale a ``cargar_pedidos``.
+
+    ``desde`` (Hora_Registro) limita el histórico a leer; data_pedidos se devuelve
+    completa. Conviene redondearlo al día para reutilizar la caché.
+    """
+    try:
+        df_hist = load_historico_columnar(s3_client, S3_BUCKET, desde=desde, keep_row_number=True)
+    except Exception:
+        df_hist = None
+    if df_hist is None:
+        return cargar_pedidos()
+    for c in PEDIDOS_COLUMNAS_MINIMAS:
+        if c not in df_hist.columns:
+            df_hist[c] = ""
+    df_hist["__hoja_origen"] = "datos_pedidos"
+    df_hist["__sheet_row"] = df_hist.pop("_fila_historico")
+    return pd.concat([df_hist, cargar_hoja_pedidos("data_pedidos")], ignore_index=True, sort=False)
+
+
 @st.cache_data(ttl=300)
 def cargar_todos_los_pedidos():
     """Carga todos los pedidos combinando datos_pedidos + data_pedidos."""
-    return cargar_pedidos().copy()
+    return cargar_pedidos_lectura().copy()
 
 
 @st.cache_data(ttl=300)
@@ -2462,6 +2785,8 @@ def _limpiar_cache_si_existe(func):
 
 def _venta_terceros_limpiar_cache_pedidos():
     """Limpia caches de pedidos para recargar datos frescos en la pestaña."""
+    for nombre_hoja in PEDIDOS_SHEETS:
+        invalidate_sheet_snapshot(SPREADSHEET_ID_MAIN, nombre_hoja)
     for cache_func in (
         cargar_hoja_pedidos,
         cargar_pedidos,
@@ -2545,6 +2870,8 @@ def _venta_terceros_actualizar_comprobantes_y_pago(
             return False, "No hay datos para actualizar."
 
         ws.update_cells(celdas, value_input_option="USER_ENTERED")
+        if hoja_origen == "datos_pedidos":
+            _reexportar_filas_historico(ws, headers, [sheet_row])
         _venta_terceros_limpiar_cache_pedidos()
         return True, f"Comprobantes, pago e historial de cobros guardados en {hoja_origen}, fila {sheet_row}."
     except Exception as exc:
@@ -3013,87 +3340,213 @@ def resolver_numero_foraneo_flujo(row, flow_map_foraneos):
     return ""
 
 
+# --- Numeración de flujo foráneo (por columnas y memorizada) ---
+# Las fechas se interpretan una vez por valor distinto (memo compartido entre
+# reruns) y el mapa se memoriza por la huella de las columnas de entrada.
+FLOW_SORT_DATETIME_FIELDS = (
+    "Hora_Registro",
+    "Fecha_Entrega",
+    "Fecha_Completado",
+    "Fecha_Pago_Comprobante",
+    "Hora_Proceso",
+    "Fecha_Registro",
+)
+FLOW_NUMBER_INPUT_COLUMNS = (
+    "Tipo_Envio",
+    "Tipo_Envio_Original",
+    "ID_Pedido",
+    "Folio_Factura",
+    "Estado",
+    "Completados_Limpiado",
+    "Numero_Foraneo",
+    "_gsheet_row_index",
+    "__sheet_row",
+    "gsheet_row_index",
+) + FLOW_SORT_DATETIME_FIELDS
+FLOW_NUMBER_MAPS_KEEP = 8
+FLOW_DATETIME_CACHE_MAX = 50000
+
+
+@st.cache_resource
+def _get_flow_number_cache():
+    """Memo de numeración foránea compartido por todas las sesiones del proceso."""
+    return {"datetimes": {}, "maps": {}}
+
+
+def _map_distinct_values(values, fn):
+    """Aplica ``fn`` una sola vez por valor distinto (respetando el tipo) de ``values``."""
+    memo = {}
+    out = []
+    for value in values:
+        try:
+            key = (type(value), value)
+            result = memo[key]
+        except KeyError:
+            result = memo[key] = fn(value)
+        except TypeError:
+            result = fn(value)
+        out.append(result)
+    return out
+
+
+def _column_values(df, column, default=""):
+    if column not in df.columns:
+        return [default] * len(df)
+    return df[column].tolist()
+
+
+def _flow_row_key_value(raw):
+    try:
+        if raw is not None and not pd.isna(raw):
+            return f"row:{int(float(raw))}"
+    except Exception:
+        pass
+    return ""
+
+
+def _flow_row_keys(df):
+    """Equivalente por columnas de ``_flow_row_key`` para todas las filas."""
+    keys = [""] * len(df)
+    for field in ("_gsheet_row_index", "__sheet_row", "gsheet_row_index"):
+        if field not in df.columns:
+            continue
+        values = _map_distinct_values(df[field].tolist(), _flow_row_key_value)
+        keys = [current or value for current, value in zip(keys, values)]
+    return keys
+
+
+def _flow_parse_datetime(value):
+    if not isinstance(value, str):
+        return pd.to_datetime(value, errors="coerce")
+    cache = _get_flow_number_cache()["datetimes"]
+    if value not in cache:
+        if len(cache) >= FLOW_DATETIME_CACHE_MAX:
+            cache.clear()
+        cache[value] = pd.to_datetime(value, errors="coerce")
+    return cache[value]
+
+
+def _flow_sort_datetimes(df):
+    """Equivalente por columnas de ``_parse_row_sort_datetime`` para todas las filas."""
+    result = [pd.Timestamp.max] * len(df)
+    pending = list(range(len(df)))
+    for field in FLOW_SORT_DATETIME_FIELDS:
+        if not pending:
+            break
+        if field not in df.columns:
+            continue
+        column = df[field].tolist()
+        parsed = _map_distinct_values([column[pos] for pos in pending], _flow_parse_datetime)
+        still_pending = []
+        for pos, value in zip(pending, parsed):
+            if pd.notna(value):
+                result[pos] = value
+            else:
+                still_pending.append(pos)
+        pending = still_pending
+    return result
+
+
+def _flow_number_fingerprint(df):
+    """Huella de las columnas que determinan la numeración (cambia con cada versión de datos)."""
+    if df is None:
+        return "none"
+    columns = [col for col in FLOW_NUMBER_INPUT_COLUMNS if col in df.columns]
+    digest = hashlib.sha1(f"{len(df)}|{'|'.join(columns)}".encode("utf-8"))
+    if columns and not df.empty:
+        hashed = pd.util.hash_pandas_object(df[columns].astype(str), index=False)
+        digest.update(hashed.to_numpy().tobytes())
+    return digest.hexdigest()
+
+
+def _flow_foraneo_frame(df, source_tag):
+    """Columnas mínimas de un bloque foráneo para el flujo combinado pedidos/casos."""
+    return pd.DataFrame(
+        {
+            "_sort_dt": _flow_sort_datetimes(df),
+            "_tag": source_tag,
+            "_row_key": _flow_row_keys(df),
+            "_id_key": _map_distinct_values(_column_values(df, "ID_Pedido"), _flow_key),
+            "_folio_key": _map_distinct_values(_column_values(df, "Folio_Factura"), _flow_key),
+            "_inactivo": [
+                cancelado or limpiado
+                for cancelado, limpiado in zip(
+                    _map_distinct_values(_column_values(df, "Estado"), _es_cancelado_estado),
+                    _map_distinct_values(
+                        _column_values(df, "Completados_Limpiado"),
+                        lambda value: normalizar(str(value)) == "si",
+                    ),
+                )
+            ],
+            "_manual": pd.Series(
+                _map_distinct_values(_column_values(df, "Numero_Foraneo"), _parse_foraneo_number)
+                if source_tag == 1
+                else [None] * len(df),
+                dtype=object,
+            ),
+        }
+    )
+
+
 def construir_mapa_numeracion_foraneos(df_data, df_casos):
     """Construye mapa de numeración foránea igual al flujo de app_i/app_a."""
     if df_data is None or df_data.empty:
         return {}
 
-    work_data = df_data.copy()
-    for col in ("Tipo_Envio", "ID_Pedido", "Folio_Factura", "Completados_Limpiado", "Estado"):
-        if col not in work_data.columns:
-            work_data[col] = ""
+    memo_key = (_flow_number_fingerprint(df_data), _flow_number_fingerprint(df_casos))
+    memo = _get_flow_number_cache()["maps"]
+    cached = memo.get(memo_key)
+    if cached is None:
+        cached = _calcular_mapa_numeracion_foraneos(df_data, df_casos)
+        memo[memo_key] = cached
+        while len(memo) > FLOW_NUMBER_MAPS_KEEP:
+            memo.pop(next(iter(memo)), None)
+    return dict(cached)
 
-    tipo_exacto = work_data["Tipo_Envio"].astype(str).map(es_pedido_foraneo_exacto)
-    df_foraneo = work_data[tipo_exacto].copy()
 
-    work_cases = pd.DataFrame() if df_casos is None else df_casos.copy()
-    if not work_cases.empty:
-        for col in (
-            "Tipo_Envio_Original",
-            "Tipo_Envio",
-            "ID_Pedido",
-            "Folio_Factura",
-            "Numero_Foraneo",
-            "Completados_Limpiado",
-            "Estado",
-        ):
-            if col not in work_cases.columns:
-                work_cases[col] = ""
-        mask_foraneo_case = (
-            work_cases["Tipo_Envio_Original"].astype(str).map(es_pedido_foraneo_exacto)
-            | work_cases["Tipo_Envio"].astype(str).map(es_pedido_foraneo_exacto)
-        )
-        work_cases = work_cases[mask_foraneo_case].copy()
+def _calcular_mapa_numeracion_foraneos(df_data, df_casos):
+    def _mask_foraneo(df, column):
+        valores = [str(value) for value in _column_values(df, column)]
+        return pd.Series(_map_distinct_values(valores, es_pedido_foraneo_exacto), index=df.index, dtype=bool)
+
+    df_foraneo = df_data[_mask_foraneo(df_data, "Tipo_Envio")]
 
-    combined_rows = []
-    if not df_foraneo.empty:
-        for _, row in df_foraneo.iterrows():
-            combined_rows.append((_parse_row_sort_datetime(row), 0, "main", row))
+    work_cases = pd.DataFrame() if df_casos is None else df_casos
     if not work_cases.empty:
-        for _, row in work_cases.iterrows():
-            combined_rows.append((_parse_row_sort_datetime(row), 1, "caso", row))
-    combined_rows.sort(key=lambda item: (item[0], item[1]))
+        work_cases = work_cases[
+            _mask_foraneo(work_cases, "Tipo_Envio_Original") | _mask_foraneo(work_cases, "Tipo_Envio")
+        ]
 
-    manual_numbers = set()
-    for _, _, source_kind, row in combined_rows:
-        if _es_cancelado_estado(row.get("Estado", "")) or _es_limpiado(row):
-            continue
-        if source_kind != "caso":
-            continue
-        parsed = _parse_foraneo_number(row.get("Numero_Foraneo", ""))
-        if parsed is not None:
-            manual_numbers.add(parsed)
+    bloques = [
+        _flow_foraneo_frame(df_block, source_tag)
+        for df_block, source_tag in ((df_foraneo, 0), (work_cases, 1))
+        if not df_block.empty
+    ]
+    if not bloques:
+        return {}
+
+    combined = pd.concat(bloques, ignore_index=True).sort_values(by=["_sort_dt", "_tag"], kind="mergesort")
+    combined = combined[~combined["_inactivo"]]
+    keys_by_row = list(zip(combined["_row_key"], combined["_id_key"], combined["_folio_key"]))
+    is_caso = (combined["_tag"] == 1).tolist()
+    manual = combined["_manual"].tolist()
 
     map_foraneo = {}
-    used_numbers = set(manual_numbers)
+    used_numbers = {parsed for parsed, caso in zip(manual, is_caso) if caso and parsed is not None}
     next_number = 1
 
-    for _, _, source_kind, row in combined_rows:
-        if _es_cancelado_estado(row.get("Estado", "")) or _es_limpiado(row):
-            continue
-        if source_kind != "caso":
-            continue
-        row_key = _flow_row_key(row)
-        keys = [row_key, _flow_key(row.get("ID_Pedido", "")), _flow_key(row.get("Folio_Factura", ""))]
-        if not any(keys):
-            continue
-        parsed = _parse_foraneo_number(row.get("Numero_Foraneo", ""))
-        if parsed is None:
+    for keys, caso, parsed in zip(keys_by_row, is_caso, manual):
+        if not caso or parsed is None or not any(keys):
             continue
         numero_fmt = f"{parsed:02d}"
         for key in keys:
             if key and key not in map_foraneo:
                 map_foraneo[key] = numero_fmt
 
-    for _, _, source_kind, row in combined_rows:
-        if _es_cancelado_estado(row.get("Estado", "")) or _es_limpiado(row):
-            continue
-        if source_kind == "caso":
-            continue
-        row_key = _flow_row_key(row)
-        keys = [row_key, _flow_key(row.get("ID_Pedido", "")), _flow_key(row.get("Folio_Factura", ""))]
-        if not any(keys):
+    for keys, caso in zip(keys_by_row, is_caso):
+        if caso or not any(keys):
             continue
+        row_key = keys[0]
         if row_key and row_key in map_foraneo:
             continue
         while next_number in used_numbers:
@@ -3322,6 +3775,282 @@ def extraer_texto_pdf(s3_key):
         return f"[ERROR AL LEER PDF]: {e}"
 
 
+# --- Índice persistente de guías (SQLite FTS5) ---
+# Un hilo en segundo plano (uno por despliegue, con candado líder) lista el bucket
+# y guarda el texto de los PDF de guía; solo vuelve a leer un PDF si cambió su
+# ETag. La búsqueda "🔢 Por número de guía" consulta el índice en lugar de bajar
+# y parsear cada PDF en cada búsqueda.
+GUIAS_INDEX_PATH = os.environ.get(
+    "GUIAS_INDEX_PATH",
+    os.path.join(tempfile.gettempdir(), "app_almacen_guias_index.sqlite3"),
+)
+GUIAS_INDEX_INTERVAL_SECONDS = 300
+GUIAS_INDEX_MAX_KEYS_POR_PREFIJO = 1000  # lo que devolvía un solo list_objects_v2
+WAYBILL_PATTERN = re.compile(r"WAYBILL[\s:]*([0-9 ]{8,})", re.IGNORECASE)
+
+
+def _guias_index_connect():
+    conn = sqlite3.connect(GUIAS_INDEX_PATH, timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.executescript(
+        """
+        CREATE TABLE IF NOT EXISTS s3_objetos (
+            s3_key TEXT PRIMARY KEY,
+            etag TEXT NOT NULL,
+            pasada INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS guias_pdf (
+            id INTEGER PRIMARY KEY,
+            s3_key TEXT NOT NULL UNIQUE,
+            etag TEXT NOT NULL,
+            texto TEXT NOT NULL,
+            waybill TEXT NOT NULL
+        );
+        CREATE VIRTUAL TABLE IF NOT EXISTS guias_fts USING fts5(texto_limpio, tokenize='trigram');
+        CREATE TABLE IF NOT EXISTS guias_estado (clave TEXT PRIMARY KEY, valor TEXT NOT NULL);
+        """
+    )
+    return conn
+
+
+def _es_pdf_guia(s3_key):
+    key = str(s3_key).lower()
+    return key.endswith(".pdf") and any(x in key for x in ["guia", "guía", "descarga"])
+
+
+def _texto_guia_coincide(texto, clave):
+    clave_sin_espacios = clave.replace(" ", "")
+    texto_limpio = texto.replace(" ", "").replace("\n", "")
+    return bool(
+        clave in texto
+        or clave_sin_espacios in texto_limpio
+        or re.search(re.escape(clave), texto_limpio)
+        or re.search(re.escape(clave_sin_espacios), texto_limpio)
+    )
+
+
+def _guardar_guia_indice(conn, s3_key, etag, texto):
+    waybill_match = WAYBILL_PATTERN.search(texto)
+    waybill = waybill_match.group(1) if waybill_match else ""
+    fila = conn.execute("SELECT id FROM guias_pdf WHERE s3_key = ?", (s3_key,)).fetchone()
+    if fila:
+        conn.execute("DELETE FROM guias_fts WHERE rowid = ?", (fila[0],))
+        conn.execute(
+            "UPDATE guias_pdf SET etag = ?, texto = ?, waybill = ? WHERE id = ?",
+            (etag, texto, waybill, fila[0]),
+        )
+        guia_id = fila[0]
+    else:
+        guia_id = conn.execute(
+            "INSERT INTO guias_pdf (s3_key, etag, texto, waybill) VALUES (?, ?, ?, ?)",
+            (s3_key, etag, texto, waybill),
+        ).lastrowid
+    conn.execute(
+        "INSERT INTO guias_fts (rowid, texto_limpio) VALUES (?, ?)",
+        (guia_id, texto.replace(" ", "").replace("\n", "")),
+    )
+
+
+def actualizar_indice_guias(s3):
+    """Una pasada del índice: lista el bucket y procesa solo PDFs de guía nuevos o con otro ETag."""
+    conn = _guias_index_connect()
+    try:
+        pasada = int(time.time() * 1000)
+        guias_listadas = []
+        paginator = s3.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=S3_BUCKET):
+            filas = [(obj["Key"], str(obj.get("ETag", "")), pasada) for obj in page.get("Contents", [])]
+            conn.executemany(
+                "INSERT INTO s3_objetos (s3_key, etag, pasada) VALUES (?, ?, ?) "
+                "ON CONFLICT(s3_key) DO UPDATE SET etag = excluded.etag, pasada = excluded.pasada",
+                filas,
+            )
+            guias_listadas.extend((key, etag) for key, etag, _ in filas if _es_pdf_guia(key))
+        conn.execute("DELETE FROM s3_objetos WHERE pasada <> ?", (pasada,))
+        eliminadas = [
+            fila[0]
+            for fila in conn.execute(
+                "SELECT id FROM guias_pdf WHERE s3_key NOT IN (SELECT s3_key FROM s3_objetos)"
+            )
+        ]
+        conn.executemany("DELETE FROM guias_fts WHERE rowid = ?", [(i,) for i in eliminadas])
+        conn.executemany("DELETE FROM guias_pdf WHERE id = ?", [(i,) for i in eliminadas])
+        conn.commit()
+
+        conocidas = dict(conn.execute("SELECT s3_key, etag FROM guias_pdf"))
+        nuevas = 0
+        for s3_key, etag in guias_listadas:
+            if conocidas.get(s3_key) == etag:
+                continue
+            try:
+                response = s3.get_object(Bucket=S3_BUCKET, Key=s3_key)
+                with pdfplumber.open(BytesIO(response["Body"].read())) as pdf:
+                    texto = "\n".join(page.extract_text() or "" for page in pdf.pages)
+            except Exception:
+                continue  # se reintenta en la siguiente pasada
+            _guardar_guia_indice(conn, s3_key, etag, texto)
+            conn.commit()
+            nuevas += 1
+
+        conn.execute(
+            "INSERT INTO guias_estado (clave, valor) VALUES ('ultima_pasada', ?) "
+            "ON CONFLICT(clave) DO UPDATE SET valor = excluded.valor",
+            (str(time.time()),),
+        )
+        conn.commit()
+        return nuevas
+    finally:
+        conn.close()
+
+
+def ultima_pasada_indice_guias():
+    """Epoch de la última pasada completa del índice (``None`` si aún no hay)."""
+    try:
+        conn = _guias_index_connect()
+        try:
+            fila = conn.execute("SELECT valor FROM guias_estado WHERE clave = 'ultima_pasada'").fetchone()
+        finally:
+            conn.close()
+        return float(fila[0]) if fila else None
+    except Exception:
+        return None
+
+
+def _prefijo_s3_indice(conn, pedido_id):
+    """Igual que ``obtener_prefijo_s3`` pero contra el listado indexado."""
+    for prefix in (
+        f"{pedido_id}/", f"adjuntos_pedidos/{pedido_id}/",
+        f"adjuntos_pedidos/{pedido_id}", f"{pedido_id}"
+    ):
+        existe = conn.execute(
+            "SELECT 1 FROM s3_objetos WHERE s3_key >= ? AND s3_key < ? LIMIT 1",
+            (prefix, prefix + "\U0010ffff"),
+        ).fetchone()
+        if existe:
+            return prefix if prefix.endswith("/") else prefix + "/"
+    return None
+
+
+def _pdfs_guia_indice(conn, prefix):
+    """Igual que ``obtener_archivos_pdf_validos`` pero contra el listado indexado."""
+    filas = conn.execute(
+        "SELECT s3_key FROM s3_objetos WHERE s3_key >= ? AND s3_key < ? ORDER BY s3_key LIMIT ?",
+        (prefix, prefix + "\U0010ffff", GUIAS_INDEX_MAX_KEYS_POR_PREFIJO),
+    )
+    return [fila[0] for fila in filas if _es_pdf_guia(fila[0])]
+
+
+def buscar_guia_en_indice(df_pedidos, clave):
+    """
+    Primer pedido de ``df_pedidos`` (en su orden) con un PDF de guía que contiene ``clave``.
+
+    Devuelve ``(row, pedido_id, prefix, s3_key, waybill)`` o ``None``; aplica el
+    mismo criterio de coincidencia y de prefijos que la búsqueda directa en S3.
+    """
+    clave_sin_espacios = clave.replace(" ", "")
+    conn = _guias_index_connect()
+    try:
+        if len(clave_sin_espacios) >= 3:
+            # Trigramas: candidatos por subcadena (sin distinguir mayúsculas); se confirma abajo.
+            filas = conn.execute(
+                "SELECT g.s3_key, g.texto, g.waybill FROM guias_fts JOIN guias_pdf g ON g.id = guias_fts.rowid "
+                "WHERE guias_fts MATCH ?",
+                ('"' + clave_sin_espacios.replace('"', '""') + '"',),
+            ).fetchall()
+        else:
+            filas = conn.execute("SELECT s3_key, texto, waybill FROM guias_pdf").fetchall()
+        coincidencias = {key: waybill for key, texto, waybill in filas if _texto_guia_coincide(texto, clave)}
+        if not coincidencias:
+            return None
+
+        ids_pedidos = set(df_pedidos.get("ID_Pedido", pd.Series(dtype=str)).astype(str).str.strip()) - {""}
+        candidatos = set()
+        for s3_key in coincidencias:
+            for base in (s3_key, s3_key[len("adjuntos_pedidos/"):] if s3_key.startswith("adjuntos_pedidos/") else ""):
+                candidatos.update(base[:n] for n in range(1, len(base) + 1) if base[:n] in ids_pedidos)
+
+        archivos_por_pedido = {}
+        for pedido_id in candidatos:
+            prefix = _prefijo_s3_indice(conn, pedido_id)
+            if not prefix:
+                continue
+            archivos = [key for key in _pdfs_guia_indice(conn, prefix) if key in coincidencias]
+            if archivos:
+                archivos_por_pedido[pedido_id] = (prefix, archivos[0])
+    finally:
+        conn.close()
+
+    if not archivos_por_pedido:
+        return None
+    for _, row in df_pedidos.iterrows():
+        pedido_id = str(row.get("ID_Pedido", "")).strip()
+        if pedido_id in archivos_por_pedido:
+            prefix, s3_key = archivos_por_pedido[pedido_id]
+            return row, pedido_id, prefix, s3_key, coincidencias[s3_key]
+    return None
+
+
+def buscar_guia_en_s3(df_pedidos, clave):
+    """Búsqueda directa en S3 (pedido por pedido); mismo resultado que ``buscar_guia_en_indice``."""
+    for _, row in df_pedidos.iterrows():
+        pedido_id = str(row.get("ID_Pedido", "")).strip()
+        if not pedido_id:
+            continue
+
+        prefix = obtener_prefijo_s3(pedido_id)
+        if not prefix:
+            continue
+
+        for archivo in obtener_archivos_pdf_validos(prefix):
+            key = archivo["Key"]
+            texto = extraer_texto_pdf(key)
+            if _texto_guia_coincide(texto, clave):
+                waybill_match = WAYBILL_PATTERN.search(texto)
+                return row, pedido_id, prefix, key, waybill_match.group(1) if waybill_match else ""
+    return None
+
+
+def _acquire_guias_index_leadership(state):
+    """Candado líder entre procesos; se conserva mientras el proceso siga vivo."""
+    if state.get("lock_file") is not None or fcntl is None:
+        return True
+    try:
+        lock_file = open(f"{GUIAS_INDEX_PATH}.lock", "a+")
+    except OSError:
+        return False
+    try:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return False
+    state["lock_file"] = lock_file
+    return True
+
+
+def _guias_index_loop(state, s3):
+    while True:
+        try:
+            if _acquire_guias_index_leadership(state):
+                state["last_indexed"] = actualizar_indice_guias(s3)
+                state["last_error"] = ""
+        except Exception as exc:
+            state["last_error"] = str(exc)
+        time.sleep(GUIAS_INDEX_INTERVAL_SECONDS)
+
+
+@st.cache_resource
+def start_guias_index_worker(_s3):
+    """Arranca (una vez por proceso) el hilo que mantiene el índice de guías."""
+    state = {"lock_file": None, "last_indexed": 0, "last_error": ""}
+    threading.Thread(
+        target=_guias_index_loop,
+        args=(state, _s3),
+        name="guias-index",
+        daemon=True,
+    ).start()
+    return state
+
+
 # --- AWS S3 Helper Functions ---
 INLINE_EXT = (".pdf", ".jpg", ".jpeg", ".png", ".webp")
 
@@ -3354,32 +4083,88 @@ def extract_s3_key(url_or_key: str) -> str:
     return url_or_key
 
 
+# Caché de URLs prefirmadas: se reutilizan hasta un margen antes de expirar en
+# lugar de firmarse de nuevo para cada adjunto en cada rerun (LRU por proceso).
+PRESIGNED_URL_CACHE_MAX = 5000
+PRESIGNED_URL_SAFETY_MARGIN_SECONDS = 3600
+
+
+@st.cache_resource
+def _get_presigned_url_cache():
+    """Caché LRU de URLs prefirmadas compartida por todas las sesiones del proceso."""
+    return {"lock": threading.Lock(), "urls": OrderedDict()}
+
+
+def _presigned_url_params(clean_key):
+    params = {"Bucket": S3_BUCKET, "Key": clean_key}
+    if isinstance(clean_key, str):
+        lower_key = clean_key.lower()
+        if lower_key.endswith(INLINE_EXT):
+            filename = (clean_key.split("/")[-1] or "archivo").replace('"', "")
+            params["ResponseContentDisposition"] = f'inline; filename="{filename}"'  # FORCE INLINE VIEW
+            if lower_key.endswith(".pdf"):
+                params["ResponseContentType"] = "application/pdf"
+            elif lower_key.endswith((".jpg", ".jpeg")):
+                params["ResponseContentType"] = "image/jpeg"
+            elif lower_key.endswith(".png"):
+                params["ResponseContentType"] = "image/png"
+            elif lower_key.endswith(".webp"):
+                params["ResponseContentType"] = "image/webp"
+    return params
+
+
+def presign_s3_file_download_urls(s3_client_param, object_keys_or_urls, expires_in=604800):
+    """URLs prefirmadas de varios objetos; firma solo las que no están vigentes en caché."""
+    cache = _get_presigned_url_cache()
+    now = time.time()
+    reuse_seconds = expires_in - min(PRESIGNED_URL_SAFETY_MARGIN_SECONDS, expires_in // 4)
+    params_list = [_presigned_url_params(extract_s3_key(valor)) for valor in object_keys_or_urls]
+    cache_keys = [
+        (
+            params["Bucket"],
+            params["Key"],
+            params.get("ResponseContentDisposition", ""),
+            params.get("ResponseContentType", ""),
+            int(expires_in),
+        )
+        for params in params_list
+    ]
+    urls = [None] * len(params_list)
+    with cache["lock"]:
+        for pos, cache_key in enumerate(cache_keys):
+            entry = cache["urls"].get(cache_key)
+            if entry and entry[1] > now:
+                cache["urls"].move_to_end(cache_key)
+                urls[pos] = entry[0]
+
+    firmadas = {}
+    for pos, params in enumerate(params_list):
+        if urls[pos] is None:
+            cache_key = cache_keys[pos]
+            if cache_key not in firmadas:
+                firmadas[cache_key] = s3_client_param.generate_presigned_url(
+                    "get_object",
+                    Params=params,
+                    ExpiresIn=expires_in,
+                )
+            urls[pos] = firmadas[cache_key]
+
+    if firmadas:
+        with cache["lock"]:
+            for cache_key, url in firmadas.items():
+                cache["urls"][cache_key] = (url, now + reuse_seconds)
+                cache["urls"].move_to_end(cache_key)
+            while len(cache["urls"]) > PRESIGNED_URL_CACHE_MAX:
+                cache["urls"].popitem(last=False)
+    return urls
+
+
 def get_s3_file_download_url(s3_client_param, object_key_or_url, expires_in=604800):
     if not s3_client_param or not S3_BUCKET:
         st.error("❌ Configuración de S3 incompleta. Verifica el cliente y el nombre del bucket.")
         return "#"
     try:
-        clean_key = extract_s3_key(object_key_or_url)
-        params = {"Bucket": S3_BUCKET, "Key": clean_key}
-        if isinstance(clean_key, str):
-            lower_key = clean_key.lower()
-            if lower_key.endswith(INLINE_EXT):
-                filename = (clean_key.split("/")[-1] or "archivo").replace('"', "")
-                params["ResponseContentDisposition"] = f'inline; filename="{filename}"'  # FORCE INLINE VIEW
-                if lower_key.endswith(".pdf"):
-                    params["ResponseContentType"] = "application/pdf"
-                elif lower_key.endswith((".jpg", ".jpeg")):
-                    params["ResponseContentType"] = "image/jpeg"
-                elif lower_key.endswith(".png"):
-                    params["ResponseContentType"] = "image/png"
-                elif lower_key.endswith(".webp"):
-                    params["ResponseContentType"] = "image/webp"
-
-        return s3_client_param.generate_presigned_url(
-            "get_object",
-            Params=params,
-            ExpiresIn=expires_in,
-        )
+        return presign_s3_file_download_urls(s3_client_param, [object_key_or_url], expires_in)[0]
     except Exception as e:
         st.error(f"❌ Error al generar URL prefirmada: {e}")
         return "#"
@@ -3994,7 +4779,7 @@ def update_checklist_daily_item(fecha_iso: str, item_id: str, item: str, complet
 
     if cells:
         sheet.update_cells(cells, value_input_option="USER_ENTERED")
-        cargar_alejandro_hoja.clear()
+        gerente_cache_invalidate("alejandro")
 
 
 def build_hoy_alerts(hoy: date, df_citas: pd.DataFrame, df_tareas: pd.DataFrame, df_cot: pd.DataFrame, chk_hoy: pd.DataFrame, df_config: pd.DataFrame):
@@ -4154,18 +4939,19 @@ def get_cobranza_spreadsheet_id() -> str:
 
 def get_cobranza_spreadsheet(force_refresh: bool = False):
     """Abre y cachea el spreadsheet de cobranza para reducir lecturas a la API."""
-    global _COBRANZA_SPREADSHEET_CACHE
-
-    if _COBRANZA_SPREADSHEET_CACHE is not None and not force_refresh:
-        return _COBRANZA_SPREADSHEET_CACHE
-
     spreadsheet_id = get_cobranza_spreadsheet_id()
-    _COBRANZA_SPREADSHEET_CACHE = _retry_gspread_api_call(
-        lambda: gspread_client.open_by_key(spreadsheet_id),
-        retries=4,
-        base_delay=0.9,
+    if force_refresh:
+        gerente_cache_invalidate("cobranza_spreadsheet")
+    return gerente_cache_get(
+        "cobranza_spreadsheet",
+        spreadsheet_id,
+        lambda: _retry_gspread_api_call(
+            lambda: gspread_client.open_by_key(spreadsheet_id),
+            retries=4,
+            base_delay=0.9,
+        ),
+        ttl_seconds=GERENTE_CACHE_HANDLE_TTL_SECONDS,
     )
-    return _COBRANZA_SPREADSHEET_CACHE
 
 
 def get_cobranza_worksheet(nombre_hoja: str):
@@ -4212,12 +4998,14 @@ def cobranza_ensure_headers(ws, expected_headers: list[str]):
         if not any(current):
             _retry_gspread_api_call(
                 lambda: ws.append_row(expected_headers, value_input_option="USER_ENTERED"),
+                kind="write",
                 retries=4,
                 base_delay=0.9,
             )
         else:
             _retry_gspread_api_call(
                 lambda: cobranza_update_row_values(ws, 1, expected_headers),
+                kind="write",
                 retries=4,
                 base_delay=0.9,
             )
@@ -4253,7 +5041,7 @@ def cobranza_migrar_comentarios_con_folio(ws):
             mes, codigo, dia, comentario, actualizado_por, timestamp = row[:len(legacy)]
             mes_operativo = _cobranza_mes_operativo(mes, "", "")
             matrix.append([mes, codigo, "", dia, comentario, actualizado_por, timestamp, "", "", "", "", mes_operativo])
-        _retry_gspread_api_call(lambda: cobranza_replace_matrix_values(ws, matrix), retries=4, base_delay=1.0)
+        _retry_gspread_api_call(lambda: cobranza_replace_matrix_values(ws, matrix), kind="write", retries=4, base_delay=1.0)
         return True
 
     if headers == with_folio:
@@ -4263,7 +5051,7 @@ def cobranza_migrar_comentarios_con_folio(ws):
             mes, codigo, folio, dia, comentario, actualizado_por, timestamp = row[:len(with_folio)]
             mes_operativo = _cobranza_mes_operativo(mes, "", "")
             matrix.append([mes, codigo, folio, dia, comentario, actualizado_por, timestamp, "", "", "", "", mes_operativo])
-        _retry_gspread_api_call(lambda: cobranza_replace_matrix_values(ws, matrix), retries=4, base_delay=1.0)
+        _retry_gspread_api_call(lambda: cobranza_replace_matrix_values(ws, matrix), kind="write", retries=4, base_delay=1.0)
         return True
 
     if headers == prev_expected:
@@ -4273,7 +5061,7 @@ def cobranza_migrar_comentarios_con_folio(ws):
             mes, codigo, folio, dia, comentario, actualizado_por, timestamp, fecha, recordatorio, estatus, fecha_cierre = row[:len(prev_expected)]
             mes_operativo = _cobranza_mes_operativo(mes, estatus, fecha)
             matrix.append([mes, codigo, folio, dia, comentario, actualizado_por, timestamp, fecha, recordatorio, estatus, fecha_cierre, mes_operativo])
-        _retry_gspread_api_call(lambda: cobranza_replace_matrix_values(ws, matrix), retries=4, base_delay=1.0)
+        _retry_gspread_api_call(lambda: cobranza_replace_matrix_values(ws, matrix), kind="write", retries=4, base_delay=1.0)
         return True
 
     # Fallback: reordena por nombre de columna para evitar corrimiento de datos.
@@ -4288,7 +5076,7 @@ def cobranza_migrar_comentarios_con_folio(ws):
                 rec.get("Fecha_Proximo_Pago", ""),
             )
             matrix.append([rec.get(h, "") for h in expected])
-        _retry_gspread_api_call(lambda: cobranza_replace_matrix_values(ws, matrix), retries=4, base_delay=1.0)
+        _retry_gspread_api_call(lambda: cobranza_replace_matrix_values(ws, matrix), kind="write", retries=4, base_delay=1.0)
         return True
 
     return False
@@ -4359,7 +5147,7 @@ def cobranza_replace_matrix_values(ws, matrix: list[list]):
     if hasattr(ws, "update"):
         end_a1 = gspread.utils.rowcol_to_a1(rows, cols)
         ws.update(f"A1:{end_a1}", matrix, value_input_option="USER_ENTERED")
-        _COBRANZA_VALUES_CACHE.pop(_cobranza_cache_key(ws), None)
+        gerente_cache_invalidate("cobranza_values", _cobranza_cache_key(ws))
         return
 
     cells = ws.range(1, 1, rows, cols)
@@ -4369,24 +5157,25 @@ def cobranza_replace_matrix_values(ws, matrix: list[list]):
             cells[i].value = matrix[r][c]
             i += 1
     ws.update_cells(cells, value_input_option="USER_ENTERED")
-    _COBRANZA_VALUES_CACHE.pop(_cobranza_cache_key(ws), None)
+    gerente_cache_invalidate("cobranza_values", _cobranza_cache_key(ws))
 
 
 def _cobranza_get_all_values_cached(ws, max_age_seconds: float = 20.0, use_cache: bool = True):
     """Lee valores de una worksheet con cache corto para bajar lecturas por minuto."""
     cache_key = _cobranza_cache_key(ws)
-    now_ts = time.time()
-    if use_cache and cache_key is not None:
-        cache_entry = _COBRANZA_VALUES_CACHE.get(cache_key)
-        if cache_entry:
-            age = now_ts - cache_entry["ts"]
-            if age <= max_age_seconds:
-                return cache_entry["values"]
 
-    values = _retry_gspread_api_call(lambda: ws.get_all_values(), retries=4, base_delay=1.0)
-    if cache_key is not None:
-        _COBRANZA_VALUES_CACHE[cache_key] = {"ts": now_ts, "values": values}
-    return values
+    def _load():
+        return _retry_gspread_api_call(lambda: ws.get_all_values(), retries=4, base_delay=1.0)
+
+    if cache_key is None:
+        return _load()
+    return gerente_cache_get(
+        "cobranza_values",
+        cache_key,
+        _load,
+        ttl_seconds=max_age_seconds,
+        use_cache=use_cache,
+    )
 
 
 def _cobranza_headers_from_values(values: list[list]) -> list[str]:
@@ -4413,6 +5202,81 @@ def cobranza_load_records_with_rows(ws, use_cache: bool = True) -> list[dict]:
     return out
 
 
+# gspread 3.1.0 no expone values:batchUpdate en Spreadsheet; se llama con la sesión del cliente.
+SHEETS_VALUES_BATCH_UPDATE_URL = "https://sheets.googleapis.com/v4/spreadsheets/{}/values:batchUpdate"
+
+
+def _cobranza_diff_ranges(base: list[list], target: list[list]) -> tuple[list[dict], list[list]]:
+    """Compara dos matrices (encabezado en la fila 0) y devuelve ``(rangos, filas_nuevas)``.
+
+    Cada fila existente con cambios produce un solo rango, del primer al último
+    valor distinto; las filas que ``target`` agrega al final se devuelven aparte.
+    """
+    ranges = []
+    for i, new_row in enumerate(target[:len(base)]):
+        old_row = base[i]
+        changed = [j for j, value in enumerate(new_row) if value != (old_row[j] if j < len(old_row) else "")]
+        if not changed:
+            continue
+        first, last = changed[0], changed[-1]
+        ranges.append({
+            "range": f"{gspread.utils.rowcol_to_a1(i + 1, first + 1)}:{gspread.utils.rowcol_to_a1(i + 1, last + 1)}",
+            "values": [new_row[first:last + 1]],
+        })
+    return ranges, [list(row) for row in target[len(base):]]
+
+
+def _cobranza_values_batch_update(spreadsheet_obj, body: dict) -> None:
+    if hasattr(spreadsheet_obj, "values_batch_update"):
+        spreadsheet_obj.values_batch_update(body)
+        return
+    spreadsheet_obj.client.request(
+        "post",
+        SHEETS_VALUES_BATCH_UPDATE_URL.format(spreadsheet_obj.id),
+        json=body,
+    )
+
+
+def cobranza_write_matrix_diff(ws, base: list[list], target: list[list]) -> int:
+    """Escribe en ``ws`` solo lo que cambió de ``base`` a ``target``; devuelve las llamadas hechas.
+
+    Las filas cambiadas van en un solo ``values:batchUpdate``. Las filas nuevas se
+    agregan con ``values:append`` (INSERT_ROWS) para no pisar filas que otra sesión
+    haya agregado después de leer ``base``.
+    """
+    ranges, tail = _cobranza_diff_ranges(base, target)
+    spreadsheet_obj = ws.spreadsheet
+    sheet_prefix = "'" + str(ws.title).replace("'", "''") + "'!"
+    calls = 0
+    if ranges:
+        body = {
+            "valueInputOption": "USER_ENTERED",
+            "data": [{"range": sheet_prefix + item["range"], "values": item["values"]} for item in ranges],
+        }
+        _retry_gspread_api_call(
+            lambda: _cobranza_values_batch_update(spreadsheet_obj, body),
+            kind="write",
+            retries=4,
+            base_delay=1.0,
+        )
+        calls += 1
+    if tail:
+        _retry_gspread_api_call(
+            lambda: spreadsheet_obj.values_append(
+                sheet_prefix + "A1",
+                params={"valueInputOption": "USER_ENTERED", "insertDataOption": "INSERT_ROWS"},
+                body={"values": tail},
+            ),
+            kind="write",
+            retries=4,
+            base_delay=1.0,
+        )
+        calls += 1
+    if calls:
+        gerente_cache_invalidate("cobranza_values", _cobranza_cache_key(ws))
+    return calls
+
+
 def cobranza_upsert_rows_by_key(
     ws,
     df: pd.DataFrame,
@@ -4420,12 +5284,24 @@ def cobranza_upsert_rows_by_key(
     update_cols: list[str],
     existing_records: list[dict] | None = None,
 ):
+    """Actualiza/agrega filas por llave escribiendo solo las celdas que cambian.
+
+    Solo se reescribe la hoja completa si sus encabezados no coinciden con los
+    de ``df`` o si ``existing_records`` no refleja las filas de la hoja en orden.
+    """
     if df.empty:
         return
     if existing_records is not None:
         # Reutiliza datos ya cargados en memoria para evitar una lectura extra de Google Sheets.
         recs = [{k: v for k, v in rec.items() if not str(k).startswith("__")} for rec in existing_records]
         headers = list(df.columns)
+        # Los registros de cobranza_load_records_with_rows conservan el orden de columnas
+        # de la hoja y su fila en "__row"; con eso se reconstruye la matriz actual.
+        sheet_headers = list(recs[0].keys()) if recs else []
+        layout_ok = bool(recs) and sheet_headers == headers and [
+            rec.get("__row") for rec in existing_records
+        ] == list(range(2, len(recs) + 2))
+        base = [sheet_headers] + [[rec.get(h, "") for h in sheet_headers] for rec in recs] if layout_ok else None
         for rec in recs:
             for h in headers:
                 rec.setdefault(h, "")
@@ -4440,8 +5316,7 @@ def cobranza_upsert_rows_by_key(
         for row in values[1:]:
             row = row + [""] * (len(headers) - len(row))
             recs.append({headers[j]: row[j] for j in range(len(headers))})
-    # Guardamos índice por posición para poder escribir todo en un solo update
-    # y evitar exceder cuota por demasiados writes por minuto.
+        base = [list(values[0][:len(headers)])] + [[rec[h] for h in headers] for rec in recs]
     idx = {
         tuple(_cobranza_clean_text(r.get(k, "")) for k in key_cols): i
         for i, r in enumerate(recs)
@@ -4459,12 +5334,16 @@ def cobranza_upsert_rows_by_key(
             idx[key] = len(recs) - 1
 
     matrix = [headers] + [[rec.get(h, "") for h in headers] for rec in recs]
+    if base is not None:
+        cobranza_write_matrix_diff(ws, base, matrix)
+        return
     _retry_gspread_api_call(
         lambda: cobranza_replace_matrix_values(ws, matrix),
+        kind="write",
         retries=4,
         base_delay=1.0,
     )
-    _COBRANZA_VALUES_CACHE.pop(_cobranza_cache_key(ws), None)
+    gerente_cache_invalidate("cobranza_values", _cobranza_cache_key(ws))
 
 
 def cobranza_prune_rows_by_keys(
@@ -4520,10 +5399,11 @@ def cobranza_prune_rows_by_keys(
     if changed:
         _retry_gspread_api_call(
             lambda: cobranza_replace_matrix_values(ws, matrix),
+            kind="write",
             retries=4,
             base_delay=1.0,
         )
-        _COBRANZA_VALUES_CACHE.pop(_cobranza_cache_key(ws), None)
+        gerente_cache_invalidate("cobranza_values", _cobranza_cache_key(ws))
 
 
 def parse_reporte_cobranza_excel(file, mes: str) -> pd.DataFrame:
@@ -4691,11 +5571,8 @@ def _cobranza_retry_cooldown_remaining() -> int:
 
 def reset_cobranza_connection_state(clear_session: bool = True, clear_cooldown: bool = False):
     """Limpia caches de Cobranza para forzar una reconexión fresca a Google Sheets."""
-    global _COBRANZA_SPREADSHEET_CACHE, _COBRANZA_WS_CACHE, _COBRANZA_VALUES_CACHE
-
-    _COBRANZA_SPREADSHEET_CACHE = None
-    _COBRANZA_WS_CACHE = None
-    _COBRANZA_VALUES_CACHE = {}
+    for namespace in ("cobranza_spreadsheet", "cobranza_ws", "cobranza_values"):
+        gerente_cache_invalidate(namespace)
 
     if clear_session:
         for key in [
@@ -4737,12 +5614,11 @@ def _render_cobranza_retry_box(message: str, *, error: Exception | None = None,
 
 def get_cobranza_worksheets_safe():
     """Abre hojas de cobranza con manejo robusto de APIError para no romper la app."""
-    global _COBRANZA_WS_CACHE
-
-    if _COBRANZA_WS_CACHE is not None:
-        return _COBRANZA_WS_CACHE
-
     spreadsheet_id = get_cobranza_spreadsheet_id()
+    ws_cache = gerente_cache_peek("cobranza_ws", spreadsheet_id)
+    if ws_cache is not None:
+        return ws_cache
+
     service_email = str(credentials_dict.get("client_email", "(sin client_email en secrets)"))
 
     cooldown = _cobranza_retry_cooldown_remaining()
@@ -4758,9 +5634,10 @@ def get_cobranza_worksheets_safe():
         ws_base = _retry_gspread_api_call(lambda: ss.worksheet("cobranza_base"), retries=4, base_delay=0.9)
         ws_venc = _retry_gspread_api_call(lambda: ss.worksheet("cobranza_vencimientos"), retries=4, base_delay=0.9)
         ws_com = _retry_gspread_api_call(lambda: ss.worksheet("cobranza_comentarios"), retries=4, base_delay=0.9)
-        _COBRANZA_WS_CACHE = (ws_base, ws_venc, ws_com)
+        ws_cache = (ws_base, ws_venc, ws_com)
+        gerente_cache_put("cobranza_ws", spreadsheet_id, ws_cache, ttl_seconds=GERENTE_CACHE_HANDLE_TTL_SECONDS)
         _clear_cobranza_transient_failure()
-        return _COBRANZA_WS_CACHE
+        return ws_cache
     except gspread.exceptions.WorksheetNotFound:
         st.error("❌ Faltan pestañas requeridas en el Google Sheet de Cobranza.")
         st.caption(
@@ -4969,7 +5846,7 @@ def _cobranza_aplicar_formato_drive(ss, ws, total_rows: int, total_cols: int):
             }
         })
 
-    _retry_gspread_api_call(lambda: ss.batch_update({"requests": requests}), retries=4, base_delay=1.0)
+    _retry_gspread_api_call(lambda: ss.batch_update({"requests": requests}), kind="write", retries=4, base_delay=1.0)
 def _cobranza_guardar_en_drive_por_mes(spreadsheet_id: str, mes: str, out_df: pd.DataFrame) -> tuple[str, bool]:
     """Guarda reporte en una hoja mensual; actualiza la existente si ya fue creada."""
     configured_id = get_cobranza_spreadsheet_id()
@@ -4993,6 +5870,7 @@ def _cobranza_guardar_en_drive_por_mes(spreadsheet_id: str, mes: str, out_df: pd
                 rows=max(len(out_df) + 5, 50),
                 cols=max(len(out_df.columns) + 2, 20),
             ),
+            kind="write",
             retries=4,
             base_delay=1.0,
         )
@@ -5000,7 +5878,7 @@ def _cobranza_guardar_en_drive_por_mes(spreadsheet_id: str, mes: str, out_df: pd
 
     encabezado = [f"Fecha De Generación: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"] + [""] * (len(out_df.columns) - 1)
     matrix = [encabezado, list(out_df.columns)] + out_df.fillna("").astype(str).values.tolist()
-    _retry_gspread_api_call(lambda: cobranza_replace_matrix_values(ws_target, matrix), retries=4, base_delay=1.0)
+    _retry_gspread_api_call(lambda: cobranza_replace_matrix_values(ws_target, matrix), kind="write", retries=4, base_delay=1.0)
     _cobranza_aplicar_formato_drive(ss, ws_target, total_rows=len(matrix), total_cols=len(out_df.columns))
     return title, creada
 
@@ -7280,12 +8158,14 @@ def render_salida_neta_tab():
                         values_matrix,
                         value_input_option="USER_ENTERED",
                     ),
+                    kind="write",
                     retries=5,
                     base_delay=1.0,
                 )
             except TypeError:
                 return _retry_gspread_api_call(
                     lambda: worksheet.update(a1_range, values_matrix),
+                    kind="write",
                     retries=5,
                     base_delay=1.0,
                 )
@@ -7294,6 +8174,7 @@ def render_salida_neta_tab():
                 if "not enough values to unpack" in str(exc):
                     return _retry_gspread_api_call(
                         lambda: worksheet.update(values_matrix, a1_range, value_input_option="USER_ENTERED"),
+                        kind="write",
                         retries=5,
                         base_delay=1.0,
                     )
@@ -7305,12 +8186,14 @@ def render_salida_neta_tab():
         try:
             return _retry_gspread_api_call(
                 lambda: worksheet.update_cells(cells, value_input_option="USER_ENTERED"),
+                kind="write",
                 retries=5,
                 base_delay=1.0,
             )
         except TypeError:
             return _retry_gspread_api_call(
                 lambda: worksheet.update_cells(cells),
+                kind="write",
                 retries=5,
                 base_delay=1.0,
             )
@@ -7327,6 +8210,7 @@ def render_salida_neta_tab():
                     data_ranges,
                     value_input_option="USER_ENTERED",
                 ),
+                kind="write",
                 retries=5,
                 base_delay=1.0,
             )
@@ -8324,9 +9208,13 @@ def get_reportes_guia_worksheet():
     )
 
 
-@st.cache_data(ttl=120, show_spinner=False)
 def load_reportes_guia_from_gsheets() -> pd.DataFrame:
     """Carga la hoja REPORTE GUÍAS y conserva la fila real para actualizar RECIBIDO POR."""
+    df = gerente_cache_get("reportes_guia", _reportes_guia_sheet_id(), _leer_reportes_guia, ttl_seconds=120)
+    return df.copy()
+
+
+def _leer_reportes_guia() -> pd.DataFrame:
     ws = get_reportes_guia_worksheet()
     values = _retry_gspread_api_call(lambda: ws.get_all_values(), retries=4, base_delay=0.9)
     if not values:
@@ -8374,6 +9262,7 @@ def _update_reportes_guia_cells(ws, cells: list[gspread.Cell], updates: list[dic
     if not hasattr(ws, "batch_update"):
         _retry_gspread_api_call(
             lambda: ws.update_cells(cells, value_input_option="USER_ENTERED"),
+            kind="write",
             retries=4,
             base_delay=0.9,
         )
@@ -8382,6 +9271,7 @@ def _update_reportes_guia_cells(ws, cells: list[gspread.Cell], updates: list[dic
     try:
         _retry_gspread_api_call(
             lambda: ws.batch_update(updates, value_input_option="USER_ENTERED"),
+            kind="write",
             retries=4,
             base_delay=0.9,
         )
@@ -8390,6 +9280,7 @@ def _update_reportes_guia_cells(ws, cells: list[gspread.Cell], updates: list[dic
         # que anuncian/ocultan métodos distinto a la clase instalada.
         _retry_gspread_api_call(
             lambda: ws.update_cells(cells, value_input_option="USER_ENTERED"),
+            kind="write",
             retries=4,
             base_delay=0.9,
         )
@@ -8413,7 +9304,7 @@ def update_reportes_guia_recibido(sheet_rows: list[int], valor: str) -> tuple[in
         return 0, 0
 
     _update_reportes_guia_cells(ws, cells, updates)
-    load_reportes_guia_from_gsheets.clear()
+    gerente_cache_invalidate("reportes_guia")
     return len(cells), 0
 
 
@@ -8573,7 +9464,7 @@ def render_reportes_guia_tab():
     st.caption("Muestra guías pendientes; las filas con RECIBIDO POR = ENTREGADO se ocultan automáticamente.")
 
     if st.button("🔄 Recargar Reportes Guía", key="reportes_guia_reload"):
-        load_reportes_guia_from_gsheets.clear()
+        gerente_cache_invalidate("reportes_guia")
         st.rerun()
 
     try:
@@ -8837,12 +9728,12 @@ def render_reportes_guia_tab():
 USUARIOS_VALIDOS = ["ALEJANDRO38", "CeciliaATD", "SChava", "BreydaFTD", "SaraiFTD", "JorgeLic"]
 
 PERMISOS_USUARIO = {
-    "ALEJANDRO38": {"organizador": True, "modificar": False, "cobranza": False},
-    "CeciliaATD": {"organizador": False, "modificar": True, "cobranza": False},
-    "SChava": {"organizador": True, "modificar": True, "cobranza": True},
-    "BreydaFTD": {"organizador": False, "modificar": False, "cobranza": True},
-    "SaraiFTD": {"organizador": False, "modificar": False, "cobranza": True},
-    "JorgeLic": {"organizador": False, "modificar": False, "cobranza": False},
+    "ALEJANDRO38": {"organizador": True, "modificar": False, "cobranza": False, "admin": False},
+    "CeciliaATD": {"organizador": False, "modificar": True, "cobranza": False, "admin": False},
+    "SChava": {"organizador": True, "modificar": True, "cobranza": True, "admin": True},
+    "BreydaFTD": {"organizador": False, "modificar": False, "cobranza": True, "admin": False},
+    "SaraiFTD": {"organizador": False, "modificar": False, "cobranza": True, "admin": False},
+    "JorgeLic": {"organizador": False, "modificar": False, "cobranza": False, "admin": False},
 }
 
 COBRANZA_ONLY_USERS = {"BreydaFTD", "SaraiFTD"}
@@ -8908,6 +9799,23 @@ def usuario_puede(usuario: str | None, permiso: str) -> bool:
 
 usuario_actual = ensure_user_logged_in()
 
+if usuario_puede(usuario_actual, "admin"):
+    # Diagnóstico interno: solo para administradores.
+    with st.sidebar.expander("🧠 Caché del proceso", expanded=False):
+        cache_stats = gerente_cache_stats()
+        consultas = cache_stats["hits"] + cache_stats["misses"]
+        st.caption(
+            f"{cache_stats['bytes'] / 1048576:.1f} de {cache_stats['max_bytes'] / 1048576:.0f} MB · "
+            f"{cache_stats['entradas']} entradas · aciertos "
+            f"{(cache_stats['hits'] / consultas * 100) if consultas else 0:.0f}% de {consultas}"
+        )
+        st.caption(
+            f"Desalojos: {cache_stats['evictions']} · vencidas: {cache_stats['expired']} · "
+            f"invalidadas: {cache_stats['invalidations']}"
+        )
+        for namespace, item in sorted(cache_stats["por_namespace"].items()):
+            st.caption(f"`{namespace}`: {item['entradas']} · {item['bytes'] / 1024:.0f} KB")
+
 if usuario_actual == "JorgeLic":
     tab_specs = [("salida_neta", "📦 Rotaciones")]
 elif usuario_actual in COBRANZA_ONLY_USERS:
@@ -8956,6 +9864,7 @@ if usuario_actual == "JorgeLic":
     st.stop()
 
 with tab_map["buscar"]:
+    start_guias_index_worker(s3_client)
     modo_busqueda = st.radio(
         "Selecciona el modo de búsqueda:",
         ["🔢 Por número de guía", "🧑 Por cliente/factura"],
@@ -9166,80 +10075,59 @@ with tab_map["buscar"]:
                 st.warning("⚠️ Ingresa una palabra clave o número de guía.")
                 st.stop()
 
-            for _, row in df_pedidos.iterrows():
-                pedido_id = str(row.get("ID_Pedido", "")).strip()
-                if not pedido_id:
-                    continue
-
-                prefix = obtener_prefijo_s3(pedido_id)
-                if not prefix:
-                    continue
-
-                archivos_validos = obtener_archivos_pdf_validos(prefix)
-                archivos_coincidentes = []
-
-                for archivo in archivos_validos:
-                    key = archivo["Key"]
-                    texto = extraer_texto_pdf(key)
+            ultima_pasada = ultima_pasada_indice_guias()
+            if ultima_pasada is not None:
+                minutos = max(0, int((time.time() - ultima_pasada) // 60))
+                st.caption(f"🗂️ Búsqueda en el índice de guías (actualizado hace {minutos} min).")
+                encontrado = buscar_guia_en_indice(df_pedidos, clave)
+            else:
+                # Índice aún sin primera pasada: búsqueda directa en S3.
+                encontrado = buscar_guia_en_s3(df_pedidos, clave)
 
-                    clave_sin_espacios = clave.replace(" ", "")
-                    texto_limpio = texto.replace(" ", "").replace("\n", "")
+            if encontrado:
+                row, pedido_id, prefix, key, waybill = encontrado
+                if waybill:
+                    st.code(f"📦 WAYBILL detectado: {waybill}")
 
-                    coincide = (
-                        clave in texto
-                        or clave_sin_espacios in texto_limpio
-                        or re.search(re.escape(clave), texto_limpio)
-                        or re.search(re.escape(clave_sin_espacios), texto_limpio)
-                    )
+                archivos_coincidentes = [(key, get_s3_file_download_url(s3_client, key))]
+                todos_los_archivos = obtener_todos_los_archivos(prefix)
+                comprobantes = [f for f in todos_los_archivos if "comprobante" in f["Key"].lower()]
+                facturas = [f for f in todos_los_archivos if "factura" in f["Key"].lower()]
+                otros = [f for f in todos_los_archivos if f not in comprobantes and f not in facturas and f["Key"] != archivos_coincidentes[0][0]]
 
-                    if coincide:
-                        waybill_match = re.search(r"WAYBILL[\s:]*([0-9 ]{8,})", texto, re.IGNORECASE)
-                        if waybill_match:
-                            st.code(f"📦 WAYBILL detectado: {waybill_match.group(1)}")
-
-                        archivos_coincidentes.append((key, get_s3_file_download_url(s3_client, key)))
-                        todos_los_archivos = obtener_todos_los_archivos(prefix)
-                        comprobantes = [f for f in todos_los_archivos if "comprobante" in f["Key"].lower()]
-                        facturas = [f for f in todos_los_archivos if "factura" in f["Key"].lower()]
-                        otros = [f for f in todos_los_archivos if f not in comprobantes and f not in facturas and f["Key"] != archivos_coincidentes[0][0]]
-
-                        resultados.append({
-                            "__source": "pedidos",
-                            "ID_Pedido": pedido_id,
-                            "Cliente": row.get("Cliente", ""),
-                            "Estado": row.get("Estado", ""),
-                            "Vendedor": row.get("Vendedor_Registro", ""),
-                            "ID_Vendedor": obtener_id_vendedor(row),
-                            "Tipo_Envio": str(row.get("Tipo_Envio", "") or "").strip(),
-                            "Folio": row.get("Folio_Factura", ""),
-                            "Hora_Registro": row.get("Hora_Registro", ""),
-                            "Comentario": str(row.get("Comentario", "")).strip(),
-                            "Comentarios": str(row.get("Comentarios", "")).strip(),
-                            "Direccion_Guia_Retorno": str(row.get("Direccion_Guia_Retorno", "")).strip(),
-                            "Nota_Venta": str(row.get("Nota_Venta", "")).strip(),
-                            "Tiene_Nota_Venta": str(row.get("Tiene_Nota_Venta", "")).strip(),
-                            "Motivo_NotaVenta": str(row.get("Motivo_NotaVenta", "")).strip(),
-                            # 🛠 Modificación de surtido
-                            "Modificacion_Surtido": str(row.get("Modificacion_Surtido", "")).strip(),
-                            "Fecha_Modificacion_Surtido": obtener_fecha_modificacion(row),
-                            "Adjuntos_Surtido_urls": partir_urls(row.get("Adjuntos_Surtido", "")),
-                            # Archivos registrados en la hoja
-                            "Adjuntos_Guia_urls": partir_urls(row.get("Adjuntos_Guia", "")),
-                            "Adjuntos_urls": partir_urls(row.get("Adjuntos", "")),
-                            # ♻️ Refacturación
-                            "Refacturacion_Tipo": str(row.get("Refacturacion_Tipo","")).strip(),
-                            "Refacturacion_Subtipo": str(row.get("Refacturacion_Subtipo","")).strip(),
-                            "Folio_Factura_Refacturada": str(row.get("Folio_Factura_Refacturada","")).strip(),
-                            # Archivos S3
-                            "Coincidentes": archivos_coincidentes,
-                            "Comprobantes": [(f["Key"], get_s3_file_download_url(s3_client, f["Key"])) for f in comprobantes],
-                            "Facturas": [(f["Key"], get_s3_file_download_url(s3_client, f["Key"])) for f in facturas],
-                            "Otros": [(f["Key"], get_s3_file_download_url(s3_client, f["Key"])) for f in otros],
-                        })
-                        break  # detener búsqueda tras encontrar coincidencia dentro del pedido
-
-                if archivos_coincidentes:
-                    break  # detener búsqueda global: por guía solo debe existir una coincidencia
+                resultados.append({
+                    "__source": "pedidos",
+                    "ID_Pedido": pedido_id,
+                    "Cliente": row.get("Cliente", ""),
+                    "Estado": row.get("Estado", ""),
+                    "Vendedor": row.get("Vendedor_Registro", ""),
+                    "ID_Vendedor": obtener_id_vendedor(row),
+                    "Tipo_Envio": str(row.get("Tipo_Envio", "") or "").strip(),
+                    "Folio": row.get("Folio_Factura", ""),
+                    "Hora_Registro": row.get("Hora_Registro", ""),
+                    "Comentario": str(row.get("Comentario", "")).strip(),
+                    "Comentarios": str(row.get("Comentarios", "")).strip(),
+                    "Direccion_Guia_Retorno": str(row.get("Direccion_Guia_Retorno", "")).strip(),
+                    "Nota_Venta": str(row.get("Nota_Venta", "")).strip(),
+                    "Tiene_Nota_Venta": str(row.get("Tiene_Nota_Venta", "")).strip(),
+                    "Motivo_NotaVenta": str(row.get("Motivo_NotaVenta", "")).strip(),
+                    # 🛠 Modificación de surtido
+                    "Modificacion_Surtido": str(row.get("Modificacion_Surtido", "")).strip(),
+                    "Fecha_Modificacion_Surtido": obtener_fecha_modificacion(row),
+                    "Adjuntos_Surtido_urls": partir_urls(row.get("Adjuntos_Surtido", "")),
+                    # Archivos registrados en la hoja
+                    "Adjuntos_Guia_urls": partir_urls(row.get("Adjuntos_Guia", "")),
+                    "Adjuntos_urls": partir_urls(row.get("Adjuntos", "")),
+                    # ♻️ Refacturación
+                    "Refacturacion_Tipo": str(row.get("Refacturacion_Tipo","")).strip(),
+                    "Refacturacion_Subtipo": str(row.get("Refacturacion_Subtipo","")).strip(),
+                    "Folio_Factura_Refacturada": str(row.get("Folio_Factura_Refacturada","")).strip(),
+                    # Archivos S3
+                    "Coincidentes": archivos_coincidentes,
+                    "Comprobantes": [(f["Key"], get_s3_file_download_url(s3_client, f["Key"])) for f in comprobantes],
+                    "Facturas": [(f["Key"], get_s3_file_download_url(s3_client, f["Key"])) for f in facturas],
+                    "Otros": [(f["Key"], get_s3_file_download_url(s3_client, f["Key"])) for f in otros],
+                })
 
         # ====== RENDER DE RESULTADOS ======
         st.markdown("---")
@@ -9460,6 +10348,7 @@ if "descargar" in tab_map:
             "🔄 Refrescar datos",
             help="Recarga los datos desde Google Sheets para ver la información más reciente.",
         ):
+            invalidate_sheet_snapshot(SPREADSHEET_ID_MAIN)
             st.cache_data.clear()
             st.rerun()
 
@@ -9547,6 +10436,7 @@ if "modificar" in tab_map:
             key="refresh_modificar_pedido",
             help="Recarga la información más reciente de la hoja para mostrar nuevos pedidos y cambios.",
         ):
+            invalidate_sheet_snapshot(SPREADSHEET_ID_MAIN)
             st.cache_data.clear()
             st.rerun()
 
@@ -10134,6 +11024,9 @@ if "modificar" in tab_map:
                             f"La columna '{nombre_col}' no se confirmó. Esperado: '{esperado}' | Guardado: '{real}'."
                         )
 
+                invalidate_sheet_snapshot(SPREADSHEET_ID_MAIN, hoja_nombre)
+                if hoja_nombre == "datos_pedidos":
+                    _reexportar_filas_historico(hoja, headers, [gspread_row_idx])
                 st.session_state["pedido_modificado"] = pedido_sel
                 st.session_state["pedido_modificado_source"] = source_sel
                 st.session_state["pedido_modificado_sheet_row"] = gspread_row_idx
@@ -10617,7 +11510,10 @@ if "organizador" in tab_map:
                                     f"({limite_72h.strftime('%d/%m/%Y %H:%M')} a {ahora_naive.strftime('%d/%m/%Y %H:%M')})."
                                 )
 
-                            df_pedidos_match = cargar_pedidos().copy()
+                            # Cada factura se busca en ±72 h de su fecha.
+                            df_pedidos_match = cargar_pedidos_lectura(
+                                desde=pd.Timestamp(limite_72h - timedelta(hours=72)).floor("D"),
+                            ).copy()
                             df_casos_match = cargar_casos_especiales().copy()
                             df_casos_match["__hoja_origen"] = "casos_especiales"
                             df_pedidos_match = pd.concat(
@@ -10879,7 +11775,10 @@ if "organizador" in tab_map:
                                         st.info("No hay faltantes en la vista actual para validar por PDF.")
                                     else:
                                         with st.spinner("Analizando PDFs de adjuntos para los faltantes mostrados..."):
-                                            df_pedidos_pdf = cargar_pedidos().copy()
+                                            # Faltantes de las últimas 72 h, buscados en ±72 h de su fecha.
+                                            df_pedidos_pdf = cargar_pedidos_lectura(
+                                                desde=pd.Timestamp(limite_72h - timedelta(hours=72)).floor("D"),
+                                            ).copy()
                                             col_hora_pdf = encontrar_columna_por_alias(
                                                 df_pedidos_pdf,
                                                 ["Hora_Registro", "Fecha_Hora_Registro", "Fecha_Registro", "Created_At"],
@@ -11487,6 +12386,7 @@ if "organizador" in tab_map:
                                     hoja_casos.update_cell(1, len(headers_casos), "Seguimiento")
                                 col_seguimiento = headers_casos.index("Seguimiento") + 1
                                 hoja_casos.update_cell(fila_sheet, col_seguimiento, "Comentado")
+                                invalidate_sheet_snapshot(SPREADSHEET_ID_MAIN, "casos_especiales")
                                 cargar_casos_especiales.clear()
                                 st.session_state["organizador_casos_filtros_guardados"] = {
                                     k: st.session_state.get(k) for k in filtros_keys if k in st.session_state
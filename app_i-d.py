@@ -6,23 +6,37 @@ import pandas as pd
 import numpy as np
 from datetime import datetime, timedelta
 import json
+import hashlib
 import re
 import gspread
 from oauth2client.service_account import ServiceAccountCredentials
 import boto3
 import gspread.utils
+import os
 import time
+import threading
 import unicodedata
 import streamlit.components.v1 as components
+from collections import OrderedDict
 from itertools import count
 from typing import Optional, Tuple
 from zoneinfo import ZoneInfo
-from streamlit_autorefresh import st_autorefresh
 from textwrap import dedent
 from difflib import SequenceMatcher
 from urllib.parse import urlsplit, urlunsplit, quote
 from urllib.parse import urlparse
 
+from sheets_quota import (
+    SheetsQuotaUnavailable,
+    acquire_sheets_quota,
+    report_sheets_quota_exhausted,
+    set_sheets_quota_user,
+)
+from historico_parquet import (
+    historico_parquet_manifest,
+    load_historico_columnar,
+)
+
 TZ = ZoneInfo("America/Mexico_City")
 
 
@@ -902,19 +916,93 @@ def _build_approx_client_match_summary(
     return results
 
 
-@st.cache_data(ttl=120)
-def load_historicos_from_gsheets() -> pd.DataFrame:
-    """Intenta leer 'datos_pedidos' (históricos). Si no existe, usa pedidos_confirmados."""
-
+# --- Lectura del histórico columnar (Parquet en S3) ---
+# ``load_historico_columnar`` y el manifiesto viven en ``historico_parquet``,
+# compartido con app_a-d (que lo escribe al archivar) y app_gerente.
+def _load_historicos_sheet() -> pd.DataFrame:
+    """Lee 'datos_pedidos' desde Sheets. Si no existe, usa pedidos_confirmados."""
     try:
-        ws_hist = spreadsheet.worksheet(SHEET_PEDIDOS_HISTORICOS)
-        data = _fetch_with_retry(ws_hist, "_cache_datos_pedidos_historicos")
+        data, _ = get_shared_sheet_snapshot(
+            GOOGLE_SHEET_ID,
+            SHEET_PEDIDOS_HISTORICOS,
+            lambda: _fetch_with_retry(
+                spreadsheet.worksheet(SHEET_PEDIDOS_HISTORICOS),
+                "_cache_datos_pedidos_historicos",
+            ),
+        )
         if not data:
             return pd.DataFrame()
         headers = data[0]
-        df = pd.DataFrame(data[1:], columns=headers)
+        return pd.DataFrame(data[1:], columns=headers)
+    except Exception:
+        return get_cached_confirmados_df(SHEET_CONFIRMADOS)
+
+
+def historico_meses_disponibles() -> list[str]:
+    """Meses (AAAA-MM) con partes en el histórico columnar; vacío si aún no se generó."""
+    try:
+        manifest = historico_parquet_manifest(s3_client, S3_BUCKET_NAME)
+    except Exception:
+        return []
+    if not manifest.get("backfill"):
+        return []
+    meses = {str(meta.get("mes", "")) for meta in (manifest.get("parts") or {}).values()}
+    return sorted(mes for mes in meses if re.fullmatch(r"\d{4}-\d{2}", mes))
+
+
+def historico_vendor_values(vendor_name: str) -> Optional[tuple[str, ...]]:
+    """
+    Valores exactos de Vendedor/Vendedor_Registro del histórico columnar que
+    corresponden a ``vendor_name`` (misma regla que ``_vendedor_names_match``).
+
+    Sirven para filtrar por vendedor dentro del Parquet. ``None`` si el histórico
+    columnar aún no se generó (se lee Sheets y se filtra en pandas).
+    """
+    try:
+        manifest = historico_parquet_manifest(s3_client, S3_BUCKET_NAME)
+    except Exception:
+        return None
+    if not manifest.get("backfill"):
+        return None
+    valores = {v for meta in (manifest.get("parts") or {}).values() for v in meta.get("vendedores") or []}
+    return tuple(sorted(v for v in valores if _vendedor_names_match(v, vendor_name)))
+
+
+@st.cache_data(ttl=120)
+def load_historicos_from_gsheets(
+    columns: Optional[tuple[str, ...]] = None,
+    desde: Optional[pd.Timestamp] = None,
+    hasta: Optional[pd.Timestamp] = None,
+    vendedores: Optional[tuple[str, ...]] = None,
+) -> pd.DataFrame:
+    """
+    Históricos desde el Parquet en S3; ``columns`` limita las columnas leídas.
+
+    ``desde``/``hasta`` (Hora_Registro) y ``vendedores`` (valores exactos, ver
+    ``historico_vendor_values``) se aplican dentro del Parquet; una tupla vacía de
+    vendedores no devuelve filas. Mientras el histórico columnar no esté generado
+    se lee 'datos_pedidos' en Sheets y los mismos filtros se aplican en pandas.
+    """
+    if vendedores is not None and not vendedores:
+        return pd.DataFrame(columns=list(columns or []))
+
+    try:
+        df = load_historico_columnar(
+            s3_client,
+            S3_BUCKET_NAME,
+            desde=desde,
+            hasta=hasta,
+            vendedores=vendedores,
+            columns=columns,
+        )
+        from_sheet = False
     except Exception:
-        df = get_cached_confirmados_df(SHEET_CONFIRMADOS)
+        df = None
+    if df is None:
+        df = _load_historicos_sheet()
+        from_sheet = True
+        if df.empty:
+            return df
 
     for col in ["ID_Pedido", "Folio_Factura", "Cliente", "Vendedor", "Vendedor_Registro", "Estado", "Tipo_Envio"]:
         if col not in df.columns:
@@ -924,6 +1012,19 @@ def load_historicos_from_gsheets() -> pd.DataFrame:
     if "Hora_Registro" in df.columns:
         df["Hora_Registro"] = pd.to_datetime(df["Hora_Registro"], errors="coerce")
 
+    if from_sheet:
+        if desde is not None or hasta is not None:
+            hora = df.get("Hora_Registro", pd.Series(pd.NaT, index=df.index))
+            mask = hora.notna()
+            if desde is not None:
+                mask &= hora >= pd.Timestamp(desde)
+            if hasta is not None:
+                mask &= hora <= pd.Timestamp(hasta)
+            df = df[mask]
+        if vendedores:
+            df = df[df["Vendedor_Registro"].isin(vendedores) | df["Vendedor"].isin(vendedores)]
+        df = df.reset_index(drop=True)
+
     return df
 
 
@@ -1010,15 +1111,34 @@ def _records_to_json_ready(df: pd.DataFrame) -> list[dict[str, object]]:
     ]
 
 
+# Columnas del histórico que usa el contexto del asistente TD.
+TD_ASSISTANT_HISTORICO_COLUMNS = (
+    "ID_Pedido",
+    "Folio_Factura",
+    "Cliente",
+    "Vendedor",
+    "Vendedor_Registro",
+    "Estado",
+    "Tipo_Envio",
+    "Hora_Registro",
+    "Fecha_Entrega",
+    "Fecha_Completado",
+)
+
+
 def build_logged_vendor_context(
     df_actual: pd.DataFrame,
     df_historicos: pd.DataFrame,
     df_casos: pd.DataFrame,
     user_message: str,
+    df_historicos_vendedor: Optional[pd.DataFrame] = None,
 ) -> str:
     logged_vendor = get_logged_vendor()
     if not logged_vendor:
         return ""
+    if df_historicos_vendedor is not None:
+        # Ya filtrado por vendedor al leer el Parquet.
+        df_historicos = df_historicos_vendedor
 
     latest_query = _looks_like_latest_query(user_message)
     sources = [
@@ -1380,6 +1500,7 @@ def build_td_assistant_context(
     remote_postal_codes: set[str],
     user_message: str,
     max_messages: int = 12,
+    df_historicos_vendedor: Optional[pd.DataFrame] = None,
 ) -> list[dict[str, str]]:
     history = st.session_state.get("td_assistant_messages", [])
     recent_history = history[-max_messages:]
@@ -1399,6 +1520,7 @@ def build_td_assistant_context(
         df_historicos=df_historicos,
         df_casos=df_casos,
         user_message=user_message,
+        df_historicos_vendedor=df_historicos_vendedor,
     )
 
     context = [{"role": "system", "content": TD_ASSISTANT_SYSTEM_PROMPT}]
@@ -1445,6 +1567,7 @@ def fetch_td_assistant_reply(
     remote_postal_codes: set[str],
     image_bytes: Optional[bytes] = None,
     image_mime_type: Optional[str] = None,
+    df_historicos_vendedor: Optional[pd.DataFrame] = None,
 ) -> str:
     api_key = get_openai_api_key()
     if not api_key:
@@ -1458,6 +1581,7 @@ def fetch_td_assistant_reply(
         df_productos=df_productos,
         remote_postal_codes=remote_postal_codes,
         user_message=user_message,
+        df_historicos_vendedor=df_historicos_vendedor,
     )
     if image_bytes and image_mime_type:
         encoded_image = base64.b64encode(image_bytes).decode("utf-8")
@@ -1643,10 +1767,165 @@ def _is_cancelado_estado(value: object) -> bool:
     return "cancelado" in estado
 
 
+# --- Numeración de flujo (por columnas y memorizada) ---
+# Las fechas se interpretan una vez por valor distinto (memo compartido entre
+# reruns) y los mapas se memorizan por la huella de las columnas de entrada.
+FLOW_SORT_DATETIME_FIELDS = (
+    "Hora_Registro",
+    "Fecha_Entrega",
+    "Fecha_Completado",
+    "Fecha_Pago_Comprobante",
+    "Hora_Proceso",
+)
+FLOW_NUMBER_INPUT_COLUMNS = (
+    "Tipo_Envio",
+    "Tipo_Envio_Original",
+    "ID_Pedido",
+    "Folio_Factura",
+    "Turno",
+    "gsheet_row_index",
+    "_gsheet_row_index",
+    "__sheet_row",
+) + FLOW_SORT_DATETIME_FIELDS
+FLOW_NUMBER_MAPS_KEEP = 8
+FLOW_DATETIME_CACHE_MAX = 50000
+
+
+@st.cache_resource
+def _get_flow_number_cache() -> dict:
+    """Memo de numeración de flujo compartido por todas las sesiones del proceso."""
+    return {"datetimes": {}, "maps": {}}
+
+
+def _map_distinct_values(values: list, fn) -> list:
+    """Aplica ``fn`` una sola vez por valor distinto (respetando el tipo) de ``values``."""
+    memo: dict = {}
+    out = []
+    for value in values:
+        try:
+            key = (type(value), value)
+            result = memo[key]
+        except KeyError:
+            result = memo[key] = fn(value)
+        except TypeError:
+            result = fn(value)
+        out.append(result)
+    return out
+
+
+def _flow_row_key_from_value(raw) -> str:
+    try:
+        if raw is not None and not pd.isna(raw):
+            return f"row:{int(float(raw))}"
+    except Exception:
+        pass
+    return ""
+
+
+def _flow_row_keys(df: pd.DataFrame) -> list[str]:
+    """Equivalente por columnas de ``_flow_row_key_from_row`` para todas las filas."""
+    keys = [""] * len(df)
+    for field in ("gsheet_row_index", "_gsheet_row_index", "__sheet_row"):
+        if field not in df.columns:
+            continue
+        values = _map_distinct_values(df[field].tolist(), _flow_row_key_from_value)
+        keys = [current or value for current, value in zip(keys, values)]
+    return keys
+
+
+def _parse_datetime_cached(value):
+    if not isinstance(value, str):
+        return parse_datetime(value)
+    cache = _get_flow_number_cache()["datetimes"]
+    if value not in cache:
+        if len(cache) >= FLOW_DATETIME_CACHE_MAX:
+            cache.clear()
+        cache[value] = parse_datetime(value)
+    return cache[value]
+
+
+def compute_sort_keys(df: pd.DataFrame) -> pd.Series:
+    """Equivalente por columnas de ``compute_sort_key`` para todas las filas."""
+    result = [None] * len(df)
+    pending = list(range(len(df)))
+    for field in FLOW_SORT_DATETIME_FIELDS:
+        if not pending:
+            break
+        if field not in df.columns:
+            continue
+        column = df[field].tolist()
+        parsed = _map_distinct_values([column[pos] for pos in pending], _parse_datetime_cached)
+        still_pending = []
+        for pos, value in zip(pending, parsed):
+            if value is not None:
+                result[pos] = value
+            else:
+                still_pending.append(pos)
+        pending = still_pending
+
+    if pending:
+        column = df["gsheet_row_index"].tolist() if "gsheet_row_index" in df.columns else [None] * len(df)
+
+        def _fallback(idx) -> pd.Timestamp:
+            try:
+                if idx is not None and not pd.isna(idx):
+                    return pd.Timestamp("1970-01-01") + pd.to_timedelta(int(float(idx)), unit="s")
+            except Exception:
+                pass
+            return pd.Timestamp.max
+
+        for pos, value in zip(pending, _map_distinct_values([column[pos] for pos in pending], _fallback)):
+            result[pos] = value
+
+    return pd.Series(result, index=df.index)
+
+
+def _flow_number_fingerprint(df: pd.DataFrame) -> str:
+    """Huella de las columnas que determinan la numeración (cambia con cada versión de datos)."""
+    columns = [col for col in FLOW_NUMBER_INPUT_COLUMNS if col in df.columns]
+    digest = hashlib.sha1(f"{len(df)}|{'|'.join(columns)}".encode("utf-8"))
+    if columns and not df.empty:
+        hashed = pd.util.hash_pandas_object(df[columns].astype(str), index=False)
+        digest.update(hashed.to_numpy().tobytes())
+    return digest.hexdigest()
+
+
+def _flow_map_from_frame(df_src: pd.DataFrame, numbers: list[str], out: dict[str, str]) -> None:
+    """Registra ``numbers`` bajo las claves fila/ID/folio de cada fila; la primera gana."""
+    def _match_key(raw) -> str:
+        return raw if isinstance(raw, str) and raw.startswith("row:") else _flow_match_key(raw)
+
+    def _values(column: str) -> list:
+        return df_src[column].tolist() if column in df_src.columns else [""] * len(df_src)
+
+    keys_by_row = zip(
+        _flow_row_keys(df_src),
+        _map_distinct_values(_values("ID_Pedido"), _match_key),
+        _map_distinct_values(_values("Folio_Factura"), _match_key),
+    )
+    for row_keys, numero in zip(keys_by_row, numbers):
+        for key in row_keys:
+            if key and key not in out:
+                out[key] = numero
+
+
 def _build_flow_number_maps(df_all: pd.DataFrame) -> tuple[dict[str, str], dict[str, str]]:
     if df_all.empty:
         return {}, {}
 
+    memo_key = _flow_number_fingerprint(df_all)
+    memo = _get_flow_number_cache()["maps"]
+    cached = memo.get(memo_key)
+    if cached is None:
+        cached = _compute_flow_number_maps(df_all)
+        memo[memo_key] = cached
+        while len(memo) > FLOW_NUMBER_MAPS_KEEP:
+            memo.pop(next(iter(memo)), None)
+    map_local, foraneo_map = cached
+    return dict(map_local), dict(foraneo_map)
+
+
+def _compute_flow_number_maps(df_all: pd.DataFrame) -> tuple[dict[str, str], dict[str, str]]:
     work = df_all.copy()
     if "Tipo_Envio" not in work.columns:
         work["Tipo_Envio"] = ""
@@ -1664,23 +1943,11 @@ def _build_flow_number_maps(df_all: pd.DataFrame) -> tuple[dict[str, str], dict[
     df_foraneo = work[mask_foraneo].reset_index(drop=True)
     df_local = work[~mask_foraneo].reset_index(drop=True)
 
-    def build_map(df_src: pd.DataFrame, formatter) -> dict[str, str]:
-        out: dict[str, str] = {}
-        for idx, row in df_src.iterrows():
-            numero = formatter(idx)
-            row_key = _flow_row_key_from_row(row)
-            for raw_key in (row_key, row.get("ID_Pedido", ""), row.get("Folio_Factura", "")):
-                key = raw_key if isinstance(raw_key, str) and raw_key.startswith("row:") else _flow_match_key(raw_key)
-                if key and key not in out:
-                    out[key] = numero
-        return out
-
     map_local: dict[str, str] = {}
     if not df_local.empty:
-        df_local_base = df_local.copy()
-        mask_local_puro = df_local_base["Tipo_Envio"].astype(str).str.strip().eq("📍 Pedido Local")
-        df_local_turno_reset = df_local_base[mask_local_puro].copy()
-        df_local_otro = df_local_base[~mask_local_puro].copy()
+        mask_local_puro = df_local["Tipo_Envio"].astype(str).str.strip().eq("📍 Pedido Local")
+        df_local_turno_reset = df_local[mask_local_puro].copy()
+        df_local_otro = df_local[~mask_local_puro].reset_index(drop=True)
 
         if not df_local_turno_reset.empty:
             df_local_turno_reset["_turno_local_norm"] = (
@@ -1691,31 +1958,22 @@ def _build_flow_number_maps(df_all: pd.DataFrame) -> tuple[dict[str, str], dict[
                 df_local_turno_reset.get("Fecha_Entrega", ""), errors="coerce"
             ).dt.strftime("%Y-%m-%d")
             df_local_turno_reset["_fecha_local_norm"] = df_local_turno_reset["_fecha_local_norm"].fillna("sin_fecha")
-            df_local_turno_reset["_sort_dt"] = df_local_turno_reset.apply(compute_sort_key, axis=1)
+            df_local_turno_reset["_sort_dt"] = compute_sort_keys(df_local_turno_reset)
             df_local_turno_reset = df_local_turno_reset.sort_values(
                 by=["_turno_local_norm", "_fecha_local_norm", "_sort_dt"], kind="mergesort"
             ).reset_index(drop=True)
 
-            counters_by_bucket: dict[tuple[str, str], int] = {}
-            for _, row in df_local_turno_reset.iterrows():
-                turno = str(row.get("_turno_local_norm", "")).strip() or "sin_turno"
-                fecha = str(row.get("_fecha_local_norm", "")).strip() or "sin_fecha"
-                bucket = (turno, fecha)
-                counters_by_bucket[bucket] = counters_by_bucket.get(bucket, 0) + 1
-                numero = str(counters_by_bucket[bucket])
-                row_key = _flow_row_key_from_row(row)
-                for raw_key in (row_key, row.get("ID_Pedido", ""), row.get("Folio_Factura", "")):
-                    key = raw_key if isinstance(raw_key, str) and raw_key.startswith("row:") else _flow_match_key(raw_key)
-                    if key and key not in map_local:
-                        map_local[key] = numero
+            # Contador por turno/fecha: posición dentro de su cubeta ya ordenada.
+            numeros_turno = (
+                df_local_turno_reset.groupby(["_turno_local_norm", "_fecha_local_norm"], sort=False).cumcount() + 1
+            )
+            _flow_map_from_frame(df_local_turno_reset, numeros_turno.astype(str).tolist(), map_local)
 
         if not df_local_otro.empty:
-            map_local_fallback = build_map(df_local_otro.reset_index(drop=True), lambda idx: str(idx + 1))
-            for key, numero in map_local_fallback.items():
-                if key and key not in map_local:
-                    map_local[key] = numero
+            _flow_map_from_frame(df_local_otro, [str(idx + 1) for idx in range(len(df_local_otro))], map_local)
 
-    foraneo_map = build_map(df_foraneo, lambda idx: f"{idx + 1:02d}")
+    foraneo_map: dict[str, str] = {}
+    _flow_map_from_frame(df_foraneo, [f"{idx + 1:02d}" for idx in range(len(df_foraneo))], foraneo_map)
     return map_local, foraneo_map
 
 
@@ -2028,7 +2286,7 @@ def add_missing_en_proceso_casos_for_surtidores(
     local_entries: list[dict], foraneo_entries: list[dict]
 ) -> tuple[list[dict], list[dict]]:
     """Agrega casos_especiales En Proceso sin surtidor que no llegaron por el flujo automático."""
-    df_casos = load_casos_from_gsheets()
+    df_casos = load_casos_from_gsheets(get_sheet_snapshot_version(GOOGLE_SHEET_ID, SHEET_CASOS))
     if df_casos.empty:
         return local_entries, foraneo_entries
 
@@ -2918,7 +3176,7 @@ def _etiqueta_tipo_caso(valor: str) -> str:
 
 
 def get_casos_orders(df_all: pd.DataFrame) -> pd.DataFrame:
-    df_casos = load_casos_from_gsheets()
+    df_casos = load_casos_from_gsheets(get_sheet_snapshot_version(GOOGLE_SHEET_ID, SHEET_CASOS))
     if df_casos.empty:
         df_casos = pd.DataFrame()
     else:
@@ -3303,6 +3561,8 @@ def get_s3_client():
             aws_access_key_id=AWS_ACCESS_KEY_ID,
             aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
             region_name=AWS_REGION,
+            # Opcional: S3 local compatible (MinIO, moto) para pruebas.
+            endpoint_url=AWS_CREDENTIALS.get("endpoint_url") or None,
         )
     except Exception as e:
         st.error(f"❌ Error al inicializar cliente S3: {e}")
@@ -3377,6 +3637,20 @@ def refresh_main_sheet_handles() -> bool:
         return False
 
 
+# --- Gobernador de cuota de Google Sheets ---
+# Vive en ``sheets_quota`` y lo comparten las tres apps; aquí solo se registra la
+# cuenta de servicio para las cuotas por usuario.
+try:
+    set_sheets_quota_user(st.secrets["gsheets"]["google_credentials"])
+except Exception:
+    pass
+
+
+def _sheets_read_priority() -> str:
+    """Las pantallas kiosko leen con prioridad baja para no competir con el almacén."""
+    return "kiosk" if _is_silent_kiosk_user() else "interactive_read"
+
+
 # --- Carga de datos ---
 def _is_silent_kiosk_user() -> bool:
     """Indica si la vista actual debe ocultar avisos operativos en pantallas kiosk."""
@@ -3386,10 +3660,10 @@ def _is_silent_kiosk_user() -> bool:
 def _fetch_with_retry(worksheet, cache_key: str, max_attempts: int = 4):
     """Lee datos de una worksheet con reintentos y respaldo local.
 
-    Cuando Google Sheets responde con un 429 (límite de cuota) se realizan
-    reintentos exponenciales. Si todos los intentos fallan pero se cuenta con
-    datos almacenados en la sesión, se devuelven como último recurso para evitar
-    detener la aplicación.
+    Cada intento pasa por el gobernador de cuota; tras un 429 (límite de cuota) o
+    sin tokens disponibles se devuelven los datos almacenados en la sesión sin
+    llamar a la API, o ``SheetsQuotaUnavailable`` si aún no hay ninguno. Si todos
+    los intentos fallan por otros errores también se usa el último dato.
     """
 
     def _is_rate_limit_error(error: Exception) -> bool:
@@ -3401,7 +3675,13 @@ def _fetch_with_retry(worksheet, cache_key: str, max_attempts: int = 4):
 
     last_success = st.session_state.get(cache_key)
     last_error: Optional[Exception] = None
+    priority = _sheets_read_priority()
     for attempt in range(1, max_attempts + 1):
+        if not acquire_sheets_quota("read", priority):
+            # Sin cuota libre para esta prioridad: se sirve el último dato sin llamar a la API.
+            if last_success is not None:
+                return last_success
+            raise SheetsQuotaUnavailable("Sin cuota de lectura de Google Sheets")
         try:
             data = worksheet.get_all_values()
             st.session_state[cache_key] = data
@@ -3411,13 +3691,10 @@ def _fetch_with_retry(worksheet, cache_key: str, max_attempts: int = 4):
             if not _is_rate_limit_error(e):
                 raise
 
-            wait_time = min(30, 2 ** attempt)
-            if not _is_silent_kiosk_user():
-                st.warning(
-                    f"⚠️ Límite de lectura de Google Sheets alcanzado. "
-                    f"Reintentando en {wait_time} s (intento {attempt}/{max_attempts})."
-                )
-            time.sleep(wait_time)
+            # El siguiente intento pasa por el gobernador, que ya no tiene tokens:
+            # sirve el último dato (o avisa) sin dormir en el hilo de la sesión.
+            report_sheets_quota_exhausted("read")
+            continue
         except Exception as e:
             last_error = e
             wait_time = min(10, 2 ** attempt)
@@ -3498,6 +3775,306 @@ def _open_worksheet_with_retry(
     raise RuntimeError(f"No se pudo abrir la hoja '{sheet_name}' en Google Sheets")
 
 
+# --- Snapshot compartido por proceso (una sola lectura por worksheet) ---
+SHEET_SNAPSHOT_SHARE_SECONDS = 20
+
+
+@st.cache_resource
+def _get_sheet_snapshot_store() -> dict:
+    """Almacén por proceso con la última lectura completa de cada worksheet."""
+    return {"lock": threading.Lock(), "entries": {}}
+
+
+def _get_sheet_snapshot_entry(sheet_id: str, sheet_name: str) -> dict:
+    store = _get_sheet_snapshot_store()
+    key = (str(sheet_id), str(sheet_name))
+    with store["lock"]:
+        entry = store["entries"].get(key)
+        if entry is None:
+            entry = {
+                "lock": threading.Lock(),
+                "values": None,
+                "version": 0,
+                "fetched_at": 0.0,
+                "stale": True,
+                "sync_state": {"dirty_rows": set()},
+            }
+            store["entries"][key] = entry
+        return entry
+
+
+def get_shared_sheet_snapshot(
+    sheet_id: str,
+    sheet_name: str,
+    fetch_fn,
+    *,
+    max_age_seconds: float = SHEET_SNAPSHOT_SHARE_SECONDS,
+    incremental: bool = False,
+):
+    """Devuelve ``(valores, versión)`` compartiendo una sola lectura entre sesiones.
+
+    Solo una sesión ejecuta ``fetch_fn`` a la vez; las que llegan mientras la
+    lectura está en curso esperan y reutilizan su resultado. La versión solo
+    avanza cuando el contenido cambia respecto al snapshot anterior. Con
+    ``incremental=True`` se llama ``fetch_fn(valores_previos, sync_state)``.
+    """
+    entry = _get_sheet_snapshot_entry(sheet_id, sheet_name)
+    requested_at = time.time()
+    with entry["lock"]:
+        fetched_at = float(entry["fetched_at"] or 0)
+        if entry["values"] is not None and not entry["stale"]:
+            if fetched_at >= requested_at or (time.time() - fetched_at) < max_age_seconds:
+                return entry["values"], int(entry["version"])
+
+        if incremental:
+            values = fetch_fn(entry["values"], entry["sync_state"])
+        else:
+            values = fetch_fn()
+        if entry["values"] is None or values != entry["values"]:
+            entry["version"] = int(entry["version"]) + 1
+        entry["values"] = values
+        entry["fetched_at"] = time.time()
+        entry["stale"] = False
+        return values, int(entry["version"])
+
+
+def invalidate_sheet_snapshot(
+    sheet_id: str,
+    sheet_name: Optional[str] = None,
+    *,
+    row_indexes=None,
+    full_resync: bool = False,
+) -> None:
+    """Marca como vencido el snapshot para que la siguiente lectura vaya a Sheets.
+
+    ``row_indexes`` registra filas escritas para que la sincronización incremental
+    las vuelva a leer; ``full_resync`` obliga a una lectura completa.
+    """
+    store = _get_sheet_snapshot_store()
+    with store["lock"]:
+        for (entry_sheet_id, entry_sheet_name), entry in store["entries"].items():
+            if entry_sheet_id != str(sheet_id):
+                continue
+            if sheet_name is not None and entry_sheet_name != str(sheet_name):
+                continue
+            entry["stale"] = True
+            if full_resync:
+                entry["sync_state"]["force_full"] = True
+            if row_indexes:
+                entry["sync_state"]["dirty_rows"].update(int(idx) for idx in row_indexes if int(idx) > 1)
+
+
+def get_sheet_snapshot_version(sheet_id: str, sheet_name: str) -> int:
+    """Versión del último snapshot leído para la worksheet (0 si aún no hay lectura)."""
+    return int(_get_sheet_snapshot_entry(sheet_id, sheet_name)["version"])
+
+
+# --- Sincronización incremental (delta) de la hoja de pedidos ---
+DELTA_SYNC_SHEETS = {SHEET_PEDIDOS}
+DELTA_SYNC_FULL_RESYNC_SECONDS = 900
+DELTA_SYNC_BLOCK_ROWS = 200
+DELTA_SYNC_MAX_RANGES = 60
+DELTA_SYNC_HOT_DAYS = 2
+DELTA_SYNC_COLD_ESTADOS = {"🟢 Completado", "🟣 Cancelado", "✅ Viajó"}
+DRIVE_FILES_API_URL = "https://www.googleapis.com/drive/v3/files"
+SHEETS_VALUES_BATCH_GET_URL = "https://sheets.googleapis.com/v4/spreadsheets/{}/values:batchGet"
+
+
+def _sheet_a1_range(sheet_name: str, a1_range: str) -> str:
+    safe_name = str(sheet_name).replace("'", "''")
+    return f"'{safe_name}'!{a1_range}"
+
+
+def _values_batch_get(spreadsheet_obj, ranges: list[str]) -> list[list[list[str]]]:
+    """Lee varios rangos A1 en una sola llamada ``values:batchGet`` (``SheetsQuotaUnavailable`` sin cuota)."""
+    if not ranges:
+        return []
+    if not acquire_sheets_quota("read", _sheets_read_priority()):
+        raise SheetsQuotaUnavailable("Sin cuota de lectura de Google Sheets")
+    if hasattr(spreadsheet_obj, "values_batch_get"):
+        response = spreadsheet_obj.values_batch_get(ranges)
+    else:
+        # gspread 3.1.0 no expone batchGet; se usa la sesión autorizada del cliente.
+        response = spreadsheet_obj.client.request(
+            "get",
+            SHEETS_VALUES_BATCH_GET_URL.format(spreadsheet_obj.id),
+            params={"ranges": list(ranges), "majorDimension": "ROWS"},
+        ).json()
+    value_ranges = response.get("valueRanges", []) if isinstance(response, dict) else []
+    return [list(item.get("values", []) or []) for item in value_ranges]
+
+
+def _drive_modified_time(client, file_id: str) -> str:
+    """``modifiedTime`` de Drive del spreadsheet; cadena vacía si no se pudo consultar."""
+    try:
+        response = client.request(
+            "get",
+            f"{DRIVE_FILES_API_URL}/{file_id}",
+            params={"fields": "modifiedTime", "supportsAllDrives": "true"},
+        )
+        return str(response.json().get("modifiedTime", "") or "")
+    except Exception:
+        return ""
+
+
+def _compress_row_numbers(row_numbers) -> list[tuple[int, int]]:
+    """Agrupa números de fila consecutivos en rangos [inicio, fin]."""
+    ordered = sorted({int(n) for n in row_numbers})
+    ranges: list[tuple[int, int]] = []
+    for n in ordered:
+        if ranges and n == ranges[-1][1] + 1:
+            ranges[-1] = (ranges[-1][0], n)
+        else:
+            ranges.append((n, n))
+    return ranges
+
+
+def _delta_sync_hot_rows(previous_values: list[list[str]]) -> set[int]:
+    """Filas (1-based) de los bloques que aún pueden cambiar (no todos en estado final antiguo)."""
+    headers = previous_values[0]
+    data_rows = previous_values[1:]
+    total = len(data_rows)
+    if not total:
+        return set()
+    if "Estado" not in headers or "Fecha_Completado" not in headers:
+        return set(range(2, total + 2))
+
+    estado_idx = headers.index("Estado")
+    fecha_idx = headers.index("Fecha_Completado")
+    estados = pd.Series([row[estado_idx] if estado_idx < len(row) else "" for row in data_rows])
+    fechas = pd.to_datetime(
+        pd.Series([row[fecha_idx] if fecha_idx < len(row) else "" for row in data_rows]),
+        errors="coerce",
+    )
+    cutoff = pd.Timestamp(datetime.now(TZ).replace(tzinfo=None) - timedelta(days=DELTA_SYNC_HOT_DAYS))
+    cold_flags = (
+        estados.astype(str).str.strip().isin(DELTA_SYNC_COLD_ESTADOS) & fechas.notna() & (fechas < cutoff)
+    ).to_numpy()
+
+    hot_rows: set[int] = set()
+    for start in range(0, total, DELTA_SYNC_BLOCK_ROWS):
+        end = min(start + DELTA_SYNC_BLOCK_ROWS, total)
+        if not cold_flags[start:end].all():
+            hot_rows.update(range(start + 2, end + 2))
+    return hot_rows
+
+
+def _delta_sync_sheet_values(worksheet, sheet_name: str, previous_values, sync_state: dict):
+    """Actualiza el snapshot leyendo solo los rangos que pueden haber cambiado.
+
+    Sondea siempre encabezados + columnas ``ID_Pedido`` y ``Estado`` (el
+    ``modifiedTime`` de Drive puede tardar en reflejar una edición) para detectar
+    filas nuevas, movidas o frías que cambiaron de estado, y lee en un solo
+    ``batchGet`` los bloques calientes, esas filas y la cola nueva. Devuelve
+    ``None`` cuando se requiere una lectura completa.
+    """
+    if not previous_values or sync_state.get("force_full"):
+        return None
+    if time.time() - float(sync_state.get("full_at", 0) or 0) > DELTA_SYNC_FULL_RESYNC_SECONDS:
+        return None
+
+    headers = list(previous_values[0])
+    if "ID_Pedido" not in headers:
+        return None
+    width = len(headers)
+    id_idx = headers.index("ID_Pedido")
+    estado_idx = headers.index("Estado") if "Estado" in headers else None
+    spreadsheet_obj = worksheet.spreadsheet
+
+    dirty_rows = set(sync_state.get("dirty_rows", set()))
+    probe_ranges = [_sheet_a1_range(sheet_name, "1:1")]
+    for col_idx in (id_idx, estado_idx):
+        if col_idx is not None:
+            col_letter = gspread.utils.rowcol_to_a1(1, col_idx + 1)[:-1]
+            probe_ranges.append(_sheet_a1_range(sheet_name, f"{col_letter}:{col_letter}"))
+    probe = _values_batch_get(spreadsheet_obj, probe_ranges)
+    if len(probe) != len(probe_ranges):
+        return None
+    live_headers = list(probe[0][0]) if probe[0] else []
+    if len(live_headers) > width or live_headers + [""] * (width - len(live_headers)) != headers:
+        return None
+
+    live_ids = [str(row[0]).strip() if row else "" for row in probe[1][1:]]
+    previous_ids = [str(row[id_idx]).strip() if id_idx < len(row) else "" for row in previous_values[1:]]
+    if len(live_ids) < len(previous_ids) or live_ids[:len(previous_ids)] != previous_ids:
+        return None
+
+    previous_total = len(previous_values)
+    live_total = len(live_ids) + 1
+    rows_to_fetch = _delta_sync_hot_rows(previous_values)
+    if estado_idx is not None:
+        # Una fila fría cuyo Estado cambió vuelve a estar caliente: se relee completa.
+        live_estados = [str(row[0]).strip() if row else "" for row in probe[2][1:]]
+        for offset, row in enumerate(previous_values[1:]):
+            previous_estado = str(row[estado_idx]).strip() if estado_idx < len(row) else ""
+            live_estado = live_estados[offset] if offset < len(live_estados) else ""
+            if live_estado != previous_estado:
+                rows_to_fetch.add(offset + 2)
+    rows_to_fetch.update(row for row in dirty_rows if 1 < row <= live_total)
+    rows_to_fetch.update(range(previous_total + 1, live_total + 1))
+    ranges = _compress_row_numbers(rows_to_fetch)
+    if len(ranges) > DELTA_SYNC_MAX_RANGES:
+        return None
+
+    last_col_letter = gspread.utils.rowcol_to_a1(1, width)[:-1]
+    fetched_blocks = _values_batch_get(
+        spreadsheet_obj,
+        [_sheet_a1_range(sheet_name, f"A{start}:{last_col_letter}{end}") for start, end in ranges],
+    )
+    if len(fetched_blocks) != len(ranges):
+        return None
+
+    values = list(previous_values)
+    values.extend([[""] * width for _ in range(live_total - previous_total)])
+    for (start, end), block in zip(ranges, fetched_blocks):
+        for offset, row_number in enumerate(range(start, end + 1)):
+            row = [str(v) for v in block[offset]] if offset < len(block) else []
+            if len(row) > width:
+                return None
+            values[row_number - 1] = row + [""] * (width - len(row))
+
+    while len(values) > 1 and not any(str(v).strip() for v in values[-1]):
+        values.pop()
+
+    sync_state["dirty_rows"].difference_update(dirty_rows)
+    return values
+
+
+def _sync_sheet_values(worksheet, sheet_name: str, cache_key: str, previous_values, sync_state: dict):
+    """Lectura del snapshot: incremental para la hoja de pedidos, completa como respaldo."""
+    if sheet_name in DELTA_SYNC_SHEETS:
+        try:
+            values = _delta_sync_sheet_values(worksheet, sheet_name, previous_values, sync_state)
+        except SheetsQuotaUnavailable:
+            # Sin cuota no se intenta la lectura completa: se sirve el snapshot previo.
+            return previous_values
+        except Exception:
+            values = None
+        if values is not None:
+            return values
+
+    pending_dirty_rows = set(sync_state.get("dirty_rows", set()))
+    values = _fetch_with_retry(worksheet, cache_key)
+    sync_state["full_at"] = time.time()
+    sync_state["force_full"] = False
+    sync_state["dirty_rows"].difference_update(pending_dirty_rows)
+    return values
+
+
+def _fetch_shared_sheet_values(worksheet, sheet_name: str, cache_key: str):
+    """Lee una worksheet del spreadsheet principal a través del snapshot compartido."""
+    data, version = get_shared_sheet_snapshot(
+        GOOGLE_SHEET_ID,
+        sheet_name,
+        lambda previous_values, sync_state: _sync_sheet_values(
+            worksheet, sheet_name, cache_key, previous_values, sync_state
+        ),
+        incremental=True,
+    )
+    st.session_state[cache_key] = data
+    return data, version
+
+
 def _warn_and_get_dataframe_fallback(cache_key: str, label: str) -> pd.DataFrame:
     fallback_df = st.session_state.get(cache_key)
     warning_key = f"_warn_once_{cache_key}"
@@ -3519,25 +4096,76 @@ def _worksheet_by_name(sheet_name: str):
     return worksheet_main
 
 
-def _get_column_index_cached(sheet_name: str, column_name: str) -> Optional[int]:
-    cache = st.session_state.setdefault("_sheet_col_index_cache", {})
-    cache_key = f"{sheet_name}::{column_name}"
-    cached = cache.get(cache_key)
-    if isinstance(cached, int) and cached > 0:
-        return cached
+# --- Registro de encabezados compartido entre sesiones ---
+# La fila 1 se valida contra la huella del snapshot compartido (sin lecturas extra)
+# y solo se relee cuando no hay registro, venció o una escritura falló.
+HEADER_REGISTRY_MAX_AGE_SECONDS = 600
+
+
+@st.cache_resource
+def _get_header_registry() -> dict:
+    """Encabezados vigentes por worksheet del spreadsheet principal."""
+    return {"lock": threading.Lock(), "entries": {}}
+
+
+def _headers_fingerprint(headers) -> str:
+    trimmed = [str(h or "").strip() for h in headers]
+    while trimmed and not trimmed[-1]:
+        trimmed.pop()
+    return hashlib.sha1("\x1f".join(trimmed).encode("utf-8")).hexdigest()
+
+
+def _get_registered_headers(sheet_name: str) -> Optional[list]:
+    registry = _get_header_registry()
+    now = time.time()
+    with registry["lock"]:
+        entry = registry["entries"].get(sheet_name)
+
+    snapshot = _get_sheet_snapshot_entry(GOOGLE_SHEET_ID, sheet_name)
+    snapshot_values = snapshot["values"]
+    if entry and (now - float(entry["loaded_at"])) < HEADER_REGISTRY_MAX_AGE_SECONDS:
+        if not snapshot_values or not snapshot_values[0]:
+            return entry["headers"]
+        if _headers_fingerprint(snapshot_values[0]) == entry["fingerprint"]:
+            return entry["headers"]
+        if float(snapshot["fetched_at"] or 0) > float(entry["loaded_at"]):
+            headers = list(snapshot_values[0])
+            with registry["lock"]:
+                registry["entries"][sheet_name] = {
+                    "headers": headers,
+                    "fingerprint": _headers_fingerprint(headers),
+                    "loaded_at": float(snapshot["fetched_at"]),
+                }
+            return headers
 
     ws = _worksheet_by_name(sheet_name)
     try:
-        headers = ws.row_values(1)
+        if not acquire_sheets_quota("read", _sheets_read_priority()):
+            raise SheetsQuotaUnavailable("Sin cuota de lectura de Google Sheets")
+        headers = list(ws.row_values(1))
     except Exception:
         # Evita que una falla transitoria de Google Sheets tumbe toda la app.
-        return cached if isinstance(cached, int) and cached > 0 else None
-    if column_name not in headers:
-        return None
+        return entry["headers"] if entry else None
+    with registry["lock"]:
+        registry["entries"][sheet_name] = {
+            "headers": headers,
+            "fingerprint": _headers_fingerprint(headers),
+            "loaded_at": time.time(),
+        }
+    return headers
+
+
+def invalidate_header_registry(sheet_name: str) -> None:
+    registry = _get_header_registry()
+    with registry["lock"]:
+        registry["entries"].pop(sheet_name, None)
 
-    col_idx = headers.index(column_name) + 1
-    cache[cache_key] = col_idx
-    return col_idx
+
+def _get_column_index_cached(sheet_name: str, column_name: str) -> Optional[int]:
+    headers = _get_registered_headers(sheet_name)
+    if not headers or column_name not in headers:
+        return None
+    return headers.index(column_name) + 1
 
 
 def persist_surtidor_to_sheets(entries: list[dict], surtidor: str) -> tuple[int, int]:
@@ -3591,6 +4219,11 @@ def persist_surtidor_to_sheets(entries: list[dict], surtidor: str) -> tuple[int,
         ws = _worksheet_by_name(sheet_name)
         sheet_fail = 0
         for row_idx, surtidor_value, fecha_value in updates:
+            if not acquire_sheets_quota("write", "interactive_write", cost=2 if col_fecha_surtido_idx else 1):
+                # Sin cuota tras la espera de la cola: la fila se reporta como no guardada.
+                fail_count += 1
+                sheet_fail += 1
+                continue
             try:
                 ws.update_cell(row_idx, col_surtidor_idx, surtidor_value)
                 if col_fecha_surtido_idx:
@@ -3599,6 +4232,7 @@ def persist_surtidor_to_sheets(entries: list[dict], surtidor: str) -> tuple[int,
             except gspread.exceptions.APIError:
                 fail_count += 1
                 sheet_fail += 1
+                invalidate_header_registry(sheet_name)
             except AttributeError:
                 fail_count += 1
                 sheet_fail += 1
@@ -3609,6 +4243,12 @@ def persist_surtidor_to_sheets(entries: list[dict], surtidor: str) -> tuple[int,
             )
 
     if success_count:
+        for sheet_name, updates in updates_by_sheet.items():
+            invalidate_sheet_snapshot(
+                GOOGLE_SHEET_ID,
+                sheet_name,
+                row_indexes=[row_idx for row_idx, _, _ in updates],
+            )
         try:
             load_data_from_gsheets.clear()
         except Exception:
@@ -3660,23 +4300,33 @@ def persist_auditor_to_sheets(entries: list[dict], auditor: str) -> tuple[int, i
 
         ws = _worksheet_by_name(sheet_name)
         for row_idx, auditor_value, hora_value in updates:
+            if not acquire_sheets_quota("write", "interactive_write", cost=2):
+                fail_count += 1
+                continue
             try:
                 ws.update_cell(row_idx, col_auditor_idx, auditor_value)
                 ws.update_cell(row_idx, col_hora_idx, hora_value)
                 success_count += 1
             except Exception:
                 fail_count += 1
+                invalidate_header_registry(sheet_name)
+        invalidate_sheet_snapshot(
+            GOOGLE_SHEET_ID,
+            sheet_name,
+            row_indexes=[row_idx for row_idx, _, _ in updates],
+        )
     return success_count, fail_count
 
 
 @st.cache_data(ttl=60)
-def load_data_from_gsheets():
+def load_data_from_gsheets(snapshot_version: int = 0):
+    """Lee 'datos_pedidos'; ``snapshot_version`` solo forma parte de la llave de caché."""
     try:
-        data = _fetch_with_retry(worksheet_main, "_cache_datos_pedidos")
+        data, snapshot_version = _fetch_shared_sheet_values(worksheet_main, SHEET_PEDIDOS, "_cache_datos_pedidos")
     except gspread.exceptions.APIError:
         if refresh_main_sheet_handles():
             try:
-                data = _fetch_with_retry(worksheet_main, "_cache_datos_pedidos")
+                data, snapshot_version = _fetch_shared_sheet_values(worksheet_main, SHEET_PEDIDOS, "_cache_datos_pedidos")
             except Exception:
                 return _warn_and_get_dataframe_fallback("_cache_datos_pedidos_df", "los pedidos")
         else:
@@ -3684,7 +4334,7 @@ def load_data_from_gsheets():
     except RuntimeError:
         if refresh_main_sheet_handles():
             try:
-                data = _fetch_with_retry(worksheet_main, "_cache_datos_pedidos")
+                data, snapshot_version = _fetch_shared_sheet_values(worksheet_main, SHEET_PEDIDOS, "_cache_datos_pedidos")
             except Exception:
                 return _warn_and_get_dataframe_fallback("_cache_datos_pedidos_df", "los pedidos")
         else:
@@ -3697,6 +4347,7 @@ def load_data_from_gsheets():
     df = pd.DataFrame(data[1:], columns=headers)
     df["gsheet_row_index"] = df.index + 2
     df["sheet_source"] = SHEET_PEDIDOS
+    df.attrs["snapshot_version"] = snapshot_version
 
     # Tipos
     if "ID_Pedido" in df.columns:
@@ -3723,14 +4374,14 @@ def load_data_from_gsheets():
 
 
 @st.cache_data(ttl=60)
-def load_casos_from_gsheets():
-    """Lee 'casos_especiales' y normaliza headers/fechas."""
+def load_casos_from_gsheets(snapshot_version: int = 0):
+    """Lee 'casos_especiales' y normaliza headers/fechas (``snapshot_version`` es llave de caché)."""
     try:
-        data = _fetch_with_retry(worksheet_casos, "_cache_casos_especiales")
+        data, snapshot_version = _fetch_shared_sheet_values(worksheet_casos, SHEET_CASOS, "_cache_casos_especiales")
     except gspread.exceptions.APIError:
         if refresh_main_sheet_handles():
             try:
-                data = _fetch_with_retry(worksheet_casos, "_cache_casos_especiales")
+                data, snapshot_version = _fetch_shared_sheet_values(worksheet_casos, SHEET_CASOS, "_cache_casos_especiales")
             except Exception:
                 return _warn_and_get_dataframe_fallback("_cache_casos_especiales_df", "los casos especiales")
         else:
@@ -3738,7 +4389,7 @@ def load_casos_from_gsheets():
     except RuntimeError:
         if refresh_main_sheet_handles():
             try:
-                data = _fetch_with_retry(worksheet_casos, "_cache_casos_especiales")
+                data, snapshot_version = _fetch_shared_sheet_values(worksheet_casos, SHEET_CASOS, "_cache_casos_especiales")
             except Exception:
                 return _warn_and_get_dataframe_fallback("_cache_casos_especiales_df", "los casos especiales")
         else:
@@ -3765,6 +4416,7 @@ def load_casos_from_gsheets():
     df = pd.DataFrame(data[1:], columns=fixed)
     df["gsheet_row_index"] = df.index + 2
     df["sheet_source"] = SHEET_CASOS
+    df.attrs["snapshot_version"] = snapshot_version
 
     # Fechas típicas
     dt_cols = [
@@ -3873,6 +4525,7 @@ def refresh_confirmados_cache(
 
 def refresh_dashboard_sources() -> None:
     """Actualiza en bloque los orígenes que alimentan dashboard (flujo + confirmados)."""
+    invalidate_sheet_snapshot(GOOGLE_SHEET_ID, full_resync=True)
     load_data_from_gsheets.clear()
     load_casos_from_gsheets.clear()
     refresh_confirmados_cache(GSHEETS_CREDENTIALS, GOOGLE_SHEET_ID, SHEET_CONFIRMADOS)
@@ -4130,8 +4783,12 @@ def _run_facturas_faltantes_check(df_facturas: pd.DataFrame) -> dict[str, object
             "ahora": ahora,
         }
 
-    df_actual = load_data_from_gsheets().copy()
-    df_hist = load_historicos_from_gsheets().copy()
+    df_actual = load_data_from_gsheets(get_sheet_snapshot_version(GOOGLE_SHEET_ID, SHEET_PEDIDOS)).copy()
+    # Cada factura se busca en ±72 h de su fecha: solo hace falta el histórico desde
+    # 72 h antes de la factura más antigua (el día completo, para reutilizar la caché).
+    df_hist = load_historicos_from_gsheets(
+        desde=(work["Fecha_dt"].min() - timedelta(hours=72)).floor("D"),
+    ).copy()
     pedidos = pd.concat([df_actual, df_hist], ignore_index=True, sort=False)
     if pedidos.empty:
         no_encontradas = work[FACTURAS_FALTANTES_REQUIRED_COLUMNS].drop_duplicates().reset_index(drop=True)
@@ -4586,7 +5243,7 @@ def build_ultimos_pedidos_data(df_pedidos: pd.DataFrame, vendedor: str) -> pd.Da
     work = df_pedidos.copy() if not df_pedidos.empty else pd.DataFrame()
     if not work.empty:
         work["_origen_pedido"] = "pedidos"
-    casos = load_casos_from_gsheets()
+    casos = load_casos_from_gsheets(get_sheet_snapshot_version(GOOGLE_SHEET_ID, SHEET_CASOS))
 
     if not casos.empty:
         if "Completados_Limpiado" not in casos.columns:
@@ -4731,17 +5388,63 @@ def _render_detail_row(label: str, value):
 
 
 # --- S3 helper (solo lectura presignada aquí) ---
+# Las URLs prefirmadas se reutilizan hasta un margen antes de expirar en lugar de
+# firmarse de nuevo para cada adjunto en cada rerun; LRU acotado por proceso.
+PRESIGNED_URL_EXPIRES_SECONDS = 3600
+PRESIGNED_URL_CACHE_MAX = 5000
+PRESIGNED_URL_SAFETY_MARGIN_SECONDS = 900
+
+
+@st.cache_resource
+def _get_presigned_url_cache() -> dict:
+    """Caché LRU de URLs prefirmadas compartida por todas las sesiones del proceso."""
+    return {"lock": threading.Lock(), "urls": OrderedDict()}
+
+
+def get_s3_file_urls(s3_object_keys) -> list:
+    """URLs prefirmadas para varias keys (``None`` si falla); firma solo las que no están en caché."""
+    cache = _get_presigned_url_cache()
+    now = time.time()
+    reuse_seconds = PRESIGNED_URL_EXPIRES_SECONDS - PRESIGNED_URL_SAFETY_MARGIN_SECONDS
+    keys = list(s3_object_keys)
+    urls = [None] * len(keys)
+    with cache["lock"]:
+        for pos, key in enumerate(keys):
+            entry = cache["urls"].get((S3_BUCKET_NAME, key)) if key else None
+            if entry and entry[1] > now:
+                cache["urls"].move_to_end((S3_BUCKET_NAME, key))
+                urls[pos] = entry[0]
+
+    signed = {}
+    for pos, key in enumerate(keys):
+        if urls[pos] is not None or not key:
+            continue
+        if key not in signed:
+            try:
+                signed[key] = s3_client.generate_presigned_url(
+                    "get_object",
+                    Params={"Bucket": S3_BUCKET_NAME, "Key": key},
+                    ExpiresIn=PRESIGNED_URL_EXPIRES_SECONDS,
+                )
+            except Exception:
+                signed[key] = None
+        urls[pos] = signed[key]
+
+    if signed:
+        with cache["lock"]:
+            for key, url in signed.items():
+                if url:
+                    cache["urls"][(S3_BUCKET_NAME, key)] = (url, now + reuse_seconds)
+                    cache["urls"].move_to_end((S3_BUCKET_NAME, key))
+            while len(cache["urls"]) > PRESIGNED_URL_CACHE_MAX:
+                cache["urls"].popitem(last=False)
+    return urls
+
+
 def get_s3_file_url(s3_object_key):
     if not s3_object_key:
         return None
-    try:
-        return s3_client.generate_presigned_url(
-            "get_object",
-            Params={"Bucket": S3_BUCKET_NAME, "Key": s3_object_key},
-            ExpiresIn=3600,
-        )
-    except Exception:
-        return None
+    return get_s3_file_urls([s3_object_key])[0]
 
 
 def display_attachments(adjuntos_str):
@@ -4757,6 +5460,8 @@ def display_attachments(adjuntos_str):
         return urlunsplit((parsed.scheme, parsed.netloc, encoded_path, encoded_query, encoded_fragment))
 
     parts = [p.strip() for p in str(adjuntos_str).split(",") if p.strip()]
+    s3_keys = [p for p in parts if not (p.startswith("http://") or p.startswith("https://"))]
+    s3_urls = dict(zip(s3_keys, get_s3_file_urls(s3_keys)))
     links = []
     for p in parts:
         if p.startswith("http://") or p.startswith("https://"):
@@ -4764,7 +5469,7 @@ def display_attachments(adjuntos_str):
             name = p.split("/")[-1] or "archivo"
             links.append(f"[{name}]({safe_url})")
         else:
-            url = get_s3_file_url(p)
+            url = s3_urls.get(p)
             name = p.split("/")[-1] or "archivo"
             links.append(f"[{name}]({_encode_url(url)})" if url else f"❌ {p}")
     return " | ".join(links) if links else "N/A"
@@ -5080,29 +5785,73 @@ if "show_grouped_panel_casos" not in globals():
                     )
 
 
-def refresh_kiosk_sources_once_per_minute(user_key: str) -> None:
-    """Fuerza lectura fresca para pantallas kiosk una sola vez por minuto."""
-    if not is_kiosk_user(user_key):
-        return
+# --- Canal de cambios para pantallas kiosko ---
+# En lugar de limpiar las cachés globales cada minuto, un fragmento por pantalla
+# consulta cada ``KIOSK_MIN_REFRESH_SECONDS`` la versión del snapshot compartido.
+# La comprobación contra Drive (``modifiedTime``) se hace una vez por proceso y
+# solo cuando el spreadsheet cambió se relee la hoja; las pantallas se vuelven a
+# pintar únicamente si cambió la versión de pedidos o de casos que muestran.
+# ``modifiedTime`` también cambia por hojas que el kiosko no pinta, así que no
+# forma parte de la comparación.
+KIOSK_MIN_REFRESH_SECONDS = max(5, int(os.environ.get("KIOSK_MIN_REFRESH_SECONDS", "20") or 20))
+KIOSK_FORCE_RERENDER_SECONDS = 300
 
-    minute_key = datetime.now(TZ).strftime("%Y%m%d%H%M")
-    state_key = "_kiosk_sources_refresh_minute"
-    if st.session_state.get(state_key) == minute_key:
-        return
 
-    load_data_from_gsheets.clear()
-    load_casos_from_gsheets.clear()
-    st.session_state[state_key] = minute_key
-    st.session_state["_kiosk_sources_last_refresh"] = datetime.now(TZ).strftime(
-        "%Y-%m-%d %H:%M:%S %Z"
-    )
+@st.cache_resource
+def _get_kiosk_change_feed() -> dict:
+    """Estado del canal de cambios compartido por todas las sesiones del proceso."""
+    return {"lock": threading.Lock(), "checked_at": 0.0, "modified_time": None}
+
+
+def poll_kiosk_change_feed() -> tuple[int, int]:
+    """Devuelve ``(versión pedidos, versión casos)`` refrescando como máximo una vez por periodo."""
+    feed = _get_kiosk_change_feed()
+    with feed["lock"]:
+        if time.time() - float(feed["checked_at"]) >= KIOSK_MIN_REFRESH_SECONDS:
+            feed["checked_at"] = time.time()
+            modified_time = _drive_modified_time(worksheet_main.spreadsheet.client, GOOGLE_SHEET_ID)
+            if not modified_time or modified_time != feed["modified_time"]:
+                invalidate_sheet_snapshot(GOOGLE_SHEET_ID, SHEET_PEDIDOS)
+                invalidate_sheet_snapshot(GOOGLE_SHEET_ID, SHEET_CASOS)
+                try:
+                    _fetch_shared_sheet_values(worksheet_main, SHEET_PEDIDOS, "_cache_datos_pedidos")
+                    _fetch_shared_sheet_values(worksheet_casos, SHEET_CASOS, "_cache_casos_especiales")
+                    feed["modified_time"] = modified_time
+                except (SheetsQuotaUnavailable, gspread.exceptions.APIError):
+                    pass  # sin cuota o error de la API: se reintenta en el siguiente periodo
+        return (
+            get_sheet_snapshot_version(GOOGLE_SHEET_ID, SHEET_PEDIDOS),
+            get_sheet_snapshot_version(GOOGLE_SHEET_ID, SHEET_CASOS),
+        )
+
+
+def begin_kiosk_render(user_key: str) -> None:
+    """Marca el inicio de un render completo; las pantallas kiosko toman antes lo más reciente del canal."""
+    st.session_state["_kiosk_full_run"] = int(st.session_state.get("_kiosk_full_run", 0)) + 1
+    if is_kiosk_user(user_key):
+        poll_kiosk_change_feed()
+
+
+@st.fragment(run_every=KIOSK_MIN_REFRESH_SECONDS)
+def kiosk_change_watcher(view_key: str) -> None:
+    """Vuelve a pintar la vista completa solo cuando cambiaron sus datos (o tras ``KIOSK_FORCE_RERENDER_SECONDS``)."""
+    versions = poll_kiosk_change_feed()
+    state = st.session_state.setdefault("_kiosk_watchers", {})
+    full_run = int(st.session_state.get("_kiosk_full_run", 0))
+    seen = state.get(view_key)
+    if seen is None or seen["run"] != full_run:
+        # Primera ejecución dentro de un render completo: esa es la versión pintada.
+        state[view_key] = {"run": full_run, "versions": versions, "at": time.time()}
+        return
+    if versions != seen["versions"] or time.time() - float(seen["at"]) >= KIOSK_FORCE_RERENDER_SECONDS:
+        st.rerun()
 
 
 # ===========================
 #        MAIN RENDER
 # ===========================
-refresh_kiosk_sources_once_per_minute(get_logged_user().upper())
-df_all = load_data_from_gsheets()
+begin_kiosk_render(get_logged_user().upper())
+df_all = load_data_from_gsheets(get_sheet_snapshot_version(GOOGLE_SHEET_ID, SHEET_PEDIDOS))
 
 # Tabs principales
 TAB_DEFINITIONS = [
@@ -5614,7 +6363,7 @@ def render_kiosk_auto_local_view(auto_local_entries: list[dict]) -> None:
                 min_content_height=40,
             )
 
-    st_autorefresh(interval=60000, key="auto_refresh_local_kiosk")
+    kiosk_change_watcher("kiosk_local")
 
 
 FORANEO_FOUR_COLUMN_THRESHOLD = 55
@@ -5704,7 +6453,7 @@ def render_kiosk_auto_foraneo_view(auto_foraneo_entries: list[dict]) -> None:
                 compact_foraneo_overflow=hoy_chunk_count == 3,
             )
 
-    st_autorefresh(interval=60000, key="auto_refresh_foraneo_kiosk")
+    kiosk_change_watcher("kiosk_foraneo")
 
 
 if is_kiosk_mode:
@@ -5785,8 +6534,7 @@ if selected_tab_key == "assistant":
         st.caption("Atendiendo como recepción (consulta general).")
 
     # Fuentes para el asistente interno
-    df_casos_assistant = load_casos_from_gsheets()
-    df_hist = load_historicos_from_gsheets()
+    df_casos_assistant = load_casos_from_gsheets(get_sheet_snapshot_version(GOOGLE_SHEET_ID, SHEET_CASOS))
     df_productos_assistant = load_productos_from_gsheets()
     remote_postal_codes = load_remote_postal_codes()
 
@@ -5852,6 +6600,17 @@ if selected_tab_key == "assistant":
                 with st.chat_message("assistant"):
                     with st.spinner("Pensando..."):
                         try:
+                            # El histórico se lee solo al preguntar y con las columnas del contexto;
+                            # el del vendedor logueado se filtra dentro del Parquet.
+                            df_hist = load_historicos_from_gsheets(TD_ASSISTANT_HISTORICO_COLUMNS)
+                            df_hist_vendedor = None
+                            if logged_vendor_assistant:
+                                vendor_values = historico_vendor_values(logged_vendor_assistant)
+                                if vendor_values is not None:
+                                    df_hist_vendedor = load_historicos_from_gsheets(
+                                        TD_ASSISTANT_HISTORICO_COLUMNS,
+                                        vendedores=vendor_values,
+                                    )
                             assistant_reply = fetch_td_assistant_reply(
                                 user_prompt,
                                 df_all,
@@ -5861,6 +6620,7 @@ if selected_tab_key == "assistant":
                                 remote_postal_codes,
                                 image_bytes=image_bytes,
                                 image_mime_type=image_type,
+                                df_historicos_vendedor=df_hist_vendedor,
                             )
                         except ValueError:
                             assistant_reply = (
@@ -6042,7 +6802,61 @@ if selected_tab_key == "reportes_surtidores":
     st.markdown("### 📊 Reportes de surtidores")
     st.caption("Total del periodo por `Hora_Registro`; participación de surtidores sobre ese total.")
 
-    df_hist_report = load_historicos_from_gsheets()
+    # El periodo se elige antes de leer el histórico: solo se leen los meses y row
+    # groups del periodo. Las opciones salen del calendario, no de los datos.
+    hoy_mx = datetime.now(TZ).date()
+    meses_rep = set(historico_meses_disponibles())
+    if not meses_rep:
+        meses_rep = {str(p) for p in pd.period_range(end=pd.Period(hoy_mx, "M"), periods=24, freq="M")}
+    if df_all is not None and "Hora_Registro" in df_all.columns:
+        meses_rep.update(pd.to_datetime(df_all["Hora_Registro"], errors="coerce").dropna().dt.strftime("%Y-%m"))
+    meses_rep = {m for m in meses_rep if m <= hoy_mx.strftime("%Y-%m")}
+    meses_rep.add(hoy_mx.strftime("%Y-%m"))
+    calendario_rep = pd.DataFrame({"dia": pd.date_range(f"{min(meses_rep)}-01", pd.Timestamp(hoy_mx), freq="D")})
+    iso_rep = calendario_rep["dia"].dt.isocalendar()
+    calendario_rep["_iso_year"] = iso_rep.year
+    calendario_rep["_iso_week"] = iso_rep.week
+    calendario_rep["_semana_label"] = (
+        calendario_rep["_iso_year"].astype(str)
+        + "-"
+        + calendario_rep["dia"].dt.strftime("%m")
+        + " | Sem ISO "
+        + calendario_rep["_iso_week"].astype(str).str.zfill(2)
+    )
+
+    periodo = st.radio("Periodo", options=["Día", "Semana", "Mes"], horizontal=True)
+    if periodo == "Día":
+        fecha_sel = st.date_input("Fecha", value=hoy_mx, key="rep_surt_fecha")
+        rep_desde, rep_hasta = fecha_sel, fecha_sel
+        refresh_key = "rep_surt_refresh_dia"
+    elif periodo == "Semana":
+        semanas_df = (
+            calendario_rep.groupby(["_semana_label", "_iso_year", "_iso_week"], as_index=False)["dia"]
+            .agg(["min", "max"])
+            .sort_values(["_iso_year", "_iso_week"], ascending=[False, False])
+        )
+        semanas_opts = semanas_df["_semana_label"].tolist()
+        semana_sel = st.selectbox("Semana (Año-Mes + Semana ISO)", options=semanas_opts)
+        semana_row = semanas_df[semanas_df["_semana_label"] == semana_sel].iloc[0]
+        rep_desde, rep_hasta = semana_row["min"].date(), semana_row["max"].date()
+        refresh_key = "rep_surt_refresh_semana"
+    else:
+        meses = sorted(meses_rep, reverse=True)
+        mes_sel = st.selectbox("Mes", options=meses)
+        mes_periodo = pd.Period(mes_sel, "M")
+        rep_desde, rep_hasta = mes_periodo.start_time.date(), mes_periodo.end_time.date()
+        refresh_key = "rep_surt_refresh_mes"
+    if st.button("🔄 Actualizar filtro actual", key=refresh_key):
+        invalidate_sheet_snapshot(GOOGLE_SHEET_ID, full_resync=True)
+        load_historicos_from_gsheets.clear()
+        load_data_from_gsheets.clear()
+        st.rerun()
+
+    df_hist_report = load_historicos_from_gsheets(
+        ("ID_Pedido", "Folio_Factura", "Surtidor", "Fecha_Surtido", "Hora_Registro"),
+        desde=pd.Timestamp(rep_desde),
+        hasta=pd.Timestamp(rep_hasta) + pd.Timedelta(days=1) - pd.Timedelta(microseconds=1),
+    )
     frames = []
     for src_name, df_src in (("data_pedidos", df_all), ("datos_pedidos", df_hist_report)):
         if df_src is None or df_src.empty:
@@ -6086,41 +6900,14 @@ if selected_tab_key == "reportes_surtidores":
             df_rep.loc[df_rep["_id_unico"] == "", "_id_unico"] = df_rep["Folio_Factura"].map(sanitize_text)
             df_rep = df_rep.drop_duplicates(subset=["_id_unico", "_origen"], keep="last")
 
-            hoy_mx = datetime.now(TZ).date()
-            periodo = st.radio("Periodo", options=["Día", "Semana", "Mes"], horizontal=True)
-
             if periodo == "Día":
-                fechas = sorted(df_rep["_fecha"].dropna().unique().tolist(), reverse=True)
-                fecha_default = hoy_mx if hoy_mx in fechas else (fechas[0] if fechas else hoy_mx)
-                fecha_sel = st.date_input("Fecha", value=fecha_default, key="rep_surt_fecha")
-                if st.button("🔄 Actualizar filtro actual", key="rep_surt_refresh_dia"):
-                    load_historicos_from_gsheets.clear()
-                    load_data_from_gsheets.clear()
-                    st.rerun()
                 df_f = df_rep[df_rep["_fecha"] == fecha_sel].copy()
                 filtro_firma = f"Día|{fecha_sel}"
             elif periodo == "Semana":
-                semanas_df = (
-                    df_rep.groupby(["_semana_label", "_iso_year", "_iso_week"], as_index=False)
-                    .size()
-                    .sort_values(["_iso_year", "_iso_week"], ascending=[False, False])
-                )
-                semanas_opts = semanas_df["_semana_label"].tolist()
-                semana_sel = st.selectbox("Semana (Año-Mes + Semana ISO)", options=semanas_opts) if semanas_opts else ""
-                if st.button("🔄 Actualizar filtro actual", key="rep_surt_refresh_semana"):
-                    load_historicos_from_gsheets.clear()
-                    load_data_from_gsheets.clear()
-                    st.rerun()
-                df_f = df_rep[df_rep["_semana_label"] == semana_sel].copy() if semana_sel else df_rep.iloc[0:0].copy()
+                df_f = df_rep[df_rep["_semana_label"] == semana_sel].copy()
                 filtro_firma = f"Semana|{semana_sel}"
             else:
-                meses = sorted(df_rep["_mes"].dropna().unique().tolist(), reverse=True)
-                mes_sel = st.selectbox("Mes", options=meses) if meses else ""
-                if st.button("🔄 Actualizar filtro actual", key="rep_surt_refresh_mes"):
-                    load_historicos_from_gsheets.clear()
-                    load_data_from_gsheets.clear()
-                    st.rerun()
-                df_f = df_rep[df_rep["_mes"] == mes_sel].copy() if mes_sel else df_rep.iloc[0:0].copy()
+                df_f = df_rep[df_rep["_mes"] == mes_sel].copy()
                 filtro_firma = f"Mes|{mes_sel}"
 
             filtro_anterior = st.session_state.get("rep_surt_filtro_firma")
@@ -6824,7 +7611,7 @@ if selected_tab_key == "dashboard":
     if st.session_state.pop("_pending_full_refresh", False):
         refresh_dashboard_sources()
 
-    st_autorefresh(interval=60000, key="auto_refresh_dashboard")
+    kiosk_change_watcher("dashboard")
 
     hora_actual_local = datetime.now(TZ).time()
     ventana_revision_inicio = datetime.strptime("17:30", "%H:%M").time()
@@ -7257,7 +8044,9 @@ if selected_tab_key == "dashboard":
             load_historicos_from_gsheets.clear()
             st.rerun()
 
-        historial_df = load_historicos_from_gsheets()
+        historial_df = load_historicos_from_gsheets(
+            vendedores=historico_vendor_values(vendedor_sel) if vendedor_sel != "(Todos)" else None,
+        )
         if historial_df.empty:
             st.info("No hay datos disponibles en `datos_pedidos` para mostrar.")
         else:
@@ -0,0 +1,376 @@
+"""
+Histórico columnar (Parquet en S3) compartido por app_a-d, app_i-d y app_gerente.
+
+Las filas archivadas también se guardan como Parquet particionado por mes de
+Hora_Registro. Los valores se conservan como texto, igual que en Sheets, más tres
+columnas auxiliares: ``_hora_registro_ts`` (filtros por fecha con las
+estadísticas de cada row group), ``_fila_historico`` y ``_exportado_ms``. El
+manifiesto lista las partes con su mes, rango de fechas y vendedores, así los
+lectores descartan archivos completos antes de descargarlos. Las partes nunca se
+modifican: una fila editada en la hoja histórica se vuelve a exportar en una
+parte nueva y gana la versión con ``_exportado_ms`` mayor (ver
+``historico_parquet_latest``); la compactación escribe una parte nueva y cambia
+el manifiesto.
+
+app_a-d escribe al archivar, app_gerente reexporta las filas que edita y app_i-d
+y app_gerente leen. Cada app pasa su propio cliente y bucket de S3.
+"""
+
+import json
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Optional, Sequence
+
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # El histórico columnar se desactiva y se lee Sheets.
+    pa = None
+    pq = None
+
+HISTORICO_PARQUET_PREFIX = "historico/datos_pedidos"
+HISTORICO_PARQUET_MANIFEST_KEY = f"{HISTORICO_PARQUET_PREFIX}/_manifest.json"
+HISTORICO_PARQUET_ROW_GROUP_ROWS = 5000
+HISTORICO_PARQUET_COMPACT_PARTS = 8
+HISTORICO_PARQUET_MANIFEST_RETRIES = 5
+HISTORICO_PARQUET_MANIFEST_TTL_SECONDS = 60
+HISTORICO_PARQUET_PART_CACHE_MAX = 96
+HISTORICO_PARQUET_VENDOR_COLUMNS = ("Vendedor_Registro", "Vendedor")
+HISTORICO_PARQUET_AUX_COLUMNS = ("_hora_registro_ts", "_fila_historico", "_exportado_ms")
+
+# Manifiesto vigente y bytes de las partes, compartidos por el proceso. Las partes
+# son inmutables, así que se conservan; el manifiesto se relee cada minuto.
+_READ_CACHE: dict[str, Any] = {"lock": threading.Lock(), "manifests": {}, "parts": OrderedDict()}
+
+
+def historico_parquet_frame(
+    headers: Sequence[Any],
+    rows: Sequence[Sequence[Any]],
+    filas: Sequence[int],
+    exportado_ms: Optional[int] = None,
+) -> pd.DataFrame:
+    """DataFrame de texto con las columnas del histórico y las columnas auxiliares."""
+    names = [str(h or "").strip() for h in headers]
+    width = len(names)
+    keep = [i for i, name in enumerate(names) if name and name not in names[:i]]
+    data = [
+        [("" if row[i] is None else str(row[i])) if i < len(row) else "" for i in keep]
+        for row in rows
+    ]
+    df = pd.DataFrame(data, columns=[names[i] for i in keep]) if width else pd.DataFrame(index=range(len(rows)))
+    hora = pd.to_datetime(df["Hora_Registro"], errors="coerce") if "Hora_Registro" in df.columns else pd.Series(pd.NaT, index=df.index)
+    if getattr(hora.dt, "tz", None) is not None:
+        hora = hora.dt.tz_convert(None)
+    df["_hora_registro_ts"] = hora.astype("datetime64[ns]")
+    df["_fila_historico"] = pd.Series(list(filas), index=df.index, dtype="int64")
+    if exportado_ms is None:
+        exportado_ms = int(time.time() * 1000)
+    df["_exportado_ms"] = pd.Series(exportado_ms, index=df.index, dtype="int64")
+    return df
+
+
+def historico_parquet_latest(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Deja la última versión exportada de cada fila, en el orden de la hoja histórica.
+
+    Una fila se identifica por ID_Pedido o, si no tiene, por ``_fila_historico``;
+    las filas sin ninguno de los dos se conservan todas. Las partes sin
+    ``_exportado_ms`` cuentan como las más antiguas.
+    """
+    if "_exportado_ms" in df.columns:
+        version = pd.to_numeric(df["_exportado_ms"], errors="coerce").fillna(0)
+    else:
+        version = pd.Series(0, index=df.index)
+    fila = pd.to_numeric(df["_fila_historico"], errors="coerce").fillna(0).astype("int64")
+    if "ID_Pedido" in df.columns:
+        ids = df["ID_Pedido"].fillna("").astype(str).str.strip()
+    else:
+        ids = pd.Series("", index=df.index)
+    clave = ids.where(ids != "", "#fila:" + fila.astype(str))
+    orden = pd.DataFrame({"version": version, "fila": fila}).sort_values(["version", "fila"], kind="stable").index
+    clave = clave.loc[orden]
+    sin_clave = (ids.loc[orden] == "") & (fila.loc[orden] <= 0)
+    vigentes = orden[(~clave.duplicated(keep="last") | sin_clave).to_numpy()]
+    return df.loc[vigentes].sort_values("_fila_historico", kind="stable")
+
+
+def historico_parquet_month(df: pd.DataFrame) -> pd.Series:
+    return df["_hora_registro_ts"].dt.strftime("%Y-%m").fillna("sin_fecha")
+
+
+def historico_parquet_put_part(s3_client_param: Any, bucket: str, mes: str, df: pd.DataFrame) -> tuple[str, dict[str, Any]]:
+    """Sube una parte inmutable del mes y devuelve ``(key, metadatos para el manifiesto)``."""
+    sort_cols = [c for c in HISTORICO_PARQUET_VENDOR_COLUMNS if c in df.columns] + ["_hora_registro_ts"]
+    df = df.sort_values(sort_cols, kind="stable", na_position="last").reset_index(drop=True)
+    buffer = pa.BufferOutputStream()
+    pq.write_table(
+        pa.Table.from_pandas(df, preserve_index=False),
+        buffer,
+        row_group_size=HISTORICO_PARQUET_ROW_GROUP_ROWS,
+        compression="zstd",
+    )
+    key = f"{HISTORICO_PARQUET_PREFIX}/mes={mes}/part-{uuid.uuid4().hex}.parquet"
+    s3_client_param.put_object(Bucket=bucket, Key=key, Body=buffer.getvalue().to_pybytes())
+    ts = df["_hora_registro_ts"].dropna()
+    vendedores: set[str] = set()
+    for col in HISTORICO_PARQUET_VENDOR_COLUMNS:
+        if col in df.columns:
+            vendedores.update(v.strip() for v in df[col].tolist() if v.strip())
+    return key, {
+        "mes": mes,
+        "filas": int(len(df)),
+        "min_ts": ts.min().isoformat() if not ts.empty else "",
+        "max_ts": ts.max().isoformat() if not ts.empty else "",
+        "vendedores": sorted(vendedores),
+        "exportado_ms": int(df["_exportado_ms"].max()) if not df.empty else 0,
+    }
+
+
+def historico_manifest_read(s3_client_param: Any, bucket: str) -> tuple[dict[str, Any], Optional[str]]:
+    """Manifiesto actual y su ETag (``None`` si aún no existe)."""
+    try:
+        response = s3_client_param.get_object(Bucket=bucket, Key=HISTORICO_PARQUET_MANIFEST_KEY)
+    except Exception as exc:
+        if getattr(exc, "response", {}).get("Error", {}).get("Code") in ("NoSuchKey", "404"):
+            return {"version": 1, "backfill": False, "parts": {}}, None
+        raise
+    return json.loads(response["Body"].read()), response.get("ETag")
+
+
+def historico_manifest_update(s3_client_param: Any, bucket: str, mutate) -> dict[str, Any]:
+    """Aplica ``mutate(manifiesto)`` con escritura condicional (ETag) y reintenta si otro proceso ganó."""
+    for _ in range(HISTORICO_PARQUET_MANIFEST_RETRIES):
+        manifest, etag = historico_manifest_read(s3_client_param, bucket)
+        if mutate(manifest) is False:
+            return manifest
+        condition = {"IfMatch": etag} if etag else {"IfNoneMatch": "*"}
+        try:
+            s3_client_param.put_object(
+                Bucket=bucket,
+                Key=HISTORICO_PARQUET_MANIFEST_KEY,
+                Body=json.dumps(manifest, ensure_ascii=False).encode("utf-8"),
+                ContentType="application/json",
+                **condition,
+            )
+            return manifest
+        except Exception as exc:
+            code = getattr(exc, "response", {}).get("Error", {}).get("Code")
+            if code not in ("PreconditionFailed", "ConditionalRequestConflict", "412", "409"):
+                raise
+    raise RuntimeError("No se pudo actualizar el manifiesto del histórico columnar (conflictos repetidos).")
+
+
+def historico_parquet_delete(s3_client_param: Any, bucket: str, keys: Sequence[str]) -> None:
+    keys = list(keys)
+    for i in range(0, len(keys), 1000):
+        s3_client_param.delete_objects(
+            Bucket=bucket,
+            Delete={"Objects": [{"Key": key} for key in keys[i:i + 1000]], "Quiet": True},
+        )
+
+
+def _historico_parquet_compact(s3_client_param: Any, bucket: str, meses: Sequence[str]) -> None:
+    """Une en una sola parte los meses que acumulan más de ``HISTORICO_PARQUET_COMPACT_PARTS`` partes."""
+    manifest, _ = historico_manifest_read(s3_client_param, bucket)
+    for mes in meses:
+        old_keys = [key for key, meta in manifest.get("parts", {}).items() if meta.get("mes") == mes]
+        if len(old_keys) <= HISTORICO_PARQUET_COMPACT_PARTS:
+            continue
+        tables = [
+            pq.read_table(pa.BufferReader(s3_client_param.get_object(Bucket=bucket, Key=key)["Body"].read()))
+            for key in old_keys
+        ]
+        df = pa.concat_tables(tables, promote_options="default").to_pandas()
+        for col in df.columns:
+            if col not in HISTORICO_PARQUET_AUX_COLUMNS:
+                df[col] = df[col].fillna("")
+        # Las partes anteriores a ``_exportado_ms`` cuentan como la versión más antigua.
+        if "_exportado_ms" not in df.columns:
+            df["_exportado_ms"] = 0
+        df["_exportado_ms"] = pd.to_numeric(df["_exportado_ms"], errors="coerce").fillna(0).astype("int64")
+        df = historico_parquet_latest(df)
+        new_key, meta = historico_parquet_put_part(s3_client_param, bucket, mes, df)
+
+        def _swap(current: dict[str, Any]) -> bool:
+            parts = current.setdefault("parts", {})
+            if not all(key in parts for key in old_keys):
+                return False  # Otro proceso ya compactó este mes.
+            for key in old_keys:
+                parts.pop(key, None)
+            parts[new_key] = meta
+            return True
+
+        manifest = historico_manifest_update(s3_client_param, bucket, _swap)
+        if new_key in manifest.get("parts", {}):
+            historico_parquet_delete(s3_client_param, bucket, old_keys)
+        else:
+            historico_parquet_delete(s3_client_param, bucket, [new_key])
+
+
+def write_historico_parquet(s3_client_param: Any, bucket: str, df: pd.DataFrame) -> int:
+    """Agrega al histórico columnar las filas de ``df`` (de ``historico_parquet_frame``), una parte por mes."""
+    if pq is None or df.empty:
+        return 0
+    new_parts: dict[str, dict[str, Any]] = {}
+    for mes, df_mes in df.groupby(historico_parquet_month(df), sort=True):
+        key, meta = historico_parquet_put_part(s3_client_param, bucket, str(mes), df_mes)
+        new_parts[key] = meta
+    historico_manifest_update(s3_client_param, bucket, lambda manifest: manifest.setdefault("parts", {}).update(new_parts))
+    _historico_parquet_compact(s3_client_param, bucket, sorted({meta["mes"] for meta in new_parts.values()}))
+    return int(len(df))
+
+
+def refresh_historico_parquet_rows(
+    s3_client_param: Any,
+    bucket: str,
+    headers: Sequence[Any],
+    filas_valores: dict[int, Sequence[Any]],
+) -> int:
+    """
+    Vuelve a exportar filas de la hoja histórica editadas después de archivarse.
+
+    ``filas_valores`` mapea fila de la hoja → valores actuales. Sin histórico
+    columnar completo no hace nada: los lectores siguen usando Sheets.
+    """
+    if pq is None or not filas_valores:
+        return 0
+    manifest, _ = historico_manifest_read(s3_client_param, bucket)
+    if not manifest.get("backfill"):
+        return 0
+    filas = sorted(int(fila) for fila in filas_valores)
+    df = historico_parquet_frame(headers, [filas_valores[fila] for fila in filas], filas)
+    escritas = write_historico_parquet(s3_client_param, bucket, df)
+    clear_historico_parquet_cache(manifest_only=True)
+    return escritas
+
+
+def clear_historico_parquet_cache(manifest_only: bool = False) -> None:
+    """Olvida los manifiestos leídos (y, si no es ``manifest_only``, las partes descargadas)."""
+    with _READ_CACHE["lock"]:
+        _READ_CACHE["manifests"].clear()
+        if not manifest_only:
+            _READ_CACHE["parts"].clear()
+
+
+def historico_parquet_manifest(s3_client_param: Any, bucket: str) -> dict[str, Any]:
+    """Manifiesto para lectura, cacheado ``HISTORICO_PARQUET_MANIFEST_TTL_SECONDS``; ``{}`` si no se puede leer."""
+    cache = _READ_CACHE
+    with cache["lock"]:
+        cached = cache["manifests"].get(bucket)
+        if cached is not None and time.time() - cached[1] < HISTORICO_PARQUET_MANIFEST_TTL_SECONDS:
+            return cached[0]
+    try:
+        response = s3_client_param.get_object(Bucket=bucket, Key=HISTORICO_PARQUET_MANIFEST_KEY)
+        manifest = json.loads(response["Body"].read())
+    except Exception:
+        manifest = {}
+    with cache["lock"]:
+        cache["manifests"][bucket] = (manifest, time.time())
+    return manifest
+
+
+def _historico_parquet_part_bytes(s3_client_param: Any, bucket: str, key: str) -> bytes:
+    cache = _READ_CACHE
+    cache_key = (bucket, key)
+    with cache["lock"]:
+        payload = cache["parts"].get(cache_key)
+        if payload is not None:
+            cache["parts"].move_to_end(cache_key)
+            return payload
+    payload = s3_client_param.get_object(Bucket=bucket, Key=key)["Body"].read()
+    with cache["lock"]:
+        cache["parts"][cache_key] = payload
+        while len(cache["parts"]) > HISTORICO_PARQUET_PART_CACHE_MAX:
+            cache["parts"].popitem(last=False)
+    return payload
+
+
+def load_historico_columnar(
+    s3_client_param: Any,
+    bucket: str,
+    *,
+    desde=None,
+    hasta=None,
+    vendedores=None,
+    columns=None,
+    keep_row_number: bool = False,
+) -> Optional[pd.DataFrame]:
+    """
+    Lee el histórico desde el Parquet en S3, sin usar cuota de Google Sheets.
+
+    ``desde``/``hasta`` filtran por Hora_Registro: se descartan meses completos con
+    el manifiesto y row groups con sus estadísticas. ``vendedores`` filtra por
+    valor exacto de Vendedor_Registro/Vendedor y ``columns`` limita las columnas
+    leídas; ``keep_row_number`` conserva ``_fila_historico`` (fila en la hoja
+    histórica). Devuelve ``None`` si el histórico columnar aún no se generó o falta
+    pyarrow; en ese caso se lee la hoja de Sheets.
+    """
+    if pq is None:
+        return None
+    manifest = historico_parquet_manifest(s3_client_param, bucket)
+    if not manifest.get("backfill"):
+        return None
+
+    desde_ts = pd.Timestamp(desde) if desde is not None else None
+    hasta_ts = pd.Timestamp(hasta) if hasta is not None else None
+    vendor_values = sorted({str(v).strip() for v in vendedores if str(v).strip()}) if vendedores else []
+
+    keys = []
+    for key, meta in (manifest.get("parts") or {}).items():
+        min_ts, max_ts = meta.get("min_ts"), meta.get("max_ts")
+        if (desde_ts is not None or hasta_ts is not None) and not min_ts:
+            continue
+        if desde_ts is not None and pd.Timestamp(max_ts) < desde_ts:
+            continue
+        if hasta_ts is not None and pd.Timestamp(min_ts) > hasta_ts:
+            continue
+        if vendor_values and not set(vendor_values).intersection(meta.get("vendedores") or []):
+            continue
+        keys.append(key)
+    if not keys:
+        return pd.DataFrame(columns=list(columns or []))
+
+    with ThreadPoolExecutor(max_workers=min(8, len(keys))) as pool:
+        payloads = list(pool.map(lambda key: _historico_parquet_part_bytes(s3_client_param, bucket, key), keys))
+
+    conditions = []
+    if desde_ts is not None:
+        conditions.append(("_hora_registro_ts", ">=", desde_ts))
+    if hasta_ts is not None:
+        conditions.append(("_hora_registro_ts", "<=", hasta_ts))
+    frames = []
+    for payload in payloads:
+        names = set(pq.read_schema(pa.BufferReader(payload)).names)
+        if vendor_values:
+            filters = [
+                conditions + [(col, "in", vendor_values)]
+                for col in HISTORICO_PARQUET_VENDOR_COLUMNS
+                if col in names
+            ]
+            if not filters:
+                continue
+        else:
+            filters = conditions or None
+        wanted = None
+        if columns is not None:
+            wanted = [c for c in dict.fromkeys([*columns, "ID_Pedido", *HISTORICO_PARQUET_AUX_COLUMNS]) if c in names]
+        frames.append(pq.read_table(pa.BufferReader(payload), columns=wanted, filters=filters).to_pandas())
+    if not frames:
+        return pd.DataFrame(columns=list(columns or []))
+
+    df = pd.concat(frames, ignore_index=True, sort=False)
+    text_columns = [c for c in df.columns if c not in HISTORICO_PARQUET_AUX_COLUMNS]
+    df[text_columns] = df[text_columns].fillna("")
+    # Una fila puede estar en varias partes (archivo, regeneración completa o
+    # reexportación tras editarla): queda la exportada al último.
+    df = historico_parquet_latest(df)
+
+    drop = [c for c in HISTORICO_PARQUET_AUX_COLUMNS if c in df.columns and not (keep_row_number and c == "_fila_historico")]
+    if columns is not None and "ID_Pedido" not in columns and "ID_Pedido" in df.columns:
+        drop.append("ID_Pedido")
+    return df.drop(columns=drop).reset_index(drop=True)
@@ -0,0 +1,188 @@
+"""
+Gobernador de cuota de Google Sheets compartido por app_a-d, app_i-d y app_gerente.
+
+Las tres apps usan la misma cuenta de servicio y el mismo proyecto, así que
+coordinan sus lecturas/escrituras con cubetas de tokens en un archivo local
+bloqueado con ``fcntl``. Las clases de prioridad reservan parte de la cuota: un
+refresco de kiosko nunca deja sin tokens a una escritura del almacén.
+
+``acquire_sheets_quota`` nunca bloquea la sesión más de unos segundos: si no hay
+tokens regresa ``False`` y quien llama sirve su último snapshot (lecturas) o
+reporta la escritura como no enviada.
+"""
+
+import json
+import os
+import tempfile
+import threading
+import time
+import uuid
+from typing import Any
+
+try:
+    import fcntl
+except ImportError:  # Windows: solo coordinación dentro del proceso.
+    fcntl = None
+
+SHEETS_QUOTA_STATE_PATH = os.environ.get(
+    "SHEETS_QUOTA_STATE_PATH",
+    os.path.join(tempfile.gettempdir(), "app_almacen_sheets_quota.json"),
+)
+# Cuotas por minuto de la API de Sheets (proyecto y usuario) para lecturas y escrituras.
+SHEETS_QUOTA_PER_MINUTE = {
+    ("project", "read"): 300,
+    ("project", "write"): 300,
+    ("user", "read"): 60,
+    ("user", "write"): 60,
+}
+SHEETS_QUOTA_PRIORITY_RANK = {
+    "interactive_write": 0,
+    "interactive_read": 1,
+    "kiosk": 2,
+    "background": 3,
+}
+# Fracción de cada cubeta que una clase no puede consumir (reservada a las superiores).
+SHEETS_QUOTA_RESERVE = {
+    "interactive_write": 0.0,
+    "interactive_read": 0.1,
+    "kiosk": 0.35,
+    "background": 0.5,
+}
+# Espera máxima en la cola. Corre en el hilo del script de Streamlit, así que es
+# breve: solo absorbe ráfagas; kiosko y segundo plano no esperan.
+SHEETS_QUOTA_MAX_WAIT_SECONDS = {
+    "interactive_write": 2.0,
+    "interactive_read": 1.0,
+    "kiosk": 0.0,
+    "background": 0.0,
+}
+SHEETS_QUOTA_WAITER_TTL_SECONDS = 5.0
+
+# Estado en memoria del gobernador (respaldo si no hay archivo compartido).
+_LOCAL_STATE: dict[str, Any] = {"lock": threading.Lock(), "state": {}, "user": "default"}
+
+
+class SheetsQuotaUnavailable(RuntimeError):
+    """El gobernador no dio cuota a tiempo; la lectura se difiere y se sirve el último snapshot."""
+
+
+def set_sheets_quota_user(credentials_json: Any) -> None:
+    """Registra la cuenta de servicio (``client_email`` de las credenciales) para las cuotas por usuario."""
+    try:
+        credentials = json.loads(credentials_json) if isinstance(credentials_json, str) else dict(credentials_json)
+        _LOCAL_STATE["user"] = str(credentials.get("client_email", "") or "default")
+    except Exception:
+        _LOCAL_STATE["user"] = "default"
+
+
+def _sheets_quota_transaction(fn):
+    """Aplica ``fn(state)`` sobre el estado compartido bajo bloqueo entre procesos."""
+    local = _LOCAL_STATE
+    with local["lock"]:
+        if fcntl is None:
+            return fn(local["state"])
+        try:
+            with open(f"{SHEETS_QUOTA_STATE_PATH}.lock", "a+") as lock_file:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+                try:
+                    try:
+                        with open(SHEETS_QUOTA_STATE_PATH, "r", encoding="utf-8") as state_file:
+                            state = json.load(state_file)
+                    except (OSError, ValueError):
+                        state = {}
+                    result = fn(state)
+                    tmp_path = f"{SHEETS_QUOTA_STATE_PATH}.{os.getpid()}.tmp"
+                    with open(tmp_path, "w", encoding="utf-8") as state_file:
+                        json.dump(state, state_file)
+                    os.replace(tmp_path, SHEETS_QUOTA_STATE_PATH)
+                    return result
+                finally:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+        except OSError:
+            return fn(local["state"])
+
+
+def _sheets_quota_buckets(state: dict, kind: str, now: float) -> list[tuple[dict, float]]:
+    """Cubetas (proyecto y usuario) del tipo ``kind`` ya rellenadas hasta ``now``."""
+    buckets = state.setdefault("buckets", {})
+    result = []
+    for scope, key in (("project", f"project:{kind}"), ("user", f"user:{_LOCAL_STATE['user']}:{kind}")):
+        capacity = float(SHEETS_QUOTA_PER_MINUTE[(scope, kind)])
+        bucket = buckets.setdefault(key, {"tokens": capacity, "ts": now})
+        elapsed = max(0.0, now - float(bucket.get("ts", now)))
+        bucket["tokens"] = min(capacity, float(bucket.get("tokens", capacity)) + elapsed * capacity / 60.0)
+        bucket["ts"] = now
+        result.append((bucket, capacity))
+    return result
+
+
+def _sheets_quota_try_take(state: dict, kind: str, priority: str, cost: int, waiter_id: str, queue: bool):
+    """Intenta tomar ``cost`` tokens; devuelve ``(concedido, segundos_sugeridos_de_espera)``."""
+    now = time.time()
+    rank = SHEETS_QUOTA_PRIORITY_RANK[priority]
+    waiters = state.setdefault("waiters", {})
+    for key in [k for k, w in waiters.items() if float(w.get("expires", 0)) < now]:
+        waiters.pop(key, None)
+
+    me = waiters.get(waiter_id)
+    my_since = float(me["since"]) if me else now
+    blocked_by_queue = any(
+        key != waiter_id
+        and waiter.get("kind") == kind
+        and (int(waiter["rank"]), float(waiter["since"])) < (rank, my_since)
+        for key, waiter in waiters.items()
+    )
+
+    buckets = _sheets_quota_buckets(state, kind, now)
+    reserve = SHEETS_QUOTA_RESERVE[priority]
+    missing = max((reserve * capacity + cost - bucket["tokens"]) for bucket, capacity in buckets)
+    if not blocked_by_queue and missing <= 0:
+        for bucket, _ in buckets:
+            bucket["tokens"] -= cost
+        waiters.pop(waiter_id, None)
+        return True, 0.0
+
+    if queue:
+        waiters[waiter_id] = {
+            "kind": kind,
+            "rank": rank,
+            "since": my_since,
+            "expires": now + SHEETS_QUOTA_WAITER_TTL_SECONDS,
+        }
+    slowest_refill = min(capacity for _, capacity in buckets) / 60.0
+    return False, max(0.05, missing / slowest_refill)
+
+
+def acquire_sheets_quota(kind: str, priority: str = "interactive_read", cost: int = 1) -> bool:
+    """
+    Toma ``cost`` tokens de lectura (``kind="read"``) o escritura (``"write"``).
+
+    Las clases interactivas esperan en la cola (por prioridad y orden de llegada)
+    a lo más ``SHEETS_QUOTA_MAX_WAIT_SECONDS``; kiosko y segundo plano regresan
+    ``False`` de inmediato. Con ``False`` quien llama no debe tocar la API.
+    """
+    waiter_id = uuid.uuid4().hex
+    max_wait = SHEETS_QUOTA_MAX_WAIT_SECONDS[priority]
+    deadline = time.time() + max_wait
+    while True:
+        granted, wait_seconds = _sheets_quota_transaction(
+            lambda state: _sheets_quota_try_take(state, kind, priority, cost, waiter_id, max_wait > 0)
+        )
+        if granted:
+            return True
+        remaining = deadline - time.time()
+        if remaining <= 0 or wait_seconds > remaining:
+            # Si el relleno tarda más que la espera permitida, no tiene caso dormir.
+            if max_wait > 0:
+                _sheets_quota_transaction(lambda state: state.setdefault("waiters", {}).pop(waiter_id, None))
+            return False
+        time.sleep(min(wait_seconds, remaining))
+
+
+def report_sheets_quota_exhausted(kind: str) -> None:
+    """Vacía las cubetas de ``kind`` tras un 429 para que todas las apps esperen el relleno."""
+    def _drain(state: dict) -> None:
+        for bucket, _ in _sheets_quota_buckets(state, kind, time.time()):
+            bucket["tokens"] = min(float(bucket["tokens"]), 0.0)
+
+    _sheets_quota_transaction(_drain)
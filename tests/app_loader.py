@@ -0,0 +1,162 @@
+"""
+Carga funciones sueltas de las apps de Streamlit para probarlas sin ejecutar el script.
+
+Las apps son scripts de un solo archivo que se conectan a Sheets/S3 al importarse,
+así que aquí se toman del AST solo los imports y las definiciones pedidas, y se
+ejecutan en un espacio de nombres propio con un ``st`` mínimo.
+"""
+
+import ast
+import sys
+import types
+from pathlib import Path
+
+REPO_DIR = Path(__file__).resolve().parents[1]
+# Los módulos compartidos (``sheets_quota``...) viven junto a las apps.
+if str(REPO_DIR) not in sys.path:
+    sys.path.insert(0, str(REPO_DIR))
+
+
+class _CachedFunction:
+    """Sustituye ``st.cache_data``/``st.cache_resource``: llama directo y expone ``clear``."""
+
+    def __init__(self, func):
+        self.__wrapped__ = func
+        self.__name__ = func.__name__
+        self._resource = None
+
+    def __call__(self, *args, **kwargs):
+        return self.__wrapped__(*args, **kwargs)
+
+    def clear(self):
+        self._resource = None
+
+
+class _CachedResource(_CachedFunction):
+    def __call__(self, *args, **kwargs):
+        if self._resource is None:
+            self._resource = self.__wrapped__(*args, **kwargs)
+        return self._resource
+
+
+def _cache_decorator(wrapper):
+    def decorator(func=None, **_kwargs):
+        if func is None:
+            return wrapper
+        return wrapper(func)
+
+    return decorator
+
+
+class _StreamlitStub(types.SimpleNamespace):
+    def __init__(self):
+        super().__init__(
+            cache_data=_cache_decorator(_CachedFunction),
+            cache_resource=_cache_decorator(_CachedResource),
+            session_state={},
+            messages=[],
+        )
+
+    def __getattr__(self, name):
+        # st.warning, st.info, st.error...: se registran para poder revisarlos.
+        def _record(*args, **_kwargs):
+            self.messages.append((name, args[0] if args else ""))
+
+        return _record
+
+
+def _is_import_block(node: ast.stmt) -> bool:
+    if isinstance(node, (ast.Import, ast.ImportFrom)):
+        return True
+    return isinstance(node, ast.Try) and all(isinstance(n, (ast.Import, ast.ImportFrom)) for n in node.body)
+
+
+def _is_static_definition(node: ast.stmt) -> bool:
+    """Funciones, clases y constantes que no llaman nada (las demás asignaciones leen Sheets/S3)."""
+    if isinstance(node, (ast.FunctionDef, ast.ClassDef)):
+        return True
+    return not any(isinstance(n, ast.Call) for n in ast.walk(node))
+
+
+def _defined_names(node: ast.stmt) -> set[str]:
+    if isinstance(node, (ast.FunctionDef, ast.ClassDef)):
+        return {node.name}
+    if isinstance(node, ast.Assign):
+        return {t.id for t in node.targets if isinstance(t, ast.Name)}
+    if isinstance(node, ast.AnnAssign) and isinstance(node.target, ast.Name):
+        return {node.target.id}
+    return set()
+
+
+def top_level_names(filename: str) -> set[str]:
+    """Nombres definidos en el nivel superior de ``filename``."""
+    tree = ast.parse((REPO_DIR / filename).read_text(encoding="utf-8"), filename=filename)
+    return set().union(*(_defined_names(node) for node in tree.body))
+
+
+class AppModule:
+    """Acceso por atributo a los globales de la app; asignar un atributo cambia el global."""
+
+    def __init__(self, namespace: dict):
+        object.__setattr__(self, "namespace", namespace)
+
+    def __getattr__(self, name):
+        try:
+            return self.namespace[name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+    def __setattr__(self, name, value):
+        self.namespace[name] = value
+
+
+def load_app(filename: str, names, **extra) -> AppModule:
+    """
+    Ejecuta los imports de ``filename`` que estén disponibles y las definiciones de
+    nivel superior llamadas como ``names``, junto con las que estas usan (en orden de
+    aparición; las asignaciones con llamadas solo si se piden). ``extra`` agrega o reemplaza globales (credenciales, clientes,
+    constantes) y no se toma del archivo.
+    """
+    tree = ast.parse((REPO_DIR / filename).read_text(encoding="utf-8"), filename=filename)
+    wanted = set(names)
+    namespace: dict = {"__name__": f"app_{Path(filename).stem.replace('-', '_')}"}
+    for node in tree.body:
+        if not _is_import_block(node):
+            continue
+        for stmt in (node.body if isinstance(node, ast.Try) else [node]):
+            try:
+                exec(compile(ast.Module(body=[stmt], type_ignores=[]), filename, "exec"), namespace)
+            except ImportError:
+                if isinstance(node, ast.Try):
+                    for handler in node.handlers:
+                        exec(compile(ast.Module(body=handler.body, type_ignores=[]), filename, "exec"), namespace)
+                    break
+    namespace["st"] = _StreamlitStub()
+    namespace.update(extra)
+
+    definitions: dict[str, list[ast.stmt]] = {}
+    for node in tree.body:
+        for name in _defined_names(node):
+            definitions.setdefault(name, []).append(node)
+    # Se agregan las definiciones de nivel superior que usan las pedidas (transitivamente).
+    pending = list(wanted)
+    while pending:
+        for node in definitions.get(pending.pop(), []):
+            for ref in {n.id for n in ast.walk(node) if isinstance(n, ast.Name)}:
+                if ref in wanted or ref in extra or ref not in definitions:
+                    continue
+                if all(_is_static_definition(n) for n in definitions[ref]):
+                    wanted.add(ref)
+                    pending.append(ref)
+
+    found: set[str] = set()
+    for node in tree.body:
+        defined = _defined_names(node) & wanted
+        if not defined:
+            continue
+        exec(compile(ast.Module(body=[node], type_ignores=[]), filename, "exec"), namespace)
+        found |= defined
+    missing = set(names) - found
+    if missing:
+        raise LookupError(f"{filename}: no se encontraron {sorted(missing)}")
+    return AppModule(namespace)
@@ -0,0 +1,397 @@
+"""
+Numeración de flujo tal como se calculaba antes de hacerlo por columnas (fila por fila).
+
+Es la referencia de las pruebas de ``test_flow_numbering.py``: ``bind_baseline``
+ejecuta cada función con los helpers de su app, así que lo único distinto frente
+a la versión actual es el recorrido de las filas. No modificar: si la numeración
+cambia a propósito, se actualiza aquí también.
+"""
+
+import types
+from typing import Optional
+
+import pandas as pd
+
+BASELINE_FUNCTIONS = {
+    "app_a-d.py": "build_flow_number_maps",
+    "app_i-d.py": "_build_flow_number_maps",
+    "app_gerente.py": "construir_mapa_numeracion_foraneos",
+}
+
+
+def baseline_globals(filename: str) -> set[str]:
+    """Globales que usa la función de referencia de ``filename`` (para pedírselos a ``load_app``)."""
+    pending = [globals()[BASELINE_FUNCTIONS[filename]].__code__]
+    names: set[str] = set()
+    while pending:
+        code = pending.pop()
+        names.update(code.co_names)
+        pending.extend(const for const in code.co_consts if isinstance(const, types.CodeType))
+    return names
+
+
+def bind_baseline(app, filename: str):
+    """La función de referencia de ``filename`` con los globales de ``app`` (ver ``app_loader``)."""
+    func = globals()[BASELINE_FUNCTIONS[filename]]
+    return types.FunctionType(func.__code__, app.namespace, func.__name__, func.__defaults__)
+
+
+# --- app_a-d.py ---
+def build_flow_number_maps(
+    df_source: pd.DataFrame,
+    df_casos: Optional[pd.DataFrame] = None,
+) -> tuple[dict[str, str], dict[str, str], list[tuple[int, str]]]:
+    """Construye mapas de numeración de flujo: foráneos 01+, locales 1+."""
+    if df_source is None or df_source.empty:
+        return {}, {}, []
+
+    work = _exclude_cleaned_completed(df_source)
+    for col in ("Tipo_Envio", "Tipo_Envio_Original", "ID_Pedido", "Folio_Factura"):
+        if col not in work.columns:
+            work[col] = ""
+
+    tipo_norm = work["Tipo_Envio"].astype(str)
+    tipo_original_norm = work["Tipo_Envio_Original"].astype(str)
+    mask_foraneo = tipo_norm.map(_is_exact_pedido_foraneo) | tipo_original_norm.map(_is_exact_pedido_foraneo)
+
+    df_foraneo = work[mask_foraneo].reset_index(drop=True)
+    df_local = work[~mask_foraneo].reset_index(drop=True)
+
+    def _build_map(df_block: pd.DataFrame, formatter) -> dict[str, str]:
+        out: dict[str, str] = {}
+        for idx, row in df_block.iterrows():
+            numero = formatter(idx)
+            row_key = _flow_row_key(row)
+            for raw in (row_key, row.get("ID_Pedido", ""), row.get("Folio_Factura", "")):
+                key = raw if isinstance(raw, str) and raw.startswith("row:") else _flow_key(raw)
+                if key and key not in out:
+                    out[key] = numero
+        return out
+
+    map_foraneo: dict[str, str] = {}
+    map_local: dict[str, str] = {}
+
+    if not df_local.empty:
+        df_local_base = df_local.copy()
+        mask_local_puro = df_local_base["Tipo_Envio"].astype(str).str.strip().eq("📍 Pedido Local")
+        df_local_turno_reset = df_local_base[mask_local_puro].copy()
+        df_local_otro = df_local_base[~mask_local_puro].copy()
+
+        if not df_local_turno_reset.empty:
+            df_local_turno_reset["_turno_local_norm"] = (
+                df_local_turno_reset["Turno"]
+                .astype(str)
+                .str.strip()
+                .replace({"🌤️ Local Día": "☀️ Local Mañana"})
+            )
+            df_local_turno_reset["_turno_local_norm"] = df_local_turno_reset["_turno_local_norm"].replace(
+                "",
+                "sin_turno",
+            )
+            df_local_turno_reset["_fecha_local_norm"] = pd.to_datetime(
+                df_local_turno_reset.get("Fecha_Entrega", ""),
+                errors="coerce",
+            ).dt.strftime("%Y-%m-%d")
+            df_local_turno_reset["_fecha_local_norm"] = df_local_turno_reset["_fecha_local_norm"].fillna("sin_fecha")
+            df_local_turno_reset["_sort_dt"] = df_local_turno_reset.apply(
+                _parse_row_sort_datetime,
+                axis=1,
+            )
+            df_local_turno_reset = df_local_turno_reset.sort_values(
+                by=["_turno_local_norm", "_fecha_local_norm", "_sort_dt"],
+                kind="mergesort",
+            ).reset_index(drop=True)
+
+            counters_by_turno_fecha: dict[tuple[str, str], int] = {}
+            for _, row in df_local_turno_reset.iterrows():
+                turno = str(row.get("_turno_local_norm", "")).strip()
+                fecha = str(row.get("_fecha_local_norm", "")).strip() or "sin_fecha"
+                bucket = (turno, fecha)
+                counters_by_turno_fecha[bucket] = counters_by_turno_fecha.get(bucket, 0) + 1
+                numero = str(counters_by_turno_fecha[bucket])
+                row_key = _flow_row_key(row)
+                for raw in (row_key, row.get("ID_Pedido", ""), row.get("Folio_Factura", "")):
+                    key = raw if isinstance(raw, str) and raw.startswith("row:") else _flow_key(raw)
+                    if key and key not in map_local:
+                        map_local[key] = numero
+
+        if not df_local_otro.empty:
+            map_local_fallback = _build_map(df_local_otro.reset_index(drop=True), lambda idx: str(idx + 1))
+            for key, numero in map_local_fallback.items():
+                if key and key not in map_local:
+                    map_local[key] = numero
+
+    casos_foraneo = pd.DataFrame()
+    if df_casos is not None and not df_casos.empty:
+        casos_work = _exclude_cleaned_completed(df_casos)
+        for col in ("Tipo_Envio_Original", "Tipo_Envio", "ID_Pedido", "Folio_Factura", "Numero_Foraneo"):
+            if col not in casos_work.columns:
+                casos_work[col] = ""
+
+        casos_foraneo = casos_work[
+            casos_work["Tipo_Envio_Original"].astype(str).map(_is_exact_pedido_foraneo)
+            | casos_work["Tipo_Envio"].astype(str).map(_is_exact_pedido_foraneo)
+        ].copy()
+
+    # Flujo foráneo combinado:
+    # - Pedidos mantienen numeración automática por orden.
+    # - Devoluciones/casos foráneos solo entran al flujo si ya tienen Numero_Foraneo.
+    # - Registros limpiados (Completados_Limpiado = sí) no cuentan.
+    combined_rows: list[tuple[pd.Timestamp, int, str, pd.Series]] = []
+    if not df_foraneo.empty:
+        for _, row in df_foraneo.iterrows():
+            combined_rows.append((_parse_row_sort_datetime(row), 0, "main", row))
+
+    if not casos_foraneo.empty:
+        for _, row in casos_foraneo.iterrows():
+            combined_rows.append((_parse_row_sort_datetime(row), 1, "caso", row))
+
+    combined_rows.sort(key=lambda item: (item[0], item[1]))
+
+    def _is_limpiado(row_data: pd.Series) -> bool:
+        return _normalize_text_for_matching(str(row_data.get("Completados_Limpiado", ""))) == "si"
+
+    manual_numbers: set[int] = set()
+    for _, _, source_kind, row in combined_rows:
+        if _is_cancelado_estado(row.get("Estado", "")) or _is_limpiado(row):
+            continue
+        if source_kind != "caso":
+            continue
+        parsed = _parse_foraneo_number(row.get("Numero_Foraneo", ""))
+        if parsed is not None:
+            manual_numbers.add(parsed)
+
+    used_numbers: set[int] = set(manual_numbers)
+    # Mantener continuidad: pedidos foráneos normales deben tomar
+    # el menor número disponible (01, 02, 03, ...), saltando únicamente
+    # los números manuales ya reservados por casos/devoluciones.
+    #
+    # Ejemplo: si aparece un caso manual con 23, los pedidos existentes
+    # se mantienen 01-22 y los nuevos continúan en 24+.
+    next_number = 1
+
+    # 1) Casos/devoluciones foráneos con Numero_Foraneo manual (se respeta tal cual).
+    for _, _, source_kind, row in combined_rows:
+        if _is_cancelado_estado(row.get("Estado", "")) or _is_limpiado(row):
+            continue
+        if source_kind != "caso":
+            continue
+
+        row_key = _flow_row_key(row)
+        keys = [row_key, _flow_key(row.get("ID_Pedido", "")), _flow_key(row.get("Folio_Factura", ""))]
+        if not any(keys):
+            continue
+
+        parsed = _parse_foraneo_number(row.get("Numero_Foraneo", ""))
+        if parsed is None:
+            continue
+
+        numero_fmt = f"{parsed:02d}"
+        for key in keys:
+            if key and key not in map_foraneo:
+                map_foraneo[key] = numero_fmt
+
+    # 2) Pedidos foráneos normales en secuencia, sin repetir manuales.
+    for _, _, source_kind, row in combined_rows:
+        if _is_cancelado_estado(row.get("Estado", "")) or _is_limpiado(row):
+            continue
+        if source_kind == "caso":
+            continue
+
+        row_key = _flow_row_key(row)
+        keys = [row_key, _flow_key(row.get("ID_Pedido", "")), _flow_key(row.get("Folio_Factura", ""))]
+        if not any(keys):
+            continue
+
+        # Evitar colisión por folio/ID repetidos entre filas diferentes:
+        # solo tratamos como "ya asignado" si la fila actual ya tiene clave row:.
+        if row_key and row_key in map_foraneo:
+            continue
+
+        while next_number in used_numbers:
+            next_number += 1
+        numero = next_number
+        next_number += 1
+
+        used_numbers.add(numero)
+        numero_fmt = f"{numero:02d}"
+
+        for key in keys:
+            if key and key not in map_foraneo:
+                map_foraneo[key] = numero_fmt
+
+    return map_local, map_foraneo, []
+
+
+# --- app_i-d.py ---
+def _build_flow_number_maps(df_all: pd.DataFrame) -> tuple[dict[str, str], dict[str, str]]:
+    if df_all.empty:
+        return {}, {}
+
+    work = df_all.copy()
+    if "Tipo_Envio" not in work.columns:
+        work["Tipo_Envio"] = ""
+    if "Tipo_Envio_Original" not in work.columns:
+        work["Tipo_Envio_Original"] = ""
+    if "ID_Pedido" not in work.columns:
+        work["ID_Pedido"] = ""
+    if "Folio_Factura" not in work.columns:
+        work["Folio_Factura"] = ""
+
+    tipo_norm = work["Tipo_Envio"].astype(str).apply(_normalize_envio_original)
+    tipo_original_norm = work["Tipo_Envio_Original"].astype(str).apply(_normalize_envio_original)
+    mask_foraneo = tipo_norm.str.contains("foraneo", na=False) | tipo_original_norm.str.contains("foraneo", na=False)
+
+    df_foraneo = work[mask_foraneo].reset_index(drop=True)
+    df_local = work[~mask_foraneo].reset_index(drop=True)
+
+    def build_map(df_src: pd.DataFrame, formatter) -> dict[str, str]:
+        out: dict[str, str] = {}
+        for idx, row in df_src.iterrows():
+            numero = formatter(idx)
+            row_key = _flow_row_key_from_row(row)
+            for raw_key in (row_key, row.get("ID_Pedido", ""), row.get("Folio_Factura", "")):
+                key = raw_key if isinstance(raw_key, str) and raw_key.startswith("row:") else _flow_match_key(raw_key)
+                if key and key not in out:
+                    out[key] = numero
+        return out
+
+    map_local: dict[str, str] = {}
+    if not df_local.empty:
+        df_local_base = df_local.copy()
+        mask_local_puro = df_local_base["Tipo_Envio"].astype(str).str.strip().eq("📍 Pedido Local")
+        df_local_turno_reset = df_local_base[mask_local_puro].copy()
+        df_local_otro = df_local_base[~mask_local_puro].copy()
+
+        if not df_local_turno_reset.empty:
+            df_local_turno_reset["_turno_local_norm"] = (
+                df_local_turno_reset["Turno"].astype(str).str.strip().replace({"🌤️ Local Día": "☀️ Local Mañana"})
+            )
+            df_local_turno_reset["_turno_local_norm"] = df_local_turno_reset["_turno_local_norm"].replace("", "sin_turno")
+            df_local_turno_reset["_fecha_local_norm"] = pd.to_datetime(
+                df_local_turno_reset.get("Fecha_Entrega", ""), errors="coerce"
+            ).dt.strftime("%Y-%m-%d")
+            df_local_turno_reset["_fecha_local_norm"] = df_local_turno_reset["_fecha_local_norm"].fillna("sin_fecha")
+            df_local_turno_reset["_sort_dt"] = df_local_turno_reset.apply(compute_sort_key, axis=1)
+            df_local_turno_reset = df_local_turno_reset.sort_values(
+                by=["_turno_local_norm", "_fecha_local_norm", "_sort_dt"], kind="mergesort"
+            ).reset_index(drop=True)
+
+            counters_by_bucket: dict[tuple[str, str], int] = {}
+            for _, row in df_local_turno_reset.iterrows():
+                turno = str(row.get("_turno_local_norm", "")).strip() or "sin_turno"
+                fecha = str(row.get("_fecha_local_norm", "")).strip() or "sin_fecha"
+                bucket = (turno, fecha)
+                counters_by_bucket[bucket] = counters_by_bucket.get(bucket, 0) + 1
+                numero = str(counters_by_bucket[bucket])
+                row_key = _flow_row_key_from_row(row)
+                for raw_key in (row_key, row.get("ID_Pedido", ""), row.get("Folio_Factura", "")):
+                    key = raw_key if isinstance(raw_key, str) and raw_key.startswith("row:") else _flow_match_key(raw_key)
+                    if key and key not in map_local:
+                        map_local[key] = numero
+
+        if not df_local_otro.empty:
+            map_local_fallback = build_map(df_local_otro.reset_index(drop=True), lambda idx: str(idx + 1))
+            for key, numero in map_local_fallback.items():
+                if key and key not in map_local:
+                    map_local[key] = numero
+
+    foraneo_map = build_map(df_foraneo, lambda idx: f"{idx + 1:02d}")
+    return map_local, foraneo_map
+
+
+# --- app_gerente.py ---
+def construir_mapa_numeracion_foraneos(df_data, df_casos):
+    """Construye mapa de numeración foránea igual al flujo de app_i/app_a."""
+    if df_data is None or df_data.empty:
+        return {}
+
+    work_data = df_data.copy()
+    for col in ("Tipo_Envio", "ID_Pedido", "Folio_Factura", "Completados_Limpiado", "Estado"):
+        if col not in work_data.columns:
+            work_data[col] = ""
+
+    tipo_exacto = work_data["Tipo_Envio"].astype(str).map(es_pedido_foraneo_exacto)
+    df_foraneo = work_data[tipo_exacto].copy()
+
+    work_cases = pd.DataFrame() if df_casos is None else df_casos.copy()
+    if not work_cases.empty:
+        for col in (
+            "Tipo_Envio_Original",
+            "Tipo_Envio",
+            "ID_Pedido",
+            "Folio_Factura",
+            "Numero_Foraneo",
+            "Completados_Limpiado",
+            "Estado",
+        ):
+            if col not in work_cases.columns:
+                work_cases[col] = ""
+        mask_foraneo_case = (
+            work_cases["Tipo_Envio_Original"].astype(str).map(es_pedido_foraneo_exacto)
+            | work_cases["Tipo_Envio"].astype(str).map(es_pedido_foraneo_exacto)
+        )
+        work_cases = work_cases[mask_foraneo_case].copy()
+
+    combined_rows = []
+    if not df_foraneo.empty:
+        for _, row in df_foraneo.iterrows():
+            combined_rows.append((_parse_row_sort_datetime(row), 0, "main", row))
+    if not work_cases.empty:
+        for _, row in work_cases.iterrows():
+            combined_rows.append((_parse_row_sort_datetime(row), 1, "caso", row))
+    combined_rows.sort(key=lambda item: (item[0], item[1]))
+
+    manual_numbers = set()
+    for _, _, source_kind, row in combined_rows:
+        if _es_cancelado_estado(row.get("Estado", "")) or _es_limpiado(row):
+            continue
+        if source_kind != "caso":
+            continue
+        parsed = _parse_foraneo_number(row.get("Numero_Foraneo", ""))
+        if parsed is not None:
+            manual_numbers.add(parsed)
+
+    map_foraneo = {}
+    used_numbers = set(manual_numbers)
+    next_number = 1
+
+    for _, _, source_kind, row in combined_rows:
+        if _es_cancelado_estado(row.get("Estado", "")) or _es_limpiado(row):
+            continue
+        if source_kind != "caso":
+            continue
+        row_key = _flow_row_key(row)
+        keys = [row_key, _flow_key(row.get("ID_Pedido", "")), _flow_key(row.get("Folio_Factura", ""))]
+        if not any(keys):
+            continue
+        parsed = _parse_foraneo_number(row.get("Numero_Foraneo", ""))
+        if parsed is None:
+            continue
+        numero_fmt = f"{parsed:02d}"
+        for key in keys:
+            if key and key not in map_foraneo:
+                map_foraneo[key] = numero_fmt
+
+    for _, _, source_kind, row in combined_rows:
+        if _es_cancelado_estado(row.get("Estado", "")) or _es_limpiado(row):
+            continue
+        if source_kind == "caso":
+            continue
+        row_key = _flow_row_key(row)
+        keys = [row_key, _flow_key(row.get("ID_Pedido", "")), _flow_key(row.get("Folio_Factura", ""))]
+        if not any(keys):
+            continue
+        if row_key and row_key in map_foraneo:
+            continue
+        while next_number in used_numbers:
+            next_number += 1
+        number = next_number
+        next_number += 1
+        used_numbers.add(number)
+        numero_fmt = f"{number:02d}"
+        for key in keys:
+            if key and key not in map_foraneo:
+                map_foraneo[key] = numero_fmt
+
+    return map_foraneo
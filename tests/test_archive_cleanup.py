@@ -0,0 +1,44 @@
+"""Eliminación de la base operativa al archivar (``_archive_delete_from_operativa`` de app_a-d)."""
+
+import types
+
+from app_loader import load_app
+
+
+def _cargar(columna_ids):
+    borradas = []
+    app = load_app(
+        "app_a-d.py",
+        ["_archive_delete_from_operativa"],
+        _archive_column_letter=lambda _col: "A",
+        _get_worksheet_name_safe=lambda _ws: "datos",
+        _sheet_a1_range=lambda nombre, rango: f"{nombre}!{rango}",
+        _run_gsheet_read_with_backoff=lambda func, **_kwargs: func(),
+        _values_batch_get=lambda *_args, **_kwargs: [[[pid] if pid else [] for pid in columna_ids]],
+        _delete_rows_by_indexes=lambda _ws, filas: borradas.extend(filas),
+    )
+    return app, borradas
+
+
+def test_rows_shifted_by_a_resumed_run_are_found_by_id():
+    # El plan se tomó con P5 en la fila 6 y P7 en la 8; una corrida retomada borró
+    # las filas 2 y 3, así que ahora están dos filas más arriba.
+    app, borradas = _cargar(["P3", "P4", "P5", "P6", "P7"])
+    hoja = types.SimpleNamespace(spreadsheet=None)
+
+    eliminadas, omitidas = app._archive_delete_from_operativa(hoja, ["ID_Pedido"], [[6, "P5"], [8, "P7"]])
+
+    assert (eliminadas, omitidas) == (2, 0)
+    assert borradas == [4, 6]
+
+
+def test_ambiguous_or_missing_ids_are_skipped():
+    app, borradas = _cargar(["P1", "P2", "P2", "", "P9"])
+    hoja = types.SimpleNamespace(spreadsheet=None)
+
+    filas = [[2, "P1"], [9, "P2"], [10, "P8"]]
+    eliminadas, omitidas = app._archive_delete_from_operativa(hoja, ["ID_Pedido"], filas)
+
+    # P1 sigue en su fila; P2 está repetido y P8 ya no existe: no se adivina.
+    assert (eliminadas, omitidas) == (1, 2)
+    assert borradas == [2]
@@ -0,0 +1,89 @@
+"""Sincronización incremental (delta) de la hoja de pedidos en app_a-d y app_i-d."""
+
+import re
+import time
+import types
+from zoneinfo import ZoneInfo
+
+import pytest
+
+from app_loader import load_app
+
+HEADERS = ["ID_Pedido", "Estado", "Fecha_Completado", "Cliente"]
+ANTERIOR = [
+    HEADERS,
+    ["P1", "🟢 Completado", "2024-01-02 10:00:00", "Cliente 1"],
+    ["P2", "🟢 Completado", "2024-01-03 10:00:00", "Cliente 2"],
+    ["P3", "🟢 Completado", "2024-01-04 10:00:00", "Cliente 3"],
+]
+
+
+def _a1_col(col):
+    return chr(ord("A") + col - 1)
+
+
+def _leer(hoja, rango):
+    """Resuelve ``1:1``, ``B:B`` o ``A2:D4`` contra la hoja en memoria, como ``values:batchGet``."""
+    if rango == "1:1":
+        return [hoja[0]]
+    columna = re.fullmatch(r"([A-Z]):\1", rango)
+    if columna:
+        idx = ord(columna.group(1)) - ord("A")
+        return [[fila[idx]] if fila[idx] else [] for fila in hoja]
+    inicio, fin = (int(n) for n in re.fullmatch(r"A(\d+):[A-Z](\d+)", rango).groups())
+    return hoja[inicio - 1:fin]
+
+
+class _Lecturas:
+    def __init__(self, hoja):
+        self.hoja = hoja
+        self.rangos = []
+
+    def __call__(self, _spreadsheet, ranges, **_kwargs):
+        self.rangos.extend(ranges)
+        return [_leer(self.hoja, rango) for rango in ranges]
+
+
+def _sincronizar(filename, hoja):
+    lecturas = _Lecturas(hoja)
+    extra = dict(
+        gspread=types.SimpleNamespace(
+            utils=types.SimpleNamespace(rowcol_to_a1=lambda row, col: f"{_a1_col(col)}{row}"),
+        ),
+        _values_batch_get=lecturas,
+        _sheet_a1_range=lambda _nombre, rango: rango,
+        _drive_modified_time=lambda *_args: pytest.fail("el delta no debe depender de Drive"),
+        _MX_TZ=ZoneInfo("America/Mexico_City"),
+        TZ=ZoneInfo("America/Mexico_City"),
+    )
+    estado = {"full_at": time.time(), "dirty_rows": set()}
+    previos = [list(fila) for fila in ANTERIOR]
+    if filename == "app_a-d.py":
+        app = load_app(filename, ["_delta_sync_sheet_values"], **extra)
+        cliente = types.SimpleNamespace(open_by_key=lambda _sheet_id: None)
+        valores = app._delta_sync_sheet_values(cliente, "principal", "datos", previos, estado)
+    else:
+        app = load_app(filename, ["_delta_sync_sheet_values"], **extra)
+        hoja_ws = types.SimpleNamespace(spreadsheet=None)
+        valores = app._delta_sync_sheet_values(hoja_ws, "datos", previos, estado)
+    return valores, lecturas.rangos
+
+
+@pytest.mark.parametrize("filename", ["app_a-d.py", "app_i-d.py"])
+def test_cold_row_whose_estado_changed_is_refetched(filename):
+    hoja = [list(fila) for fila in ANTERIOR]
+    hoja[2] = ["P2", "🟡 Pendiente", "", "Cliente 2 reabierto"]
+
+    valores, rangos = _sincronizar(filename, hoja)
+
+    assert valores == hoja
+    # Sondeo (encabezados, ID_Pedido y Estado) y solo la fila que cambió.
+    assert rangos == ["1:1", "A:A", "B:B", "A3:D3"]
+
+
+@pytest.mark.parametrize("filename", ["app_a-d.py", "app_i-d.py"])
+def test_cold_rows_without_changes_only_probe(filename):
+    valores, rangos = _sincronizar(filename, [list(fila) for fila in ANTERIOR])
+
+    assert valores == ANTERIOR
+    assert rangos == ["1:1", "A:A", "B:B"]
@@ -0,0 +1,144 @@
+"""Numeración de flujo por columnas contra la versión fila por fila (``flow_numbering_baseline``)."""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from app_loader import load_app, top_level_names
+from flow_numbering_baseline import BASELINE_FUNCTIONS, baseline_globals, bind_baseline
+
+TIPOS = [
+    "📍 Pedido Local",
+    " 📍 Pedido Local ",
+    "🚚 Pedido Foráneo",
+    " 🚚 Pedido Foráneo ",
+    "🚚 pedido foraneo",
+    "Pedido Foráneo urgente",
+    "🎓 Cursos y Eventos",
+    "🔁 Devolución",
+    "",
+    None,
+]
+TURNOS = ["☀️ Local Mañana", "🌤️ Local Día", "🌙 Local Tarde", "🌵 Saltillo", "", None]
+ESTADOS = ["🟡 Pendiente", "🔵 En Proceso", "🟢 Completado", "❌ Cancelado", "cancelado", "", None]
+LIMPIADO = ["", "", "", "Sí", "si", "No", None]
+FECHAS = [
+    "2024-03-01 09:15:00",
+    "2024-03-01 09:15:00",
+    "2024-03-02 17:40:10",
+    "2024-03-02",
+    "02/03/2024 08:00",
+    "",
+    "sin fecha",
+    None,
+]
+NUMEROS_FORANEO = ["", "03", "12", "7", "0", "x", "12a", None]
+
+
+def _pick(rng, values, size):
+    return [values[i] for i in rng.integers(0, len(values), size)]
+
+
+def _random_frame(rng, size: int, casos: bool = False) -> pd.DataFrame:
+    ids = [f"P{n}" if n % 7 else "" for n in rng.integers(0, max(size // 2, 1), size)]
+    folios = [f" f{n} " if n % 3 == 0 else (f"F{n}" if n % 5 else "") for n in rng.integers(0, size + 1, size)]
+    filas = rng.integers(2, size + 4, size).astype(float)
+    filas[rng.random(size) < 0.15] = np.nan
+    data = {
+        "ID_Pedido": ids,
+        "Folio_Factura": folios,
+        "Tipo_Envio": _pick(rng, TIPOS, size),
+        "Tipo_Envio_Original": _pick(rng, TIPOS[2:], size),
+        "Turno": _pick(rng, TURNOS, size),
+        "Estado": _pick(rng, ESTADOS, size),
+        "Completados_Limpiado": _pick(rng, LIMPIADO, size),
+        "Hora_Registro": _pick(rng, FECHAS, size),
+        "Fecha_Entrega": _pick(rng, FECHAS, size),
+        "_gsheet_row_index": filas,
+    }
+    if casos:
+        data["Numero_Foraneo"] = _pick(rng, NUMEROS_FORANEO, size)
+    return pd.DataFrame(data, index=rng.permutation(size) + 100)
+
+
+def _edge_frames():
+    base = pd.DataFrame(
+        {
+            "ID_Pedido": ["P1", "P2", "P2", "P3", ""],
+            "Folio_Factura": ["F1", "", "F2", "f1", ""],
+            "Tipo_Envio": ["📍 Pedido Local", "🚚 Pedido Foráneo", "🚚 Pedido Foráneo", "📍 Pedido Local", "🎓 Cursos y Eventos"],
+            "Turno": ["🌤️ Local Día", "", "", "☀️ Local Mañana", ""],
+            "Estado": ["", "❌ Cancelado", "", "", ""],
+            "Hora_Registro": ["2024-03-01 10:00:00", "2024-03-01 09:00:00", "", "2024-03-01 08:00:00", ""],
+            "Fecha_Entrega": ["2024-03-02", "", "", "2024-03-02", ""],
+        }
+    )
+    return {
+        "sin_filas": base.iloc[0:0],
+        "columnas_minimas": base,
+        "solo_foraneos": base[base["Tipo_Envio"] == "🚚 Pedido Foráneo"],
+        "solo_locales": base[base["Tipo_Envio"] == "📍 Pedido Local"],
+    }
+
+
+CASOS_EDGE = pd.DataFrame(
+    {
+        "ID_Pedido": ["C1", "C2", "P2", "C4"],
+        "Tipo_Envio": ["🔁 Devolución"] * 4,
+        "Tipo_Envio_Original": ["🚚 Pedido Foráneo"] * 3 + ["📍 Pedido Local"],
+        "Numero_Foraneo": ["02", "", "05", "09"],
+        "Hora_Registro": ["2024-03-01 07:00:00", "2024-03-01 07:30:00", "", "2024-03-01 07:00:00"],
+    }
+)
+
+
+@pytest.fixture(params=list(BASELINE_FUNCTIONS), scope="module")
+def apps(request):
+    filename = request.param
+    names = {BASELINE_FUNCTIONS[filename]} | (baseline_globals(filename) & top_level_names(filename))
+    app = load_app(filename, sorted(names))
+    return filename, getattr(app, BASELINE_FUNCTIONS[filename]), bind_baseline(app, filename), app
+
+
+def _call(filename, func, df, df_casos):
+    if filename == "app_i-d.py":
+        return func(df)
+    return func(df, df_casos)
+
+
+def _assert_same(apps, df, df_casos):
+    filename, current, baseline, app = apps
+    esperado = _call(filename, baseline, df.copy(), None if df_casos is None else df_casos.copy())
+    app._get_flow_number_cache.clear()
+    assert _call(filename, current, df, df_casos) == esperado
+    # La segunda llamada sale de la memoria de huellas y debe dar lo mismo.
+    assert _call(filename, current, df, df_casos) == esperado
+
+
+@pytest.mark.parametrize("seed", range(12))
+def test_random_frames_match_row_by_row_numbering(apps, seed):
+    rng = np.random.default_rng(seed)
+    size = int(rng.integers(1, 60))
+    df = _random_frame(rng, size)
+    df_casos = _random_frame(rng, int(rng.integers(0, 15)), casos=True) if seed % 3 else None
+    _assert_same(apps, df, df_casos)
+
+
+@pytest.mark.parametrize("nombre", list(_edge_frames()))
+def test_edge_frames_match_row_by_row_numbering(apps, nombre):
+    df = _edge_frames()[nombre]
+    _assert_same(apps, df, None)
+    _assert_same(apps, df, CASOS_EDGE)
+
+
+def test_golden_foraneo_numbers_skip_manual_cases():
+    app = load_app("app_a-d.py", ["build_flow_number_maps"])
+    df = _edge_frames()["columnas_minimas"]
+
+    local, foraneo, pendientes = app.build_flow_number_maps(df, CASOS_EDGE)
+
+    assert pendientes == []
+    # Mismo turno (Día cuenta como Mañana) y fecha: P3 se registró antes que P1.
+    assert local == {"p3": "1", "f1": "1", "p1": "2"}
+    # C1 y P2 conservan su número manual; el pedido P2 vigente toma el primero libre.
+    assert foraneo == {"c1": "02", "p2": "05", "f2": "01"}
@@ -0,0 +1,169 @@
+"""Histórico columnar compartido (``historico_parquet``): escritura, compactación, manifiesto y lectura filtrada."""
+
+import itertools
+
+import pandas as pd
+import pytest
+
+pytest.importorskip("pyarrow")
+boto3 = pytest.importorskip("boto3")
+moto = pytest.importorskip("moto")
+
+import historico_parquet  # noqa: E402
+
+BUCKET = "historico-pruebas"
+HEADERS = ["ID_Pedido", "Hora_Registro", "Vendedor_Registro", "Cliente", "Estado"]
+
+
+@pytest.fixture
+def s3():
+    with moto.mock_aws():
+        client = boto3.client("s3", region_name="us-east-1")
+        client.create_bucket(Bucket=BUCKET)
+        yield client
+
+
+@pytest.fixture
+def hp():
+    historico_parquet.clear_historico_parquet_cache()
+    return historico_parquet
+
+
+def _rows():
+    return [
+        ["P1", "2024-01-05 10:00:00", "ANA", "Cliente 1", "Completado"],
+        ["P2", "2024-01-20 12:00:00", "LUIS", "Cliente 2", "Completado"],
+        ["P3", "2024-02-03 09:30:00", "ANA", "Cliente 3", "Completado"],
+        ["P4", "2024-02-28 18:00:00", "LUIS", "Cliente 4", "Cancelado"],
+        ["", "2024-02-10 08:00:00", "ANA", "Sin ID", "Completado"],
+    ]
+
+
+def _backfill(hp, s3, rows=None, exportado_ms=1):
+    rows = _rows() if rows is None else rows
+    df = hp.historico_parquet_frame(HEADERS, rows, range(2, len(rows) + 2), exportado_ms=exportado_ms)
+    hp.write_historico_parquet(s3, BUCKET, df)
+    hp.historico_manifest_update(s3, BUCKET, lambda manifest: manifest.update(backfill=True))
+
+
+def _read(hp, s3, **kwargs):
+    hp.clear_historico_parquet_cache()
+    return hp.load_historico_columnar(s3, BUCKET, **kwargs)
+
+
+def test_write_splits_by_month_and_lists_parts(hp, s3):
+    _backfill(hp, s3)
+    manifest, etag = hp.historico_manifest_read(s3, BUCKET)
+
+    assert etag
+    assert manifest["backfill"] is True
+    por_mes = {meta["mes"]: meta for meta in manifest["parts"].values()}
+    assert set(por_mes) == {"2024-01", "2024-02"}
+    assert por_mes["2024-01"]["filas"] == 2
+    assert por_mes["2024-02"]["vendedores"] == ["ANA", "LUIS"]
+    assert por_mes["2024-02"]["min_ts"] == "2024-02-03T09:30:00"
+    for key in manifest["parts"]:
+        s3.head_object(Bucket=BUCKET, Key=key)
+
+
+def test_read_without_backfill_falls_back_to_sheets(hp, s3):
+    rows = _rows()
+    hp.write_historico_parquet(s3, BUCKET, hp.historico_parquet_frame(HEADERS, rows, range(2, len(rows) + 2)))
+
+    assert _read(hp, s3) is None
+
+
+def test_filtered_read_prunes_by_date_vendor_and_columns(hp, s3):
+    _backfill(hp, s3)
+
+    df = _read(hp, s3)
+    assert df["ID_Pedido"].tolist() == ["P1", "P2", "P3", "P4", ""]
+    assert not set(hp.HISTORICO_PARQUET_AUX_COLUMNS) & set(df.columns)
+
+    df = _read(hp, s3, desde=pd.Timestamp("2024-02-01"), hasta=pd.Timestamp("2024-02-15"))
+    assert df["ID_Pedido"].tolist() == ["P3", ""]
+
+    df = _read(hp, s3, vendedores=["LUIS"], columns=["Cliente"])
+    assert list(df.columns) == ["Cliente"]
+    assert df["Cliente"].tolist() == ["Cliente 2", "Cliente 4"]
+
+    df = _read(hp, s3, desde=pd.Timestamp("2025-01-01"))
+    assert df.empty
+
+    df = _read(hp, s3, vendedores=["ANA"], keep_row_number=True)
+    assert df["_fila_historico"].tolist() == [2, 4, 6]
+
+
+def test_refreshed_row_replaces_archived_version(hp, s3):
+    _backfill(hp, s3)
+    editada = ["P2", "2024-01-20 12:00:00", "LUIS", "Cliente 2", "Cancelado"]
+
+    assert hp.refresh_historico_parquet_rows(s3, BUCKET, HEADERS, {3: editada}) == 1
+
+    df = _read(hp, s3)
+    assert df["ID_Pedido"].tolist() == ["P1", "P2", "P3", "P4", ""]
+    assert df.loc[df["ID_Pedido"] == "P2", "Estado"].item() == "Cancelado"
+    df = _read(hp, s3, columns=["Estado"], desde=pd.Timestamp("2024-01-20"), hasta=pd.Timestamp("2024-01-21"))
+    assert df["Estado"].tolist() == ["Cancelado"]
+
+
+def test_refresh_without_backfill_writes_nothing(hp, s3):
+    assert hp.refresh_historico_parquet_rows(s3, BUCKET, HEADERS, {2: _rows()[0]}) == 0
+    manifest, etag = hp.historico_manifest_read(s3, BUCKET)
+    assert etag is None and manifest["parts"] == {}
+
+
+def test_compaction_keeps_latest_export_regardless_of_key_order(hp, s3, monkeypatch):
+    _backfill(hp, s3, rows=_rows()[:1])
+    # Nombres de parte decrecientes: el orden de las llaves es el inverso del de escritura.
+    nombres = (f"{n:032x}" for n in itertools.count(10**6, -1))
+    monkeypatch.setattr(hp.uuid, "uuid4", lambda: type("U", (), {"hex": next(nombres)})())
+
+    limite = hp.HISTORICO_PARQUET_COMPACT_PARTS
+    for version in range(1, limite + 1):
+        fila = ["P1", "2024-01-05 10:00:00", "ANA", "Cliente 1", f"Estado {version}"]
+        sin_id = ["", "2024-01-06 10:00:00", "ANA", f"Sin ID {version}", ""]
+        df = hp.historico_parquet_frame(HEADERS, [fila, sin_id], [2, 9], exportado_ms=10 + version)
+        hp.write_historico_parquet(s3, BUCKET, df)
+
+    manifest, _ = hp.historico_manifest_read(s3, BUCKET)
+    partes_enero = [key for key, meta in manifest["parts"].items() if meta["mes"] == "2024-01"]
+    assert len(partes_enero) == 1
+    assert manifest["parts"][partes_enero[0]]["filas"] == 2
+    objetos = s3.list_objects_v2(Bucket=BUCKET, Prefix=f"{hp.HISTORICO_PARQUET_PREFIX}/mes=2024-01/")
+    assert [obj["Key"] for obj in objetos["Contents"]] == partes_enero
+
+    df = _read(hp, s3)
+    assert df["Estado"].tolist() == [f"Estado {limite}", ""]
+    assert df["Cliente"].tolist() == ["Cliente 1", f"Sin ID {limite}"]
+
+
+def test_manifest_update_retries_after_concurrent_write(hp, s3):
+    _backfill(hp, s3)
+    llamadas = []
+
+    def mutate(manifest):
+        llamadas.append(dict(manifest.get("parts", {})))
+        if len(llamadas) == 1:
+            # Otro proceso cambia el manifiesto entre la lectura y la escritura condicional.
+            hp.historico_manifest_update(s3, BUCKET, lambda current: current.update(otro_proceso=True))
+        manifest["marca"] = len(llamadas)
+
+    manifest = hp.historico_manifest_update(s3, BUCKET, mutate)
+
+    assert len(llamadas) == 2
+    guardado, _ = hp.historico_manifest_read(s3, BUCKET)
+    assert guardado["otro_proceso"] is True
+    assert guardado["marca"] == 2 == manifest["marca"]
+
+
+def test_manifest_update_gives_up_after_repeated_conflicts(hp, s3):
+    _backfill(hp, s3)
+
+    def mutate(manifest):
+        hp.historico_manifest_update(s3, BUCKET, lambda current: current.update(contador=current.get("contador", 0) + 1))
+
+    with pytest.raises(RuntimeError):
+        hp.historico_manifest_update(s3, BUCKET, mutate)
+    guardado, _ = hp.historico_manifest_read(s3, BUCKET)
+    assert guardado["contador"] == hp.HISTORICO_PARQUET_MANIFEST_RETRIES
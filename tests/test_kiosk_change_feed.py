@@ -0,0 +1,57 @@
+"""Canal de cambios de las pantallas kiosko de app_i-d (``poll_kiosk_change_feed``)."""
+
+import types
+
+import pytest
+
+from app_loader import load_app
+from sheets_quota import SheetsQuotaUnavailable
+
+
+def _cargar_canal(modified_times, fetch):
+    versiones = {"pedidos": 3, "casos": 7}
+    hoja = types.SimpleNamespace(spreadsheet=types.SimpleNamespace(client=None))
+    return load_app(
+        "app_i-d.py",
+        ["poll_kiosk_change_feed"],
+        gspread=types.SimpleNamespace(exceptions=types.SimpleNamespace(APIError=type("APIError", (Exception,), {}))),
+        KIOSK_MIN_REFRESH_SECONDS=0,
+        GOOGLE_SHEET_ID="principal",
+        SHEET_PEDIDOS="pedidos",
+        SHEET_CASOS="casos",
+        worksheet_main=hoja,
+        worksheet_casos=hoja,
+        _drive_modified_time=lambda *_args: next(modified_times),
+        invalidate_sheet_snapshot=lambda *_args, **_kwargs: None,
+        _fetch_shared_sheet_values=fetch,
+        get_sheet_snapshot_version=lambda _sheet_id, sheet_name: versiones[sheet_name],
+    )
+
+
+def test_drive_modified_time_alone_does_not_change_versions():
+    app = _cargar_canal(iter(["t1", "t2"]), lambda *_args: None)
+
+    # Cambió otra hoja del spreadsheet: se relee, pero pedidos y casos siguen igual.
+    assert app.poll_kiosk_change_feed() == (3, 7)
+    assert app.poll_kiosk_change_feed() == (3, 7)
+
+
+def test_quota_denial_is_retried_next_period():
+    def sin_cuota(*_args):
+        raise SheetsQuotaUnavailable("sin cuota")
+
+    app = _cargar_canal(iter(["t1", "t1"]), sin_cuota)
+
+    assert app.poll_kiosk_change_feed() == (3, 7)
+    # La lectura no se completó: el siguiente periodo vuelve a intentarla.
+    assert app._get_kiosk_change_feed()["modified_time"] is None
+
+
+def test_unexpected_errors_are_not_swallowed():
+    def falla(*_args):
+        raise KeyError("encabezado")
+
+    app = _cargar_canal(iter(["t1"]), falla)
+
+    with pytest.raises(KeyError):
+        app.poll_kiosk_change_feed()
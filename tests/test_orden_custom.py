@@ -0,0 +1,68 @@
+"""Orden de pedidos de app_a-d (``asignar_orden_custom``) cacheado por versión del snapshot."""
+
+import pandas as pd
+
+from app_loader import load_app
+
+
+def _cargar():
+    app = load_app("app_a-d.py", ["asignar_orden_custom", "ordenar_pedidos_custom"])
+    calcular = app._orden_custom_rango.__wrapped__
+    memoria = {}
+
+    def con_memoria(worksheet_name, snapshot_version, local_key, _df):
+        # Como ``st.cache_data``: ``_df`` no entra en la clave.
+        clave = (worksheet_name, snapshot_version, local_key)
+        if clave not in memoria:
+            memoria[clave] = calcular(worksheet_name, snapshot_version, local_key, _df)
+        return memoria[clave]
+
+    app._orden_custom_rango = con_memoria
+    return app, memoria
+
+
+def _pedidos():
+    return pd.DataFrame(
+        {
+            "ID_Pedido": ["P1", "P2", "P3"],
+            "Estado": ["🔵 En Proceso", "🟡 Pendiente", "🔴 Demorado"],
+            "Hora_Registro": ["2024-03-01 10:00:00", "2024-03-01 09:00:00", "2024-03-01 11:00:00"],
+            "_gsheet_row_index": [2, 3, 4],
+        }
+    )
+
+
+def _ids(app, df):
+    return app.ordenar_pedidos_custom(df)["ID_Pedido"].tolist()
+
+
+def test_cached_order_matches_direct_order():
+    app, memoria = _cargar()
+
+    directo = app.asignar_orden_custom(_pedidos())
+    cacheado = app.asignar_orden_custom(_pedidos(), 5, "datos")
+
+    assert _ids(app, cacheado) == _ids(app, directo) == ["P3", "P2", "P1"]
+    app.asignar_orden_custom(_pedidos(), 5, "datos")
+    assert len(memoria) == 1
+
+
+def test_local_update_changes_the_cache_key():
+    app, memoria = _cargar()
+    app.asignar_orden_custom(_pedidos(), 5, "datos")
+
+    df = _pedidos()
+    df.loc[0, "Estado"] = "🔴 Demorado"
+    app.st.session_state["local_sheet_updates"] = {"datos": {2: {"Estado": "🔴 Demorado", "__updated_at": 1.0}}}
+
+    assert _ids(app, app.asignar_orden_custom(df, 5, "datos")) == ["P1", "P3", "P2"]
+    assert len(memoria) == 2
+
+
+def test_different_rows_under_the_same_key_are_recomputed():
+    app, _ = _cargar()
+    app.asignar_orden_custom(_pedidos(), 5, "datos")
+
+    df = _pedidos().iloc[[2, 0]].reset_index(drop=True)
+
+    assert _ids(app, app.asignar_orden_custom(df, 5, "datos")) == ["P3", "P1"]
@@ -0,0 +1,45 @@
+"""Clave de versión de las cachés de datos de app_a-d (``current_sheet_snapshot_version``)."""
+
+import time
+import types
+
+from app_loader import load_app
+
+
+def _cargar(lecturas):
+    def sync(_client, _sheet_id, _worksheet_name, _previous, _sync_state):
+        lecturas.append(time.time())
+        return [["ID_Pedido"], [f"P{len(lecturas)}"]]
+
+    return load_app(
+        "app_a-d.py",
+        ["current_sheet_snapshot_version"],
+        gspread=types.SimpleNamespace(
+            client=types.SimpleNamespace(Client=object),
+            exceptions=types.SimpleNamespace(APIError=type("APIError", (Exception,), {})),
+        ),
+        g_spread_client=object(),
+        _sync_sheet_values=sync,
+    )
+
+
+def test_fresh_snapshot_does_not_call_sheets():
+    lecturas = []
+    app = _cargar(lecturas)
+
+    primera = app.current_sheet_snapshot_version("principal", "datos")
+    assert app.current_sheet_snapshot_version("principal", "datos") == primera
+    assert len(lecturas) == 1
+
+
+def test_snapshot_older_than_share_window_advances_the_version():
+    lecturas = []
+    app = _cargar(lecturas)
+    primera = app.current_sheet_snapshot_version("principal", "datos")
+
+    # Antes la versión cacheada duraba el TTL de ``st.cache_data`` (300 s).
+    entrada = app._get_sheet_snapshot_entry("principal", "datos")
+    entrada["fetched_at"] -= app.SHEET_SNAPSHOT_SHARE_SECONDS + 1
+
+    assert app.current_sheet_snapshot_version("principal", "datos") == primera + 1
+    assert len(lecturas) == 2
@@ -0,0 +1,74 @@
+"""Cola de escrituras agrupadas de app_a-d (``coalesced_sheet_writes``) con un spreadsheet falso."""
+
+import types
+
+from app_loader import load_app
+
+
+class _Spreadsheet:
+    id = "hoja_prueba"
+
+    def __init__(self):
+        self.lotes = []
+
+    def values_batch_update(self, body):
+        self.lotes.append(sorted(item["range"] for item in body["data"]))
+
+
+class _Worksheet:
+    def __init__(self, spreadsheet, title):
+        self.spreadsheet = spreadsheet
+        self.title = title
+
+
+def _cargar_cola():
+    gspread = types.SimpleNamespace(
+        utils=types.SimpleNamespace(rowcol_to_a1=lambda row, col: f"R{row}C{col}"),
+        exceptions=types.SimpleNamespace(APIError=type("APIError", (Exception,), {})),
+    )
+    return load_app(
+        "app_a-d.py",
+        ["coalesced_sheet_writes", "_write_sheet_cells", "_flush_sheet_write_queue"],
+        gspread=gspread,
+        acquire_sheets_quota=lambda *_args, **_kwargs: True,
+        _get_worksheet_name_safe=lambda worksheet: worksheet.title,
+        _sheet_a1_range=lambda title, cell: f"{title}!{cell}",
+        _invalidate_worksheet_snapshot=lambda *_args, **_kwargs: None,
+        invalidate_header_registry=lambda *_args, **_kwargs: None,
+        _record_local_sheet_update=lambda *_args: None,
+        GOOGLE_SHEET_ID="otra_hoja",
+        GOOGLE_SHEET_HISTORICAL_WORKSHEET_NAME="historico",
+    )
+
+
+def test_open_block_cells_are_not_sent_by_another_sessions_flush():
+    app = _cargar_cola()
+    spreadsheet = _Spreadsheet()
+    hoja = _Worksheet(spreadsheet, "datos")
+
+    with app.coalesced_sheet_writes() as resultado:
+        app._write_sheet_cells(hoja, [(5, 1, "🔵 En Proceso")], value_input_option="USER_ENTERED")
+        app._write_sheet_cells(hoja, [(5, 2, "2024-03-01 10:00:00")], value_input_option="USER_ENTERED")
+        # Otra sesión escribe sin bloque y vacía la cola compartida mientras este sigue abierto.
+        sesiones = app.st.session_state.pop("_sheet_write_scopes")
+        assert app._write_sheet_cells(hoja, [(9, 1, "otra")], value_input_option="USER_ENTERED")
+        app.st.session_state["_sheet_write_scopes"] = sesiones
+        assert spreadsheet.lotes == [["datos!R9C1"]]
+
+    assert resultado["ok"]
+    # Las dos celdas de la tarjeta viajan juntas en un solo lote al cerrar el bloque.
+    assert spreadsheet.lotes == [["datos!R9C1"], ["datos!R5C1", "datos!R5C2"]]
+
+
+def test_nested_blocks_are_sent_with_the_outermost():
+    app = _cargar_cola()
+    spreadsheet = _Spreadsheet()
+    hoja = _Worksheet(spreadsheet, "datos")
+
+    with app.coalesced_sheet_writes():
+        with app.coalesced_sheet_writes():
+            app._write_sheet_cells(hoja, [(3, 1, "a")], value_input_option="USER_ENTERED")
+        assert spreadsheet.lotes == []
+        app._write_sheet_cells(hoja, [(3, 1, "b"), (3, 4, "c")], value_input_option="USER_ENTERED")
+
+    assert spreadsheet.lotes == [["datos!R3C1", "datos!R3C4"]]
@@ -0,0 +1,90 @@
+"""Gobernador de cuota compartido (``sheets_quota``) y los envoltorios de lectura/escritura de cada app."""
+
+import time
+
+import pytest
+
+import sheets_quota
+from app_loader import load_app
+
+
+class _Llamadas:
+    def __init__(self):
+        self.total = 0
+
+    def __call__(self, *_args, **_kwargs):
+        self.total += 1
+        return [["ok"]]
+
+
+def _sin_cuota(*_args, **_kwargs):
+    return False
+
+
+@pytest.fixture
+def quota_state(tmp_path, monkeypatch):
+    monkeypatch.setattr(sheets_quota, "SHEETS_QUOTA_STATE_PATH", str(tmp_path / "quota.json"))
+    return sheets_quota
+
+
+def test_acquire_returns_promptly_when_buckets_are_empty(quota_state):
+    assert quota_state.acquire_sheets_quota("write", "interactive_write")
+    quota_state.report_sheets_quota_exhausted("write")
+
+    # Rellenar 5 tokens tarda ~5 s, más que la espera interactiva: se niega sin dormir.
+    inicio = time.monotonic()
+    assert quota_state.acquire_sheets_quota("write", "interactive_write", cost=5) is False
+    assert time.monotonic() - inicio < 0.5
+    assert quota_state.acquire_sheets_quota("read", "kiosk") is True
+
+
+def test_reserve_keeps_tokens_for_higher_priorities(quota_state):
+    tomados = 0
+    while quota_state.acquire_sheets_quota("read", "background"):
+        tomados += 1
+    # Segundo plano no puede bajar de la mitad de la cubeta por usuario (60/min).
+    assert 30 <= tomados <= 31
+    assert quota_state.acquire_sheets_quota("read", "interactive_read")
+
+
+@pytest.mark.parametrize(
+    "filename, name",
+    [
+        ("app_a-d.py", "_run_gsheet_read_with_backoff"),
+        ("app_a-d.py", "_run_gsheet_write_with_backoff"),
+    ],
+)
+def test_ad_backoff_wrappers_never_call_sheets_without_quota(filename, name):
+    app = load_app(filename, [name], acquire_sheets_quota=_sin_cuota)
+    func = _Llamadas()
+
+    with pytest.raises(app.SheetsQuotaUnavailable):
+        getattr(app, name)(func, operation_name="prueba")
+    assert func.total == 0
+
+
+def test_gerente_retry_never_calls_sheets_without_quota():
+    app = load_app("app_gerente.py", ["_retry_gspread_api_call"], acquire_sheets_quota=_sin_cuota)
+    func = _Llamadas()
+
+    for kind in ("read", "write"):
+        with pytest.raises(app.SheetsQuotaUnavailable):
+            app._retry_gspread_api_call(func, kind=kind)
+    assert func.total == 0
+
+
+def test_id_fetch_serves_last_snapshot_without_quota():
+    app = load_app(
+        "app_i-d.py",
+        ["_fetch_with_retry"],
+        acquire_sheets_quota=_sin_cuota,
+        _sheets_read_priority=lambda: "interactive_read",
+        _is_silent_kiosk_user=lambda: False,
+    )
+    worksheet = type("Hoja", (), {"get_all_values": _Llamadas()})()
+
+    with pytest.raises(app.SheetsQuotaUnavailable):
+        app._fetch_with_retry(worksheet, "_cache_prueba")
+    app.st.session_state["_cache_prueba"] = [["previo"]]
+    assert app._fetch_with_retry(worksheet, "_cache_prueba") == [["previo"]]
+    assert worksheet.get_all_values.total == 0